@@ -3,9 +3,16 @@ from datetime import datetime
 from flask import Flask, request, jsonify, abort
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
 from dotenv import load_dotenv
-from handlers import register_handlers
+from handlers import register_handlers, is_bot_event, COMMAND_ROUTER, COMMAND_THROTTLE
+from notifications.outbox import get_outbox
+from utils.run_metrics import get_run_metrics
+from utils.circuit_breaker import circuit_breaker_states, STATE_CLOSED
+from utils.webhook_dispatcher import WebhookDispatcher, WebhookQueueFull
+from utils.webhook_dedup import WebhookEventDedup
+from utils.line_client import get_line_api
+from utils.background import get_background_executor
+from utils.shutdown import add_shutdown_hook, install_signal_handlers
 
 # เพิ่ม Notification Service
 try:
@@ -35,13 +42,12 @@ if not CHANNEL_ACCESS_TOKEN or not CHANNEL_SECRET:
     CHANNEL_ACCESS_TOKEN = "dummy"
     CHANNEL_SECRET = "dummy"
 
-# สร้าง Configuration และ MessagingApi สำหรับ v3
+# สร้าง MessagingApi สำหรับ v3 (client ร่วมของ process พร้อม connection pool แบบ keep-alive)
 notification_service = None
+webhook_dispatcher = None
 try:
     # Configuration ใน LINE Bot SDK v3 ไม่รองรับ timeout parameters
-    configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
-    api_client = ApiClient(configuration)
-    line_bot_api = MessagingApi(api_client)
+    line_bot_api = get_line_api(CHANNEL_ACCESS_TOKEN)
     handler = WebhookHandler(CHANNEL_SECRET)
     
     # ลงทะเบียน event handlers เฉพาะเมื่อมี tokens จริง
@@ -49,6 +55,17 @@ try:
         register_handlers(handler, line_bot_api)
         print("✅ LINE Bot handlers registered successfully")
         
+        # ประมวลผล webhook event ใน worker pool - /callback ตอบ 200 OK ทันทีหลังตรวจ signature
+        webhook_dispatcher = WebhookDispatcher(handler, dedup=WebhookEventDedup(), prefilter=is_bot_event)
+        webhook_dispatcher.start()
+        # event ที่ process ก่อนหน้ายังไม่ได้ทำตอนถูกปิด (redeploy)
+        webhook_dispatcher.restore_backlog()
+        print("✅ Webhook dispatcher started")
+        
+        # เริ่ม sender ของ push outbox (ทุก push ส่งผ่าน outbox พร้อม retry)
+        get_outbox().start(line_bot_api)
+        print("✅ Push outbox sender started")
+        
         # เริ่มต้น Notification Service
         if NOTIFICATION_ENABLED:
             try:
@@ -58,6 +75,16 @@ try:
             except Exception as e:
                 print(f"❌ Failed to start notification service: {e}")
                 notification_service = None
+        
+        # SIGTERM (redeploy): หยุด scheduler ที่ขอบ batch, หยุดรับ webhook แล้วทำคิวให้หมด,
+        # รองานลบเบื้องหลัง และให้ outbox ส่งข้อความที่ถึงกำหนด - ภายใน SHUTDOWN_DEADLINE_SECONDS
+        # งานที่ไม่เสร็จถูกบันทึกไว้ให้ process ถัดไปทำต่อ
+        if notification_service:
+            add_shutdown_hook('scheduler', notification_service.stop_scheduler)
+        add_shutdown_hook('webhook', webhook_dispatcher.drain)
+        add_shutdown_hook('background', get_background_executor().drain)
+        add_shutdown_hook('outbox', get_outbox().drain)
+        install_signal_handlers()
     else:
         print("⚠️ LINE Bot running in dummy mode - handlers not registered")
         
@@ -69,19 +96,25 @@ except Exception as e:
     line_bot_api = None
 
 
+def health_payload() -> dict:
+    """ข้อมูลของ /health (ใช้ร่วมกับ asgi.py)"""
+    return {
+        'status': 'ok',
+        'message': 'LINE Bot is running normally',
+        'timestamp': datetime.now().isoformat(),
+        'uptime': 'Service is awake',
+        'notification_scheduler': 'Active' if notification_service and notification_service.scheduler.running else 'Inactive',
+        'circuit_breakers': circuit_breaker_states(),
+        'version': '1.0.0'
+    }
+
+
 @app.route('/healthz', methods=['GET'])
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint เพื่อป้องกัน Render service หลับ"""
     try:
-        return jsonify({
-            'status': 'ok',
-            'message': 'LINE Bot is running normally',
-            'timestamp': datetime.now().isoformat(),
-            'uptime': 'Service is awake',
-            'notification_scheduler': 'Active' if notification_service and notification_service.scheduler.running else 'Inactive',
-            'version': '1.0.0'
-        })
+        return jsonify(health_payload())
     except Exception as e:
         return jsonify({
             'status': 'error',
@@ -176,6 +209,14 @@ def warmup():
                 warmup_results['checks']['handlers'] = 'empty_response'
         except Exception as e:
             warmup_results['checks']['handlers'] = f'error: {str(e)[:50]}'
+        
+        # 7. Circuit breakers (LINE API / Google Sheets)
+        breakers = circuit_breaker_states()
+        warmup_results['circuit_breakers'] = breakers
+        not_closed = [name for name, breaker in breakers.items() if breaker['state'] != STATE_CLOSED]
+        warmup_results['checks']['circuit_breakers'] = (
+            ', '.join(f"{name}: {breakers[name]['state']}" for name in not_closed) if not_closed else 'closed'
+        )
          
         elapsed_time = time.time() - start_time
         warmup_results['warmup_time_seconds'] = round(elapsed_time, 3)
@@ -183,7 +224,7 @@ def warmup():
         
         # Determine overall health
         error_count = sum(1 for check in warmup_results['checks'].values() if 'error' in str(check))
-        if error_count == 0:
+        if error_count == 0 and not not_closed:
             warmup_results['overall_health'] = 'healthy'
             return jsonify(warmup_results), 200
         elif error_count <= 2:
@@ -302,15 +343,111 @@ def debug_notification_endpoint():
         }), 500
 
 
+@app.route('/outbox-status', methods=['GET'])
+def outbox_status_endpoint():
+    """สถานะของ push outbox - ความลึกของคิว อายุข้อความ โควตา push และ dead letters"""
+    try:
+        outbox = get_outbox()
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+        return jsonify({
+            'status': 'ok',
+            'outbox': outbox.stats(),
+            'quota': notification_service.quota.stats() if notification_service else None,
+            'recent_dead_letters': outbox.dead_letters(limit=limit),
+            'timestamp': datetime.now().isoformat()
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }), 500
+
+
+@app.route('/webhook-status', methods=['GET'])
+def webhook_status_endpoint():
+    """สถานะของคิว webhook event - ความลึกของคิว event ที่กำลังประมวลผล อายุของ reply token และเวลาต่อคำสั่ง"""
+    if not webhook_dispatcher:
+        return jsonify({
+            'status': 'error',
+            'message': 'Webhook dispatcher not available',
+            'timestamp': datetime.now().isoformat()
+        }), 503
+    
+    return jsonify({
+        'status': 'ok',
+        'webhook': webhook_dispatcher.stats(),
+        'dedup': webhook_dispatcher.dedup.stats() if webhook_dispatcher.dedup else None,
+        'commands': COMMAND_ROUTER.stats(),
+        'rate_limits': COMMAND_THROTTLE.stats(),
+        'background': get_background_executor().stats(),
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+
+@app.route('/notification-metrics', methods=['GET'])
+def notification_metrics_endpoint():
+    """รอบแจ้งเตือน/reconcile ล่าสุดพร้อมเวลาต่อขั้นตอน จำนวน ข้อผิดพลาด และ p50/p95 latency ของ push"""
+    try:
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+        return jsonify({
+            'status': 'ok',
+            **get_run_metrics().stats(limit=limit),
+            'timestamp': datetime.now().isoformat()
+        }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }), 500
+
+
+@app.route('/notification-run-status', methods=['GET'])
+def notification_run_status_endpoint():
+    """ความคืบหน้าของรอบแจ้งเตือนต่อ bucket (ค่าเริ่มต้นวันนี้, ?date=YYYY-MM-DD)"""
+    if not notification_service:
+        return jsonify({
+            'status': 'error',
+            'message': 'Notification service not available',
+            'timestamp': datetime.now().isoformat()
+        }), 503
+    
+    try:
+        run_date = request.args.get('date')
+        if run_date:
+            run_date = datetime.strptime(run_date, '%Y-%m-%d').date().isoformat()
+        runs = notification_service.run_status(run_date)
+        return jsonify({
+            'status': 'ok',
+            'runs': runs,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+        
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'date must be YYYY-MM-DD',
+            'timestamp': datetime.now().isoformat()
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        }), 500
+
+
 @app.route('/callback', methods=['POST'])
 def callback():
     """Webhook endpoint สำหรับรับข้อความจาก LINE"""
     
-    print(f"[WEBHOOK] Received callback request")
-    print(f"[WEBHOOK] Headers: {dict(request.headers)}")
-    
+    # ไม่ log headers/body ทุก request - กลุ่มที่คุยกันมากส่ง webhook บ่อยแต่แทบไม่มีคำสั่ง
+    # (ดูจำนวน event ที่ถูกข้ามได้ที่ /webhook-status)
     # ตรวจสอบว่ามี LINE Bot handler หรือไม่
-    if not handler or CHANNEL_ACCESS_TOKEN == "dummy":
+    if not handler or not webhook_dispatcher or CHANNEL_ACCESS_TOKEN == "dummy":
         print("[WEBHOOK] ERROR: LINE Bot not configured")
         return jsonify({
             'status': 'error',
@@ -325,28 +462,31 @@ def callback():
     
     # รับ request body เป็น text
     body = request.get_data(as_text=True)
-    print(f"[WEBHOOK] Body length: {len(body)}")
-    print(f"[WEBHOOK] Body: {body[:500]}...")  # แสดง 500 ตัวอักษรแรก
     
     try:
-        print(f"[WEBHOOK] Processing webhook with signature verification...")
-        
-        # เพิ่ม timeout protection แต่ยัง process แบบ sync เพื่อใช้ reply_token
-        import signal
         import time
         
         start_time = time.time()
         
-        handler.handle(body, signature)
+        # ตรวจ signature ที่นี่ แล้วให้ worker pool ประมวลผล event (reply token ยังใช้ได้ ~1 นาที
+        # ถ้ารอในคิวนานกว่านั้น sender จะ push แทน)
+        queued = webhook_dispatcher.submit(body, signature)
         
-        end_time = time.time()
-        process_time = end_time - start_time
-        print(f"[WEBHOOK] SUCCESS: Webhook processed in {process_time:.2f} seconds")
+        if queued:
+            process_time = time.time() - start_time
+            print(f"[WEBHOOK] SUCCESS: {queued} events queued in {process_time * 1000:.1f} ms")
         
     except InvalidSignatureError as e:
         print(f"[WEBHOOK] ERROR: Invalid signature - {e}")
         print(f"[WEBHOOK] Channel Secret Length: {len(CHANNEL_SECRET) if CHANNEL_SECRET else 'None'}")
         abort(400, description="Invalid signature")
+    except WebhookQueueFull as e:
+        # ไม่ตอบ 200 เพื่อให้ LINE ส่ง webhook นี้ซ้ำภายหลัง
+        print(f"[WEBHOOK] ERROR: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Webhook queue is full, please retry'
+        }), 503
     except Exception as e:
         print(f"[WEBHOOK] ERROR: Exception in webhook setup - {e}")
         import traceback
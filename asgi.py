@@ -0,0 +1,294 @@
+"""
+ASGI entry point (ทางเลือก) ของ LINE Group Reminder Bot
+
+รันแทน gunicorn app:app เมื่อต้องรับ webhook ที่ช้าพร้อมกันจำนวนมากใน process เดียว:
+
+    pip install uvicorn
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+- /callback, /health, /healthz, /ping, /alive ทำบน asyncio event loop โดยตรง
+  การอ่าน body ที่ส่งมาช้าไม่ยึด thread และ /callback เพียงตรวจ signature แล้วส่ง event
+  เข้า WebhookDispatcher (ตัวเดียวกับ app.py) ก่อนตอบ 200
+- LINE API ใช้ AsyncLineClient (utils/async_line.py) บน loop: reply ของ webhook worker
+  (RobustMessageSender.send_reply_async) และ push ของ outbox sender ใช้ connection pool แบบ keep-alive เดียวกัน
+- /run-notification-check อ่าน Sheets ผ่าน AsyncSheetsClient (storage/async_sheets.py) ใน batchGet เดียว
+  บน loop แล้วสร้างข้อความใน thread pool (CPU/SQLite เท่านั้น) - push ส่งโดย outbox sender บน loop
+- route อื่นทั้งหมดเรียก Flask app เดิมใน thread pool ที่มีขนาดจำกัด (ASGI_BLOCKING_WORKERS)
+  คำสั่งใน chat ที่อ่าน/เขียน Sheets ยังใช้ SheetsRepository (gspread) ใน webhook worker pool
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from typing import List, Tuple
+
+from linebot.v3.exceptions import InvalidSignatureError
+
+import app as wsgi
+from notifications.outbox import get_outbox
+from storage.async_sheets import AsyncSheetsClient
+from utils import async_line
+from utils.shutdown import wait_for_shutdown
+from utils.webhook_dispatcher import WebhookQueueFull
+
+logger = logging.getLogger(__name__)
+
+# จำนวน thread สำหรับ route ที่ยังเป็น Flask (notification triggers, migration, status)
+ASGI_BLOCKING_WORKERS = int(os.getenv('ASGI_BLOCKING_WORKERS', 32))
+# ขนาด body สูงสุดของ webhook (LINE ส่งไม่เกินไม่กี่ร้อย KB)
+ASGI_MAX_BODY_BYTES = int(os.getenv('ASGI_MAX_BODY_BYTES', 1024 * 1024))
+
+_blocking_pool = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix='asgi-wsgi')
+
+# สร้างใน lifespan startup (ผูกกับ event loop ของ server)
+_line_client = None
+_sheets_client = None
+_notification_lock = None
+
+
+class BodyTooLarge(Exception):
+    """request body ใหญ่เกิน ASGI_MAX_BODY_BYTES"""
+
+
+class ClientDisconnected(Exception):
+    """client ปิด connection ก่อนส่ง body ครบ - ไม่ต้องประมวลผลหรือตอบ"""
+
+
+async def _read_body(receive, limit: int = ASGI_MAX_BODY_BYTES) -> bytes:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected(f"Client disconnected after {size} bytes")
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(f"Request body exceeds {limit} bytes")
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def _respond(send, status: int, body: bytes, content_type: bytes = b'text/plain; charset=utf-8',
+                   headers: List[Tuple[bytes, bytes]] = None):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] + (headers or [])
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _respond_json(send, status: int, payload: dict):
+    await _respond(send, status, json.dumps(payload, ensure_ascii=False).encode('utf-8'), b'application/json')
+
+
+async def _callback(scope, receive, send):
+    """เหมือน app.callback แต่ไม่ใช้ thread ระหว่างรอ body"""
+    if not wsgi.handler or not wsgi.webhook_dispatcher or wsgi.CHANNEL_ACCESS_TOKEN == "dummy":
+        await _respond_json(send, 500, {
+            'status': 'error',
+            'message': 'LINE Bot not configured. Please set environment variables.'
+        })
+        return
+
+    signature = None
+    for name, value in scope.get('headers', []):
+        if name.lower() == b'x-line-signature':
+            signature = value.decode('latin-1')
+    if not signature:
+        await _respond(send, 400, b'Missing X-Line-Signature header')
+        return
+
+    try:
+        body = (await _read_body(receive)).decode('utf-8')
+        # submit ทำ HMAC + json + บันทึก webhookEventId ลง SQLite - ทำนอก loop เพื่อไม่ให้ fsync หยุด request อื่น
+        queued = await asyncio.get_running_loop().run_in_executor(
+            _blocking_pool, wsgi.webhook_dispatcher.submit, body, signature)
+        if queued:
+            print(f"[WEBHOOK] SUCCESS: {queued} events queued (asgi)")
+    except BodyTooLarge as e:
+        await _respond(send, 413, str(e).encode('utf-8'))
+        return
+    except ClientDisconnected as e:
+        logger.info(f"Webhook request aborted: {e}")
+        return
+    except InvalidSignatureError as e:
+        print(f"[WEBHOOK] ERROR: Invalid signature - {e}")
+        await _respond(send, 400, b'Invalid signature')
+        return
+    except WebhookQueueFull as e:
+        print(f"[WEBHOOK] ERROR: {e}")
+        await _respond_json(send, 503, {'status': 'error', 'message': 'Webhook queue is full, please retry'})
+        return
+    except Exception as e:
+        logger.error(f"Webhook ingress failed: {e}", exc_info=True)
+        await _respond(send, 500, b'Internal server error')
+        return
+
+    await _respond(send, 200, b'OK')
+
+
+async def _run_notification_check(scope, receive, send):
+    """
+    เหมือน app.run_notification_check_endpoint: reconcile agenda ด้วย AsyncSheetsClient บน loop
+    แล้วสร้าง/enqueue ข้อความใน thread pool โดยไม่อ่าน Sheets ซ้ำ (agenda เพิ่งถูก reconcile)
+    """
+    global _notification_lock
+    service = wsgi.notification_service
+    if not service:
+        await _respond_json(send, 503, {'status': 'error', 'message': 'Notification service not available'})
+        return
+    if _notification_lock is None:
+        _notification_lock = asyncio.Lock()
+    try:
+        async with _notification_lock:
+            if _sheets_client is not None and not await service.reconcile_agenda_async(_sheets_client):
+                raise RuntimeError("Agenda reconciliation failed")
+            await asyncio.get_running_loop().run_in_executor(_blocking_pool, service.check_and_send_notifications)
+    except Exception as e:
+        await _respond_json(send, 500, {'status': 'error', 'message': str(e),
+                                        'timestamp': datetime.now().isoformat()})
+        return
+    await _respond_json(send, 200, {'status': 'success', 'message': 'Notification check completed',
+                                    'timestamp': datetime.now().isoformat()})
+
+
+async def _health(scope, receive, send):
+    try:
+        await _respond_json(send, 200, wsgi.health_payload())
+    except Exception as e:
+        await _respond_json(send, 500, {'status': 'error', 'message': str(e)})
+
+
+def _wsgi_environ(scope, body: bytes) -> dict:
+    """สร้าง WSGI environ จาก ASGI scope (HTTP/1.1 เท่านั้น)"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _run_wsgi(environ: dict) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    """เรียก Flask app ใน thread pool แล้วเก็บ response ทั้งหมด"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    result = wsgi.app.wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+async def _flask(scope, receive, send):
+    try:
+        body = await _read_body(receive)
+    except BodyTooLarge as e:
+        await _respond(send, 413, str(e).encode('utf-8'))
+        return
+    except ClientDisconnected:
+        return
+    status, headers, payload = await asyncio.get_running_loop().run_in_executor(
+        _blocking_pool, _run_wsgi, _wsgi_environ(scope, body))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def _lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await _start_async_clients()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # หยุดรับ webhook, ทำคิวให้หมด และบันทึกงานที่ค้าง (เหมือน SIGTERM ของ app.py)
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_shutdown)
+            await _close_async_clients()
+            _blocking_pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _start_async_clients():
+    """สร้าง LINE/Sheets client ของ event loop และย้าย outbox sender มาทำบน loop"""
+    global _line_client, _sheets_client
+    if wsgi.line_bot_api is not None and wsgi.CHANNEL_ACCESS_TOKEN != "dummy":
+        _line_client = async_line.AsyncLineClient(wsgi.CHANNEL_ACCESS_TOKEN)
+        async_line.install(asyncio.get_running_loop(), _line_client)
+        get_outbox().start_async(_line_client)
+    try:
+        _sheets_client = AsyncSheetsClient.from_env()
+    except Exception as e:
+        logger.error(f"Async Sheets client not available: {e}")
+        _sheets_client = None
+
+
+async def _close_async_clients():
+    global _line_client, _sheets_client
+    async_line.uninstall()
+    for client in (_line_client, _sheets_client):
+        if client is not None:
+            await client.close()
+    _line_client, _sheets_client = None, None
+
+
+_ASYNC_ROUTES = {
+    ('POST', '/callback'): _callback,
+    ('GET', '/run-notification-check'): _run_notification_check,
+    ('GET', '/health'): _health,
+    ('GET', '/healthz'): _health,
+}
+
+
+async def app(scope, receive, send):
+    """ASGI 3 application"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(scope, receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    if scope['method'] == 'GET' and path in ('/ping', '/alive'):
+        await _respond(send, 200, b'pong' if path == '/ping' else b'1')
+        return
+    route = _ASYNC_ROUTES.get((scope['method'], path))
+    await (route or _flask)(scope, receive, send)
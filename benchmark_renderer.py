@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Message renderer benchmark
+วัดเวลาสร้างข้อความสรุปรายวัน, รายการ 'ดูนัด' และประวัตินัดหมาย บน agenda ขนาดใหญ่
+
+ตัวอย่าง:
+    python benchmark_renderer.py --items 1000 --repeat 50
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from storage.models import Appointment
+from utils.message_renderer import (BANGKOK_TZ, ICON_PAST, classify_by_urgency, render_appointment_items,
+                                    render_digest)
+
+
+def build_agenda(items: int, seed: int = 42):
+    """สร้างนัดหมายจำลอง กระจาย -30..+90 วันจากวันนี้"""
+    rng = random.Random(seed)
+    now = datetime.now(BANGKOK_TZ).replace(second=0, microsecond=0)
+    agenda = []
+    for i in range(items):
+        when = now + timedelta(days=rng.randint(-30, 90), minutes=15 * rng.randint(0, 40))
+        agenda.append(Appointment(
+            id=f"APT{i:05d}", group_id="BENCH", datetime_iso=when.isoformat(),
+            location=rng.choice(["LINE Bot", "โรงพยาบาลศิริราช", ""]),
+            building_floor_dept=rng.choice(["General", "ตึก 3 ชั้น 2", ""]),
+            contact_person=rng.choice(["", "หมอสมชาย"]), phone_number=rng.choice(["", "0812345678"]),
+            note=f"นัดหมายทดสอบ {i}"
+        ))
+    agenda.sort(key=lambda apt: apt.datetime_iso)
+    return agenda, now
+
+
+def _time(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def run_benchmark(items: int, repeat: int, seed: int = 42) -> dict:
+    agenda, now = build_agenda(items, seed)
+    past = [apt for apt in agenda if apt.appointment_datetime < now]
+
+    def digest():
+        return render_digest(classify_by_urgency(agenda, now.date()), len(agenda), now, "08:00")
+
+    return {
+        'items': items,
+        'repeat': repeat,
+        'digest_ms': round(_time(digest, repeat), 3),
+        'list_ms': round(_time(lambda: render_appointment_items(agenda, now=now), repeat), 3),
+        'history_ms': round(_time(lambda: render_appointment_items(past, icon=ICON_PAST), repeat), 3),
+        'list_chars': len(render_appointment_items(agenda, now=now)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark appointment message rendering")
+    parser.add_argument('--items', type=int, default=1000, help="จำนวนนัดหมายใน agenda")
+    parser.add_argument('--repeat', type=int, default=50, help="จำนวนรอบที่วัดต่อข้อความ")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help="แสดงผลเป็น JSON")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.items, args.repeat, args.seed)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"📊 Renderer benchmark ({result['items']} items, {result['repeat']} repeats)")
+        print(f"   digest : {result['digest_ms']} ms")
+        print(f"   list   : {result['list_ms']} ms ({result['list_chars']} chars)")
+        print(f"   history: {result['history_ms']} ms")
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration ของ LINE Group Reminder Bot (โหลดอัตโนมัติจาก ./gunicorn.conf.py)
+
+SIGTERM ตอน redeploy: signal handler ของ app (utils/shutdown.py) เริ่ม graceful shutdown ใน thread แยก
+แล้ว gunicorn worker หยุดรับ request - worker_exit รอให้ shutdown hooks เสร็จก่อน interpreter ปิด
+(ก่อนที่ concurrent.futures จะปิด executor ของตัวเอง)
+"""
+
+import os
+
+# รอ worker ปิดนานกว่า deadline ของ shutdown hooks เล็กน้อย ก่อนที่ master จะส่ง SIGKILL
+graceful_timeout = float(os.getenv('SHUTDOWN_DEADLINE_SECONDS', 20)) + 5
+
+
+def worker_exit(server, worker):
+    """เรียกใน worker process หลัง worker loop จบ - ก่อน interpreter ปิด"""
+    from utils.shutdown import wait_for_shutdown
+    wait_for_shutdown()
@@ -4,6 +4,7 @@ Event handlers module for LINE Group Reminder Bot
 """
 
 import logging
+import threading
 import uuid
 import time
 from datetime import datetime, timedelta
@@ -13,10 +14,18 @@ from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
 from storage.models import Appointment
 from utils.message_sender import create_connection_aware_sender, MessageQueue
+from notifications.outbox import get_outbox, PRIORITY_INTERACTIVE
+from utils.message_renderer import render_appointment_items, render_deleted_appointment, ICON_PAST
+from utils.circuit_breaker import get_circuit_breaker, GOOGLE_SHEETS
+from utils.webhook_dispatcher import defer_in_chat
+from utils.background import get_background_executor, BackgroundQueueFull
+from utils.command_router import Command, CommandContext, CommandRouter, strip_mention
+from utils.rate_limiter import CommandThrottle
+from storage import change_feed
 
 # Conditional import สำหรับ SheetsRepository
 try:
-    from storage.sheets_repo import SheetsRepository
+    from storage.sheets_repo import SheetsRepository, get_sheets_repository
     SHEETS_AVAILABLE = True
 except ImportError as e:
     print(f"Warning: SheetsRepository not available: {e}")
@@ -35,12 +44,36 @@ except ImportError as e:
             return False
     
     SheetsRepository = DummySheetsRepository
+    
+    def get_sheets_repository():
+        return DummySheetsRepository()
 
 # ตั้งค่า logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def is_bot_event(raw_event: dict) -> bool:
+    """
+    prefilter ของ WebhookDispatcher: ตรวจ event จาก JSON ดิบก่อนสร้าง model หรือ log ใด ๆ
+
+    ข้อความในกลุ่มที่ไม่ได้ขึ้นต้นด้วยคำสั่งที่ใช้ในกลุ่มได้ (ซึ่ง handle_text_message
+    จะข้ามอยู่แล้ว) ถูกทิ้งตั้งแต่ /callback - event ชนิดอื่นและแชทส่วนตัวผ่านทั้งหมด
+
+    Args:
+        raw_event (dict): event หนึ่งรายการจาก body ของ webhook
+
+    Returns:
+        bool: True หากต้องประมวลผล event นี้
+    """
+    if raw_event.get('type') != 'message' or (raw_event.get('source') or {}).get('type') != 'group':
+        return True
+    message = raw_event.get('message') or {}
+    if message.get('type') != 'text':
+        return True
+    return COMMAND_ROUTER.is_group_command(strip_mention((message.get('text') or '').strip()).lower())
+
+
 def register_handlers(handler, line_bot_api):
     """
     ลงทะเบียน event handlers ทั้งหมดสำหรับ LINE Bot
@@ -59,136 +92,50 @@ def register_handlers(handler, line_bot_api):
         
         # ตรวจสอบ context: 1:1 chat หรือ group chat
         if hasattr(event.source, 'group_id'):
-            # Group Chat - ข้อมูลรวมกัน
+            # Group Chat - ข้อมูลรวมกัน (log หลังตรวจว่าเป็นคำสั่ง)
             context_type = "group"
             context_id = event.source.group_id
-            logger.info(f"Group message from {user_id} in group {context_id}: {user_message}")
         else:
             # 1:1 Chat - ข้อมูลส่วนตัว
             context_type = "personal" 
             context_id = user_id
             logger.info(f"Personal message from {user_id}: {user_message}")
         
-        # จัดการข้อความและคำสั่งต่าง ๆ
-        message_lower = user_message.lower().strip()
-        
-        # ถ้าเป็นกลุ่ม ตรวจสอบว่าเป็นคำสั่งบอทหรือไม่
+        # หาคำสั่งด้วย COMMAND_ROUTER (ในกลุ่ม: ตัด mention และข้ามข้อความที่ไม่ใช่คำสั่ง)
+        command, user_message, message_lower = COMMAND_ROUTER.route(user_message, context_type)
         if context_type == "group":
-            # ตอบเฉพาะคำสั่งที่เกี่ยวข้องกับการจัดการนัดหมาย
-            if not message_lower.startswith(('เพิ่มนัด', 'ดูนัด', 'ลบนัด', 'แก้ไขนัด', 'แก้นัด', 'ยกเลิกนัด', 'ลบการนัด', 'นัดใหม่', 'เพิ่มการนัด', 'แก้ไขการนัด',
-                                              'ดูนัดย้อนหลัง', 'นัดย้อนหลัง', 'ประวัตินัด', 'ย้อนหลัง', 'ดูย้อนหลัง',
-                                              'hello', 'สวัสดี', 'ทักทาย', 'help', 'คำสั่ง', 'สถานะ', 'เตือน', 'ทดสอบ')):
-                # ไม่ใช่คำสั่งสำหรับบอท ให้ข้าม
+            if not message_lower:
+                # ไม่ใช่คำสั่งสำหรับบอท ให้ข้าม (ปกติถูกทิ้งตั้งแต่ is_bot_event แล้ว)
                 return
-            
-            # ลบ mention ออกจากข้อความ (ถ้ามี) เพื่อให้ประมวลผลต่อได้
-            if message_lower.startswith('@'):
-                space_index = user_message.find(' ')
-                if space_index > 0:
-                    user_message = user_message[space_index + 1:].strip()
-                    message_lower = user_message.lower().strip()
-                else:
-                    # ถ้าพิมพ์แค่ mention อย่างเดียว ให้แสดงความช่วยเหลือ
-                    message_lower = "help"
-        
-        # คำสั่งทักทาย
-        if message_lower in ['hello', 'สวัสดี', 'ทักทาย']:
-            if context_type == "group":
-                reply_message = '''สวัสดี! ยินดีต้อนรับสู่ LINE Group Reminder Bot
-นี่คือกลุ่มสำหรับจัดการการนัดหมายร่วมกัน
-
-พิมพ์ "คำสั่ง" เพื่อดูวิธีใช้งาน'''
-            else:
-                reply_message = '''สวัสดี! ยินดีต้อนรับสู่ LINE Group Reminder Bot
-นี่คือการนัดหมายส่วนตัวของคุณ
-
-พิมพ์ "คำสั่ง" เพื่อดูวิธีใช้งาน'''
-        
-        # คำสั่งความช่วยเหลือ (Thai language commands)
-        elif message_lower in ['help', 'คำสั่ง', 'ช่วยเหลือ', 'วิธีใช้']:
-            base_help = '''📋 คำสั่งการจัดการนัดหมาย (รองรับภาษาไทยแบบธรรมชาติ):
-
-• "เพิ่มนัด" - เพิ่มการนัดหมายใหม่
-• "ดูนัด" - ดูรายการนัดหมายที่กำลังจะมาถึง
-• "ดูนัดย้อนหลัง" - ดูประวัตินัดหมาย
-• "ลบนัด [รหัส]" - ลบการนัดหมาย
-• "แก้ไขนัด [รหัส]" - แก้ไขการนัดหมาย
-
-📝 ตัวอย่างเพิ่มนัด (Natural Language):
-• เพิ่มนัด ไปหาหมอ ศุกร์หน้า 9:30 ที่ โรงพยาบาลจุฬา แผนกหัวใจ กับหมอเอ
-• เพิ่มนัด ประชุมทีม 24 ตุลา 15:00 at CentralWorld
-• เพิ่มนัด กินข้าวกับที่บ้าน วันอาทิตย์ เย็น
-
-📌 เคล็ดลับ:
-• เดือนแบบย่อได้: ตุลา พฤศจิกา ธันวา ฯลฯ
-• ปี พ.ศ. หรือ ย่อ 26 → 2026 ก็ได้
-• เวลาแบบคำพูดได้: บ่ายสาม, สามทุ่มครึ่ง, เช้า
-
-🗑️ ลบนัดหมาย:
-ลบนัด ABC123
-
-🔄 แก้ไขนัดหมาย:
-แก้ไขนัด ABC123 นัดหมาย:"ตรวจร่างกาย"
-
-หรือส่งหลายแถว:
-แก้ไขนัด ABC123
-นัดหมาย:"ตรวจสุขภาพ"
-วันเวลา:"10 ตุลาคม 2025 15:00"
-บุคคล/ผู้ติดต่อ:"ดร.สมชาย"'''
-            
-            if context_type == "group":
-                reply_message = base_help + '\n\n🏥 โหมดกลุ่ม: การนัดหมายจะแสดงให้ทุกคนในกลุ่มเห็น'
-            else:
-                reply_message = base_help + '\n\n👤 โหมดส่วนตัว: การนัดหมายของคุณเท่านั้น'
-        
-        # คำสั่งเพิ่มการนัดหมาย (รองรับแบบยืดหยุ่น)
-        elif message_lower.startswith(('เพิ่มนัด', 'นัดใหม่', 'เพิ่มการนัด')):
-            reply_message = handle_add_appointment_command(user_message, user_id, context_type, context_id)
-        
-        # คำสั่งดูการนัดหมาย
-        elif message_lower in ['ดูนัด', 'รายการนัด', 'นัดหมาย', 'ดูการนัด']:
-            reply_message = handle_list_appointments_command(user_id, context_type, context_id, show_past=False)
-            
-        elif message_lower in ['ดูนัดย้อนหลัง', 'นัดย้อนหลัง', 'ประวัตินัด', 'ดูประวัตินัด']:
-            reply_message = handle_historical_appointments_menu(user_id, context_type, context_id)
-            
-        elif message_lower.startswith(('ย้อนหลัง', 'ดูย้อนหลัง')):
-            reply_message = handle_historical_appointments_command(user_message, user_id, context_type, context_id)
-        
-        # คำสั่งลบการนัดหมาย (รองรับแบบยืดหยุ่น)
-        elif message_lower.startswith(('ลบนัด', 'ยกเลิกนัด', 'ลบการนัด')):
-            reply_message = handle_delete_appointment_command(user_message, user_id, context_type, context_id)
-        
-        # คำสั่งแก้ไขการนัดหมาย (รองรับแบบยืดหยุ่น)
-        elif message_lower.startswith(('แก้ไขนัด', 'แก้นัด', 'แก้ไขการนัด')):
-            reply_message = handle_edit_appointment_command(user_message, user_id, context_type, context_id)
-                
-        # คำสั่งเกี่ยวกับการแจ้งเตือน
-        elif message_lower in ['reminder', 'เตือน', 'การแจ้งเตือน']:
-            reply_message = handle_reminder_info_command(context_type)
-        
-        elif message_lower in ['ทดสอบเตือน', 'test notification', 'testnotification']:
-            reply_message = handle_test_notification_command(user_id)
-        
-        elif message_lower in ['ทดสอบวันที่', 'test date', 'testdate']:
-            reply_message = handle_test_date_parser_command()
+            logger.info(f"Group message from {user_id} in group {context_id}: {user_message}")
         
-        elif message_lower in ['force check', 'forcecheck', 'เช็คเตือน', 'เช็คทันที']:
-            reply_message = handle_force_notification_check_command()
-                
-        elif message_lower == 'status':
-            reply_message = f'สถานะของบอท:\\nเชื่อมต่อ LINE API สำเร็จ\\nรับข้อความได้ปกติ\\nส่งข้อความตอบกลับได้ปกติ\\nระบบ Scheduler พร้อมใช้งาน\\nContext: {context_type} ({context_id[:10]}...)'
+        # Google Sheets ไม่พร้อม: ไม่รอ timeout/retry ของ repository ตอบกลับทันที
+        if command and command.uses_sheets and get_circuit_breaker(GOOGLE_SHEETS).is_open():
+            logger.warning(f"Google Sheets circuit open - replying busy to: {command.name}")
+            create_connection_aware_sender(line_bot_api).send_busy_reply(event.reply_token)
+            return
+        
+        # rate limit ต่อผู้ใช้/กลุ่ม: คำสั่งที่เกินขีดจำกัดไม่ถึง Sheets (ตอบจากคำตอบล่าสุดหรือขอให้รอ)
+        retry_after = COMMAND_THROTTLE.acquire(command, user_id, context_type, context_id) if command else 0
+        if retry_after:
+            logger.warning(f"Command {command.name} throttled for {user_id} in {context_id} "
+                           f"(retry in {retry_after:.0f}s)")
+            reply_message = COMMAND_THROTTLE.throttled_reply(command, context_type, context_id,
+                                                             message_lower, retry_after)
+        elif command:
+            reply_message = COMMAND_ROUTER.dispatch(
+                command, CommandContext(user_message, user_id, context_type, context_id))
+            COMMAND_THROTTLE.remember_reply(command, context_type, context_id, message_lower, reply_message)
         else:
             reply_message = f'คุณพิมพ์: "{user_message}"\\n\\nพิมพ์ "help" เพื่อดูคำสั่งที่ใช้ได้\\nContext: {context_type.title()}'
         
-        # ส่งข้อความตอบกลับด้วย robust sender
-        sender = create_connection_aware_sender(line_bot_api)
-        success, error = sender.send_reply_with_timeout(event.reply_token, reply_message)
-        
-        if not success:
-            logger.error(f"Failed to send reply after retries: {error}")
-            # Send fallback message
-            sender.send_fallback_message(event.reply_token)
+        # ส่งข้อความตอบกลับด้วย robust sender - retry ทำใน background ภายในอายุของ reply token
+        # แล้ว push แทนเมื่อ token หมดอายุ (ไม่ block webhook thread)
+        # คำตอบยาวเกิน 5 ข้อความ: ส่วนที่เกินเข้า outbox หลัง reply แทนการตัดทิ้ง
+        queue = MessageQueue(create_connection_aware_sender(line_bot_api))
+        queue.add_message(event.reply_token, reply_message, recipient_id=context_id)
+        received_at = event.timestamp / 1000 if getattr(event, 'timestamp', None) else None
+        queue.send_all(received_at=received_at)
     
     logger.info("LINE event handlers registered successfully")
 
@@ -305,7 +252,7 @@ def handle_add_appointment_command(user_message: str, user_id: str, context_type
                 logger.info(f"Attempting to save appointment with context: {sheets_context}")
                 logger.info(f"Appointment data: {appointment.to_dict()}")
                 
-                repo = SheetsRepository()
+                repo = get_sheets_repository()
                 logger.info(f"SheetsRepository created successfully. Connected: {repo.gc is not None}")
                 logger.info(f"Spreadsheet available: {repo.spreadsheet is not None}")
                 
@@ -396,7 +343,7 @@ def handle_list_appointments_command(user_id: str, context_type: str, context_id
         show_past (bool): True = แสดงทั้งอนาคตและอดีต, False = แสดงเฉพาะอนาคต
     """
     try:
-        repo = SheetsRepository()
+        repo = get_sheets_repository()
         
         # กำหนด context และ group_id สำหรับ Google Sheets
         if context_type == "group":
@@ -451,29 +398,9 @@ def handle_list_appointments_command(user_id: str, context_type: str, context_id
         if total_appointments > MAX_APPOINTMENTS:
             appointments = appointments[:MAX_APPOINTMENTS]
             
-        # สร้างรายการนัดหมาย
+        # สร้างรายการนัดหมาย (🔴 = นัดหมายใกล้ถึง, ⚪ = นัดหมายที่ผ่านมาแล้ว)
         appointment_list = f"{list_title} ({total_appointments} รายการ)\n\n"
-        
-        for i, appointment in enumerate(appointments, 1):
-            date_str = appointment.appointment_datetime.strftime("%d/%m/%Y %H:%M")
-            
-            # เพิ่ม indicator สำหรับนัดหมายอนาคต/อดีต
-            if appointment.appointment_datetime >= now:
-                status_icon = "🔴"  # นัดหมายใกล้ถึง
-            else:
-                status_icon = "⚪"  # นัดหมายที่ผ่านมาแล้ว
-            
-            appointment_list += f"📅 {i}. {status_icon} {appointment.note}\n"
-            appointment_list += f"     🕐 {date_str}\n"
-            if appointment.location and appointment.location != "LINE Bot":
-                appointment_list += f"     📍 {appointment.location}\n"
-            if appointment.building_floor_dept and appointment.building_floor_dept != "General":
-                appointment_list += f"     🏢 {appointment.building_floor_dept}\n"
-            if getattr(appointment, 'contact_person', None) and appointment.contact_person:
-                appointment_list += f"     👤 {appointment.contact_person}\n"
-            if getattr(appointment, 'phone_number', None) and appointment.phone_number:
-                appointment_list += f"     📞 {appointment.phone_number}\n"
-            appointment_list += f"     🆔 {appointment.id}\n\n"
+        appointment_list += render_appointment_items(appointments, now=now)
         
         # เพิ่มข้อความถ้ามีการนัดหมายมากกว่าที่แสดง
         if show_past:
@@ -610,7 +537,7 @@ def handle_historical_appointments_command(user_message: str, user_id: str, cont
 • "ดูย้อนหลัง กันยายน 2025" """
         
         # ดึงข้อมูลนัดหมาย
-        repo = SheetsRepository()
+        repo = get_sheets_repository()
         
         if context_type == "group":
             sheets_context = f"group_{context_id}"
@@ -657,20 +584,7 @@ def handle_historical_appointments_command(user_message: str, user_id: str, cont
 
 """
         
-        for i, appointment in enumerate(filtered_appointments, 1):
-            date_str = appointment.appointment_datetime.strftime("%d/%m/%Y %H:%M")
-            
-            appointment_list += f"📅 {i}. ⚪ {appointment.note}\n"
-            appointment_list += f"     🕐 {date_str}\n"
-            if appointment.location and appointment.location != "LINE Bot":
-                appointment_list += f"     📍 {appointment.location}\n"
-            if appointment.building_floor_dept and appointment.building_floor_dept != "General":
-                appointment_list += f"     🏢 {appointment.building_floor_dept}\n"
-            if getattr(appointment, 'contact_person', None) and appointment.contact_person:
-                appointment_list += f"     👤 {appointment.contact_person}\n"
-            if getattr(appointment, 'phone_number', None) and appointment.phone_number:
-                appointment_list += f"     📞 {appointment.phone_number}\n"
-            appointment_list += f"     🆔 {appointment.id}\n\n"
+        appointment_list += render_appointment_items(filtered_appointments, icon=ICON_PAST)
         
         # Footer
         footer = "⚪ = นัดหมายที่ผ่านแล้ว\n💡 พิมพ์ \"ดูนัดย้อนหลัง\" เพื่อเลือกช่วงเวลาอื่น"
@@ -690,8 +604,6 @@ def handle_historical_appointments_command(user_message: str, user_id: str, cont
 def handle_delete_appointment_command(user_message: str, user_id: str, context_type: str, context_id: str) -> str:
     """จัดการคำสั่งลบการนัดหมาย - ใช้ robust message sending"""
     try:
-        from linebot.v3.messaging import MessagingApi, PushMessageRequest, TextMessage, Configuration, ApiClient
-        import os
         import re
         
         # แยกรหัสนัดหมายจากข้อความ
@@ -712,110 +624,84 @@ def handle_delete_appointment_command(user_message: str, user_id: str, context_t
 
         appointment_id = match.group(1).strip()
         
-        # เริ่ม background deletion process ด้วย robust messaging
+        # เริ่ม background deletion process - ข้อความทั้งหมดส่งผ่าน outbox (LINE client ร่วมของ process)
         try:
-            channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-            if channel_access_token:
-                configuration = Configuration(access_token=channel_access_token)
-                api_client = ApiClient(configuration)
-                line_bot_api = MessagingApi(api_client)
-                
-                # สร้าง robust sender
-                sender = create_connection_aware_sender(line_bot_api)
-                
-                target_id = context_id if context_type == "group" else user_id
-                
-                # ข้อความยืนยัน
-                confirmation_message = f"⏳ กำลังลบนัดหมาย {appointment_id}...\nรอสักครู่นะคะ"
-                
-                # ส่งข้อความยืนยันทันที
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=target_id,
-                        messages=[TextMessage(text=confirmation_message)]
-                    )
-                )
-                logger.info(f"Sent deletion confirmation for appointment {appointment_id}")
-                
-                # ดำเนินการลบและส่งผลลัพธ์
-                def process_deletion():
-                    try:
-                        # เชื่อมต่อกับ database
-                        repo = SheetsRepository()
-                        
-                        # กำหนด context
-                        if context_type == "group":
-                            sheets_context = f"group_{context_id}"
-                            group_id_for_query = context_id
-                        else:
-                            sheets_context = "personal"
-                            group_id_for_query = user_id
-                        
-                        # ดึงรายการนัดหมาย
-                        appointments = repo.get_appointments(group_id_for_query, sheets_context)
-                        
-                        logger.info(f"Delete attempt - Found {len(appointments)} appointments for group_id: {group_id_for_query}, context: {sheets_context}")
-                        for apt in appointments:
-                            logger.info(f"Available appointment ID: {apt.id}")
-                        
-                        # หานัดหมายที่ต้องการลบ
-                        target_appointment = None
-                        for apt in appointments:
-                            if apt.id == appointment_id:
-                                target_appointment = apt
-                                break
-                        
-                        if not target_appointment:
-                            final_message = f"""❌ ไม่พบนัดหมายรหัส: {appointment_id}
+            target_id = context_id if context_type == "group" else user_id
+            
+            # ข้อความยืนยัน
+            confirmation_message = f"⏳ กำลังลบนัดหมาย {appointment_id}...\nรอสักครู่นะคะ"
+            outbox = get_outbox()
+            confirmation_queued = threading.Event()
+            
+            # ดำเนินการลบและส่งผลลัพธ์
+            def process_deletion():
+                try:
+                    # เชื่อมต่อกับ database
+                    repo = get_sheets_repository()
+                    
+                    # กำหนด context
+                    if context_type == "group":
+                        sheets_context = f"group_{context_id}"
+                        group_id_for_query = context_id
+                    else:
+                        sheets_context = "personal"
+                        group_id_for_query = user_id
+                    
+                    # ดึงรายการนัดหมาย
+                    appointments = repo.get_appointments(group_id_for_query, sheets_context)
+                    
+                    logger.info(f"Delete attempt - Found {len(appointments)} appointments for group_id: {group_id_for_query}, context: {sheets_context}")
+                    for apt in appointments:
+                        logger.info(f"Available appointment ID: {apt.id}")
+                    
+                    # หานัดหมายที่ต้องการลบ
+                    target_appointment = None
+                    for apt in appointments:
+                        if apt.id == appointment_id:
+                            target_appointment = apt
+                            break
+                    
+                    if not target_appointment:
+                        final_message = f"""❌ ไม่พบนัดหมายรหัส: {appointment_id}
 
 💡 ตรวจสอบรหัสนัดหมายด้วยคำสั่ง "ดูนัด" """
-                        else:
-                            # ลบนัดหมาย
-                            success = repo.delete_appointment(appointment_id, sheets_context)
-                            
-                            if success:
-                                final_message = f"""✅ ลบนัดหมายเรียบร้อย!
-
-🗑️ นัดหมายที่ถูกลบ:
-• รหัส: {appointment_id}
-• ชื่อ: {target_appointment.title}
-• วันที่: {target_appointment.date}
-• เวลา: {target_appointment.time}
-• บุคคล/ผู้ติดต่อ: {target_appointment.contact_person}"""
-                            else:
-                                final_message = f"❌ ไม่สามารถลบนัดหมายรหัส {appointment_id} ได้ กรุณาลองใหม่อีกครั้ง"
-                        
-                        # ส่งผลลัพธ์ด้วย robust sender
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=target_id,
-                                messages=[TextMessage(text=final_message)]
-                            )
-                        )
-                        logger.info(f"Sent final deletion result for appointment {appointment_id}")
+                    else:
+                        # ลบนัดหมาย
+                        success = repo.delete_appointment(appointment_id, sheets_context)
                         
-                    except Exception as e:
-                        logger.error(f"Error in deletion process: {e}")
-                        # ส่งข้อความ error
-                        error_message = f"❌ เกิดข้อผิดพลาดในการลบนัดหมาย {appointment_id}"
-                        try:
-                            line_bot_api.push_message(
-                                PushMessageRequest(
-                                    to=target_id,
-                                    messages=[TextMessage(text=error_message)]
-                                )
-                            )
-                        except:
-                            pass
-                
-                # Run deletion in background thread
-                import threading
-                thread = threading.Thread(target=process_deletion)
-                thread.daemon = True
-                thread.start()
-                
-                return "🔄 กำลังดำเนินการลบนัดหมาย..."
-                
+                        if success:
+                            final_message = render_deleted_appointment(target_appointment)
+                        else:
+                            final_message = f"❌ ไม่สามารถลบนัดหมายรหัส {appointment_id} ได้ กรุณาลองใหม่อีกครั้ง"
+                    
+                    # ส่งผลลัพธ์ผ่าน outbox (หลังข้อความยืนยัน)
+                    confirmation_queued.wait(timeout=5)
+                    outbox.enqueue(target_id, [final_message], priority=PRIORITY_INTERACTIVE)
+                    logger.info(f"Queued final deletion result for appointment {appointment_id}")
+                    
+                except Exception as e:
+                    logger.error(f"Error in deletion process: {e}")
+                    # ส่งข้อความ error
+                    error_message = f"❌ เกิดข้อผิดพลาดในการลบนัดหมาย {appointment_id}"
+                    outbox.enqueue(target_id, [error_message], priority=PRIORITY_INTERACTIVE)
+            
+            # ลบต่อในคิวของแชทนี้ (ก่อนคำสั่งถัดไปของแชท เช่น "ดูนัด" ที่ส่งตามมา)
+            # ถ้าไม่ได้ถูกเรียกจาก webhook dispatcher ให้ใช้ background executor ที่จำกัดขนาด
+            # และถ้า executor เต็มให้ตอบว่าระบบไม่ว่าง - ไม่ลบใน thread นี้ (backpressure)
+            if not defer_in_chat(process_deletion):
+                try:
+                    get_background_executor().submit(process_deletion)
+                except BackgroundQueueFull as e:
+                    logger.warning(f"{e} - not deleting {appointment_id}, replying busy")
+                    return f"⏳ ระบบกำลังทำงานอื่นอยู่จำนวนมาก ยังไม่ได้ลบนัดหมาย {appointment_id}\nกรุณาส่ง \"ลบนัด {appointment_id}\" อีกครั้งในอีกสักครู่"
+            
+            # ส่งข้อความยืนยัน (ผ่าน outbox เพื่อ retry หาก LINE ขัดข้อง) เมื่อการลบถูกจัดคิวแล้วเท่านั้น
+            outbox.enqueue(target_id, [confirmation_message], priority=PRIORITY_INTERACTIVE)
+            confirmation_queued.set()
+            logger.info(f"Queued deletion confirmation for appointment {appointment_id}")
+            
+            return "🔄 กำลังดำเนินการลบนัดหมาย..."
+            
         except Exception as e:
             logger.error(f"Failed to setup deletion process: {e}")
             return f"❌ ไม่สามารถเริ่มกระบวนการลบนัดหมาย {appointment_id} ได้"
@@ -887,7 +773,7 @@ def handle_edit_appointment_command(user_message: str, user_id: str, context_typ
 เบอร์โทร:"02-419-7000" """
 
         # เชื่อมต่อกับ database
-        repo = SheetsRepository()
+        repo = get_sheets_repository()
         
         # กำหนด context และ group_id สำหรับ Google Sheets
         if context_type == "group":
@@ -1049,11 +935,68 @@ def handle_edit_appointment_command(user_message: str, user_id: str, context_typ
         return "❌ เกิดข้อผิดพลาดในการแก้ไขนัดหมาย กรุณาลองใหม่อีกครั้ง"
 
 
+def handle_set_delivery_time_command(user_message: str, user_id: str, context_type: str, context_id: str) -> str:
+    """จัดการคำสั่งตั้งเวลารับสรุปนัดหมายประจำวัน"""
+    try:
+        import re
+        from notifications.delivery_schedule import DeliverySchedule
+        
+        schedule = DeliverySchedule()
+        recipient_id = context_id if context_type == "group" else user_id
+        
+        match = re.match(r'(?:ตั้งเวลาเตือน|เวลาเตือน)\s*(.*)', user_message.strip(), re.DOTALL)
+        time_text = match.group(1).strip() if match else ""
+        
+        if not time_text:
+            return f"""⏰ ตั้งเวลารับสรุปนัดหมายประจำวัน
+
+📝 วิธีการใช้งาน:
+ตั้งเวลาเตือน [เวลา]
+
+ตัวอย่าง:
+ตั้งเวลาเตือน 07:30
+ตั้งเวลาเตือน 18.00
+ตั้งเวลาเตือน ค่าเริ่มต้น
+
+🌙 งดส่งข้อความช่วง {schedule.quiet_hours_text} น.
+💡 เวลาจะถูกปัดเป็นช่วงละ {schedule.bucket_minutes} นาที"""
+        
+        if time_text in ('ค่าเริ่มต้น', 'default', 'ยกเลิก'):
+            delivery_time = ""
+        else:
+            delivery_time = schedule.validate(time_text)
+            if not delivery_time:
+                return f"""❌ เวลาไม่ถูกต้อง: "{time_text}"
+
+📝 ใช้รูปแบบ HH:MM เช่น 07:30
+🌙 ไม่สามารถตั้งเวลาในช่วง {schedule.quiet_hours_text} น."""
+        
+        repo = get_sheets_repository()
+        if not repo.set_delivery_time(recipient_id, delivery_time):
+            return "❌ ไม่สามารถบันทึกเวลาแจ้งเตือนได้ กรุณาลองใหม่อีกครั้ง"
+        
+        schedule.set_preference(recipient_id, delivery_time)
+        effective_time = schedule.bucket_for(recipient_id)
+        
+        if not delivery_time:
+            return f"""✅ กลับไปใช้เวลาแจ้งเตือนเริ่มต้นแล้ว
+
+🔔 จะได้รับสรุปนัดหมายทุกวันเวลา {effective_time} น."""
+        
+        return f"""✅ ตั้งเวลาแจ้งเตือนเรียบร้อย!
+
+🔔 จะได้รับสรุปนัดหมายทุกวันเวลา {effective_time} น."""
+        
+    except Exception as e:
+        logger.error(f"Error in handle_set_delivery_time_command: {e}")
+        return "❌ เกิดข้อผิดพลาดในการตั้งเวลาแจ้งเตือน กรุณาลองใหม่อีกครั้ง"
+
+
 def handle_reminder_info_command(context_type: str) -> str:
     """จัดการคำสั่งข้อมูลการแจ้งเตือน"""
     base_info = """🔔 ระบบแจ้งเตือนอัตโนมัติ
 
-✅ ระบบทำงานอัตโนมัติทุกวันเวลา 09:00 น.
+✅ ระบบทำงานอัตโนมัติทุกวันตามเวลาที่ตั้งไว้
 ⏰ จะแจ้งเตือนในช่วงเวลา:
 
 📅 7 วันก่อนนัดหมาย:
@@ -1065,7 +1008,8 @@ def handle_reminder_info_command(context_type: str) -> str:
    • เตรียมเอกสารที่จำเป็น
    • แนะนำให้ไปให้ทันเวลา
 
-💡 พิมพ์ "ทดสอบเตือน" เพื่อทดสอบระบบ"""
+💡 พิมพ์ "ทดสอบเตือน" เพื่อทดสอบระบบ
+⏰ พิมพ์ "ตั้งเวลาเตือน 07:30" เพื่อเปลี่ยนเวลารับสรุป"""
     
     if context_type == "group":
         return base_info + '\n\n🏥 โหมดกลุ่ม: การแจ้งเตือนจะส่งให้สมาชิกในกลุ่ม'
@@ -1085,7 +1029,7 @@ def handle_test_notification_command(user_id: str) -> str:
 ✅ ระบบแจ้งเตือนพร้อมใช้งาน!
 
 📋 การตั้งค่าปัจจุบัน:
-• เวลาแจ้งเตือน: ทุกวัน 09:00 น.
+• เวลาแจ้งเตือน: ทุกวันตามเวลาที่ตั้งไว้ ("ตั้งเวลาเตือน")
 • แจ้งเตือนล่วงหน้า: 7 วัน, 1 วัน
 • สถานะ: เปิดใช้งาน ✅
 
@@ -1179,7 +1123,7 @@ def handle_force_notification_check_command() -> str:
 🔍 ระบบได้ตรวจสอบการนัดหมายทั้งหมดแล้ว
 📨 หากมีการแจ้งเตือนจะส่งให้ทันที
 
-⏰ ระบบปกติจะเช็คทุกวัน 09:00 น.
+⏰ ระบบปกติจะเช็คทุกวันตามเวลาที่ตั้งไว้
 💡 คำสั่งนี้ใช้สำหรับทดสอบเท่านั้น"""
             else:
                 return f"""⚠️ เช็คระบบแจ้งเตือนไม่สำเร็จ
@@ -1211,4 +1155,121 @@ https://line-group-reminder-bot.onrender.com/run-notification-check"""
         return f"""❌ เกิดข้อผิดพลาด
 
 🔍 รายละเอียด: {str(e)}
-💡 ลองใหม่อีกครั้ง หรือติดต่อผู้ดูแลระบบ"""
\ No newline at end of file
+💡 ลองใหม่อีกครั้ง หรือติดต่อผู้ดูแลระบบ"""
+
+
+def handle_greeting_command(context_type: str) -> str:
+    """จัดการคำสั่งทักทาย"""
+    if context_type == "group":
+        return '''สวัสดี! ยินดีต้อนรับสู่ LINE Group Reminder Bot
+นี่คือกลุ่มสำหรับจัดการการนัดหมายร่วมกัน
+
+พิมพ์ "คำสั่ง" เพื่อดูวิธีใช้งาน'''
+    else:
+        return '''สวัสดี! ยินดีต้อนรับสู่ LINE Group Reminder Bot
+นี่คือการนัดหมายส่วนตัวของคุณ
+
+พิมพ์ "คำสั่ง" เพื่อดูวิธีใช้งาน'''
+
+
+def handle_help_command(context_type: str) -> str:
+    """จัดการคำสั่งความช่วยเหลือ (Thai language commands)"""
+    base_help = '''📋 คำสั่งการจัดการนัดหมาย (รองรับภาษาไทยแบบธรรมชาติ):
+
+• "เพิ่มนัด" - เพิ่มการนัดหมายใหม่
+• "ดูนัด" - ดูรายการนัดหมายที่กำลังจะมาถึง
+• "ดูนัดย้อนหลัง" - ดูประวัตินัดหมาย
+• "ลบนัด [รหัส]" - ลบการนัดหมาย
+• "แก้ไขนัด [รหัส]" - แก้ไขการนัดหมาย
+• "ตั้งเวลาเตือน 07:30" - ตั้งเวลารับสรุปนัดหมายประจำวัน
+
+📝 ตัวอย่างเพิ่มนัด (Natural Language):
+• เพิ่มนัด ไปหาหมอ ศุกร์หน้า 9:30 ที่ โรงพยาบาลจุฬา แผนกหัวใจ กับหมอเอ
+• เพิ่มนัด ประชุมทีม 24 ตุลา 15:00 at CentralWorld
+• เพิ่มนัด กินข้าวกับที่บ้าน วันอาทิตย์ เย็น
+
+📌 เคล็ดลับ:
+• เดือนแบบย่อได้: ตุลา พฤศจิกา ธันวา ฯลฯ
+• ปี พ.ศ. หรือ ย่อ 26 → 2026 ก็ได้
+• เวลาแบบคำพูดได้: บ่ายสาม, สามทุ่มครึ่ง, เช้า
+
+🗑️ ลบนัดหมาย:
+ลบนัด ABC123
+
+🔄 แก้ไขนัดหมาย:
+แก้ไขนัด ABC123 นัดหมาย:"ตรวจร่างกาย"
+
+หรือส่งหลายแถว:
+แก้ไขนัด ABC123
+นัดหมาย:"ตรวจสุขภาพ"
+วันเวลา:"10 ตุลาคม 2025 15:00"
+บุคคล/ผู้ติดต่อ:"ดร.สมชาย"'''
+    
+    if context_type == "group":
+        return base_help + '\n\n🏥 โหมดกลุ่ม: การนัดหมายจะแสดงให้ทุกคนในกลุ่มเห็น'
+    else:
+        return base_help + '\n\n👤 โหมดส่วนตัว: การนัดหมายของคุณเท่านั้น'
+
+
+def handle_status_command(context_type: str, context_id: str) -> str:
+    """จัดการคำสั่งดูสถานะของบอท"""
+    return f'สถานะของบอท:\\nเชื่อมต่อ LINE API สำเร็จ\\nรับข้อความได้ปกติ\\nส่งข้อความตอบกลับได้ปกติ\\nระบบ Scheduler พร้อมใช้งาน\\nContext: {context_type} ({context_id[:10]}...)'
+
+
+# Registry ของคำสั่ง - ลำดับคือลำดับความสำคัญเมื่อหลาย keyword ตรงกับข้อความ
+# exact=True: ข้อความต้องตรงทั้งข้อความ, uses_sheets: ตอบ "ระบบไม่พร้อม" เมื่อวงจรของ Sheets เปิด,
+# group: keyword ที่ทำให้ข้อความในกลุ่มถือเป็นคำสั่งถึงบอท, cacheable: ตอบจากคำตอบล่าสุดเมื่อเกิน rate limit
+COMMANDS = (
+    Command('greeting', ('hello', 'สวัสดี', 'ทักทาย'), exact=True,
+            handler=lambda ctx: handle_greeting_command(ctx.context_type)),
+    Command('help', ('help', 'คำสั่ง', 'ช่วยเหลือ', 'วิธีใช้'), exact=True, group=('help', 'คำสั่ง'),
+            handler=lambda ctx: handle_help_command(ctx.context_type)),
+    Command('add_appointment', ('เพิ่มนัด', 'นัดใหม่', 'เพิ่มการนัด'), uses_sheets=True,
+            handler=lambda ctx: handle_add_appointment_command(ctx.user_message, ctx.user_id,
+                                                               ctx.context_type, ctx.context_id)),
+    Command('list_appointments', ('ดูนัด', 'รายการนัด', 'นัดหมาย', 'ดูการนัด'), exact=True, uses_sheets=True,
+            group=('ดูนัด',), cacheable=True,
+            handler=lambda ctx: handle_list_appointments_command(ctx.user_id, ctx.context_type, ctx.context_id,
+                                                                 show_past=False)),
+    Command('history_menu', ('ดูนัดย้อนหลัง', 'นัดย้อนหลัง', 'ประวัตินัด', 'ดูประวัตินัด'), exact=True,
+            group=('ดูนัดย้อนหลัง', 'นัดย้อนหลัง', 'ประวัตินัด'),
+            handler=lambda ctx: handle_historical_appointments_menu(ctx.user_id, ctx.context_type, ctx.context_id)),
+    Command('history', ('ย้อนหลัง', 'ดูย้อนหลัง'), uses_sheets=True, cacheable=True,
+            handler=lambda ctx: handle_historical_appointments_command(ctx.user_message, ctx.user_id,
+                                                                       ctx.context_type, ctx.context_id)),
+    Command('delete_appointment', ('ลบนัด', 'ยกเลิกนัด', 'ลบการนัด'), uses_sheets=True,
+            handler=lambda ctx: handle_delete_appointment_command(ctx.user_message, ctx.user_id,
+                                                                  ctx.context_type, ctx.context_id)),
+    Command('edit_appointment', ('แก้ไขนัด', 'แก้นัด', 'แก้ไขการนัด'), uses_sheets=True,
+            handler=lambda ctx: handle_edit_appointment_command(ctx.user_message, ctx.user_id,
+                                                                ctx.context_type, ctx.context_id)),
+    Command('set_delivery_time', ('ตั้งเวลาเตือน', 'เวลาเตือน'), uses_sheets=True,
+            handler=lambda ctx: handle_set_delivery_time_command(ctx.user_message, ctx.user_id,
+                                                                 ctx.context_type, ctx.context_id)),
+    Command('reminder_info', ('reminder', 'เตือน', 'การแจ้งเตือน'), exact=True, group=('เตือน',),
+            handler=lambda ctx: handle_reminder_info_command(ctx.context_type)),
+    Command('test_notification', ('ทดสอบเตือน', 'test notification', 'testnotification'), exact=True,
+            group=('ทดสอบเตือน',),
+            handler=lambda ctx: handle_test_notification_command(ctx.user_id)),
+    Command('test_date_parser', ('ทดสอบวันที่', 'test date', 'testdate'), exact=True, group=('ทดสอบวันที่',),
+            handler=lambda ctx: handle_test_date_parser_command()),
+    Command('force_notification_check', ('force check', 'forcecheck', 'เช็คเตือน', 'เช็คทันที'), exact=True,
+            group=False,
+            handler=lambda ctx: handle_force_notification_check_command()),
+    Command('status', ('status',), exact=True, group=False,
+            handler=lambda ctx: handle_status_command(ctx.context_type, ctx.context_id)),
+)
+
+# "สถานะ" และ "ทดสอบ..." ในกลุ่มถือเป็นข้อความถึงบอทเสมอ (ตอบแนะนำให้พิมพ์ "help" แม้ไม่ตรงคำสั่ง)
+COMMAND_ROUTER = CommandRouter(COMMANDS, group_prefixes=('สถานะ', 'ทดสอบ'))
+
+# ขีดจำกัดของคำสั่งต่อผู้ใช้/กลุ่ม (COMMAND_RATE_LIMITS) และคำตอบล่าสุดของคำสั่งอ่านอย่างเดียว
+COMMAND_THROTTLE = CommandThrottle()
+
+
+def _invalidate_cached_replies(event):
+    """Subscriber ของ change feed - คำตอบที่เก็บไว้ของ worksheet ที่เปลี่ยนใช้ไม่ได้อีก"""
+    COMMAND_THROTTLE.invalidate(event.context)
+
+
+change_feed.subscribe(_invalidate_cached_replies)
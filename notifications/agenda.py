@@ -0,0 +1,165 @@
+"""
+Materialized agenda สำหรับระบบแจ้งเตือน
+เก็บนัดหมายแยกตามผู้รับ (group_id/user_id) ไว้ในหน่วยความจำ
+อัปเดตจาก change feed ของ SheetsRepository และ reconcile กับ Google Sheets เป็นระยะ
+"""
+
+import dataclasses
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from storage.change_feed import ChangeEvent
+from storage.models import Appointment
+
+logger = logging.getLogger(__name__)
+
+# ฟิลด์ของ Appointment ที่ update event สามารถแก้ไขได้
+_APPOINTMENT_FIELDS = {f.name for f in dataclasses.fields(Appointment)}
+
+
+class MaterializedAgenda:
+    """
+    Agenda ที่คำนวณไว้ล่วงหน้าต่อผู้รับ
+
+    - rebuild จากการอ่าน Sheets เต็ม ๆ (reconciliation scan)
+    - apply ChangeEvent จาก add/update/delete ระหว่างรอบ reconcile
+    - event ที่อ้างถึงนัดหมายที่ไม่รู้จักจะทำให้ agenda ถูก mark เป็น stale
+      เพื่อบังคับ reconcile ก่อนรอบส่งแจ้งเตือนครั้งถัดไป
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_recipient: Dict[str, Dict[str, Appointment]] = {}
+        self._recipient_of: Dict[str, str] = {}
+        self._pending: Optional[List[ChangeEvent]] = None  # event ที่เข้ามาระหว่าง reconcile
+        self._stale = False
+        self.last_reconciled_at: Optional[datetime] = None
+        self.changes_applied = 0
+
+    @property
+    def is_loaded(self) -> bool:
+        """True หาก agenda เคยถูก reconcile แล้วอย่างน้อยหนึ่งครั้ง"""
+        return self.last_reconciled_at is not None
+
+    @property
+    def is_stale(self) -> bool:
+        """True หาก agenda อาจไม่ตรงกับ Sheets และควร reconcile ใหม่"""
+        return self._stale or not self.is_loaded
+
+    def begin_reconcile(self):
+        """เริ่มรอบ reconcile - เก็บ event ที่เข้ามาระหว่างอ่าน Sheets ไว้ replay ภายหลัง"""
+        with self._lock:
+            self._pending = []
+
+    def finish_reconcile(self, appointments: List[Appointment], reconciled_at: datetime = None):
+        """
+        แทนที่ agenda ด้วยผลการอ่าน Sheets แล้ว replay event ที่เข้ามาระหว่างนั้น
+
+        Args:
+            appointments (List[Appointment]): นัดหมายทั้งหมดที่อ่านได้
+            reconciled_at (datetime): เวลาที่ reconcile (ค่าเริ่มต้นคือเวลาปัจจุบัน)
+        """
+        by_recipient: Dict[str, Dict[str, Appointment]] = {}
+        recipient_of: Dict[str, str] = {}
+        for appointment in appointments:
+            recipient_id = appointment.group_id
+            by_recipient.setdefault(recipient_id, {})[appointment.id] = appointment
+            recipient_of[appointment.id] = recipient_id
+
+        with self._lock:
+            pending = self._pending or []
+            self._pending = None
+            self._by_recipient = by_recipient
+            self._recipient_of = recipient_of
+            self._stale = False
+            self.last_reconciled_at = reconciled_at or datetime.now()
+            for event in pending:
+                self._apply_locked(event)
+
+        logger.info(f"Agenda reconciled: {len(appointments)} appointments for "
+                    f"{len(by_recipient)} recipients ({len(pending)} events replayed)")
+
+    def abort_reconcile(self):
+        """ยกเลิกรอบ reconcile ที่ล้มเหลว - event ที่ค้างไว้ยังถูก apply กับ agenda เดิม"""
+        with self._lock:
+            pending = self._pending or []
+            self._pending = None
+            for event in pending:
+                self._apply_locked(event)
+
+    def apply(self, event: ChangeEvent):
+        """Apply ChangeEvent จาก change feed (ใช้เป็น subscriber ได้โดยตรง)"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(event)
+            self._apply_locked(event)
+
+    def _apply_locked(self, event: ChangeEvent):
+        if event.op == 'add' and event.appointment is not None:
+            appointment = event.appointment
+            self._remove_locked(appointment.id)
+            self._by_recipient.setdefault(appointment.group_id, {})[appointment.id] = appointment
+            self._recipient_of[appointment.id] = appointment.group_id
+
+        elif event.op == 'update':
+            recipient_id = self._recipient_of.get(event.appointment_id)
+            current = self._by_recipient.get(recipient_id, {}).get(event.appointment_id)
+            if current is None:
+                self._stale = True
+                logger.info(f"Agenda missing appointment {event.appointment_id} on update - marked stale")
+                return
+            changes = {k: v for k, v in event.fields.items() if k in _APPOINTMENT_FIELDS and k != 'id'}
+            updated = dataclasses.replace(current, **changes)
+            self._remove_locked(event.appointment_id)
+            self._by_recipient.setdefault(updated.group_id, {})[updated.id] = updated
+            self._recipient_of[updated.id] = updated.group_id
+
+        elif event.op == 'delete':
+            if not self._remove_locked(event.appointment_id):
+                self._stale = True
+                logger.info(f"Agenda missing appointment {event.appointment_id} on delete - marked stale")
+                return
+
+        else:
+            logger.warning(f"Unknown change event op: {event.op}")
+            return
+
+        self.changes_applied += 1
+
+    def _remove_locked(self, appointment_id: str) -> bool:
+        recipient_id = self._recipient_of.pop(appointment_id, None)
+        if recipient_id is None:
+            return False
+        appointments = self._by_recipient.get(recipient_id, {})
+        appointments.pop(appointment_id, None)
+        if not appointments:
+            self._by_recipient.pop(recipient_id, None)
+        return True
+
+    def snapshot(self) -> Dict[str, List[Appointment]]:
+        """
+        คืน agenda ต่อผู้รับ เรียงนัดหมายจากใกล้ที่สุดไปไกลที่สุด
+
+        Returns:
+            Dict[str, List[Appointment]]: recipient_id -> รายการนัดหมาย
+        """
+        with self._lock:
+            items = {recipient_id: list(appointments.values())
+                     for recipient_id, appointments in self._by_recipient.items()}
+
+        for appointments in items.values():
+            appointments.sort(key=lambda apt: apt.appointment_datetime)
+        return items
+
+    def stats(self) -> dict:
+        """สถิติของ agenda สำหรับ debug"""
+        with self._lock:
+            return {
+                'recipients': len(self._by_recipient),
+                'appointments': len(self._recipient_of),
+                'changes_applied': self.changes_applied,
+                'stale': self.is_stale,
+                'last_reconciled_at': self.last_reconciled_at.isoformat() if self.last_reconciled_at else None
+            }
@@ -0,0 +1,155 @@
+"""
+Delivery time buckets สำหรับระบบแจ้งเตือน
+แต่ละกลุ่ม/ผู้ใช้เลือกเวลารับสรุปนัดหมายได้เอง ผู้รับถูกจัดเข้า bucket ตามเวลา
+และ scheduler รันหนึ่ง job ต่อ bucket เพื่อกระจายโหลดของ LINE push และ Sheets
+"""
+
+import os
+import re
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# ขนาดของ bucket (นาที) - เวลาที่เลือกจะถูกปัดลงให้ตรง bucket
+DELIVERY_BUCKET_MINUTES = int(os.getenv('DELIVERY_BUCKET_MINUTES', 15))
+# ช่วงเวลาห้ามส่งข้อความ (ข้ามเที่ยงคืนได้)
+QUIET_HOURS = os.getenv('NOTIFICATION_QUIET_HOURS', '21:00-07:00')
+# ช่วงเวลาที่ผู้รับที่ไม่ได้ตั้งค่าจะถูกกระจายเข้าไป
+DEFAULT_DELIVERY_WINDOW = os.getenv('DEFAULT_DELIVERY_WINDOW', '08:00-10:00')
+
+_TIME_PATTERN = re.compile(r'^\s*(\d{1,2})[:.](\d{2})\s*(?:น\.?)?\s*$')
+
+
+def parse_time(text: str) -> Optional[Tuple[int, int]]:
+    """
+    แปลงข้อความเวลา เช่น '07:30', '7.30', '18:00 น.' เป็น (hour, minute)
+
+    Returns:
+        Optional[Tuple[int, int]]: (hour, minute) หรือ None หากรูปแบบไม่ถูกต้อง
+    """
+    match = _TIME_PATTERN.match(text or '')
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+
+def format_time(minutes_of_day: int) -> str:
+    """แปลงนาทีของวันเป็น 'HH:MM'"""
+    return f"{minutes_of_day // 60:02d}:{minutes_of_day % 60:02d}"
+
+
+def _parse_range(text: str) -> Tuple[int, int]:
+    start_text, end_text = text.split('-', 1)
+    start, end = parse_time(start_text), parse_time(end_text)
+    if not start or not end:
+        raise ValueError(f"Invalid time range: {text}")
+    return start[0] * 60 + start[1], end[0] * 60 + end[1]
+
+
+class DeliverySchedule:
+    """
+    จัดผู้รับเข้า delivery bucket ตามเวลาที่ตั้งไว้
+
+    - ผู้รับที่ตั้งเวลาไว้: ใช้ bucket ของเวลานั้น (เลื่อนออกจาก quiet hours ถ้าจำเป็น)
+    - ผู้รับที่ไม่ได้ตั้ง: กระจายแบบคงที่ (ตาม hash ของ id) ไปใน DEFAULT_DELIVERY_WINDOW
+    """
+
+    def __init__(self, bucket_minutes: int = DELIVERY_BUCKET_MINUTES,
+                 quiet_hours: str = QUIET_HOURS,
+                 default_window: str = DEFAULT_DELIVERY_WINDOW):
+        self.bucket_minutes = max(1, bucket_minutes)
+        self.quiet_start, self.quiet_end = _parse_range(quiet_hours)
+        window_start, window_end = _parse_range(default_window)
+        self.default_slots = self._slots_between(window_start, window_end)
+        self._preferences: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _floor(self, minutes_of_day: int) -> int:
+        return minutes_of_day - minutes_of_day % self.bucket_minutes
+
+    def _ceil(self, minutes_of_day: int) -> int:
+        return self._floor(minutes_of_day + self.bucket_minutes - 1) % (24 * 60)
+
+    def _slots_between(self, start: int, end: int) -> List[int]:
+        slots = list(range(self._floor(start), end, self.bucket_minutes)) or [self._floor(start)]
+        return [self._out_of_quiet_hours(slot) for slot in slots]
+
+    def is_quiet(self, minutes_of_day: int) -> bool:
+        """True หากเวลาอยู่ในช่วง quiet hours"""
+        if self.quiet_start == self.quiet_end:
+            return False
+        if self.quiet_start < self.quiet_end:
+            return self.quiet_start <= minutes_of_day < self.quiet_end
+        return minutes_of_day >= self.quiet_start or minutes_of_day < self.quiet_end
+
+    def _out_of_quiet_hours(self, minutes_of_day: int) -> int:
+        # bucket แรกที่ไม่อยู่ใน quiet hours (ปัดขึ้น เพราะปัดลงอาจย้อนกลับเข้า quiet hours)
+        return self._ceil(self.quiet_end) if self.is_quiet(minutes_of_day) else minutes_of_day
+
+    def _bucket_of(self, minutes_of_day: int) -> int:
+        floored = self._floor(minutes_of_day)
+        if not self.is_quiet(floored):
+            return floored
+        if not self.is_quiet(minutes_of_day):
+            return self._ceil(minutes_of_day)  # ปัดลงแล้วตกใน quiet hours - ใช้ bucket ถัดไป
+        return self._out_of_quiet_hours(minutes_of_day)
+
+    def validate(self, text: str) -> Optional[str]:
+        """
+        ตรวจสอบเวลาที่ผู้ใช้ต้องการตั้ง
+
+        Returns:
+            Optional[str]: เวลาในรูปแบบ 'HH:MM' หากใช้ได้, None หากรูปแบบผิดหรืออยู่ใน quiet hours
+        """
+        parsed = parse_time(text)
+        if not parsed:
+            return None
+        minutes_of_day = parsed[0] * 60 + parsed[1]
+        if self.is_quiet(minutes_of_day):
+            return None
+        return format_time(minutes_of_day)
+
+    @property
+    def quiet_hours_text(self) -> str:
+        return f"{format_time(self.quiet_start)}-{format_time(self.quiet_end)}"
+
+    def load(self, preferences: Dict[str, str]):
+        """แทนที่เวลาที่ผู้รับตั้งไว้ทั้งหมด (recipient_id -> 'HH:MM')"""
+        with self._lock:
+            self._preferences = {k: v for k, v in preferences.items() if k and parse_time(v)}
+
+    def set_preference(self, recipient_id: str, delivery_time: Optional[str]):
+        """ตั้ง/ลบเวลาของผู้รับหนึ่งราย (None หรือค่าว่าง = กลับไปใช้ค่าเริ่มต้น)"""
+        with self._lock:
+            if delivery_time and parse_time(delivery_time):
+                self._preferences[recipient_id] = delivery_time
+            else:
+                self._preferences.pop(recipient_id, None)
+
+    def preference_of(self, recipient_id: str) -> Optional[str]:
+        with self._lock:
+            return self._preferences.get(recipient_id)
+
+    def bucket_for(self, recipient_id: str) -> str:
+        """คืน bucket ('HH:MM') ที่ผู้รับจะได้รับสรุปนัดหมาย"""
+        preferred = self.preference_of(recipient_id)
+        if preferred:
+            hour, minute = parse_time(preferred)
+            return format_time(self._bucket_of(hour * 60 + minute))
+        index = zlib.crc32(recipient_id.encode('utf-8')) % len(self.default_slots)
+        return format_time(self.default_slots[index])
+
+    def occupied_buckets(self) -> Set[str]:
+        """bucket ทั้งหมดที่ต้องมี job (ช่วงค่าเริ่มต้น + เวลาที่ผู้รับตั้งไว้)"""
+        with self._lock:
+            recipients = list(self._preferences)
+        buckets = {format_time(slot) for slot in self.default_slots}
+        buckets.update(self.bucket_for(recipient_id) for recipient_id in recipients)
+        return buckets
+
+    def recipients_in_bucket(self, bucket: str, recipients: Iterable[str]) -> List[str]:
+        """กรองผู้รับที่อยู่ใน bucket ที่กำหนด"""
+        return [recipient_id for recipient_id in recipients if self.bucket_for(recipient_id) == bucket]
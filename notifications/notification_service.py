@@ -3,16 +3,41 @@ Notification System for LINE Group Reminder Bot
 จัดการระบบแจ้งเตือนอัตโนมัติสำหรับการนัดหมาย
 """
 
+import heapq
 import logging
+import os
+import sys
+import threading
+import time
 import pytz
 from datetime import datetime, timedelta
 from typing import List, Dict, Any
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.triggers.cron import CronTrigger
-from linebot.v3.messaging import MessagingApi, PushMessageRequest, TextMessage
+from apscheduler.triggers.interval import IntervalTrigger
+from linebot.v3.messaging import MessagingApi
 
 from storage.sheets_repo import SheetsRepository
 from storage.models import Appointment
+from storage import change_feed, local_db
+from notifications.agenda import MaterializedAgenda
+from notifications.delivery_schedule import DeliverySchedule
+from notifications.outbox import PushOutbox, get_outbox, PRIORITY_URGENT, PRIORITY_BULK
+from notifications.run_state import RunStateStore, NOTIFICATION_RUN_BATCH_SIZE, NOTIFICATION_RUN_LEASE_SECONDS
+from utils.message_renderer import classify_by_urgency, days_until, render_digest_segments
+from utils.message_packer import pack_requests
+from utils.run_metrics import (get_run_metrics, STAGE_WORKSHEET_DISCOVERY, STAGE_GROUPING,
+                               STAGE_RENDERING, STAGE_QUEUEING)
+from notifications.quota import (QuotaTracker, DigestHistory, digest_fingerprint,
+                                 QUOTA_MODE_NORMAL, QUOTA_MODE_URGENT_ONLY)
+
+# Job store แบบถาวร (ต้องใช้ SQLAlchemy) - ถ้าไม่มีจะใช้ memory job store แทน
+try:
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    SQLALCHEMY_JOBSTORE_AVAILABLE = True
+except ImportError:
+    SQLALCHEMY_JOBSTORE_AVAILABLE = False
 
 # ตั้งค่า logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +46,56 @@ logger = logging.getLogger(__name__)
 # ตั้งค่า timezone สำหรับประเทศไทย
 BANGKOK_TZ = pytz.timezone('Asia/Bangkok')
 
+# ความถี่ของ reconciliation scan และอายุสูงสุดของ agenda ก่อนรอบส่งแจ้งเตือน
+AGENDA_RECONCILE_INTERVAL_HOURS = int(os.getenv('AGENDA_RECONCILE_INTERVAL_HOURS', 6))
+AGENDA_MAX_AGE_HOURS = int(os.getenv('AGENDA_MAX_AGE_HOURS', 12))
+# รอบที่พลาดไป (เช่น process restart ตรงเวลาส่ง) จะถูกรันย้อนหลังหากยังไม่เกินช่วงนี้
+NOTIFICATION_MISFIRE_GRACE_SECONDS = int(os.getenv('NOTIFICATION_MISFIRE_GRACE_SECONDS', 3 * 60 * 60))
+
+# job ที่ scheduler เรียกผ่าน run_scheduled_job ได้
+_SCHEDULED_JOBS = ('check_and_send_notifications', 'reconcile_agenda')
+_SCHEDULED_JOB_REF = 'notifications.notification_service:run_scheduled_job'
+_active_service = None
+
+
+def run_scheduled_job(job_name: str, *args):
+    """
+    Entry point ของ job ที่เก็บใน job store แบบถาวร
+
+    Job store เก็บได้เฉพาะ reference ของฟังก์ชันระดับ module จึงเรียก method
+    ของ NotificationService ที่กำลังทำงานผ่านฟังก์ชันนี้แทน bound method
+    """
+    service = _active_service
+    if service is None:
+        logger.warning(f"Scheduled job {job_name} fired without an active NotificationService")
+        return
+    if job_name not in _SCHEDULED_JOBS:
+        logger.error(f"Unknown scheduled job: {job_name}")
+        return
+    return getattr(service, job_name)(*args)
+
+
+def earliest_days_until(appointments: List[Appointment], today) -> int:
+    """
+    จำนวนวันถึงนัดหมายที่ใกล้ที่สุดซึ่งยังไม่ผ่าน (ใช้จัดลำดับผู้รับในรอบส่ง)
+    
+    Returns:
+        int: วันที่น้อยที่สุด (>= 0) หรือ sys.maxsize หากมีแต่นัดที่ผ่านไปแล้ว
+    """
+    return min((days for days in (days_until(apt, today) for apt in appointments) if days >= 0),
+               default=sys.maxsize)
+
+
+def _build_jobstore(db_path: str = None):
+    """สร้าง job store ใน local SQLite เพื่อให้ job และเวลารันถัดไปอยู่รอดข้าม restart"""
+    path = db_path or local_db.LOCAL_DB_PATH
+    if path == ':memory:':
+        return MemoryJobStore()
+    if not SQLALCHEMY_JOBSTORE_AVAILABLE:
+        logger.warning("SQLAlchemy not installed - scheduler jobs will not survive restarts")
+        return MemoryJobStore()
+    return SQLAlchemyJobStore(url=f"sqlite:///{os.path.abspath(path)}", tablename='apscheduler_jobs')
+
 
 class NotificationService:
     """
@@ -28,118 +103,489 @@ class NotificationService:
     รองรับการแจ้งเตือนล่วงหน้า 7 วัน และ 1 วัน
     """
     
-    def __init__(self, line_bot_api: MessagingApi):
+    def __init__(self, line_bot_api: MessagingApi, sheets_repo: SheetsRepository = None,
+                 outbox: PushOutbox = None, run_state: RunStateStore = None,
+                 jobstore_path: str = None, quota: QuotaTracker = None,
+                 digest_history: DigestHistory = None):
         """
         Initialize NotificationService
         
         Args:
             line_bot_api (MessagingApi): LINE Bot API instance
+            sheets_repo (SheetsRepository): repository ที่จะใช้ (ค่าเริ่มต้นสร้างใหม่จาก environment)
+            outbox (PushOutbox): outbox สำหรับ push (ค่าเริ่มต้นใช้ outbox ร่วมของ process)
+            run_state (RunStateStore): ledger ของรอบที่ส่งเสร็จแล้ว (ค่าเริ่มต้นใช้ LOCAL_DB_PATH)
+            jobstore_path (str): path ของ SQLite สำหรับ scheduler jobs (ค่าเริ่มต้น LOCAL_DB_PATH)
+            quota (QuotaTracker): ตัวติดตามโควตา push (ค่าเริ่มต้นใช้ LOCAL_DB_PATH)
+            digest_history (DigestHistory): fingerprint ของ digest ที่ส่งล่าสุด (ค่าเริ่มต้นใช้ LOCAL_DB_PATH)
         """
         self.line_bot_api = line_bot_api
-        self.scheduler = BackgroundScheduler(timezone=BANGKOK_TZ)
-        self.sheets_repo = SheetsRepository()
-        self._notification_running = False  # ป้องกันการรันซ้ำ
-        
-        # ตั้งค่า scheduler ให้ทำงานทุกวันเวลา 09:00
-        self.scheduler.add_job(
-            func=self.check_and_send_notifications,
-            trigger=CronTrigger(hour=9, minute=0, timezone=BANGKOK_TZ),
-            id='daily_notification_check',
-            name='Daily Notification Check',
-            replace_existing=True,
-            max_instances=1  # จำกัดให้รันได้แค่ instance เดียว
+        # coalesce: รอบที่พลาดหลายครั้งรวมเป็นครั้งเดียว, grace: รันย้อนหลังได้ไม่เกินช่วงที่กำหนด
+        self.scheduler = BackgroundScheduler(
+            timezone=BANGKOK_TZ,
+            jobstores={'default': _build_jobstore(jobstore_path)},
+            job_defaults={
+                'coalesce': True,
+                'misfire_grace_time': NOTIFICATION_MISFIRE_GRACE_SECONDS,
+                'max_instances': 1
+            }
         )
+        self.sheets_repo = sheets_repo or SheetsRepository()
+        self.outbox = outbox or get_outbox()
+        self.run_state = run_state or RunStateStore()
+        # โควตา push รายเดือน - นับจาก push ที่ outbox ส่งสำเร็จ
+        self.quota = quota or QuotaTracker(line_bot_api)
+        self.digest_history = digest_history or DigestHistory()
+        # นับโควตาและบันทึก fingerprint ของ digest เมื่อ outbox ส่งสำเร็จ (ไม่ใช่ตอน enqueue)
+        self.outbox.add_sent_listener(self._on_push_sent)
+        self.metrics = get_run_metrics()
+        self.missed_runs: List[Dict[str, Any]] = []
+        self.run_batch_size = NOTIFICATION_RUN_BATCH_SIZE
+        self.run_lease_seconds = NOTIFICATION_RUN_LEASE_SECONDS
+        self._synced_buckets = set()  # bucket ที่มี job อยู่ใน job store แล้ว
+        self._running_buckets = set()  # ป้องกันการรัน bucket เดียวกันซ้ำ
+        self._running_lock = threading.Lock()
+        self._stopping = threading.Event()  # graceful shutdown: หยุดรอบที่กำลังส่งที่ขอบ batch
+        
+        # Agenda ต่อผู้รับที่อัปเดตจาก change feed แทนการอ่าน Sheets ใหม่ทุกรอบ
+        self.agenda = MaterializedAgenda()
+        # เวลารับการแจ้งเตือนต่อผู้รับ - หนึ่ง job ต่อ delivery bucket
+        self.delivery_schedule = DeliverySchedule()
+        change_feed.subscribe(self._on_change)
+        
+        logger.info("NotificationService initialized with per-recipient delivery buckets (Bangkok time)")
+    
+    def _on_change(self, event):
+        """Subscriber ของ change feed - แยก event การตั้งค่าออกจาก event นัดหมาย"""
+        if event.op == 'settings':
+            self.delivery_schedule.set_preference(
+                event.fields.get('recipient_id', ''),
+                event.fields.get('delivery_time', '')
+            )
+            self._sync_delivery_jobs()
+        else:
+            self.agenda.apply(event)
+    
+    def _load_delivery_settings(self):
+        """
+        โหลดเวลาที่ผู้รับตั้งไว้จาก Google Sheets แล้วปรับ bucket jobs
+        แตะ job store เฉพาะเมื่อชุดของ bucket เปลี่ยน (เมธอดนี้ถูกเรียกจาก job thread ด้วย)
+        """
+        if self.sheets_repo.gc and self.sheets_repo.spreadsheet:
+            settings = self.sheets_repo.get_notification_settings()
+            if settings is None:
+                # อ่านไม่สำเร็จ - คงเวลาเดิมไว้ ไม่ย้ายทุกกลุ่มกลับไปช่วงค่าเริ่มต้น
+                logger.warning("Could not read notification settings - keeping current delivery times")
+            else:
+                self.delivery_schedule.load(settings)
+        if self.delivery_schedule.occupied_buckets() != self._synced_buckets:
+            self._sync_delivery_jobs()
+    
+    def _sync_delivery_jobs(self):
+        """
+        สร้าง job สำหรับ bucket ที่มีผู้รับ และลบ job ของ bucket ที่ไม่มีผู้รับแล้ว
+        job ที่มีอยู่แล้วใน job store จะไม่ถูกแทนที่ เพื่อคงเวลารันถัดไป (และรอบที่พลาด) ไว้
+        """
+        if not self.scheduler.running:
+            return  # job store ยังไม่เปิด - start_scheduler จะเรียกอีกครั้ง
+        buckets = self.delivery_schedule.occupied_buckets()
+        existing = {job.id for job in self.scheduler.get_jobs() if job.id.startswith('notification_bucket_')}
+        
+        for bucket in sorted(buckets):
+            job_id = f"notification_bucket_{bucket.replace(':', '')}"
+            if job_id in existing:
+                existing.discard(job_id)
+                continue
+            hour, minute = (int(part) for part in bucket.split(':'))
+            self.scheduler.add_job(
+                func=_SCHEDULED_JOB_REF,
+                trigger=CronTrigger(hour=hour, minute=minute, timezone=BANGKOK_TZ),
+                args=['check_and_send_notifications', bucket],
+                id=job_id,
+                name=f'Notification Bucket {bucket}',
+                replace_existing=True,
+                max_instances=1  # จำกัดให้รันได้แค่ instance เดียว
+            )
+        
+        for job_id in existing:
+            self.scheduler.remove_job(job_id)
+        self._synced_buckets = buckets
         
-        logger.info("NotificationService initialized with daily scheduler at 09:00 Bangkok time")
+        logger.info(f"Delivery buckets scheduled: {', '.join(sorted(buckets))}")
     
     def start_scheduler(self):
-        """เริ่มต้น background scheduler"""
+        """
+        เริ่มต้น background scheduler
+        
+        เริ่มแบบ paused ก่อนเพื่อโหลด job จาก job store และตรวจรอบที่พลาดไประหว่าง restart
+        (จาก job store และ run ledger) แล้วจึง resume - รอบที่พลาดภายใน NOTIFICATION_MISFIRE_GRACE_SECONDS
+        จะถูกรันหนึ่งครั้ง
+        """
+        global _active_service
         try:
-            if not self.scheduler.running:
-                self.scheduler.start()
-                logger.info("Notification scheduler started successfully")
-            else:
+            if self.scheduler.running:
                 logger.info("Notification scheduler is already running")
+                return
+            _active_service = self
+            self._stopping.clear()
+            self.outbox.start(self.line_bot_api)
+            self.scheduler.start(paused=True)
+            
+            # Reconciliation scan เป็นระยะ เพื่อจับการแก้ไขที่ไม่ได้ผ่าน change feed (เช่นแก้ใน Sheets ตรง ๆ)
+            if not self.scheduler.get_job('agenda_reconciliation'):
+                self.scheduler.add_job(
+                    func=_SCHEDULED_JOB_REF,
+                    trigger=IntervalTrigger(hours=AGENDA_RECONCILE_INTERVAL_HOURS, timezone=BANGKOK_TZ),
+                    args=['reconcile_agenda'],
+                    id='agenda_reconciliation',
+                    name='Agenda Reconciliation Scan',
+                    max_instances=1
+                )
+            
+            self._load_delivery_settings()
+            self._detect_missed_runs()
+            self._schedule_interrupted_runs()
+            self.scheduler.resume()
+            logger.info("Notification scheduler started successfully")
         except Exception as e:
             logger.error(f"Failed to start notification scheduler: {e}")
     
-    def stop_scheduler(self):
-        """หยุด background scheduler"""
+    def _detect_missed_runs(self) -> List[Dict[str, Any]]:
+        """
+        หารอบของวันนี้ที่เวลาผ่านไปแล้วแต่ยังไม่ได้ส่ง (process ไม่ได้ทำงานตอนถึงเวลา)
+        
+        - job ใน job store ที่เวลารันถัดไปผ่านไปแล้ว: scheduler รันให้หนึ่งครั้งเมื่อ resume (misfire grace)
+        - bucket ที่เคยส่งเสร็จมาก่อน (last_completed) แต่ ledger ยังไม่มีรอบของวันนี้ทั้งที่เวลาผ่านไปแล้ว
+          (เช่น job store ถูกสร้างใหม่หลัง deploy จึงนัดเวลารันเป็นพรุ่งนี้): ตั้ง job ครั้งเดียวส่งย้อนหลังทันที
+        รอบที่ถูกจองแต่ไม่เสร็จเป็นหน้าที่ของ _schedule_interrupted_runs
+        
+        Returns:
+            List[Dict[str, Any]]: รายการ {'bucket', 'job_id', 'scheduled_for', 'last_completed', 'within_grace', 'catch_up'}
+        """
+        now = datetime.now(BANGKOK_TZ)
+        run_date = now.date().isoformat()
+        jobs = {job.id: job for job in self.scheduler.get_jobs() if job.id.startswith('notification_bucket_')}
+        interrupted = {run['bucket'] for run in self.run_state.interrupted_runs(run_date)}
+        missed = []
+        for bucket in sorted(self.delivery_schedule.occupied_buckets()):
+            job_id = f"notification_bucket_{bucket.replace(':', '')}"
+            job = jobs.get(job_id)
+            if job is not None and job.next_run_time is not None and job.next_run_time < now:
+                scheduled_for, catch_up = job.next_run_time, 'scheduler'
+            else:
+                hour, minute = (int(part) for part in bucket.split(':'))
+                scheduled_for, catch_up = now.replace(hour=hour, minute=minute, second=0, microsecond=0), 'ledger'
+                if (scheduled_for > now or bucket in interrupted
+                        or self.run_state.has_completed(bucket, run_date)):
+                    continue
+            last_completed = self.run_state.last_completed(bucket)
+            if catch_up == 'ledger' and last_completed is None:
+                continue  # bucket ใหม่ที่ยังไม่เคยส่ง - ไม่ใช่รอบที่พลาด
+            
+            within_grace = (now - scheduled_for).total_seconds() <= NOTIFICATION_MISFIRE_GRACE_SECONDS
+            missed.append({
+                'bucket': bucket,
+                'job_id': job_id,
+                'scheduled_for': scheduled_for.isoformat(),
+                'last_completed': last_completed,
+                'within_grace': within_grace,
+                'catch_up': catch_up
+            })
+            if not within_grace:
+                logger.warning(f"Missed run of bucket {bucket} at {scheduled_for} is past the grace period - skipped")
+                continue
+            if catch_up == 'ledger':
+                self._schedule_one_off('notification_catchup_', 'Catch-up', bucket, now)
+            logger.warning(f"Missed run of bucket {bucket} at {scheduled_for} (last completed {last_completed}) "
+                           f"- catching up now")
+        self.missed_runs = missed
+        return missed
+    
+    def _schedule_one_off(self, job_prefix: str, name: str, bucket: str, run_at: datetime):
+        """ตั้ง job ครั้งเดียวที่ส่งสรุปของ bucket (ใช้กับรอบย้อนหลังและรอบที่ทำต่อ)"""
+        self.scheduler.add_job(
+            func=_SCHEDULED_JOB_REF,
+            trigger='date',
+            run_date=run_at,
+            args=['check_and_send_notifications', bucket],
+            id=f"{job_prefix}{bucket.replace(':', '')}",
+            name=f"{name} Notification Bucket {bucket}",
+            replace_existing=True
+        )
+    
+    def _schedule_interrupted_runs(self) -> List[str]:
+        """
+        ตั้ง job ครั้งเดียวเพื่อทำต่อรอบของวันนี้ที่ถูกจองแต่ไม่เสร็จ (process หยุดกลางรอบ)
+        job จะรันเมื่อ lease ของ worker เดิมหมด - ถ้า worker เดิมยังทำงานอยู่ take_over จะไม่สำเร็จและข้ามไป
+        
+        Returns:
+            List[str]: bucket ที่ตั้ง job ทำต่อไว้
+        """
+        run_date = datetime.now(BANGKOK_TZ).date().isoformat()
+        resumed = []
+        for run in self.run_state.interrupted_runs(run_date):
+            resume_at = max(datetime.now(BANGKOK_TZ),
+                            datetime.fromtimestamp(run['heartbeat_at'] + self.run_lease_seconds, BANGKOK_TZ))
+            self._schedule_one_off('notification_resume_', 'Resume', run['bucket'], resume_at)
+            logger.warning(f"Run of bucket {run['bucket']} for {run_date} was interrupted - resuming at {resume_at}")
+            resumed.append(run['bucket'])
+        return resumed
+    
+    def stop_scheduler(self, timeout: float = 0):
+        """
+        หยุด background scheduler
+        
+        Args:
+            timeout (float): เวลารอรอบที่กำลังส่งหยุดที่ขอบ batch (วินาที, 0 = ไม่รอ)
+                รอบที่หยุดกลางทางถูก suspend ไว้ให้ process ถัดไปทำต่อจาก batch ที่ยังไม่เสร็จ
+        """
+        global _active_service
+        self._stopping.set()
         try:
+            if _active_service is self:
+                _active_service = None
             if self.scheduler.running:
-                self.scheduler.shutdown()
+                # ไม่รอ job ที่กำลังรัน: shutdown ถือ lock ของ job store ไว้ระหว่างรอ
+                # ส่วน job (เช่น reconcile) อาจต้องใช้ job store - รอกันเองจน deadlock
+                self.scheduler.shutdown(wait=False)
                 logger.info("Notification scheduler stopped")
+            change_feed.unsubscribe(self._on_change)
         except Exception as e:
             logger.error(f"Failed to stop notification scheduler: {e}")
+        
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._running_lock:
+                if not self._running_buckets:
+                    break
+            time.sleep(0.05)
+        with self._running_lock:
+            if self._running_buckets:
+                logger.warning(f"Notification runs still in progress at shutdown: {sorted(self._running_buckets)}")
     
-    def check_and_send_notifications(self):
+    def reconcile_agenda(self) -> bool:
+        """
+        อ่านนัดหมายทั้งหมดจาก Google Sheets แล้วสร้าง agenda ใหม่
+        
+        Returns:
+            bool: True หาก reconcile สำเร็จ
+        """
+        if not self.sheets_repo.gc or not self.sheets_repo.spreadsheet:
+            logger.error("Google Sheets not connected - cannot reconcile agenda")
+            return False
+        
+        with self.metrics.run('reconcile'):
+            self.agenda.begin_reconcile()
+            try:
+                all_appointments = self._get_all_appointments()
+                with self.metrics.stage(STAGE_GROUPING):
+                    self.agenda.finish_reconcile(all_appointments)
+                self.metrics.count('appointments_read', len(all_appointments))
+                self._load_delivery_settings()
+                return True
+            except Exception as e:
+                self.agenda.abort_reconcile()
+                self.metrics.error('reconcile')
+                logger.error(f"Agenda reconciliation failed: {e}", exc_info=True)
+                return False
+    
+    def _on_push_sent(self, recipient_id: str, message_count: int, dedup_key: str = None):
+        """sent listener ของ outbox: นับโควตา และยืนยัน digest ที่ส่งแล้ว (ใช้ข้าม digest ที่ไม่เปลี่ยน)"""
+        self.quota.record_push(recipient_id, message_count)
+        if dedup_key and dedup_key.startswith('digest:'):
+            self.digest_history.confirm(dedup_key)
+    
+    async def reconcile_agenda_async(self, sheets_client) -> bool:
+        """
+        reconcile agenda บน event loop ของ ASGI mode (storage.async_sheets.AsyncSheetsClient)
+        อ่านทุก worksheet ใน batchGet เดียวแทนการอ่านทีละ worksheet ผ่าน gspread
+        
+        Returns:
+            bool: True หาก reconcile สำเร็จ
+        """
+        with self.metrics.run('reconcile', label='async'):
+            self.agenda.begin_reconcile()
+            try:
+                with self.metrics.stage(STAGE_SHEET_READS):
+                    all_appointments = await sheets_client.read_all_appointments()
+                with self.metrics.stage(STAGE_GROUPING):
+                    self.agenda.finish_reconcile(all_appointments)
+                self.metrics.count('appointments_read', len(all_appointments))
+                return True
+            except Exception as e:
+                self.agenda.abort_reconcile()
+                self.metrics.error('reconcile')
+                logger.error(f"Async agenda reconciliation failed: {e}", exc_info=True)
+                return False
+    
+    def _ensure_agenda_fresh(self) -> bool:
+        """Reconcile agenda ถ้ายังไม่เคยโหลด ถูก mark stale หรือเก่ากว่า AGENDA_MAX_AGE_HOURS"""
+        last = self.agenda.last_reconciled_at
+        too_old = last is None or datetime.now() - last > timedelta(hours=AGENDA_MAX_AGE_HOURS)
+        if self.agenda.is_stale or too_old:
+            logger.info("Agenda is stale or not loaded - running reconciliation scan")
+            return self.reconcile_agenda()
+        return True
+    
+    def check_and_send_notifications(self, bucket: str = None):
         """
         ตรวจสอบการนัดหมายและส่งการแจ้งเตือน
-        ฟังก์ชันนี้จะถูกเรียกทุกวันเวลา 09:00
+        ฟังก์ชันนี้จะถูกเรียกทุกวันตามเวลาของแต่ละ delivery bucket
         แจ้งเตือนทุกนัดหมายที่มีอยู่ทุกวัน
+        
+        Args:
+            bucket (str): delivery bucket 'HH:MM' ที่จะส่ง (None = ส่งให้ผู้รับทุกราย)
         """
+        # บันทึกเวลาต่อขั้นตอนของรอบไว้ใน run metrics (ดูได้ที่ /notification-metrics)
+        with self.metrics.run('notification', label=bucket or 'all'):
+            self._check_and_send_notifications(bucket)
+    
+    def _check_and_send_notifications(self, bucket: str = None):
         # ป้องกันการรันซ้ำ
-        if self._notification_running:
-            logger.warning("Notification check already running, skipping...")
-            return
+        run_key = bucket or 'all'
+        with self._running_lock:
+            if run_key in self._running_buckets:
+                logger.warning(f"Notification check for {run_key} already running, skipping...")
+                return
+            self._running_buckets.add(run_key)
         
-        self._notification_running = True
+        run_date = datetime.now(BANGKOK_TZ).date().isoformat()
+        # จองรอบ (bucket, วันที่) ก่อนส่ง - รอบ catch-up หลัง restart หรือ worker อื่น
+        # ที่ใช้ job store เดียวกันจะจองไม่ได้และข้ามไป เว้นแต่รอบเดิมหยุดกลางทางเกิน lease
+        claimed = bool(bucket)
+        if bucket and not self.run_state.claim(bucket, run_date):
+            if not self.run_state.take_over(bucket, run_date, self.run_lease_seconds):
+                logger.info(f"Bucket {bucket} already claimed for {run_date}, skipping")
+                self.metrics.count('skipped_already_claimed')
+                with self._running_lock:
+                    self._running_buckets.discard(run_key)
+                return
+            logger.warning(f"Resuming interrupted run of bucket {bucket} for {run_date}")
+            claimed = False  # รอบที่รับช่วงอาจส่งไปแล้วบางส่วน - ห้ามปล่อยการจอง
         
         try:
             logger.info("="*50)
-            logger.info("Starting daily notification check...")
+            logger.info(f"Starting daily notification check (bucket: {run_key})...")
             logger.info(f"Current time: {datetime.now(BANGKOK_TZ)}")
             
-            # ตรวจสอบ Google Sheets connection
-            if not self.sheets_repo.gc or not self.sheets_repo.spreadsheet:
-                logger.error("Google Sheets not connected - cannot send notifications")
+            # ใช้ agenda ที่คำนวณไว้ล่วงหน้า (reconcile เฉพาะเมื่อจำเป็น)
+            if not self._ensure_agenda_fresh() and not self.agenda.is_loaded:
+                logger.error("Agenda not available - cannot send notifications")
+                if claimed:
+                    self.run_state.release(bucket, run_date)
                 return
             
-            logger.info("Google Sheets connected successfully")
-            
-            # ดึงการนัดหมายทั้งหมดจาก Google Sheets
-            all_appointments = self._get_all_appointments()
-            
-            if not all_appointments:
+            with self.metrics.stage(STAGE_GROUPING):
+                appointments_by_recipient = self.agenda.snapshot()
+                plan = self.run_state.load_plan(bucket, run_date) if bucket else []
+                if plan:
+                    # ทำต่อจากแผนเดิม - ผู้รับตามแผน (ที่ยังมีนัดหมายอยู่) แทนการคำนวณ bucket ใหม่
+                    planned = {recipient_id for _, batch, _ in plan for recipient_id in batch}
+                    appointments_by_recipient = {r: a for r, a in appointments_by_recipient.items() if r in planned}
+                elif bucket:
+                    recipients = self.delivery_schedule.recipients_in_bucket(bucket, appointments_by_recipient)
+                    appointments_by_recipient = {r: appointments_by_recipient[r] for r in recipients}
+            
+            if not appointments_by_recipient:
                 logger.warning("No appointments found for notification")
-                logger.info("Checked both personal and group contexts")
+                if bucket:
+                    self.run_state.mark_completed(bucket, run_date, 0)
                 return
             
-            logger.info(f"Found {len(all_appointments)} appointments to process")
+            total = sum(len(appointments) for appointments in appointments_by_recipient.values())
+            logger.info(f"Found {total} appointments for {len(appointments_by_recipient)} recipients in agenda")
             
-            # เรียงลำดับนัดหมายจากใกล้ที่สุดไปไกลที่สุด
             now = datetime.now(BANGKOK_TZ)
-            all_appointments.sort(key=lambda apt: apt.appointment_datetime)
-            logger.info("Sorted appointments from nearest to farthest")
-            
-            # จัดกลุ่มนัดหมายตาม group_id/user_id
-            appointments_by_recipient = {}
-            for appointment in all_appointments:
-                recipient_id = appointment.group_id
-                if recipient_id not in appointments_by_recipient:
-                    appointments_by_recipient[recipient_id] = []
-                appointments_by_recipient[recipient_id].append(appointment)
             
             notifications_sent = 0
-            
-            # ส่งการแจ้งเตือนแยกตาม recipient
-            for recipient_id, appointments in appointments_by_recipient.items():
-                try:
-                    self._send_daily_notification_summary(appointments, recipient_id, now)
-                    notifications_sent += len(appointments)
-                    logger.info(f"Notification summary sent to {recipient_id} for {len(appointments)} appointments")
-                    
-                except Exception as e:
-                    logger.error(f"Error sending notification summary to {recipient_id}: {e}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-            
-            logger.info(f"Daily notification check completed. Sent {notifications_sent} notifications")
+            digests_skipped = 0
+            # ตั้งแต่จุดนี้อาจมีข้อความเข้า outbox แล้ว - ห้ามปล่อยการจองแม้รอบจะล้มเหลว
+            claimed = False
+            
+            if not plan:
+                with self.metrics.stage(STAGE_GROUPING):
+                    plan = self._plan_run(appointments_by_recipient, now)
+                if bucket:
+                    self.run_state.save_plan(bucket, run_date, [batch for _, batch, _ in plan])
+            self.metrics.count('recipients', len(appointments_by_recipient))
+            
+            # งบ push ของวันใช้ร่วมกันทุก bucket - เทียบจำนวน request ของ batch ที่ยังไม่ได้ส่งกับงบที่เหลือ
+            quota_mode = QUOTA_MODE_NORMAL
+            if self.quota.allowance_left(now.date()) is not None:
+                pending = [recipient_id for _, batch, done in plan if not done for recipient_id in batch]
+                quota_mode = self.quota.plan(
+                    self._planned_requests(appointments_by_recipient, pending, now), now.date())
+            
+            # ส่งทีละ batch ตามแผน แล้ว checkpoint - worker ที่รับช่วงจะข้าม batch ที่เสร็จแล้ว
+            for batch_index, batch, done in plan:
+                if done:
+                    continue
+                if self._stopping.is_set() and bucket:
+                    # process กำลังปิด - batch ที่เหลือให้ process ถัดไปทำต่อทันที
+                    self.run_state.suspend(bucket, run_date)
+                    logger.warning(f"Run of bucket {bucket} suspended at batch {batch_index} for shutdown")
+                    self.metrics.count('runs_suspended')
+                    return
+                for recipient_id in batch:
+                    appointments = appointments_by_recipient.get(recipient_id)
+                    if not appointments:
+                        continue
+                    try:
+                        if self._send_daily_notification_summary(appointments, recipient_id, now, quota_mode):
+                            notifications_sent += len(appointments)
+                            logger.info(f"Notification summary sent to {recipient_id} for {len(appointments)} appointments")
+                        else:
+                            digests_skipped += 1
+                        
+                    except Exception as e:
+                        logger.error(f"Error sending notification summary to {recipient_id}: {e}")
+                        self.metrics.error('digest')
+                        import traceback
+                        logger.error(traceback.format_exc())
+                if bucket:
+                    self.run_state.complete_batch(bucket, run_date, batch_index)
+            
+            logger.info(f"Daily notification check completed. Sent {notifications_sent} notifications, "
+                        f"skipped {digests_skipped} digests (quota mode: {quota_mode})")
+            self.metrics.count('appointments_notified', notifications_sent)
+            self.metrics.count('digests_skipped', digests_skipped)
+            if bucket:
+                self.run_state.mark_completed(bucket, run_date, len(appointments_by_recipient))
             
         except Exception as e:
             logger.error(f"Error in daily notification check: {e}", exc_info=True)
+            self.metrics.error('run')
+            if claimed:
+                self.run_state.release(bucket, run_date)
         finally:
-            self._notification_running = False  # เสร็จแล้วปลดล็อก
+            with self._running_lock:
+                self._running_buckets.discard(run_key)  # เสร็จแล้วปลดล็อก
+    
+    def _plan_run(self, appointments_by_recipient: Dict[str, List[Appointment]],
+                  now: datetime) -> List[tuple]:
+        """
+        สร้างแผนการส่งของรอบ: เรียงผู้รับตามความเร่งด่วน (นัดใกล้ที่สุดก่อน)
+        แล้วแบ่งเป็น batch ละ run_batch_size ราย
+        
+        Returns:
+            List[tuple]: [(batch_index, [recipient_id, ...], False), ...]
+        """
+        send_queue = [(earliest_days_until(appointments, now.date()), recipient_id)
+                      for recipient_id, appointments in appointments_by_recipient.items()]
+        heapq.heapify(send_queue)
+        ordered = [heapq.heappop(send_queue)[1] for _ in range(len(send_queue))]
+        return [(index, ordered[start:start + self.run_batch_size], False)
+                for index, start in enumerate(range(0, len(ordered), self.run_batch_size))]
+    
+    def run_status(self, run_date: str = None) -> List[Dict[str, Any]]:
+        """
+        ความคืบหน้าของรอบแจ้งเตือนในวันที่กำหนด (ค่าเริ่มต้นวันนี้)
+        
+        Returns:
+            List[Dict[str, Any]]: สถานะต่อ bucket จาก run ledger
+        """
+        run_date = run_date or datetime.now(BANGKOK_TZ).date().isoformat()
+        return self.run_state.progress(run_date, self.run_lease_seconds)
     
     def _get_all_group_contexts(self):
         """หา group contexts ทั้งหมดจาก Google Sheets worksheets"""
@@ -153,7 +599,7 @@ class NotificationService:
                 return []
             
             group_contexts = []
-            worksheets = spreadsheet.worksheets()
+            worksheets = self.sheets_repo.breaker.call(spreadsheet.worksheets)
             
             for worksheet in worksheets:
                 worksheet_title = worksheet.title
@@ -187,16 +633,15 @@ class NotificationService:
             all_appointments = []
             logger.info("Starting to retrieve all appointments...")
             
-            # ดึงการนัดหมาย Personal
+            # ดึงการนัดหมาย Personal ของผู้ใช้ทุกคน - อ่าน appointments_personal ครั้งเดียว
             try:
                 logger.info("Attempting to retrieve personal appointments...")
-                personal_appointments = self.sheets_repo.get_appointments("", "personal")
-                if personal_appointments:
-                    all_appointments.extend(personal_appointments)
-                    logger.info(f"Retrieved {len(personal_appointments)} personal appointments")
-                    # Debug: แสดงรายละเอียด personal appointments
-                    for apt in personal_appointments:
-                        logger.info(f"Personal appointment: {apt.id} - {apt.note} - User: {apt.group_id}")
+                personal_by_user = self.sheets_repo.get_appointments_by_user("personal")
+                if personal_by_user:
+                    for user_id, personal_appointments in personal_by_user.items():
+                        all_appointments.extend(personal_appointments)
+                        logger.debug(f"Retrieved {len(personal_appointments)} personal appointments for {user_id}")
+                    logger.info(f"Retrieved personal appointments for {len(personal_by_user)} users")
                 else:
                     logger.info("No personal appointments found")
             except Exception as e:
@@ -207,7 +652,8 @@ class NotificationService:
             # ดึงการนัดหมาย Group - หาอัตโนมัติจาก worksheets
             try:
                 logger.info("Attempting to retrieve group appointments...")
-                group_contexts = self._get_all_group_contexts()
+                with self.metrics.stage(STAGE_WORKSHEET_DISCOVERY):
+                    group_contexts = self._get_all_group_contexts()
                 logger.info(f"Found {len(group_contexts)} group contexts")
                 
                 for group_info in group_contexts:
@@ -301,125 +747,105 @@ class NotificationService:
             logger.info(f"Sending notification to {appointment.group_id} for appointment {appointment.id}")
             logger.info(f"Message preview: {message[:100]}...")
             
-            self.line_bot_api.push_message(
-                PushMessageRequest(
-                    to=appointment.group_id,
-                    messages=[TextMessage(text=message)]
-                )
-            )
+            self.outbox.enqueue(appointment.group_id, [message])
             
-            logger.info(f"✅ Sent daily notification for appointment {appointment.id} to {appointment.group_id} (days_diff: {days_diff})")
+            logger.info(f"✅ Queued daily notification for appointment {appointment.id} to {appointment.group_id} (days_diff: {days_diff})")
             
         except Exception as e:
             logger.error(f"❌ Failed to send daily notification for appointment {appointment.id}: {e}")
             import traceback
             logger.error(traceback.format_exc())
 
-    def _send_daily_notification_summary(self, appointments: List[Appointment], recipient_id: str, current_time: datetime):
-        """ส่งสรุปการแจ้งเตือนรายวันสำหรับหลายนัดหมาย เรียงจากใกล้ที่สุดไปไกลที่สุด"""
+    def _planned_requests(self, appointments_by_recipient: Dict[str, List[Appointment]],
+                          recipients: List[str], now: datetime) -> int:
+        """
+        จำนวน push request ที่ digest ของผู้รับเหล่านี้จะใช้ในโหมดปกติ (ตาม pack_requests)
+        digest ที่ไม่เปลี่ยนและไม่มีนัดด่วนจะถูกข้ามจึงไม่นับ
+        """
+        total = 0
+        with self.metrics.stage(STAGE_RENDERING):
+            for recipient_id in recipients:
+                appointments = appointments_by_recipient.get(recipient_id)
+                if not appointments:
+                    continue
+                groups = classify_by_urgency(appointments, now.date())
+                if not groups[0] and self.digest_history.is_unchanged(
+                        recipient_id, digest_fingerprint(appointments), now.date()):
+                    continue
+                segments = render_digest_segments(groups, len(appointments), now,
+                                                  self.delivery_schedule.bucket_for(recipient_id), False)
+                total += len(pack_requests(segments))
+        return total
+    
+    def _send_daily_notification_summary(self, appointments: List[Appointment], recipient_id: str,
+                                         current_time: datetime, quota_mode: str = QUOTA_MODE_NORMAL) -> bool:
+        """
+        ส่งสรุปการแจ้งเตือนรายวันสำหรับหลายนัดหมาย เรียงจากใกล้ที่สุดไปไกลที่สุด
+        
+        Args:
+            quota_mode (str): QUOTA_MODE_URGENT_ONLY = โควตาใกล้หมด ส่งเฉพาะนัดวันนี้/พรุ่งนี้
+        
+        Returns:
+            bool: True หากส่ง digest เข้า outbox, False หากข้าม (ไม่เปลี่ยนจากครั้งก่อน/ไม่มีนัดด่วน)
+        """
         try:
             if not appointments:
-                return
-            
-            # สร้างหัวข้อข้อความ
-            total_appointments = len(appointments)
-            message = f"📋 สรุปนัดหมายประจำวัน ({total_appointments} รายการ)\n"
-            message += f"🕘 {current_time.strftime('%d/%m/%Y %H:%M')}\n\n"
-            
-            # จัดกลุ่มนัดหมายตามความเร่งด่วน
-            urgent_appointments = []      # วันนี้และพรุ่งนี้
-            upcoming_appointments = []    # สัปดาห์นี้ (2-7 วัน)
-            future_appointments = []      # อนาคต (>7 วัน)
-            past_appointments = []        # ที่ผ่านแล้ว
-            
-            for appointment in appointments:
-                appointment_date = appointment.appointment_datetime
-                if appointment_date.tzinfo is None:
-                    appointment_date = appointment_date.replace(tzinfo=BANGKOK_TZ)
-                
-                days_diff = (appointment_date.date() - current_time.date()).days
-                
-                if days_diff < 0:
-                    past_appointments.append((appointment, days_diff))
-                elif days_diff <= 1:
-                    urgent_appointments.append((appointment, days_diff))
-                elif days_diff <= 7:
-                    upcoming_appointments.append((appointment, days_diff))
-                else:
-                    future_appointments.append((appointment, days_diff))
-            
-            # แสดงนัดหมายด่วน (วันนี้/พรุ่งนี้)
-            if urgent_appointments:
-                message += "🚨 นัดหมายด่วน:\n"
-                for appointment, days_diff in urgent_appointments:
-                    if days_diff == 0:
-                        status_emoji = "🔥"
-                        status_text = "วันนี้"
-                    else:
-                        status_emoji = "⚡"
-                        status_text = "พรุ่งนี้"
-                    
-                    message += f"{status_emoji} {status_text} - {appointment.note}\n"
-                    message += f"   📅 {appointment.appointment_datetime.strftime('%H:%M')}"
-                    if appointment.location and appointment.location != "LINE Bot":
-                        message += f" ที่ {appointment.location}"
-                    if getattr(appointment, 'contact_person', None) and appointment.contact_person:
-                        message += f" พบ {appointment.contact_person}"
-                    message += f"\n   🆔 {appointment.id}\n\n"
-            
-            # แสดงนัดหมายสัปดาห์นี้
-            if upcoming_appointments:
-                message += "📅 สัปดาห์นี้:\n"
-                for appointment, days_diff in upcoming_appointments:
-                    message += f"🔴 ในอีก {days_diff} วัน - {appointment.note}\n"
-                    message += f"   📅 {appointment.appointment_datetime.strftime('%d/%m/%Y %H:%M')}"
-                    if appointment.location and appointment.location != "LINE Bot":
-                        message += f" ที่ {appointment.location}"
-                    message += f"\n   🆔 {appointment.id}\n\n"
-            
-            # แสดงนัดหมายในอนาคต (จำกัด 3 รายการแรก)
-            if future_appointments:
-                message += "🟡 นัดหมายถัดไป:\n"
-                for appointment, days_diff in future_appointments[:3]:
-                    message += f"📅 ในอีก {days_diff} วัน - {appointment.note}\n"
-                    message += f"   📅 {appointment.appointment_datetime.strftime('%d/%m/%Y %H:%M')}"
-                    if appointment.location and appointment.location != "LINE Bot":
-                        message += f" ที่ {appointment.location}"
-                    message += f"\n   🆔 {appointment.id}\n\n"
-                
-                if len(future_appointments) > 3:
-                    message += f"   และอีก {len(future_appointments) - 3} นัดหมาย...\n\n"
-            
-            # แสดงนัดหมายที่ผ่านแล้ว (จำกัด 2 รายการล่าสุด)
-            if past_appointments:
-                message += "⚪ ที่ผ่านมา:\n"
-                # เรียงจากล่าสุดก่อน
-                past_appointments.sort(key=lambda x: x[1], reverse=True)
-                for appointment, days_diff in past_appointments[:2]:
-                    message += f"⏰ เมื่อ {abs(days_diff)} วันที่แล้ว - {appointment.note}\n"
-                    message += f"   🆔 {appointment.id}\n\n"
-            
-            # เพิ่ม footer
-            message += "💡 พิมพ์ 'ดูนัด' เพื่อดูรายละเอียดทั้งหมด\n"
-            message += "🔔 ระบบแจ้งเตือนอัตโนมัติทุกวัน 09:00 น."
+                return False
+            
+            # จัดกลุ่มนัดหมายตามความเร่งด่วน: วันนี้/พรุ่งนี้, สัปดาห์นี้, อนาคต, ที่ผ่านแล้ว
+            with self.metrics.stage(STAGE_RENDERING):
+                groups = classify_by_urgency(appointments, current_time.date())
+                fingerprint = digest_fingerprint(appointments)
+            urgent_appointments = groups[0]
+            
+            # ประหยัดโควตา push: ข้าม digest ที่เหมือนครั้งก่อน เว้นแต่มีนัดด่วน
+            urgent_only = quota_mode == QUOTA_MODE_URGENT_ONLY
+            if not urgent_appointments:
+                if urgent_only:
+                    logger.info(f"Skipping digest for {recipient_id} - quota low and no urgent appointments")
+                    return False
+                if self.digest_history.is_unchanged(recipient_id, fingerprint, current_time.date()):
+                    logger.info(f"Skipping digest for {recipient_id} - unchanged since last digest")
+                    return False
+            
+            total_appointments = len(urgent_appointments) if urgent_only else len(appointments)
+            with self.metrics.stage(STAGE_RENDERING):
+                segments = render_digest_segments(groups, total_appointments, current_time,
+                                                  self.delivery_schedule.bucket_for(recipient_id), urgent_only)
+                # digest ยาวถูกแบ่งตามนัดหมายเป็นหลายข้อความ (request ละไม่เกิน 5 ข้อความ) แทนการตัดทิ้ง
+                requests = pack_requests(segments)
             
             # ส่งข้อความแจ้งเตือน
-            logger.info(f"Sending daily summary to {recipient_id} for {total_appointments} appointments")
-            logger.info(f"Summary preview: {message[:200]}...")
-            
-            self.line_bot_api.push_message(
-                PushMessageRequest(
-                    to=recipient_id,
-                    messages=[TextMessage(text=message)]
-                )
-            )
-            
-            logger.info(f"✅ Sent daily notification summary to {recipient_id}")
+            logger.info(f"Sending daily summary to {recipient_id} for {total_appointments} appointments "
+                        f"({sum(len(texts) for texts in requests)} messages in {len(requests)} requests)")
+            logger.info(f"Summary preview: {requests[0][0][:200]}...")
+            
+            # digest ที่มีนัดด่วนถูกส่งออกจาก outbox ก่อน digest อื่นภายใต้ rate limit เดียวกัน
+            dedup_key = f"digest:{current_time.date().isoformat()}:{recipient_id}"
+            if not urgent_only:
+                # fingerprint มีผลเมื่อ outbox ส่ง request แรกสำเร็จ (_on_push_sent)
+                self.digest_history.expect(dedup_key, recipient_id, fingerprint, current_time.date())
+            queued = 0
+            with self.metrics.stage(STAGE_QUEUEING):
+                for index, texts in enumerate(requests):
+                    queued += self.outbox.enqueue(
+                        recipient_id,
+                        texts,
+                        dedup_key=dedup_key if index == 0 else f"{dedup_key}:{index}",
+                        priority=PRIORITY_URGENT if urgent_appointments else PRIORITY_BULK
+                    )
+            self.quota.spend(queued, current_time.date())
+            self.metrics.count('digests_queued')
+            self.metrics.count('digest_requests', len(requests))
+            
+            logger.info(f"✅ Queued daily notification summary to {recipient_id}")
+            return True
             
         except Exception as e:
             logger.error(f"❌ Failed to send daily notification summary to {recipient_id}: {e}")
             import traceback
             logger.error(traceback.format_exc())
+            return False
 
 
 
@@ -434,17 +860,13 @@ class NotificationService:
 ⏰ เวลาปัจจุบัน: {datetime.now(BANGKOK_TZ).strftime('%d/%m/%Y %H:%M:%S')}
 
 📋 ระบบจะแจ้งเตือน:
-• 🗓️ 7 วันก่อนนัดหมาย (09:00 น.)
-• ⏰ 1 วันก่อนนัดหมาย (09:00 น.)"""
+• 🗓️ 7 วันก่อนนัดหมาย (ตามเวลาที่ตั้งไว้)
+• ⏰ 1 วันก่อนนัดหมาย (ตามเวลาที่ตั้งไว้)"""
             
-            self.line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=test_message)]
-                )
-            )
+            if not self.outbox.enqueue(user_id, [test_message]):
+                return False
             
-            logger.info(f"Sent test notification to user {user_id}")
+            logger.info(f"Queued test notification to user {user_id}")
             return True
             
         except Exception as e:
@@ -494,6 +916,11 @@ class NotificationService:
             logger.warning("   ❌ No appointments found")
             return
         
+        # 2.5 ตรวจสอบ Materialized Agenda
+        logger.info("\n2.5. Materialized Agenda:")
+        for key, value in self.agenda.stats().items():
+            logger.info(f"   📒 {key}: {value}")
+        
         # 3. ตรวจสอบ Scheduler
         logger.info("\n3. Scheduler Status:")
         logger.info(f"   ⏰ Running: {self.scheduler.running}")
@@ -506,7 +933,8 @@ class NotificationService:
         logger.info("\n4. Test Summary:")
         if all_appointments and self.sheets_repo.gc:
             logger.info("   ✅ System ready for notifications")
-            logger.info("   💡 Next check: 09:00 Bangkok time daily")
+            buckets = ', '.join(sorted(self.delivery_schedule.occupied_buckets()))
+            logger.info(f"   💡 Delivery buckets (Bangkok time): {buckets}")
         else:
             logger.warning("   ❌ System not ready - missing data or connection")
         
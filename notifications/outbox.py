@@ -0,0 +1,494 @@
+"""
+Durable push outbox สำหรับ LINE push messages
+ทุก push ถูกบันทึกลง SQLite ก่อน แล้ว sender loop จะทยอยส่งพร้อม retry/backoff
+ข้อความที่ส่งไม่สำเร็จเกินจำนวนครั้งที่กำหนดจะถูกย้ายไป dead-letter table
+ใน ASGI mode sender เป็น task บน event loop ที่ส่งผ่าน AsyncLineClient (start_async) แทน thread
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+
+from linebot.v3.messaging import PushMessageRequest, TextMessage
+
+from storage import local_db
+from utils.run_metrics import get_run_metrics
+from utils.circuit_breaker import get_circuit_breaker, LINE_API
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BASE_BACKOFF_SECONDS = float(os.getenv('OUTBOX_BASE_BACKOFF_SECONDS', 5))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_MAX_BACKOFF_SECONDS', 900))
+# ระยะห่างขั้นต่ำระหว่าง push เพื่อกระจาย burst ให้อยู่ใน rate limit ของ LINE
+OUTBOX_SEND_INTERVAL_SECONDS = float(os.getenv('OUTBOX_SEND_INTERVAL_SECONDS', 0.05))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+# เก็บแถวที่ส่งแล้วไว้ช่วงหนึ่ง เพื่อให้ dedup_key กันการส่งซ้ำได้หลังส่งสำเร็จ (เช่นรันรอบเดิมซ้ำในวันเดียวกัน)
+OUTBOX_SENT_RETENTION_HOURS = float(os.getenv('OUTBOX_SENT_RETENTION_HOURS', 48))
+
+# ลำดับความสำคัญ (ค่าน้อยส่งก่อน) - ข้อความตอบโต้ผู้ใช้ต้องไม่ต่อคิวหลัง digest ตอนเช้า
+PRIORITY_INTERACTIVE = 0
+PRIORITY_URGENT = 5   # digest ที่มีนัดวันนี้/พรุ่งนี้
+PRIORITY_BULK = 10
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS push_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient_id TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    dedup_key TEXT UNIQUE,
+    retry_key TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT,
+    sent_at REAL,
+    priority INTEGER NOT NULL DEFAULT 10
+);
+CREATE TABLE IF NOT EXISTS push_dead_letter (
+    id INTEGER PRIMARY KEY,
+    recipient_id TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    dedup_key TEXT,
+    attempts INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL,
+    last_error TEXT
+);
+"""
+
+# ฐานข้อมูลที่สร้างก่อนมีคอลัมน์เหล่านี้จะถูกเพิ่มคอลัมน์ตอนเปิด
+_MIGRATIONS = {
+    'sent_at': "ALTER TABLE push_outbox ADD COLUMN sent_at REAL",
+    'priority': "ALTER TABLE push_outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 10",
+}
+
+_INDEXES = """
+DROP INDEX IF EXISTS idx_push_outbox_due;
+DROP INDEX IF EXISTS idx_push_outbox_pending;
+CREATE INDEX IF NOT EXISTS idx_push_outbox_queue ON push_outbox (priority, next_attempt_at, id) WHERE sent_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_push_outbox_sent ON push_outbox (sent_at) WHERE sent_at IS NOT NULL;
+"""
+
+
+def _is_retryable(error: Exception) -> bool:
+    """4xx (ยกเว้น 429) จาก LINE API ส่งซ้ำก็ไม่สำเร็จ - error อื่นถือว่าชั่วคราว"""
+    status = getattr(error, 'status', None)
+    if isinstance(status, int) and 400 <= status < 500:
+        return status == 429
+    return True
+
+
+class PushOutbox:
+    """
+    Outbox สำหรับ LINE push messages ที่เก็บใน SQLite
+
+    - enqueue() บันทึกข้อความ (idempotent ด้วย dedup_key) แล้วปลุก sender loop
+    - sender loop ส่งตาม priority แล้วตามลำดับเวลา, เว้นระยะระหว่าง push และ retry แบบ exponential backoff
+    - แถวที่ส่งแล้วถูก mark sent และเก็บไว้ OUTBOX_SENT_RETENTION_HOURS เพื่อให้ dedup ยังมีผล
+    - ใช้ X-Line-Retry-Key ต่อข้อความ เพื่อไม่ให้การ retry ส่งซ้ำถ้า LINE รับไปแล้ว
+    """
+
+    def __init__(self, db_path: str = None,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 base_backoff: float = OUTBOX_BASE_BACKOFF_SECONDS,
+                 max_backoff: float = OUTBOX_MAX_BACKOFF_SECONDS,
+                 send_interval: float = OUTBOX_SEND_INTERVAL_SECONDS,
+                 sent_retention_hours: float = OUTBOX_SENT_RETENTION_HOURS):
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.send_interval = send_interval
+        self.sent_retention = sent_retention_hours * 3600
+        self.line_bot_api = None
+        self.breaker = get_circuit_breaker(LINE_API)
+        self.sent_total = 0
+        self.failed_total = 0
+        self._conn = local_db.connect(db_path)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._interactive_waiting = threading.Event()
+        self._sent_listeners: List[Callable[[str, int, Optional[str]], None]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # ASGI mode: sender task บน event loop (start_async)
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_wakeup: Optional[asyncio.Event] = None
+        self._async_done: Optional[threading.Event] = None
+        self._last_purge = 0.0
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(push_outbox)")}
+            for column, statement in _MIGRATIONS.items():
+                if column not in columns:
+                    self._conn.execute(statement)
+            self._conn.executescript(_INDEXES)
+
+    # ------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------
+    def enqueue(self, recipient_id: str, texts: List[str], dedup_key: str = None,
+                priority: int = PRIORITY_BULK) -> bool:
+        """
+        บันทึกข้อความที่จะ push
+
+        Args:
+            recipient_id (str): LINE Group ID หรือ User ID
+            texts (List[str]): ข้อความที่จะส่งใน PushMessageRequest เดียวกัน
+            dedup_key (str): key สำหรับกันการ enqueue ซ้ำ (เช่น 'digest:2025-10-01:Cxxx')
+                มีผลทั้งกับข้อความที่ยังรอส่งและที่ส่งไปแล้วภายในช่วง retention
+            priority (int): PRIORITY_INTERACTIVE สำหรับข้อความตอบโต้ผู้ใช้ (ส่งก่อน digest)
+
+        Returns:
+            bool: True หากบันทึกใหม่, False หากมี dedup_key นี้อยู่แล้วหรือบันทึกไม่สำเร็จ
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        now = time.time()
+        try:
+            with self._lock:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO push_outbox "
+                    "(recipient_id, messages, dedup_key, retry_key, next_attempt_at, created_at, priority) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (recipient_id, json.dumps(texts, ensure_ascii=False), dedup_key,
+                     str(uuid.uuid4()), now, now, priority)
+                )
+                inserted = cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Failed to enqueue push to {recipient_id}: {e}")
+            return False
+
+        if inserted:
+            if priority <= PRIORITY_INTERACTIVE:
+                self._interactive_waiting.set()
+            self._wake()
+        else:
+            logger.info(f"Push to {recipient_id} already queued (dedup_key: {dedup_key})")
+        return inserted
+
+    def add_sent_listener(self, callback: Callable[[str, int, Optional[str]], None]):
+        """ลงทะเบียน callback(recipient_id, message_count, dedup_key) ที่จะถูกเรียกหลัง push สำเร็จแต่ละครั้ง"""
+        if callback not in self._sent_listeners:
+            self._sent_listeners.append(callback)
+
+    # ------------------------------------------------------------------
+    # Sender side
+    # ------------------------------------------------------------------
+    def start(self, line_bot_api):
+        """เริ่ม sender loop ใน background thread"""
+        self.line_bot_api = line_bot_api
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='push-outbox-sender', daemon=True)
+        self._thread.start()
+        logger.info("Push outbox sender started")
+
+    def start_async(self, client):
+        """
+        ASGI mode: หยุด sender thread แล้วส่งผ่าน AsyncLineClient ใน task บน event loop ที่กำลังรัน
+        push ใช้ connection pool แบบ keep-alive เดียวกับ reply และไม่ใช้ thread ระหว่างรอ LINE API
+
+        Args:
+            client (AsyncLineClient): client ของ event loop นี้
+        """
+        if self._thread and self._thread.is_alive():
+            self.stop()
+        self._stop.clear()
+        self._async_loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+        self._async_done = threading.Event()
+        self._async_loop.create_task(self._run_async(client))
+        logger.info("Push outbox sender started on the event loop")
+
+    def stop(self, timeout: float = 10.0):
+        """หยุด sender loop (ข้อความที่ค้างอยู่ยังอยู่ในฐานข้อมูล)"""
+        self._stop.set()
+        self._wake()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._async_done is not None and not self._on_event_loop():
+            self._async_done.wait(timeout)
+        logger.info("Push outbox sender stopped")
+
+    def _wake(self):
+        self._wakeup.set()
+        loop = self._async_loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._async_wakeup.set)
+            except RuntimeError:
+                pass  # event loop ปิดแล้ว
+
+    def _on_event_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._async_loop
+        except RuntimeError:
+            return False
+
+    def _sender_running(self) -> bool:
+        if self._async_done is not None and not self._async_done.is_set():
+            return True
+        return bool(self._thread and self._thread.is_alive() and self.line_bot_api is not None)
+
+    def drain(self, timeout: float) -> dict:
+        """
+        graceful shutdown: ให้ sender ส่งข้อความที่ถึงกำหนดแล้วต่อจนหมดหรือครบ timeout แล้วหยุด
+        ข้อความที่เหลืออยู่ในฐานข้อมูลและถูกส่งโดย process ถัดไป (retry key เดิมกันการส่งซ้ำ)
+
+        Returns:
+            dict: stats() หลังหยุด
+        """
+        deadline = time.time() + timeout
+        while self._sender_running() and not self.breaker.is_open() and time.time() < deadline:
+            if self._seconds_until_next_due() > 0:
+                break  # ไม่มีข้อความที่ถึงกำหนดแล้ว
+            self._wake()
+            time.sleep(0.05)
+        self.stop(timeout=max(0.5, deadline - time.time()))
+        stats = self.stats()
+        if stats['depth']:
+            logger.warning(f"{stats['depth']} push messages left in the outbox for the next process")
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = self.drain_once()
+            except Exception as e:
+                logger.error(f"Push outbox sender error: {e}", exc_info=True)
+                processed = 0
+            if processed == 0:
+                self._wakeup.wait(timeout=self._seconds_until_next_due())
+                self._wakeup.clear()
+
+    async def _run_async(self, client):
+        try:
+            while not self._stop.is_set():
+                try:
+                    processed = await self.drain_once_async(client)
+                except Exception as e:
+                    logger.error(f"Push outbox sender error: {e}", exc_info=True)
+                    processed = 0
+                if processed == 0:
+                    try:
+                        await asyncio.wait_for(self._async_wakeup.wait(), self._seconds_until_next_due())
+                    except asyncio.TimeoutError:
+                        pass
+                    self._async_wakeup.clear()
+        finally:
+            self._async_done.set()
+
+    def _seconds_until_next_due(self) -> float:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) AS due FROM push_outbox WHERE sent_at IS NULL"
+            ).fetchone()
+        if not row or row['due'] is None:
+            return 60.0
+        # ระหว่างที่วงจรของ LINE API เปิดอยู่ไม่มีอะไรส่งได้ - รอจนถึงเวลาทดสอบ
+        return min(60.0, max(0.0, row['due'] - time.time(), self.breaker.seconds_until_retry()))
+
+    def drain_once(self, limit: int = OUTBOX_BATCH_SIZE) -> int:
+        """
+        ส่งข้อความที่ถึงกำหนดหนึ่งชุด
+
+        Returns:
+            int: จำนวนข้อความที่ประมวลผล (สำเร็จหรือไม่ก็ตาม)
+        """
+        if self.line_bot_api is None:
+            return 0
+
+        rows = self._due_rows(limit)
+        for index, row in enumerate(rows):
+            if self._stop.is_set():
+                return index
+            if index and row['priority'] > PRIORITY_INTERACTIVE and self._interactive_waiting.is_set():
+                return index  # มีข้อความตอบโต้เข้ามาระหว่าง batch - เริ่ม batch ใหม่เพื่อส่งก่อน
+            if index and self.send_interval:
+                time.sleep(self.send_interval)
+            if not self.breaker.allow_request():
+                return index  # LINE API ไม่พร้อม - ไม่นับเป็น attempt ข้อความยังรออยู่ในคิว
+            self._send_row(row)
+        return len(rows)
+
+    async def drain_once_async(self, client, limit: int = OUTBOX_BATCH_SIZE) -> int:
+        """
+        เหมือน drain_once แต่ส่งผ่าน AsyncLineClient และเว้นระยะด้วย asyncio.sleep (ASGI mode)
+
+        Returns:
+            int: จำนวนข้อความที่ประมวลผล (สำเร็จหรือไม่ก็ตาม)
+        """
+        rows = self._due_rows(limit)
+        for index, row in enumerate(rows):
+            if self._stop.is_set():
+                return index
+            if index and row['priority'] > PRIORITY_INTERACTIVE and self._interactive_waiting.is_set():
+                return index
+            if index and self.send_interval:
+                await asyncio.sleep(self.send_interval)
+            if not self.breaker.allow_request():
+                return index
+            texts = json.loads(row['messages'])
+            started = time.perf_counter()
+            try:
+                await client.push(row['recipient_id'], texts, retry_key=row['retry_key'])
+            except Exception as e:
+                self._complete_row(row, texts, time.perf_counter() - started, e)
+                continue
+            self._complete_row(row, texts, time.perf_counter() - started)
+        return len(rows)
+
+    def _due_rows(self, limit: int):
+        self._purge_sent()
+        self._interactive_waiting.clear()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM push_outbox WHERE sent_at IS NULL AND next_attempt_at <= ? "
+                "ORDER BY priority, next_attempt_at, id LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+
+    def _send_row(self, row):
+        texts = json.loads(row['messages'])
+        started = time.perf_counter()
+        try:
+            self.line_bot_api.push_message(
+                PushMessageRequest(
+                    to=row['recipient_id'],
+                    messages=[TextMessage(text=text) for text in texts]
+                ),
+                x_line_retry_key=row['retry_key']
+            )
+        except Exception as e:
+            self._complete_row(row, texts, time.perf_counter() - started, e)
+            return
+        self._complete_row(row, texts, time.perf_counter() - started)
+
+    def _complete_row(self, row, texts: List[str], seconds: float, error: Exception = None):
+        """บันทึกผลของ push หนึ่งครั้ง (เวลา, circuit breaker, sent/retry/dead-letter และ sent listeners)"""
+        if error is None:
+            get_run_metrics().record_push(seconds)
+            self.breaker.record_success()
+        else:
+            self.breaker.record_error(error)
+            status = getattr(error, 'status', None)
+            get_run_metrics().record_push(seconds, error=str(status) if status else type(error).__name__)
+            if status == 409:
+                # LINE รับข้อความที่มี retry key นี้ไปแล้ว
+                logger.info(f"Push {row['id']} already accepted by LINE (409)")
+            else:
+                self._record_failure(row, error)
+                return
+
+        with self._lock:
+            self._conn.execute("UPDATE push_outbox SET sent_at = ? WHERE id = ?", (time.time(), row['id']))
+        self.sent_total += 1
+        logger.info(f"✅ Outbox push {row['id']} sent to {row['recipient_id']}")
+        for callback in list(self._sent_listeners):
+            try:
+                callback(row['recipient_id'], len(texts), row['dedup_key'])
+            except Exception as e:
+                logger.error(f"Outbox sent listener failed: {e}")
+
+    def _purge_sent(self):
+        """ลบแถวที่ส่งแล้วและเกินช่วง retention (อย่างมากชั่วโมงละครั้ง)"""
+        now = time.time()
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM push_outbox WHERE sent_at IS NOT NULL AND sent_at < ?",
+                (now - self.sent_retention,)
+            )
+
+    def _record_failure(self, row, error: Exception):
+        attempts = row['attempts'] + 1
+        last_error = str(error)[:500]
+        self.failed_total += 1
+
+        if attempts >= self.max_attempts or not _is_retryable(error):
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO push_dead_letter "
+                        "(id, recipient_id, messages, dedup_key, attempts, created_at, failed_at, last_error) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (row['id'], row['recipient_id'], row['messages'], row['dedup_key'],
+                         attempts, row['created_at'], time.time(), last_error)
+                    )
+                    self._conn.execute("DELETE FROM push_outbox WHERE id = ?", (row['id'],))
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            logger.error(f"❌ Outbox push {row['id']} to {row['recipient_id']} dead-lettered "
+                         f"after {attempts} attempts: {last_error}")
+            return
+
+        backoff = min(self.max_backoff, self.base_backoff * (2 ** (attempts - 1)))
+        backoff *= random.uniform(0.8, 1.2)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE push_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + backoff, last_error, row['id'])
+            )
+        logger.warning(f"Outbox push {row['id']} to {row['recipient_id']} failed (attempt {attempts}), "
+                       f"retrying in {backoff:.1f}s: {last_error}")
+
+    # ------------------------------------------------------------------
+    # Introspection
+    # ------------------------------------------------------------------
+    def stats(self) -> dict:
+        """ความลึกของคิว, อายุของข้อความที่เก่าที่สุด และจำนวน dead letters"""
+        now = time.time()
+        with self._lock:
+            queue = self._conn.execute(
+                "SELECT COUNT(*) AS depth, MIN(created_at) AS oldest, "
+                "SUM(CASE WHEN next_attempt_at <= ? THEN 1 ELSE 0 END) AS due, "
+                "SUM(CASE WHEN attempts > 0 THEN 1 ELSE 0 END) AS retrying "
+                "FROM push_outbox WHERE sent_at IS NULL", (now,)
+            ).fetchone()
+            dead = self._conn.execute("SELECT COUNT(*) AS count FROM push_dead_letter").fetchone()
+
+        return {
+            'depth': queue['depth'],
+            'due': queue['due'] or 0,
+            'retrying': queue['retrying'] or 0,
+            'oldest_age_seconds': round(now - queue['oldest'], 1) if queue['oldest'] else 0,
+            'dead_letters': dead['count'],
+            'sent_total': self.sent_total,
+            'failed_attempts_total': self.failed_total,
+            'sender_running': self._sender_running()
+        }
+
+    def dead_letters(self, limit: int = 20) -> List[dict]:
+        """รายการ dead letters ล่าสุด"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, recipient_id, attempts, created_at, failed_at, last_error "
+                "FROM push_dead_letter ORDER BY failed_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+_outbox: Optional[PushOutbox] = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> PushOutbox:
+    """คืน PushOutbox ที่ใช้ร่วมกันทั้ง process (สร้างเมื่อเรียกครั้งแรก)"""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = PushOutbox()
+        return _outbox
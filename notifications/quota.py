@@ -0,0 +1,299 @@
+"""
+ติดตามโควตา push message ของ LINE และประวัติ digest ที่ส่งไปแล้ว
+push ทุกข้อความนับรวมในโควตารายเดือนของ channel - ระบบแจ้งเตือนจึงข้าม digest ที่ไม่เปลี่ยน
+และลดเหลือเฉพาะนัดด่วนเมื่อโควตาใกล้หมด
+"""
+
+import calendar
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Iterable, Optional
+
+from storage import local_db
+
+logger = logging.getLogger(__name__)
+
+# ความถี่ในการถาม quota API ของ LINE (ระหว่างนั้นใช้ตัวนับ local)
+QUOTA_REFRESH_MINUTES = int(os.getenv('QUOTA_REFRESH_MINUTES', 60))
+# สัดส่วนของโควตาที่กันไว้ให้ข้อความตอบโต้ผู้ใช้ (ไม่ใช้กับ digest)
+QUOTA_RESERVE_RATIO = float(os.getenv('QUOTA_RESERVE_RATIO', 0.1))
+# digest ที่เนื้อหาไม่เปลี่ยนจะถูกข้าม แต่ส่งซ้ำอย่างน้อยทุกกี่วัน
+DIGEST_RESEND_DAYS = int(os.getenv('DIGEST_RESEND_DAYS', 3))
+
+QUOTA_MODE_NORMAL = 'normal'
+QUOTA_MODE_URGENT_ONLY = 'urgent_only'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS push_quota_usage (
+    month TEXT PRIMARY KEY,
+    pushes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS push_quota_day (
+    day TEXT PRIMARY KEY,
+    allowance INTEGER NOT NULL,
+    spent INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS digest_fingerprints (
+    recipient_id TEXT PRIMARY KEY,
+    digest_hash TEXT NOT NULL,
+    sent_date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS digest_pending (
+    dedup_key TEXT PRIMARY KEY,
+    recipient_id TEXT NOT NULL,
+    digest_hash TEXT NOT NULL,
+    sent_date TEXT NOT NULL
+);
+"""
+
+
+def digest_fingerprint(appointments: Iterable) -> str:
+    """
+    Hash ของข้อมูลนัดหมายใน digest (ไม่รวมเวลาส่งและจำนวนวันที่เหลือ ซึ่งเปลี่ยนทุกวัน)
+
+    Args:
+        appointments (Iterable[Appointment]): นัดหมายของผู้รับ
+
+    Returns:
+        str: sha1 hex digest
+    """
+    digest = hashlib.sha1()
+    for appointment in sorted(appointments, key=lambda apt: apt.id):
+        digest.update('\x1f'.join((
+            appointment.id,
+            appointment.datetime_iso,
+            appointment.location or '',
+            appointment.building_floor_dept or '',
+            getattr(appointment, 'contact_person', '') or '',
+            getattr(appointment, 'phone_number', '') or '',
+            appointment.note or ''
+        )).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+class QuotaTracker:
+    """
+    ประเมินโควตา push ที่เหลือของเดือนนี้
+
+    ใช้ตัวนับ local (push ที่ outbox ส่งสำเร็จ) ระหว่างรอบ และปรับให้ตรงกับ
+    get_message_quota / get_message_quota_consumption ของ LINE ทุก QUOTA_REFRESH_MINUTES
+    (LINE นับ push เข้ากลุ่มตามจำนวนสมาชิก ตัวนับ local จึงเป็นค่าขั้นต่ำเท่านั้น)
+
+    งบของ digest ต่อวันถูกกำหนดครั้งแรกที่วางแผนในวันนั้น แล้วทุก delivery bucket ใช้งบเดียวกัน
+    (spend) - รอบหลังของวันเห็นเฉพาะงบที่เหลือ ไม่ใช่งบทั้งวัน
+    """
+
+    def __init__(self, line_bot_api=None, db_path: str = None,
+                 refresh_minutes: int = QUOTA_REFRESH_MINUTES,
+                 reserve_ratio: float = QUOTA_RESERVE_RATIO):
+        self.line_bot_api = line_bot_api
+        self.refresh_seconds = refresh_minutes * 60
+        self.reserve_ratio = reserve_ratio
+        self._limit: Optional[int] = None
+        self._api_usage: Optional[int] = None
+        self._local_at_refresh = 0
+        self._refreshed_at = 0.0
+        self._conn = local_db.connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    @staticmethod
+    def _month(now: datetime = None) -> str:
+        return (now or datetime.now()).strftime('%Y-%m')
+
+    def record_push(self, recipient_id: str = None, message_count: int = 1, dedup_key: str = None):
+        """
+        นับ push ที่ส่งสำเร็จ (ใช้เป็น sent listener ของ PushOutbox)
+        นับตามจำนวนข้อความใน request - ค่าประเมินแบบระมัดระวังที่ไม่ต่ำกว่าที่ LINE นับ
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO push_quota_usage (month, pushes) VALUES (?, ?) "
+                "ON CONFLICT (month) DO UPDATE SET pushes = pushes + excluded.pushes",
+                (self._month(), max(1, message_count))
+            )
+
+    def local_usage(self, now: datetime = None) -> int:
+        """จำนวน push ที่นับได้เองในเดือนนี้"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT pushes FROM push_quota_usage WHERE month = ?", (self._month(now),)
+            ).fetchone()
+        return row['pushes'] if row else 0
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        อ่านโควตาและการใช้งานจาก LINE API (ถ้าครบรอบ refresh หรือ force)
+
+        Returns:
+            bool: True หากได้ข้อมูลล่าสุดจาก API
+        """
+        if self.line_bot_api is None:
+            return False
+        if not force and time.time() - self._refreshed_at < self.refresh_seconds:
+            return False
+        try:
+            quota = self.line_bot_api.get_message_quota()
+            consumption = self.line_bot_api.get_message_quota_consumption()
+        except Exception as e:
+            logger.warning(f"Could not read LINE message quota - using local counter: {e}")
+            return False
+
+        self._limit = quota.value if str(getattr(quota.type, 'value', quota.type)) == 'limited' else None
+        self._api_usage = consumption.total_usage
+        self._local_at_refresh = self.local_usage()
+        self._refreshed_at = time.time()
+        logger.info(f"LINE message quota: {self._api_usage}/{self._limit if self._limit is not None else 'unlimited'}")
+        return True
+
+    def usage(self) -> int:
+        """การใช้งานโดยประมาณ = ค่าจาก API ล่าสุด + push ที่นับได้หลังจากนั้น"""
+        local = self.local_usage()
+        if self._api_usage is None:
+            return local
+        return max(local, self._api_usage + local - self._local_at_refresh)
+
+    def remaining(self) -> Optional[int]:
+        """โควตาที่เหลือ (None = ไม่จำกัดหรือยังไม่รู้ค่า)"""
+        if self._limit is None:
+            return None
+        return max(0, self._limit - self.usage())
+
+    def daily_budget(self, today: date) -> Optional[int]:
+        """จำนวน push ที่ใช้กับ digest ได้วันนี้ โดยเฉลี่ยโควตาที่เหลือ (หักส่วนที่กันไว้) ตามวันที่เหลือของเดือน"""
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        usable = max(0, remaining - int(self._limit * self.reserve_ratio))
+        days_left = calendar.monthrange(today.year, today.month)[1] - today.day + 1
+        return usable // days_left
+
+    def allowance_left(self, today: date) -> Optional[int]:
+        """
+        งบ push ของ digest ที่เหลือวันนี้ (None = ไม่จำกัด)
+        งบของวันถูกบันทึกครั้งแรกที่เรียก - ไม่เกินงบที่คำนวณใหม่จากโควตาที่เหลือ
+        (กรณีโควตาถูกใช้จากทางอื่น เช่น push เข้ากลุ่มที่ LINE นับตามจำนวนสมาชิก)
+        """
+        self.refresh()
+        budget = self.daily_budget(today)
+        if budget is None:
+            return None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO push_quota_day (day, allowance, spent) VALUES (?, ?, 0)",
+                (today.isoformat(), budget)
+            )
+            row = self._conn.execute(
+                "SELECT allowance, spent FROM push_quota_day WHERE day = ?", (today.isoformat(),)
+            ).fetchone()
+        return max(0, min(row['allowance'] - row['spent'], budget))
+
+    def spend(self, requests: int, today: date):
+        """หักงบของวันด้วยจำนวน push request ของ digest ที่เพิ่ง enqueue"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE push_quota_day SET spent = spent + ? WHERE day = ?", (requests, today.isoformat())
+            )
+
+    def plan(self, planned_requests: int, today: date) -> str:
+        """
+        เลือกโหมดของรอบแจ้งเตือนตามงบที่เหลือของวันนี้
+
+        Args:
+            planned_requests (int): จำนวน push request ของ digest ที่รอบนี้จะส่งในโหมดปกติ
+
+        Returns:
+            str: QUOTA_MODE_NORMAL หรือ QUOTA_MODE_URGENT_ONLY
+        """
+        left = self.allowance_left(today)
+        if left is None or planned_requests <= left:
+            return QUOTA_MODE_NORMAL
+        logger.warning(f"Push quota budget low ({left} left today for {planned_requests} requests) "
+                       f"- sending urgent items only")
+        return QUOTA_MODE_URGENT_ONLY
+
+    def stats(self) -> dict:
+        with self._lock:
+            today = self._conn.execute(
+                "SELECT allowance, spent FROM push_quota_day WHERE day = ?", (date.today().isoformat(),)
+            ).fetchone()
+        return {
+            'limit': self._limit,
+            'usage': self.usage(),
+            'remaining': self.remaining(),
+            'local_usage_this_month': self.local_usage(),
+            'digest_allowance_today': today['allowance'] if today else None,
+            'digest_requests_today': today['spent'] if today else 0,
+            'refreshed_at': datetime.fromtimestamp(self._refreshed_at).isoformat() if self._refreshed_at else None
+        }
+
+
+class DigestHistory:
+    """
+    เก็บ fingerprint ของ digest ล่าสุดต่อผู้รับ เพื่อข้าม digest ที่เหมือนเมื่อวาน
+
+    digest ที่ enqueue ถูกบันทึกเป็น pending ตาม dedup_key ของ outbox (expect) และถือว่าส่งแล้ว
+    เมื่อ outbox ส่งสำเร็จ (confirm) - digest ที่ค้างหรือ dead-letter จึงไม่ทำให้ digest ถัดไปถูกข้าม
+    """
+
+    def __init__(self, db_path: str = None, resend_days: int = DIGEST_RESEND_DAYS):
+        self.resend_days = resend_days
+        self._conn = local_db.connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def is_unchanged(self, recipient_id: str, digest_hash: str, today: date) -> bool:
+        """True หาก digest เหมือนครั้งล่าสุดที่ส่ง และยังไม่ครบ resend_days"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest_hash, sent_date FROM digest_fingerprints WHERE recipient_id = ?",
+                (recipient_id,)
+            ).fetchone()
+        if not row or row['digest_hash'] != digest_hash:
+            return False
+        return (today - date.fromisoformat(row['sent_date'])).days < self.resend_days
+
+    def remember(self, recipient_id: str, digest_hash: str, today: date):
+        """บันทึก digest ที่เพิ่งส่ง"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digest_fingerprints (recipient_id, digest_hash, sent_date) VALUES (?, ?, ?)",
+                (recipient_id, digest_hash, today.isoformat())
+            )
+
+    def expect(self, dedup_key: str, recipient_id: str, digest_hash: str, today: date):
+        """บันทึก digest ที่ enqueue แล้วแต่ยังไม่ได้ส่ง (ลบรายการที่ค้างเกิน resend_days)"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM digest_pending WHERE sent_date < ?",
+                ((today - timedelta(days=self.resend_days)).isoformat(),)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digest_pending (dedup_key, recipient_id, digest_hash, sent_date) "
+                "VALUES (?, ?, ?, ?)",
+                (dedup_key, recipient_id, digest_hash, today.isoformat())
+            )
+
+    def confirm(self, dedup_key: str) -> bool:
+        """
+        ย้าย digest pending ของ dedup_key เป็น digest ล่าสุดของผู้รับ (เรียกเมื่อ outbox ส่งสำเร็จ)
+
+        Returns:
+            bool: True หากมี digest pending ของ dedup_key นี้
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT recipient_id, digest_hash, sent_date FROM digest_pending WHERE dedup_key = ?", (dedup_key,)
+            ).fetchone()
+            if not row:
+                return False
+            self._conn.execute("DELETE FROM digest_pending WHERE dedup_key = ?", (dedup_key,))
+        self.remember(row['recipient_id'], row['digest_hash'], date.fromisoformat(row['sent_date']))
+        return True
@@ -0,0 +1,262 @@
+"""
+สถานะของรอบแจ้งเตือนที่ต้องอยู่รอดข้าม restart
+เก็บใน local SQLite ร่วมกับ push outbox
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from storage import local_db
+
+logger = logging.getLogger(__name__)
+
+# จำนวนผู้รับต่อ batch ของแผนการส่ง - รอบที่หยุดกลางทางจะทำต่อจาก batch ที่เสร็จล่าสุด
+NOTIFICATION_RUN_BATCH_SIZE = int(os.getenv('NOTIFICATION_RUN_BATCH_SIZE', 50))
+# รอบที่ไม่มี heartbeat นานกว่านี้ถือว่า worker ตายแล้ว และ worker อื่นรับช่วงต่อได้
+NOTIFICATION_RUN_LEASE_SECONDS = int(os.getenv('NOTIFICATION_RUN_LEASE_SECONDS', 600))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notification_run_ledger (
+    bucket TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    claimed_at REAL NOT NULL,
+    completed_at REAL,
+    recipients INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, run_date)
+);
+CREATE TABLE IF NOT EXISTS notification_run_batches (
+    bucket TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    batch_index INTEGER NOT NULL,
+    recipients TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    completed_at REAL,
+    PRIMARY KEY (bucket, run_date, batch_index)
+);
+"""
+
+# คอลัมน์ที่เพิ่มภายหลังใน ledger เดิม
+_MIGRATIONS = {
+    'heartbeat_at': "ALTER TABLE notification_run_ledger ADD COLUMN heartbeat_at REAL",
+}
+
+# (batch_index, recipient ids, เสร็จแล้วหรือยัง)
+PlanBatch = Tuple[int, List[str], bool]
+
+
+class RunStateStore:
+    """
+    บันทึกรอบแจ้งเตือนต่อ (bucket, วันที่)
+    ใช้กันการส่งซ้ำเมื่อ scheduler catch-up รอบที่พลาดไปหลัง restart
+
+    รอบต้อง claim() แถวของตัวเองก่อนส่ง - primary key รับประกันว่ามีเพียง
+    ผู้เรียกเดียว (ข้าม thread และข้าม process ที่ใช้ไฟล์เดียวกัน) ที่ได้รันรอบนั้น
+
+    แผนการส่งของรอบถูกเก็บเป็น batch ของผู้รับพร้อม checkpoint ต่อ batch
+    worker ที่รับช่วงรอบที่ค้าง (take_over) จะส่งต่อจาก batch ที่ยังไม่เสร็จ
+    """
+
+    def __init__(self, db_path: str = None):
+        self._conn = local_db.connect(db_path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(notification_run_ledger)")}
+            for column, statement in _MIGRATIONS.items():
+                if column not in columns:
+                    self._conn.execute(statement)
+
+    def claim(self, bucket: str, run_date: str) -> bool:
+        """
+        จองรอบของ bucket ในวันที่กำหนดก่อนเริ่มส่ง
+
+        Returns:
+            bool: True หากจองสำเร็จ, False หากรอบนี้ถูกจองหรือส่งไปแล้ว
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO notification_run_ledger (bucket, run_date, claimed_at, heartbeat_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (bucket, run_date, now, now)
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def take_over(self, bucket: str, run_date: str, lease_seconds: float = NOTIFICATION_RUN_LEASE_SECONDS) -> bool:
+        """
+        รับช่วงรอบที่ถูกจองแต่ยังไม่เสร็จ และไม่มี heartbeat เกิน lease_seconds (worker เดิมหยุดไปแล้ว)
+
+        Returns:
+            bool: True หากรับช่วงสำเร็จ - ผู้เรียกต้องส่งต่อจาก batch ที่ยังไม่เสร็จ
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE notification_run_ledger SET claimed_at = ?, heartbeat_at = ? "
+                "WHERE bucket = ? AND run_date = ? AND completed_at IS NULL "
+                "AND COALESCE(heartbeat_at, claimed_at) < ?",
+                (now, now, bucket, run_date, now - lease_seconds)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, bucket: str, run_date: str):
+        """ยกเลิกการจองของรอบที่ยังไม่ได้ส่งอะไรออกไป เพื่อให้รันใหม่ได้"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM notification_run_ledger WHERE bucket = ? AND run_date = ? AND completed_at IS NULL",
+                (bucket, run_date)
+            )
+            if cursor.rowcount:
+                self._conn.execute(
+                    "DELETE FROM notification_run_batches WHERE bucket = ? AND run_date = ?",
+                    (bucket, run_date)
+                )
+
+    def save_plan(self, bucket: str, run_date: str, batches: List[List[str]]):
+        """
+        บันทึกแผนการส่งของรอบ (ผู้รับเรียงตามลำดับที่จะส่ง แบ่งเป็น batch)
+        แผนที่มีอยู่แล้วจะไม่ถูกแทนที่
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO notification_run_batches (bucket, run_date, batch_index, recipients, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(bucket, run_date, index, json.dumps(batch), len(batch)) for index, batch in enumerate(batches)]
+            )
+
+    def load_plan(self, bucket: str, run_date: str) -> List[PlanBatch]:
+        """แผนการส่งที่บันทึกไว้ เรียงตาม batch_index (ว่างหากยังไม่มีแผน)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT batch_index, recipients, completed_at FROM notification_run_batches "
+                "WHERE bucket = ? AND run_date = ? ORDER BY batch_index",
+                (bucket, run_date)
+            ).fetchall()
+        return [(row['batch_index'], json.loads(row['recipients']), row['completed_at'] is not None) for row in rows]
+
+    def complete_batch(self, bucket: str, run_date: str, batch_index: int):
+        """checkpoint: batch นี้ส่งเข้า outbox ครบแล้ว (และต่ออายุ lease ของรอบ)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE notification_run_batches SET completed_at = ? "
+                "WHERE bucket = ? AND run_date = ? AND batch_index = ?",
+                (now, bucket, run_date, batch_index)
+            )
+            self._conn.execute(
+                "UPDATE notification_run_ledger SET heartbeat_at = ? WHERE bucket = ? AND run_date = ?",
+                (now, bucket, run_date)
+            )
+
+    def suspend(self, bucket: str, run_date: str):
+        """
+        worker หยุดรอบกลางทางเอง (graceful shutdown) - ล้าง heartbeat เพื่อให้ process ถัดไป
+        รับช่วงต่อได้ทันทีโดยไม่ต้องรอ lease หมด
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE notification_run_ledger SET heartbeat_at = 0 "
+                "WHERE bucket = ? AND run_date = ? AND completed_at IS NULL",
+                (bucket, run_date)
+            )
+
+    def interrupted_runs(self, run_date: str) -> List[Dict]:
+        """รอบของวันที่กำหนดที่ถูกจองแต่ยังไม่เสร็จ พร้อมเวลา heartbeat ล่าสุด"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT bucket, COALESCE(heartbeat_at, claimed_at) AS heartbeat_at FROM notification_run_ledger "
+                "WHERE run_date = ? AND completed_at IS NULL ORDER BY bucket",
+                (run_date,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def progress(self, run_date: str, lease_seconds: float = NOTIFICATION_RUN_LEASE_SECONDS) -> List[Dict]:
+        """
+        ความคืบหน้าของทุกรอบในวันที่กำหนด (สำหรับ status endpoint)
+
+        Returns:
+            List[Dict]: {'bucket', 'status' (completed/running/stalled), 'batches_total', 'batches_done',
+                         'recipients_total', 'recipients_done', 'progress_percent', ...}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT l.bucket, l.claimed_at, l.completed_at, COALESCE(l.heartbeat_at, l.claimed_at) AS heartbeat_at, "
+                "COUNT(b.batch_index) AS batches_total, COUNT(b.completed_at) AS batches_done, "
+                "COALESCE(SUM(b.size), 0) AS recipients_total, "
+                "COALESCE(SUM(CASE WHEN b.completed_at IS NOT NULL THEN b.size ELSE 0 END), 0) AS recipients_done "
+                "FROM notification_run_ledger l LEFT JOIN notification_run_batches b "
+                "ON b.bucket = l.bucket AND b.run_date = l.run_date "
+                "WHERE l.run_date = ? GROUP BY l.bucket ORDER BY l.bucket",
+                (run_date,)
+            ).fetchall()
+
+        now = time.time()
+        runs = []
+        for row in rows:
+            completed = row['completed_at'] is not None
+            if completed:
+                status = 'completed'
+            elif now - row['heartbeat_at'] > lease_seconds:
+                status = 'stalled'
+            else:
+                status = 'running'
+            if completed:
+                percent = 100.0
+            elif row['recipients_total']:
+                percent = round(100.0 * row['recipients_done'] / row['recipients_total'], 1)
+            else:
+                percent = 0.0
+            runs.append({
+                'bucket': row['bucket'],
+                'run_date': run_date,
+                'status': status,
+                'batches_total': row['batches_total'],
+                'batches_done': row['batches_done'],
+                'recipients_total': row['recipients_total'],
+                'recipients_done': row['recipients_done'],
+                'progress_percent': percent,
+                'claimed_at': row['claimed_at'],
+                'heartbeat_at': row['heartbeat_at'],
+                'completed_at': row['completed_at']
+            })
+        return runs
+
+    def has_completed(self, bucket: str, run_date: str) -> bool:
+        """True หาก bucket นี้ส่งสรุปของวันที่กำหนดไปแล้ว"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM notification_run_ledger "
+                "WHERE bucket = ? AND run_date = ? AND completed_at IS NOT NULL",
+                (bucket, run_date)
+            ).fetchone()
+        return row is not None
+
+    def mark_completed(self, bucket: str, run_date: str, recipients: int = 0):
+        """บันทึกว่า bucket นี้ส่งสรุปของวันที่กำหนดเสร็จแล้ว"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO notification_run_ledger (bucket, run_date, claimed_at, completed_at, recipients) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (bucket, run_date) DO UPDATE SET completed_at = excluded.completed_at, "
+                "recipients = excluded.recipients",
+                (bucket, run_date, now, now, recipients)
+            )
+
+    def last_completed(self, bucket: str) -> Optional[str]:
+        """วันที่ล่าสุดที่ bucket นี้ส่งสรุปเสร็จ"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(run_date) AS run_date FROM notification_run_ledger "
+                "WHERE bucket = ? AND completed_at IS NOT NULL",
+                (bucket,)
+            ).fetchone()
+        return row['run_date'] if row else None
@@ -0,0 +1,233 @@
+"""
+Simulation backends สำหรับทดสอบและวัดประสิทธิภาพระบบแจ้งเตือน
+จำลอง LINE MessagingApi และ Google Sheets (ระดับ gspread) โดยไม่ต้องเชื่อมต่อจริง
+"""
+
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import pytz
+from linebot.v3.messaging import MessageQuotaResponse, QuotaConsumptionResponse, QuotaType
+
+from storage.sheets_repo import SheetsRepository
+
+BANGKOK_TZ = pytz.timezone('Asia/Bangkok')
+
+SHEET_HEADERS = [
+    'id', 'group_id', 'datetime_iso', 'location', 'building_floor_dept',
+    'contact_person', 'phone_number', 'note', 'lead_days', 'notified_flags',
+    'created_at', 'updated_at'
+]
+
+
+class FakeMessagingApi:
+    """MessagingApi จำลอง - บันทึกข้อความที่ push/reply แทนการส่งจริง"""
+
+    def __init__(self, push_latency: float = 0.0, quota_limit: int = None, quota_used: int = 0):
+        """
+        Args:
+            push_latency (float): เวลาหน่วงต่อการเรียก API (วินาที) เพื่อจำลอง network
+            quota_limit (int): โควตา push รายเดือน (None = ไม่จำกัด)
+            quota_used (int): จำนวน push ที่ใช้ไปแล้วก่อนเริ่มจำลอง
+        """
+        self.push_latency = push_latency
+        self.quota_limit = quota_limit
+        self.quota_used = quota_used
+        self.pushed = []
+        self.replied = []
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def push_message(self, push_message_request, *args, **kwargs):
+        if self.push_latency:
+            time.sleep(self.push_latency)
+        with self._lock:
+            self.calls['push_message'] += 1
+            self.quota_used += 1
+            self.pushed.append(push_message_request)
+
+    def reply_message(self, reply_message_request, *args, **kwargs):
+        if self.push_latency:
+            time.sleep(self.push_latency)
+        with self._lock:
+            self.calls['reply_message'] += 1
+            self.replied.append(reply_message_request)
+
+
+    def get_message_quota(self, *args, **kwargs):
+        with self._lock:
+            self.calls['get_message_quota'] += 1
+        if self.quota_limit is None:
+            return MessageQuotaResponse(type=QuotaType.NONE)
+        return MessageQuotaResponse(type=QuotaType.LIMITED, value=self.quota_limit)
+
+    def get_message_quota_consumption(self, *args, **kwargs):
+        with self._lock:
+            self.calls['get_message_quota_consumption'] += 1
+            return QuotaConsumptionResponse(total_usage=self.quota_used)
+
+
+class FakeWorksheet:
+    """gspread.Worksheet จำลองที่เก็บ records ไว้ในหน่วยความจำ"""
+
+    def __init__(self, title: str, records: List[dict], calls: Counter):
+        self.title = title
+        self._records = records
+        self._calls = calls
+
+    @property
+    def row_count(self) -> int:
+        return len(self._records) + 1
+
+    def get_all_records(self) -> List[dict]:
+        self._calls['get_all_records'] += 1
+        return [dict(record) for record in self._records]
+
+    def get_all_values(self) -> List[List[str]]:
+        self._calls['get_all_values'] += 1
+        return [list(SHEET_HEADERS)] + [[str(record.get(h, '')) for h in SHEET_HEADERS] for record in self._records]
+
+    def row_values(self, row: int) -> List[str]:
+        self._calls['row_values'] += 1
+        if row == 1:
+            return list(SHEET_HEADERS)
+        record = self._records[row - 2]
+        return [str(record.get(h, '')) for h in SHEET_HEADERS]
+
+    def append_row(self, values: List):
+        self._calls['append_row'] += 1
+        if list(values) == SHEET_HEADERS:
+            return
+        self._records.append(dict(zip(SHEET_HEADERS, values)))
+
+    def update_cell(self, row: int, col: int, value):
+        self._calls['update_cell'] += 1
+        self._records[row - 2][SHEET_HEADERS[col - 1]] = value
+
+    def delete_rows(self, index: int):
+        self._calls['delete_rows'] += 1
+        del self._records[index - 2]
+
+
+class FakeSpreadsheet:
+    """gspread.Spreadsheet จำลองที่นับจำนวนการเรียก API"""
+
+    def __init__(self, title: str = "Simulated Reminder Sheet"):
+        self.title = title
+        self.calls = Counter()
+        self._worksheets: Dict[str, FakeWorksheet] = {}
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 10, records: List[dict] = None):
+        self.calls['add_worksheet'] += 1
+        worksheet = FakeWorksheet(title, records or [], self.calls)
+        self._worksheets[title] = worksheet
+        return worksheet
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.calls['worksheet'] += 1
+        if title not in self._worksheets:
+            import gspread
+            raise gspread.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def worksheets(self) -> List[FakeWorksheet]:
+        self.calls['worksheets'] += 1
+        return list(self._worksheets.values())
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+class SimulatedSheetsRepository(SheetsRepository):
+    """SheetsRepository ที่ต่อกับ FakeSpreadsheet แทน Google Sheets จริง"""
+
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self._fake_spreadsheet = spreadsheet
+        super().__init__(spreadsheet_id='simulated')
+
+    def _initialize_connection(self):
+        self.gc = object()  # ค่าใด ๆ ที่ไม่ใช่ None เพื่อให้ repository ถือว่าเชื่อมต่อแล้ว
+        self.spreadsheet = self._fake_spreadsheet
+
+
+def build_simulated_service(line_api, sheets_repo: SheetsRepository, jobstore_path: str = ':memory:', **kwargs):
+    """
+    สร้าง NotificationService ที่เก็บสถานะ local ทั้งหมด (outbox, run ledger, โควตา, digest history)
+    ไว้ในหน่วยความจำ เพื่อไม่ให้การจำลอง/ทดสอบเขียนลง LOCAL_DB_PATH จริง
+
+    Args:
+        line_api: MessagingApi (หรือ FakeMessagingApi)
+        sheets_repo (SheetsRepository): repository ที่จะใช้
+        jobstore_path (str): path ของ scheduler job store
+        **kwargs: ส่งต่อให้ NotificationService เพื่อแทนค่าเริ่มต้น
+    """
+    from notifications.notification_service import NotificationService
+    from notifications.outbox import PushOutbox
+    from notifications.quota import DigestHistory, QuotaTracker
+    from notifications.run_state import RunStateStore
+
+    kwargs.setdefault('outbox', PushOutbox(db_path=':memory:', send_interval=0))
+    kwargs.setdefault('run_state', RunStateStore(':memory:'))
+    kwargs.setdefault('quota', QuotaTracker(line_api, db_path=':memory:'))
+    kwargs.setdefault('digest_history', DigestHistory(':memory:'))
+    return NotificationService(line_api, sheets_repo=sheets_repo, jobstore_path=jobstore_path, **kwargs)
+
+
+def build_dataset(groups: int, appointments_per_group: int, personal_users: int = 0,
+                  days_back: int = 3, days_ahead: int = 30, seed: int = 42) -> FakeSpreadsheet:
+    """
+    สร้าง spreadsheet จำลองพร้อมนัดหมายกระจายตามวันที่
+
+    Args:
+        groups (int): จำนวนกลุ่ม (หนึ่ง worksheet ต่อกลุ่ม)
+        appointments_per_group (int): จำนวนนัดหมายต่อกลุ่ม/ต่อผู้ใช้
+        personal_users (int): จำนวนผู้ใช้ส่วนตัวใน appointments_personal
+        days_back (int): กระจายนัดหมายย้อนหลังได้กี่วัน
+        days_ahead (int): กระจายนัดหมายล่วงหน้าได้กี่วัน
+        seed (int): random seed เพื่อให้ผลซ้ำได้
+
+    Returns:
+        FakeSpreadsheet: spreadsheet จำลอง
+    """
+    rng = random.Random(seed)
+    now = datetime.now(BANGKOK_TZ).replace(minute=0, second=0, microsecond=0)
+    spreadsheet = FakeSpreadsheet()
+
+    def make_records(owner_id: str) -> List[dict]:
+        records = []
+        for _ in range(appointments_per_group):
+            when = now + timedelta(days=rng.randint(-days_back, days_ahead), hours=rng.randint(-8, 8))
+            records.append({
+                'id': uuid.UUID(int=rng.getrandbits(128)).hex[:8],
+                'group_id': owner_id,
+                'datetime_iso': when.replace(tzinfo=None).isoformat(),
+                'location': rng.choice(['โรงพยาบาลจุฬา', 'ศิริราช', 'CentralWorld', '']),
+                'building_floor_dept': rng.choice(['อาคาร 1 ชั้น 3', 'แผนกหัวใจ', '']),
+                'contact_person': rng.choice(['หมอเอ', 'ดร.สมชาย', '']),
+                'phone_number': rng.choice(['02-419-7000', '']),
+                'note': rng.choice(['ตรวจสุขภาพ', 'ประชุมทีม', 'พบหมอ', 'ทำฟัน']),
+                'lead_days': '[7, 3, 1]',
+                'notified_flags': '[False, False, False]',
+                'created_at': now.isoformat(),
+                'updated_at': now.isoformat()
+            })
+        return records
+
+    for _ in range(groups):
+        group_id = 'C' + uuid.UUID(int=rng.getrandbits(128)).hex
+        spreadsheet.add_worksheet(f"appointments_group_{group_id}", records=make_records(group_id))
+
+    personal_records = []
+    for _ in range(personal_users):
+        user_id = 'U' + uuid.UUID(int=rng.getrandbits(128)).hex
+        personal_records.extend(make_records(user_id))
+    spreadsheet.add_worksheet("appointments_personal", records=personal_records)
+
+    spreadsheet.calls.clear()  # ไม่นับการสร้าง dataset
+    return spreadsheet
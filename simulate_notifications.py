@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Notification run simulator / benchmark
+รัน NotificationService.check_and_send_notifications กับ LINE API และ Google Sheets จำลอง
+แล้วรายงานเวลา, จำนวน push ต่อวินาที, จำนวนการเรียก Sheets และหน่วยความจำสูงสุด
+
+ตัวอย่าง:
+    python simulate_notifications.py --groups 200 --appointments 20
+    python simulate_notifications.py --groups 50 --personal-users 100 --runs 3 --json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate and benchmark a daily notification run")
+    parser.add_argument('--groups', type=int, default=100, help="จำนวนกลุ่ม (worksheet ต่อกลุ่ม)")
+    parser.add_argument('--appointments', type=int, default=10, help="จำนวนนัดหมายต่อกลุ่ม/ผู้ใช้")
+    parser.add_argument('--personal-users', type=int, default=0, help="จำนวนผู้ใช้ใน appointments_personal")
+    parser.add_argument('--days-back', type=int, default=3, help="กระจายนัดหมายย้อนหลังกี่วัน")
+    parser.add_argument('--days-ahead', type=int, default=30, help="กระจายนัดหมายล่วงหน้ากี่วัน")
+    parser.add_argument('--push-latency-ms', type=float, default=0.0, help="latency จำลองต่อ push (ms)")
+    parser.add_argument('--quota-limit', type=int, default=None, help="โควตา push รายเดือนจำลอง (ค่าเริ่มต้นไม่จำกัด)")
+    parser.add_argument('--quota-used', type=int, default=0, help="จำนวน push ที่ใช้ไปแล้วในเดือนนี้")
+    parser.add_argument('--runs', type=int, default=1, help="จำนวนรอบที่รันต่อเนื่อง (รอบแรกเป็น cold run)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help="แสดงผลเป็น JSON")
+    parser.add_argument('--verbose', action='store_true', help="แสดง log ของ service ระหว่างรัน")
+    return parser.parse_args(argv)
+
+
+def run_simulation(args) -> dict:
+    """สร้าง dataset จำลองแล้วรันรอบแจ้งเตือนตามจำนวนที่กำหนด"""
+    from notifications.outbox import PushOutbox
+    from notifications.quota import DigestHistory
+    from notifications.simulation import (FakeMessagingApi, SimulatedSheetsRepository, build_dataset,
+                                          build_simulated_service)
+
+    spreadsheet = build_dataset(
+        groups=args.groups,
+        appointments_per_group=args.appointments,
+        personal_users=args.personal_users,
+        days_back=args.days_back,
+        days_ahead=args.days_ahead,
+        seed=args.seed
+    )
+    line_api = FakeMessagingApi(push_latency=args.push_latency_ms / 1000.0,
+                                quota_limit=args.quota_limit, quota_used=args.quota_used)
+    service = build_simulated_service(line_api, SimulatedSheetsRepository(spreadsheet))
+
+    results = []
+    try:
+        for run_index in range(args.runs):
+            pushes_before = line_api.calls['push_message']
+            spreadsheet.calls.clear()
+            # outbox และ digest history ใหม่ทุกรอบ - ไม่เช่นนั้นรอบที่สองในวันเดียวกันจะถูก dedup/ข้ามทั้งหมด
+            outbox = PushOutbox(db_path=':memory:', send_interval=0)
+            outbox.line_bot_api = line_api  # drain แบบ synchronous ภายในรอบที่วัดผล
+            outbox.add_sent_listener(service.quota.record_push)
+            service.outbox = outbox
+            service.digest_history = DigestHistory(':memory:')
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            service.check_and_send_notifications()
+            while outbox.drain_once():
+                pass
+            wall_time = time.perf_counter() - started
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            pushes = line_api.calls['push_message'] - pushes_before
+            results.append({
+                'run': run_index + 1,
+                'wall_time_seconds': round(wall_time, 4),
+                'pushes': pushes,
+                'pushes_per_second': round(pushes / wall_time, 1) if wall_time > 0 else None,
+                'sheets_calls': spreadsheet.total_calls,
+                'sheets_calls_by_method': dict(spreadsheet.calls),
+                'peak_memory_kib': round(peak_memory / 1024, 1),
+                'stages_ms': service.metrics.recent_runs(limit=1)[0]['stages_ms'],
+                # วัดโดย outbox sender รอบ push_message (sample สะสมของ process)
+                'push_latency': service.metrics.push_latency()
+            })
+    finally:
+        service.stop_scheduler()
+
+    return {
+        'dataset': {
+            'groups': args.groups,
+            'appointments_per_group': args.appointments,
+            'personal_users': args.personal_users,
+            'total_appointments': (args.groups + args.personal_users) * args.appointments
+        },
+        'runs': results
+    }
+
+
+def print_report(report: dict):
+    dataset = report['dataset']
+    print("📊 Notification run simulation")
+    print("=" * 60)
+    print(f"Groups: {dataset['groups']}  Personal users: {dataset['personal_users']}  "
+          f"Appointments: {dataset['total_appointments']}")
+    print("-" * 60)
+    print(f"{'run':>3} {'wall (s)':>10} {'pushes':>7} {'push/s':>9} {'sheets':>7} {'peak KiB':>10}")
+    for run in report['runs']:
+        print(f"{run['run']:>3} {run['wall_time_seconds']:>10.4f} {run['pushes']:>7} "
+              f"{run['pushes_per_second'] or 0:>9.1f} {run['sheets_calls']:>7} {run['peak_memory_kib']:>10.1f}")
+        stages = ', '.join(f"{name} {ms:.1f}" for name, ms in run['stages_ms'].items())
+        print(f"    stages (ms): {stages}")
+        latency = run['push_latency']
+        print(f"    push latency (ms): p50 {latency['p50_ms']}, p95 {latency['p95_ms']} "
+              f"({latency['samples']} samples)")
+    print("=" * 60)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        # log ระดับ INFO ต่อนัดหมายทำให้ตัวเลขเพี้ยน - ปิดไว้ระหว่างวัดผล
+        logging.disable(logging.ERROR)
+    try:
+        report = run_simulation(args)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return report
+
+
+if __name__ == '__main__':
+    main()
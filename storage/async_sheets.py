@@ -0,0 +1,162 @@
+"""
+Google Sheets REST (v4) client แบบ async (aiohttp) สำหรับ ASGI mode (asgi.py)
+
+อ่านอย่างเดียว: ใช้โดย notification trigger ของ ASGI mode เพื่อ reconcile agenda บน event loop
+อ่านทุก worksheet ของนัดหมายใน values:batchGet request เดียว แทนการอ่านทีละ worksheet ผ่าน gspread
+การเขียน (เพิ่ม/แก้/ลบนัด) ยังผ่าน SheetsRepository ใน webhook worker pool
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+import aiohttp
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+
+from .models import Appointment
+from .sheets_repo import SHEETS_REQUEST_TIMEOUT_SECONDS, SheetsRepository
+from utils.circuit_breaker import get_circuit_breaker, GOOGLE_SHEETS
+from utils.line_client import LINE_CONNECTION_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+SHEETS_API_BASE_URL = os.getenv('SHEETS_API_BASE_URL', 'https://sheets.googleapis.com')
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+# connection pool ของ Sheets client (ใช้ค่าเดียวกับ LINE client เว้นแต่ระบุ)
+ASYNC_SHEETS_POOL_SIZE = int(os.getenv('ASYNC_SHEETS_POOL_SIZE', LINE_CONNECTION_POOL_SIZE))
+ASYNC_HTTP_KEEPALIVE_SECONDS = float(os.getenv('ASYNC_HTTP_KEEPALIVE_SECONDS', 60))
+
+
+class SheetsApiError(Exception):
+    """Sheets API ตอบ HTTP error"""
+
+    def __init__(self, status: int, body: str):
+        super().__init__(f"Sheets API error {status}: {body[:200]}")
+        self.status = status
+
+
+def _is_appointment_worksheet(title: str) -> bool:
+    return title == 'appointments_personal' or title.startswith(('appointments_group_', 'group_'))
+
+
+def _group_id_of(title: str) -> Optional[str]:
+    """group_id ของ worksheet กลุ่ม (None สำหรับ appointments_personal)"""
+    for prefix in ('appointments_group_', 'group_'):
+        if title.startswith(prefix):
+            return title[len(prefix):]
+    return None
+
+
+def rows_to_appointments(title: str, rows: List[List[str]]) -> List[Appointment]:
+    """
+    แปลงค่าของ worksheet เป็นนัดหมาย (เหมือน SheetsRepository.get_appointments/get_appointments_by_user)
+
+    Args:
+        title (str): ชื่อ worksheet
+        rows (List[List[str]]): ค่าทั้งหมดของ worksheet (แถวแรกที่ขึ้นต้นด้วย 'id' คือ header)
+
+    Returns:
+        List[Appointment]: นัดหมายที่ decode ได้ (worksheet กลุ่มเฉพาะแถวของกลุ่มนั้น)
+    """
+    header_index = next((index for index, row in enumerate(rows) if row and row[0] == 'id'), -1)
+    if header_index == -1:
+        return []
+    headers = rows[header_index]
+    group_id = _group_id_of(title)
+    appointments = []
+    for row in rows[header_index + 1:]:
+        record = dict(zip(headers, list(row) + [''] * (len(headers) - len(row))))
+        owner_id = record.get('group_id')
+        if not owner_id or (group_id is not None and owner_id != group_id):
+            continue
+        try:
+            appointments.append(SheetsRepository._record_to_appointment(record))
+        except Exception as e:
+            logger.error(f"Error parsing appointment record in {title}: {e}")
+    return appointments
+
+
+class AsyncSheetsClient:
+    """อ่าน Google Sheets ผ่าน REST API ด้วย aiohttp (ใช้ภายใน event loop เดียว)"""
+
+    def __init__(self, spreadsheet_id: str, credentials: Credentials, pool_size: int = ASYNC_SHEETS_POOL_SIZE,
+                 base_url: str = SHEETS_API_BASE_URL, timeout: float = SHEETS_REQUEST_TIMEOUT_SECONDS):
+        self.spreadsheet_id = spreadsheet_id
+        self.credentials = credentials
+        self.pool_size = pool_size
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.breaker = get_circuit_breaker(GOOGLE_SHEETS)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._token_lock: Optional[asyncio.Lock] = None
+
+    @classmethod
+    def from_env(cls) -> Optional['AsyncSheetsClient']:
+        """สร้างจาก GOOGLE_CREDENTIALS_JSON / GOOGLE_SPREADSHEET_ID (None หากไม่ได้ตั้งค่า)"""
+        credentials_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
+        spreadsheet_id = os.getenv('GOOGLE_SPREADSHEET_ID')
+        if not credentials_json or not spreadsheet_id:
+            return None
+        credentials = Credentials.from_service_account_info(json.loads(credentials_json), scopes=SHEETS_SCOPES)
+        return cls(spreadsheet_id, credentials)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=ASYNC_HTTP_KEEPALIVE_SECONDS)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _access_token(self) -> str:
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            if not self.credentials.valid:
+                # google-auth refresh เป็น sync (ประมาณชั่วโมงละครั้ง) - ทำนอก loop
+                await asyncio.get_running_loop().run_in_executor(None, self.credentials.refresh, Request())
+            return self.credentials.token
+
+    async def _get(self, path: str, params=None) -> dict:
+        headers = {'Authorization': f'Bearer {await self._access_token()}'}
+        url = f"{self.base_url}/v4/spreadsheets/{self.spreadsheet_id}{path}"
+        with self.breaker.guard():
+            try:
+                async with self._get_session().get(url, params=params, headers=headers) as response:
+                    if response.status >= 400:
+                        raise SheetsApiError(response.status, await response.text())
+                    return await response.json()
+            except asyncio.TimeoutError as e:
+                raise TimeoutError(f"Sheets API request timeout ({self.timeout}s)") from e
+            except aiohttp.ClientError as e:
+                raise ConnectionError(f"Sheets API connection failed: {e}") from e
+
+    async def worksheet_titles(self) -> List[str]:
+        data = await self._get('', params={'fields': 'sheets.properties.title'})
+        return [sheet['properties']['title'] for sheet in data.get('sheets', [])]
+
+    async def batch_get(self, titles: List[str]) -> Dict[str, List[List[str]]]:
+        """ค่าทั้งหมดของหลาย worksheet ใน request เดียว"""
+        if not titles:
+            return {}
+        params = [('ranges', f"'{title}'") for title in titles] + [('majorDimension', 'ROWS')]
+        data = await self._get('/values:batchGet', params=params)
+        return {title: value_range.get('values', [])
+                for title, value_range in zip(titles, data.get('valueRanges', []))}
+
+    async def read_all_appointments(self) -> List[Appointment]:
+        """นัดหมายทั้งหมด (personal + ทุกกลุ่ม) - สอง request: รายชื่อ worksheet และ batchGet"""
+        titles = [title for title in await self.worksheet_titles() if _is_appointment_worksheet(title)]
+        values = await self.batch_get(titles)
+        appointments = []
+        for title in titles:
+            appointments.extend(rows_to_appointments(title, values.get(title, [])))
+        logger.info(f"Read {len(appointments)} appointments from {len(titles)} worksheets (async)")
+        return appointments
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
@@ -0,0 +1,63 @@
+"""
+Change feed สำหรับการเปลี่ยนแปลงข้อมูลนัดหมาย
+SheetsRepository จะ publish event ทุกครั้งที่เพิ่ม/แก้ไข/ลบนัดหมายสำเร็จ
+เพื่อให้ส่วนอื่น (เช่น NotificationService) อัปเดตข้อมูลในหน่วยความจำได้โดยไม่ต้องอ่าน Sheets ใหม่
+"""
+
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from .models import Appointment
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ChangeEvent:
+    """
+    Event ที่เกิดขึ้นเมื่อข้อมูลนัดหมายเปลี่ยนแปลง
+
+    Attributes:
+        op (str): ประเภทการเปลี่ยนแปลง ('add', 'update', 'delete', 'settings')
+        context (str): บริบทของ worksheet ('personal' หรือ 'group_{group_id}')
+        appointment_id (str): รหัสนัดหมาย (ค่าว่างสำหรับ 'settings')
+        appointment (Appointment): ข้อมูลนัดหมายเต็ม (เฉพาะ 'add')
+        fields (dict): คอลัมน์ที่ถูกแก้ไข ('update') หรือ recipient_id/delivery_time ('settings')
+    """
+    op: str
+    context: str
+    appointment_id: str
+    appointment: Optional[Appointment] = None
+    fields: Dict[str, Any] = field(default_factory=dict)
+
+
+_subscribers: List[Callable[[ChangeEvent], None]] = []
+_lock = threading.Lock()
+
+
+def subscribe(callback: Callable[[ChangeEvent], None]):
+    """ลงทะเบียน callback ที่จะถูกเรียกทุกครั้งที่มี ChangeEvent"""
+    with _lock:
+        if callback not in _subscribers:
+            _subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[ChangeEvent], None]):
+    """ยกเลิกการลงทะเบียน callback"""
+    with _lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+
+def publish(event: ChangeEvent):
+    """ส่ง ChangeEvent ไปยัง subscribers ทั้งหมด (error ของ subscriber จะไม่กระทบผู้เรียก)"""
+    with _lock:
+        subscribers = list(_subscribers)
+
+    for callback in subscribers:
+        try:
+            callback(event)
+        except Exception as e:
+            logger.error(f"Change feed subscriber failed on {event.op} {event.appointment_id}: {e}")
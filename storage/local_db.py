@@ -0,0 +1,41 @@
+"""
+Local SQLite storage สำหรับสถานะภายในของบอท
+ใช้เก็บข้อมูลที่ต้องอยู่รอดข้าม restart แต่ไม่ควรอยู่ใน Google Sheets (เช่น push outbox)
+"""
+
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# ตำแหน่งไฟล์ฐานข้อมูล local (":memory:" สำหรับการทดสอบ)
+LOCAL_DB_PATH = os.getenv('LOCAL_DB_PATH', 'local_state.sqlite3')
+
+
+def connect(db_path: str = None) -> sqlite3.Connection:
+    """
+    เปิด connection ไปยังฐานข้อมูล local
+
+    Connection ใช้ร่วมกันได้หลาย thread (ผู้เรียกต้องถือ lock เอง)
+    และเปิด WAL mode เพื่อให้อ่านระหว่างเขียนได้
+
+    Args:
+        db_path (str): path ของไฟล์ SQLite (ค่าเริ่มต้น LOCAL_DB_PATH)
+
+    Returns:
+        sqlite3.Connection: connection ที่ตั้ง row_factory เป็น sqlite3.Row
+    """
+    path = db_path or LOCAL_DB_PATH
+    directory = os.path.dirname(path)
+    if directory and path != ':memory:':
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if path != ':memory:':
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Could not enable WAL mode for {path}: {e}")
+    return conn
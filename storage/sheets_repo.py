@@ -7,16 +7,28 @@ Google Sheets Repository for LINE Group Reminder Bot
 import os
 import json
 import logging
+import threading
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict, Any
 import gspread
 from google.oauth2.service_account import Credentials
 from .models import Appointment
+from . import change_feed
+from .change_feed import ChangeEvent
+from utils.run_metrics import get_run_metrics, STAGE_SHEET_READS, STAGE_DECODE
+from utils.circuit_breaker import get_circuit_breaker, GOOGLE_SHEETS
 
 # ตั้งค่า logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Worksheet สำหรับเก็บการตั้งค่าการแจ้งเตือนต่อกลุ่ม/ผู้ใช้
+NOTIFICATION_SETTINGS_WORKSHEET = "notification_settings"
+NOTIFICATION_SETTINGS_HEADERS = ['recipient_id', 'delivery_time', 'updated_at']
+
+# timeout ต่อ request ของ Google Sheets (วินาที) - request ที่ค้างจะไม่ยึด webhook worker ของแชทไว้ไม่จำกัด
+SHEETS_REQUEST_TIMEOUT_SECONDS = float(os.getenv('SHEETS_REQUEST_TIMEOUT_SECONDS', 20))
+
 
 class SheetsRepository:
     """
@@ -34,6 +46,8 @@ class SheetsRepository:
         self.spreadsheet_id = spreadsheet_id or os.getenv('GOOGLE_SPREADSHEET_ID')
         self.gc = None
         self.spreadsheet = None
+        # ทุกการเรียก Google Sheets ผ่าน breaker - ระหว่าง outage จะล้มเหลวทันทีแทนการรอ timeout
+        self.breaker = get_circuit_breaker(GOOGLE_SHEETS)
         self._initialize_connection()
         logger.info(f"SheetsRepository initialized with spreadsheet_id: {self.spreadsheet_id}")
     
@@ -72,9 +86,10 @@ class SheetsRepository:
             
             # เชื่อมต่อ gspread
             self.gc = gspread.authorize(credentials)
+            self.gc.set_timeout(SHEETS_REQUEST_TIMEOUT_SECONDS)
             
             if self.spreadsheet_id:
-                self.spreadsheet = self.gc.open_by_key(self.spreadsheet_id)
+                self.spreadsheet = self.breaker.call(self.gc.open_by_key, self.spreadsheet_id)
                 logger.info("Successfully connected to Google Sheets")
             else:
                 logger.warning("No spreadsheet ID provided")
@@ -106,10 +121,11 @@ class SheetsRepository:
             
             # หา worksheet หรือสร้างใหม่ถ้าไม่มี
             try:
-                worksheet = self.spreadsheet.worksheet(worksheet_name)
+                worksheet = self.breaker.call(self.spreadsheet.worksheet, worksheet_name)
             except gspread.WorksheetNotFound:
                 # สร้าง worksheet ใหม่พร้อม header
-                worksheet = self.spreadsheet.add_worksheet(
+                worksheet = self.breaker.call(
+                    self.spreadsheet.add_worksheet,
                     title=worksheet_name, 
                     rows=1000, 
                     cols=10
@@ -120,7 +136,7 @@ class SheetsRepository:
                     'contact_person', 'phone_number', 'note', 'lead_days', 'notified_flags',
                     'created_at', 'updated_at'
                 ]
-                worksheet.append_row(headers)
+                self.breaker.call(worksheet.append_row, headers)
                 logger.info(f"Created new worksheet: {worksheet_name}")
             
             return worksheet
@@ -176,8 +192,14 @@ class SheetsRepository:
             ]
             
             # เพิ่มข้อมูลลงใน worksheet
-            worksheet.append_row(row_data)
+            self.breaker.call(worksheet.append_row, row_data)
             logger.info(f"Successfully added appointment ID: {appointment.id} for group: {appointment.group_id}")
+            change_feed.publish(ChangeEvent(
+                op='add',
+                context=context,
+                appointment_id=appointment.id,
+                appointment=appointment
+            ))
             return True
             
         except Exception as e:
@@ -199,60 +221,137 @@ class SheetsRepository:
             logger.warning("Google Sheets not connected, returning empty list")
             return []
         
+        metrics = get_run_metrics()
         try:
-            worksheet = self._get_worksheet(context)
-            if not worksheet:
-                return []
-            
-            # ดึงข้อมูลทั้งหมดจาก worksheet
-            try:
-                records = worksheet.get_all_records()
-            except Exception as e:
-                if "header row in the worksheet is not unique" in str(e):
-                    logger.error("Duplicate headers detected in worksheet. Attempting to fix...")
-                    # ลองใช้วิธีแก้ไขโดยการอ่านข้อมูลแบบ manual
-                    return self._get_appointments_manual_headers(worksheet, user_id, context)
-                else:
-                    raise e
+            with metrics.stage(STAGE_SHEET_READS):
+                worksheet = self._get_worksheet(context)
+                if not worksheet:
+                    return []
+                
+                # ดึงข้อมูลทั้งหมดจาก worksheet
+                try:
+                    records = self.breaker.call(worksheet.get_all_records)
+                except Exception as e:
+                    if "header row in the worksheet is not unique" in str(e):
+                        logger.error("Duplicate headers detected in worksheet. Attempting to fix...")
+                        # ลองใช้วิธีแก้ไขโดยการอ่านข้อมูลแบบ manual
+                        return self._get_appointments_manual_headers(worksheet, user_id, context)
+                    else:
+                        raise e
+            metrics.count('sheet_reads')
             
             appointments = []
-            for record in records:
-                # ตรวจสอบว่าตรงกับ group_id ที่ต้องการหรือไม่
-                # สำหรับ group: user_id จะเป็น group_id จริง
-                # สำหรับ personal: user_id จะเป็น user_id จริง
-                if record.get('group_id') == user_id:
-                    try:
-                        # สร้าง Appointment object จากข้อมูล
-                        # Parse lead_days และ notified_flags จาก string
-                        lead_days = eval(record.get('lead_days', '[7, 3, 1]'))
-                        notified_flags = eval(record.get('notified_flags', '[False, False, False]'))
-                        
-                        appointment = Appointment(
-                            id=record.get('id'),
-                            group_id=record.get('group_id'),
-                            datetime_iso=record.get('datetime_iso'),
-                            location=record.get('location', record.get('hospital', '')),  # Backward compatibility
-                            building_floor_dept=record.get('building_floor_dept', record.get('department', '')),  # Backward compatibility
-                            contact_person=record.get('contact_person', record.get('doctor', '')),  # Backward compatibility
-                            phone_number=record.get('phone_number', ''),
-                            note=record.get('note', ''),
-                            lead_days=lead_days,
-                            notified_flags=notified_flags,
-                            created_at=record.get('created_at', ''),
-                            updated_at=record.get('updated_at', '')
-                        )
-                        appointments.append(appointment)
-                    except Exception as e:
-                        logger.error(f"Error parsing appointment record: {e}")
-                        continue
+            with metrics.stage(STAGE_DECODE):
+                for record in records:
+                    # ตรวจสอบว่าตรงกับ group_id ที่ต้องการหรือไม่
+                    # สำหรับ group: user_id จะเป็น group_id จริง
+                    # สำหรับ personal: user_id จะเป็น user_id จริง
+                    if record.get('group_id') == user_id:
+                        try:
+                            appointments.append(self._record_to_appointment(record))
+                        except Exception as e:
+                            logger.error(f"Error parsing appointment record: {e}")
+                            metrics.error('decode')
+                            continue
             
             logger.info(f"Retrieved {len(appointments)} appointments for user {user_id} in context {context}")
             return appointments
             
         except Exception as e:
             logger.error(f"Error retrieving appointments: {e}")
+            metrics.error('sheet_read')
             return []
     
+    @staticmethod
+    def _record_to_appointment(record: Dict[str, Any]) -> Appointment:
+        """
+        แปลง record หนึ่งแถวจาก worksheet เป็น Appointment
+        
+        Args:
+            record (Dict[str, Any]): ข้อมูลหนึ่งแถว (header -> value)
+            
+        Returns:
+            Appointment: นัดหมาย (raise exception หากข้อมูลไม่ถูกต้อง)
+        """
+        # Parse lead_days และ notified_flags จาก string
+        lead_days = eval(record.get('lead_days', '[7, 3, 1]'))
+        notified_flags = eval(record.get('notified_flags', '[False, False, False]'))
+        
+        return Appointment(
+            id=record.get('id'),
+            group_id=record.get('group_id'),
+            datetime_iso=record.get('datetime_iso'),
+            location=record.get('location', record.get('hospital', '')),  # Backward compatibility
+            building_floor_dept=record.get('building_floor_dept', record.get('department', '')),  # Backward compatibility
+            contact_person=record.get('contact_person', record.get('doctor', '')),  # Backward compatibility
+            phone_number=record.get('phone_number', ''),
+            note=record.get('note', ''),
+            lead_days=lead_days,
+            notified_flags=notified_flags,
+            created_at=record.get('created_at', ''),
+            updated_at=record.get('updated_at', '')
+        )
+    
+    def get_appointments_by_user(self, context: str = "personal") -> Dict[str, List[Appointment]]:
+        """
+        อ่าน worksheet ครั้งเดียวแล้วจัดกลุ่มนัดหมายตามเจ้าของ (group_id ของแถว)
+        ใช้กับ appointments_personal ซึ่งเก็บนัดหมายของผู้ใช้ทุกคนไว้ใน sheet เดียว
+        
+        Args:
+            context (str): บริบท (ค่าเริ่มต้น 'personal')
+            
+        Returns:
+            Dict[str, List[Appointment]]: user_id -> รายการนัดหมาย
+        """
+        if not self.gc:
+            logger.warning("Google Sheets not connected, returning empty dict")
+            return {}
+        
+        metrics = get_run_metrics()
+        try:
+            with metrics.stage(STAGE_SHEET_READS):
+                worksheet = self._get_worksheet(context)
+                if not worksheet:
+                    return {}
+                
+                try:
+                    records = self.breaker.call(worksheet.get_all_records)
+                except Exception as e:
+                    if "header row in the worksheet is not unique" not in str(e):
+                        raise e
+                    logger.error("Duplicate headers detected in worksheet. Reading values manually...")
+                    all_values = self.breaker.call(worksheet.get_all_values)
+                    header_row_idx = next((i for i, row in enumerate(all_values) if row and row[0] == 'id'), -1)
+                    if header_row_idx == -1:
+                        logger.error("No valid header row found")
+                        return {}
+                    headers = all_values[header_row_idx]
+                    records = [dict(zip(headers, row)) for row in all_values[header_row_idx + 1:]
+                               if len(row) >= len(headers)]
+            metrics.count('sheet_reads')
+            
+            appointments_by_user: Dict[str, List[Appointment]] = {}
+            with metrics.stage(STAGE_DECODE):
+                for record in records:
+                    owner_id = record.get('group_id')
+                    if not owner_id:
+                        continue
+                    try:
+                        appointments_by_user.setdefault(owner_id, []).append(self._record_to_appointment(record))
+                    except Exception as e:
+                        logger.error(f"Error parsing appointment record: {e}")
+                        metrics.error('decode')
+                        continue
+            
+            total = sum(len(appointments) for appointments in appointments_by_user.values())
+            logger.info(f"Retrieved {total} appointments for {len(appointments_by_user)} users in context {context}")
+            return appointments_by_user
+            
+        except Exception as e:
+            logger.error(f"Error retrieving appointments by user: {e}")
+            metrics.error('sheet_read')
+            return {}
+    
     def _get_appointments_manual_headers(self, worksheet, user_id: str, context: str) -> List[Appointment]:
         """
         แก้ไขปัญหา duplicate headers โดยการอ่านข้อมูลแบบ manual
@@ -267,7 +366,7 @@ class SheetsRepository:
         """
         try:
             # อ่าน header row แรก
-            all_values = worksheet.get_all_values()
+            all_values = self.breaker.call(worksheet.get_all_values)
             if not all_values:
                 return []
             
@@ -305,25 +404,7 @@ class SheetsRepository:
                 # ตรวจสอบว่าตรงกับ user_id หรือไม่
                 if record.get('group_id') == user_id:
                     try:
-                        # Parse lead_days และ notified_flags
-                        lead_days = eval(record.get('lead_days', '[7, 3, 1]'))
-                        notified_flags = eval(record.get('notified_flags', '[False, False, False]'))
-                        
-                        appointment = Appointment(
-                            id=record.get('id'),
-                            group_id=record.get('group_id'),
-                            datetime_iso=record.get('datetime_iso'),
-                            location=record.get('location', record.get('hospital', '')),  # Backward compatibility
-                            building_floor_dept=record.get('building_floor_dept', record.get('department', '')),  # Backward compatibility
-                            contact_person=record.get('contact_person', record.get('doctor', '')),  # Backward compatibility
-                            phone_number=record.get('phone_number', ''),
-                            note=record.get('note', ''),
-                            lead_days=lead_days,
-                            notified_flags=notified_flags,
-                            created_at=record.get('created_at', ''),
-                            updated_at=record.get('updated_at', '')
-                        )
-                        appointments.append(appointment)
+                        appointments.append(self._record_to_appointment(record))
                     except Exception as e:
                         logger.error(f"Error parsing appointment record: {e}")
                         continue
@@ -358,13 +439,13 @@ class SheetsRepository:
                 return False
             
             # ค้นหา row ที่มี id ตรงกัน
-            records = worksheet.get_all_records()
+            records = self.breaker.call(worksheet.get_all_records)
             for i, record in enumerate(records):
                 if record.get('id') == appointment_id:
                     row_index = i + 2  # +1 for 0-based index, +1 for header row
                     
                     # Update เฉพาะคอลัมน์ที่ระบุใน updated_data
-                    headers = worksheet.row_values(1)
+                    headers = self.breaker.call(worksheet.row_values, 1)
                     
                     # อัปเดต updated_at
                     updated_data['updated_at'] = datetime.now().isoformat()
@@ -372,9 +453,15 @@ class SheetsRepository:
                     for column_name, new_value in updated_data.items():
                         if column_name in headers:
                             col_index = headers.index(column_name) + 1
-                            worksheet.update_cell(row_index, col_index, new_value)
+                            self.breaker.call(worksheet.update_cell, row_index, col_index, new_value)
                     
                     logger.info(f"Successfully updated appointment ID: {appointment_id}")
+                    change_feed.publish(ChangeEvent(
+                        op='update',
+                        context=context,
+                        appointment_id=appointment_id,
+                        fields=dict(updated_data)
+                    ))
                     return True
             
             logger.warning(f"Appointment ID not found: {appointment_id}")
@@ -406,12 +493,17 @@ class SheetsRepository:
                 return False
             
             # ค้นหา row ที่มี id ตรงกัน
-            records = worksheet.get_all_records()
+            records = self.breaker.call(worksheet.get_all_records)
             for i, record in enumerate(records):
                 if record.get('id') == appointment_id:
                     row_index = i + 2  # +1 for 0-based index, +1 for header row
-                    worksheet.delete_rows(row_index)
+                    self.breaker.call(worksheet.delete_rows, row_index)
                     logger.info(f"Successfully deleted appointment ID: {appointment_id}")
+                    change_feed.publish(ChangeEvent(
+                        op='delete',
+                        context=context,
+                        appointment_id=appointment_id
+                    ))
                     return True
             
             logger.warning(f"Appointment ID not found: {appointment_id}")
@@ -421,6 +513,99 @@ class SheetsRepository:
             logger.error(f"Error deleting appointment: {e}")
             return False
     
+    def _get_settings_worksheet(self):
+        """รับ worksheet การตั้งค่าการแจ้งเตือน (สร้างใหม่พร้อม header ถ้ายังไม่มี)"""
+        if not self.spreadsheet:
+            return None
+        
+        try:
+            return self.breaker.call(self.spreadsheet.worksheet, NOTIFICATION_SETTINGS_WORKSHEET)
+        except gspread.WorksheetNotFound:
+            worksheet = self.breaker.call(
+                self.spreadsheet.add_worksheet,
+                title=NOTIFICATION_SETTINGS_WORKSHEET,
+                rows=1000,
+                cols=len(NOTIFICATION_SETTINGS_HEADERS)
+            )
+            self.breaker.call(worksheet.append_row, NOTIFICATION_SETTINGS_HEADERS)
+            logger.info(f"Created new worksheet: {NOTIFICATION_SETTINGS_WORKSHEET}")
+            return worksheet
+    
+    def get_notification_settings(self) -> Optional[Dict[str, str]]:
+        """
+        ดึงเวลารับการแจ้งเตือนที่แต่ละกลุ่ม/ผู้ใช้ตั้งไว้
+        
+        Returns:
+            Optional[Dict[str, str]]: recipient_id -> เวลา 'HH:MM'
+            หรือ None หากอ่านไม่สำเร็จ (ผู้เรียกควรคงค่าเดิมไว้ ไม่ใช่ล้างทิ้ง)
+        """
+        if not self.gc:
+            logger.warning("Google Sheets not connected, cannot read notification settings")
+            return None
+        
+        try:
+            worksheet = self._get_settings_worksheet()
+            if not worksheet:
+                return None
+            
+            settings = {}
+            for record in self.breaker.call(worksheet.get_all_records):
+                recipient_id = str(record.get('recipient_id', '')).strip()
+                delivery_time = str(record.get('delivery_time', '')).strip()
+                if recipient_id and delivery_time:
+                    settings[recipient_id] = delivery_time
+            
+            logger.info(f"Retrieved notification settings for {len(settings)} recipients")
+            return settings
+            
+        except Exception as e:
+            logger.error(f"Error retrieving notification settings: {e}")
+            return None
+    
+    def set_delivery_time(self, recipient_id: str, delivery_time: str) -> bool:
+        """
+        บันทึกเวลารับการแจ้งเตือนของกลุ่ม/ผู้ใช้
+        
+        Args:
+            recipient_id (str): LINE Group ID หรือ User ID
+            delivery_time (str): เวลา 'HH:MM' (ค่าว่าง = กลับไปใช้ค่าเริ่มต้น)
+        
+        Returns:
+            bool: True หากบันทึกสำเร็จ
+        """
+        if not self.gc:
+            logger.warning("Google Sheets not connected, cannot save notification settings")
+            return False
+        
+        try:
+            worksheet = self._get_settings_worksheet()
+            if not worksheet:
+                return False
+            
+            updated_at = datetime.now().isoformat()
+            records = self.breaker.call(worksheet.get_all_records)
+            for i, record in enumerate(records):
+                if str(record.get('recipient_id', '')) == recipient_id:
+                    row_index = i + 2  # +1 for 0-based index, +1 for header row
+                    self.breaker.call(worksheet.update_cell, row_index, 2, delivery_time)
+                    self.breaker.call(worksheet.update_cell, row_index, 3, updated_at)
+                    break
+            else:
+                self.breaker.call(worksheet.append_row, [recipient_id, delivery_time, updated_at])
+            
+            logger.info(f"Saved delivery time {delivery_time or '(default)'} for {recipient_id}")
+            change_feed.publish(ChangeEvent(
+                op='settings',
+                context=NOTIFICATION_SETTINGS_WORKSHEET,
+                appointment_id='',
+                fields={'recipient_id': recipient_id, 'delivery_time': delivery_time}
+            ))
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving notification settings: {e}")
+            return False
+    
     def list_appointments_by_group_between(
         self, 
         group_id: str, 
@@ -449,7 +634,7 @@ class SheetsRepository:
                 return []
             
             # ดึงข้อมูลทั้งหมดจาก worksheet
-            records = worksheet.get_all_records()
+            records = self.breaker.call(worksheet.get_all_records)
             
             appointments = []
             for record in records:
@@ -518,6 +703,10 @@ class SheetsRepository:
             
             for worksheet in worksheets:
                 try:
+                    # worksheet การตั้งค่าไม่ใช่ข้อมูลนัดหมาย
+                    if worksheet.title == NOTIFICATION_SETTINGS_WORKSHEET:
+                        continue
+                    
                     # ตรวจสอบว่า worksheet มีข้อมูลหรือไม่
                     if worksheet.row_count < 1:
                         logger.info(f"⏭️  Skipping empty worksheet: {worksheet.title}")
@@ -610,4 +799,17 @@ class SheetsRepository:
 
 # Singleton instance สำหรับใช้งานทั่วไป
 # TODO: กำหนด spreadsheet_id จริงเมื่อพร้อมใช้งาน
-sheets_repo = SheetsRepository()
\ No newline at end of file
+sheets_repo = SheetsRepository()
+_sheets_repo_lock = threading.Lock()
+
+
+def get_sheets_repository() -> SheetsRepository:
+    """
+    คืน repository ร่วมของ process (gspread client และ HTTP connection pool เดียว)
+    แทนการสร้าง SheetsRepository ใหม่ (ยืนยันตัวตนและเปิด spreadsheet ใหม่) ทุกคำสั่ง
+    ถ้าการเชื่อมต่อครั้งก่อนไม่สำเร็จจะลองเชื่อมต่อใหม่
+    """
+    with _sheets_repo_lock:
+        if sheets_repo.spreadsheet is None:
+            sheets_repo._initialize_connection()
+        return sheets_repo
\ No newline at end of file
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ Materialized Agenda และ change feed
+ตรวจสอบว่า add/update/delete อัปเดต agenda ได้โดยไม่ต้องอ่าน Google Sheets ใหม่
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.agenda import MaterializedAgenda
+from storage.change_feed import ChangeEvent
+from storage.models import Appointment
+
+
+def make_appointment(apt_id, group_id, datetime_iso, note="นัดทดสอบ"):
+    return Appointment(
+        id=apt_id,
+        group_id=group_id,
+        datetime_iso=datetime_iso,
+        location="โรงพยาบาลทดสอบ",
+        building_floor_dept="",
+        note=note
+    )
+
+
+def test_agenda_apply_changes():
+    """ทดสอบการ apply add/update/delete หลัง reconcile"""
+    print("🧪 ทดสอบ Materialized Agenda")
+
+    agenda = MaterializedAgenda()
+    assert agenda.is_stale
+
+    agenda.begin_reconcile()
+    agenda.finish_reconcile([
+        make_appointment("a1", "C1", "2030-01-02T10:00:00"),
+        make_appointment("a2", "C1", "2030-01-01T09:00:00"),
+        make_appointment("b1", "U1", "2030-01-03T09:00:00"),
+    ])
+    assert not agenda.is_stale
+
+    snapshot = agenda.snapshot()
+    assert [apt.id for apt in snapshot["C1"]] == ["a2", "a1"]  # เรียงจากใกล้ที่สุด
+
+    agenda.apply(ChangeEvent(op='add', context='group_C2', appointment_id='c1',
+                             appointment=make_appointment("c1", "C2", "2030-02-01T09:00:00")))
+    agenda.apply(ChangeEvent(op='update', context='group_C1', appointment_id='a1',
+                             fields={'note': 'แก้ไขแล้ว', 'datetime_iso': '2029-12-31T08:00:00'}))
+    agenda.apply(ChangeEvent(op='delete', context='personal', appointment_id='b1'))
+
+    snapshot = agenda.snapshot()
+    assert [apt.id for apt in snapshot["C1"]] == ["a1", "a2"]
+    assert snapshot["C1"][0].note == "แก้ไขแล้ว"
+    assert "U1" not in snapshot
+    assert [apt.id for apt in snapshot["C2"]] == ["c1"]
+    assert not agenda.is_stale
+    print("   ✅ add/update/delete ถูก apply ครบ")
+
+
+def test_agenda_unknown_change_marks_stale():
+    """ทดสอบว่า event ของนัดหมายที่ไม่รู้จักบังคับให้ reconcile ใหม่"""
+    agenda = MaterializedAgenda()
+    agenda.begin_reconcile()
+    agenda.finish_reconcile([])
+
+    agenda.apply(ChangeEvent(op='delete', context='personal', appointment_id='missing'))
+    assert agenda.is_stale
+    print("   ✅ event ที่ไม่รู้จัก mark agenda เป็น stale")
+
+
+def test_agenda_replays_events_during_reconcile():
+    """ทดสอบว่า event ที่เข้ามาระหว่าง reconcile ไม่หายเมื่อสลับ agenda"""
+    agenda = MaterializedAgenda()
+    agenda.begin_reconcile()
+    # นัดนี้ถูกเพิ่มหลังจากที่ reconcile อ่าน Sheets ไปแล้ว
+    agenda.apply(ChangeEvent(op='add', context='group_C9', appointment_id='late',
+                             appointment=make_appointment("late", "C9", "2030-03-01T09:00:00")))
+    agenda.finish_reconcile([make_appointment("a1", "C1", "2030-01-01T09:00:00")])
+
+    snapshot = agenda.snapshot()
+    assert "C9" in snapshot and "C1" in snapshot
+    print("   ✅ event ระหว่าง reconcile ถูก replay")
+
+
+if __name__ == "__main__":
+    test_agenda_apply_changes()
+    test_agenda_unknown_change_marks_stale()
+    test_agenda_replays_events_during_reconcile()
+    print("🎉 ผ่านทั้งหมด")
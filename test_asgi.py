@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ ASGI entry point (asgi.py)
+ตรวจว่า /callback และ /health ทำบน event loop, webhook ที่ส่ง body ช้าจำนวนมากพร้อมกันไม่ต้องใช้ thread
+ต่อ request, client ที่ตัดการเชื่อมต่อกลางทางไม่ถูกประมวลผล, route อื่นยังเรียก Flask app เดิมได้
+และ LINE/Sheets client แบบ async (ทดสอบกับ fake API บน aiohttp ในเครื่อง) ใช้ connection แบบ keep-alive
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+import asgi
+from notifications.outbox import PushOutbox
+from storage.async_sheets import AsyncSheetsClient
+from test_webhook_dispatcher import CHANNEL_SECRET, make_body, sign, wait_for
+from utils import async_line
+from utils.message_sender import RobustMessageSender
+from utils.webhook_dispatcher import WebhookDispatcher
+
+
+async def call(method, path, body=b'', headers=(), chunk_delay=0.0, chunks=1):
+    """ส่ง request หนึ่งครั้งเข้า asgi.app แล้วคืน (status, body)"""
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+             'headers': [(name.encode(), value.encode()) for name, value in headers]}
+    size = max(1, len(body) // chunks + 1)
+    parts = [body[index:index + size] for index in range(0, len(body), size)] or [b'']
+    pending = list(parts)
+    sent = []
+
+    async def receive():
+        if chunk_delay:
+            await asyncio.sleep(chunk_delay)  # client ที่ส่ง body ช้า
+        part = pending.pop(0)
+        return {'type': 'http.request', 'body': part, 'more_body': bool(pending)}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    status = sent[0]['status']
+    payload = b''.join(message.get('body', b'') for message in sent[1:])
+    return status, payload
+
+
+class configured_bot:
+    """ตั้ง handler/dispatcher ของ app.py ชั่วคราวให้เหมือนมี LINE token จริง"""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def __enter__(self):
+        wsgi = asgi.wsgi
+        self.saved = (wsgi.handler, wsgi.webhook_dispatcher, wsgi.CHANNEL_ACCESS_TOKEN)
+        wsgi.handler, wsgi.webhook_dispatcher, wsgi.CHANNEL_ACCESS_TOKEN = \
+            self.dispatcher.handler, self.dispatcher, "token"
+        self.dispatcher.start()
+        return self.dispatcher
+
+    def __exit__(self, *exc):
+        self.dispatcher.stop()
+        wsgi = asgi.wsgi
+        wsgi.handler, wsgi.webhook_dispatcher, wsgi.CHANNEL_ACCESS_TOKEN = self.saved
+
+
+def test_health_and_ping_on_event_loop():
+    print("🧪 ทดสอบ /health และ /ping")
+    status, body = asyncio.run(call('GET', '/health'))
+    assert status == 200 and json.loads(body)['status'] == 'ok'
+    assert asyncio.run(call('GET', '/ping')) == (200, b'pong')
+    print("   ✅ ตอบจาก event loop")
+
+
+def test_concurrent_slow_webhooks():
+    print("🧪 ทดสอบ webhook ช้า 300 request พร้อมกัน")
+    handler = WebhookHandler(CHANNEL_SECRET)
+    received = []
+    lock = threading.Lock()
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        with lock:
+            received.append(event.message.text)
+
+    requests = 300
+    with configured_bot(WebhookDispatcher(handler, workers=4, max_queue=1000)):
+        async def run():
+            calls = []
+            for index in range(requests):
+                body = make_body([f"ดูนัด {index}"],
+                                 sources=[{'type': 'user', 'userId': f'U{index}'}])
+                calls.append(call('POST', '/callback', body.encode(), headers=[('X-Line-Signature', sign(body))],
+                                  chunk_delay=0.1, chunks=3))
+            return await asyncio.gather(*calls)
+
+        threads_before = threading.active_count()
+        started = time.perf_counter()
+        results = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+        assert all(result == (200, b'OK') for result in results)
+        assert elapsed < 2.0, elapsed  # แต่ละ request ใช้ ~0.3s ในการส่ง body - ทำพร้อมกันทั้งหมด
+        assert threading.active_count() - threads_before <= asgi.ASGI_BLOCKING_WORKERS + 16
+        assert wait_for(lambda: len(received) == requests)
+
+        body = make_body(["ดูนัด"])
+        status, _ = asyncio.run(call('POST', '/callback', body.encode(), headers=[('X-Line-Signature', 'bad')]))
+        assert status == 400
+    print(f"   ✅ {requests} request เสร็จใน {elapsed:.2f}s")
+
+
+def test_disconnect_aborts_request():
+    print("🧪 ทดสอบ client ตัดการเชื่อมต่อระหว่างส่ง body")
+    handler = WebhookHandler(CHANNEL_SECRET)
+    received = []
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        received.append(event.message.text)
+
+    body = make_body(["ดูนัด"])
+    with configured_bot(WebhookDispatcher(handler, workers=1, max_queue=10)):
+        messages = [{'type': 'http.request', 'body': body.encode()[:10], 'more_body': True},
+                    {'type': 'http.disconnect'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/callback', 'query_string': b'',
+                 'headers': [(b'x-line-signature', sign(body).encode())]}
+        asyncio.run(asgi.app(scope, receive, send))
+        assert sent == []  # ไม่ตอบและไม่ส่ง body ที่ไม่ครบเข้า dispatcher
+        time.sleep(0.1)
+        assert received == []
+    print("   ✅ request ถูกยกเลิกโดยไม่ประมวลผล body บางส่วน")
+
+
+class FakeApi:
+    """LINE/Sheets API ปลอมบน aiohttp - บันทึก request และ port ของ client (ตรวจการใช้ connection ซ้ำ)"""
+
+    def __init__(self, reply_failures=0):
+        self.requests = []
+        self.client_ports = set()
+        self.reply_failures = reply_failures
+        self.app = web.Application()
+        self.app.router.add_post('/v2/bot/message/{kind}', self.line_message)
+        self.app.router.add_get('/v4/spreadsheets/SID', self.spreadsheet)
+        self.app.router.add_get('/v4/spreadsheets/SID/values:batchGet', self.batch_get)
+
+    async def __aenter__(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+    def record(self, request, payload=None):
+        self.client_ports.add(request.transport.get_extra_info('peername')[1])
+        self.requests.append((request.path, dict(request.headers), payload, request.query))
+
+    async def line_message(self, request):
+        self.record(request, await request.json())
+        if request.match_info['kind'] == 'reply' and self.reply_failures:
+            self.reply_failures -= 1
+            return web.json_response({'message': 'busy'}, status=500)
+        return web.json_response({})
+
+    async def spreadsheet(self, request):
+        self.record(request)
+        titles = ['appointments_personal', 'appointments_group_G1', 'notification_settings']
+        return web.json_response({'sheets': [{'properties': {'title': title}} for title in titles]})
+
+    async def batch_get(self, request):
+        self.record(request)
+        header = ['id', 'group_id', 'datetime_iso', 'location', 'note']
+        return web.json_response({'valueRanges': [
+            {'values': [header, ['A1', 'U1', '2026-01-10T09:00:00+07:00', 'รพ.', ''], ['A2', '', '', '', '']]},
+            {'values': [['ชื่อกลุ่ม'], header, ['A3', 'G1', '2026-01-11T10:00:00+07:00', 'คลินิก'],
+                        ['A4', 'G2', '2026-01-12T10:00:00+07:00', 'อื่น', '']]},
+        ]})
+
+
+def test_async_line_client_reply_and_outbox():
+    print("🧪 ทดสอบ reply และ push ผ่าน AsyncLineClient")
+    outbox = PushOutbox(os.path.join(tempfile.mkdtemp(), 'outbox.sqlite3'), send_interval=0)
+
+    async def run():
+        async with FakeApi(reply_failures=1) as api:
+            client = async_line.AsyncLineClient('token', base_url=api.url)
+            async_line.install(asyncio.get_running_loop(), client)
+            outbox.start_async(client)
+            sender = RobustMessageSender(None)
+            sender.base_timeout = 0.01
+            sender.outbox = outbox
+            try:
+                # webhook worker thread: reply (retry หลัง 500) ทำบน loop ไม่ block thread
+                future = await asyncio.to_thread(sender.send_reply_async, 'reply-token', 'สวัสดี',
+                                                 recipient_id='U1')
+                assert await asyncio.wrap_future(future) == (True, None, 'reply')
+
+                for index in range(3):
+                    outbox.enqueue('U1', [f'แจ้งเตือน {index}'])
+                assert await asyncio.to_thread(wait_for, lambda: outbox.stats()['sent_total'] == 3)
+            finally:
+                assert (await asyncio.to_thread(outbox.drain, 2))['sender_running'] is False
+                async_line.uninstall()
+                await client.close()
+            return api
+
+    api = asyncio.run(run())
+    paths = [path for path, _, _, _ in api.requests]
+    assert paths == ['/v2/bot/message/reply'] * 2 + ['/v2/bot/message/push'] * 3
+    pushes = [(headers, payload) for path, headers, payload, _ in api.requests if path.endswith('push')]
+    assert all(headers['Authorization'] == 'Bearer token' and headers['X-Line-Retry-Key'] for headers, _ in pushes)
+    assert [payload['messages'][0]['text'] for _, payload in pushes] == [f'แจ้งเตือน {i}' for i in range(3)]
+    assert len(api.client_ports) == 1  # ทุก request ใช้ connection เดียวกัน (keep-alive)
+    print("   ✅ reply retry และ push ของ outbox ใช้ connection pool เดียวกันบน event loop")
+
+
+class StaticCredentials:
+    """credentials ที่มี token แล้ว (ไม่ต้อง refresh กับ Google)"""
+    valid = True
+    token = 'sheets-token'
+
+
+def test_async_sheets_reads_all_worksheets_in_one_batch():
+    print("🧪 ทดสอบ AsyncSheetsClient")
+
+    async def run():
+        async with FakeApi() as api:
+            client = AsyncSheetsClient('SID', StaticCredentials(), base_url=api.url)
+            try:
+                return api, await client.read_all_appointments()
+            finally:
+                await client.close()
+
+    api, appointments = asyncio.run(run())
+    assert sorted(appointment.id for appointment in appointments) == ['A1', 'A3']
+    assert len(api.requests) == 2  # รายชื่อ worksheet + batchGet
+    _, headers, _, query = api.requests[1]
+    assert query.getall('ranges') == ["'appointments_personal'", "'appointments_group_G1'"]
+    assert headers['Authorization'] == 'Bearer sheets-token'
+    print("   ✅ อ่านทุก worksheet ของนัดหมายในสอง request")
+
+
+def test_notification_check_reconciles_on_event_loop():
+    print("🧪 ทดสอบ /run-notification-check")
+    calls = []
+
+    class Service:
+        async def reconcile_agenda_async(self, sheets_client):
+            calls.append(('reconcile', threading.current_thread().name, sheets_client))
+            return True
+
+        def check_and_send_notifications(self):
+            calls.append(('check', threading.current_thread().name, None))
+
+    saved = (asgi.wsgi.notification_service, asgi._sheets_client)
+    asgi.wsgi.notification_service, asgi._sheets_client = Service(), 'sheets'
+    try:
+        status, body = asyncio.run(call('GET', '/run-notification-check'))
+    finally:
+        asgi.wsgi.notification_service, asgi._sheets_client = saved
+    assert status == 200 and json.loads(body)['status'] == 'success'
+    assert calls[0] == ('reconcile', threading.main_thread().name, 'sheets')  # อ่าน Sheets บน loop
+    assert calls[1][0] == 'check' and calls[1][1].startswith('asgi-wsgi')
+    print("   ✅ reconcile บน loop แล้วสร้างข้อความใน thread pool")
+
+
+def test_other_routes_use_flask_app():
+    status, body = asyncio.run(call('GET', '/webhook-status'))
+    assert status == 503 and json.loads(body)['message'] == 'Webhook dispatcher not available'
+    status, body = asyncio.run(call('GET', '/no-such-page'))
+    assert status == 404 and json.loads(body)['error'] == 'Not found'
+    status, _ = asyncio.run(call('POST', '/callback', b'{}', headers=[('X-Line-Signature', 'x')]))
+    assert status == 500  # ยังไม่ได้ตั้งค่า LINE token
+    print("   ✅ route อื่นผ่าน Flask app")
+
+
+if __name__ == "__main__":
+    test_health_and_ping_on_event_loop()
+    test_concurrent_slow_webhooks()
+    test_disconnect_aborts_request()
+    test_async_line_client_reply_and_outbox()
+    test_async_sheets_reads_all_worksheets_in_one_batch()
+    test_notification_check_reconciles_on_event_loop()
+    test_other_routes_use_flask_app()
+    print("🎉 ผ่านทั้งหมด")
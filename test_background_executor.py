@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ BoundedExecutor และ LINE client ร่วม
+ตรวจว่างานเบื้องหลังถูกจำกัดจำนวน (backpressure), คำสั่งลบนัดตอบว่าไม่ว่างเมื่อคิวเต็ม
+และ MessagingApi / SheetsRepository ถูกใช้ร่วมกันทั้ง process
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import handlers
+from notifications.outbox import PushOutbox
+from storage import sheets_repo
+from utils.background import BackgroundQueueFull, BoundedExecutor
+from utils import line_client
+
+
+def test_bounded_executor_applies_backpressure():
+    print("🧪 ทดสอบ BoundedExecutor")
+    executor = BoundedExecutor(workers=1, queue_size=1, name='test-background')
+    release = threading.Event()
+    try:
+        first = executor.submit(release.wait, 5)
+        second = executor.submit(release.wait, 5)
+        started = time.time()
+        try:
+            executor.submit(release.wait, 5, timeout=0.05)
+            assert False, "full executor must reject"
+        except BackgroundQueueFull:
+            pass
+        assert time.time() - started < 1.0
+        assert executor.stats()['pending'] == 2 and executor.stats()['rejected_total'] == 1
+
+        release.set()
+        first.result(timeout=5)
+        second.result(timeout=5)
+        time.sleep(0.05)
+        assert executor.stats()['pending'] == 0
+
+        def fail():
+            raise ValueError("boom")
+
+        executor.submit(fail).exception(timeout=5)
+        time.sleep(0.05)
+        stats = executor.stats()
+        assert stats['failed_total'] == 1 and stats['pending'] == 0
+        assert executor.submit(lambda: "ok").result(timeout=5) == "ok"  # slot คืนแล้ว
+    finally:
+        release.set()
+        executor.shutdown()
+    print("   ✅ ปฏิเสธงานเมื่อเต็มและคืน slot เมื่อเสร็จ")
+
+
+def test_delete_replies_busy_when_background_is_full():
+    print("🧪 ทดสอบลบนัดเมื่องานเบื้องหลังเต็ม")
+    executor = BoundedExecutor(workers=1, queue_size=0, name='test-delete')
+    release = threading.Event()
+    outbox = PushOutbox(db_path=':memory:')
+    repositories = []
+    saved = (handlers.get_background_executor, handlers.get_outbox, handlers.get_sheets_repository)
+    handlers.get_background_executor = lambda: executor
+    handlers.get_outbox = lambda: outbox
+    handlers.get_sheets_repository = lambda: repositories.append(1)
+    try:
+        executor.submit(release.wait, 5)
+        reply = handlers.handle_delete_appointment_command("ลบนัด ABC123", "U1", "personal", "U1")
+        assert "ยังไม่ได้ลบนัดหมาย ABC123" in reply
+        assert outbox.stats()['depth'] == 0  # ไม่ส่งข้อความ "กำลังลบ"
+        assert repositories == []  # ไม่ลบใน thread ของ webhook
+    finally:
+        handlers.get_background_executor, handlers.get_outbox, handlers.get_sheets_repository = saved
+        release.set()
+        executor.shutdown()
+    assert sheets_repo.get_sheets_repository() is sheets_repo.get_sheets_repository() is sheets_repo.sheets_repo
+    print("   ✅ ตอบว่าไม่ว่างแทนการลบใน webhook thread")
+
+
+def test_line_api_is_shared():
+    saved = line_client._line_api
+    line_client._line_api = None
+    try:
+        api = line_client.get_line_api("test-token")
+        assert line_client.get_line_api() is api
+        configuration = api.api_client.configuration
+        assert configuration.access_token == "test-token"
+        assert configuration.connection_pool_maxsize == line_client.LINE_CONNECTION_POOL_SIZE
+    finally:
+        line_client._line_api = saved
+    print("   ✅ ใช้ MessagingApi ตัวเดียวทั้ง process")
+
+
+if __name__ == "__main__":
+    test_bounded_executor_applies_backpressure()
+    test_delete_replies_busy_when_background_is_full()
+    test_line_api_is_shared()
+    print("🎉 ผ่านทั้งหมด")
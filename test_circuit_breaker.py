@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ circuit breaker ของ LINE API และ Google Sheets
+ตรวจสอบ closed -> open -> half-open -> closed, การล้มเหลวทันทีของ repository/outbox/sender
+ขณะวงจรเปิด และการตอบ "ระบบไม่พร้อม"
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.outbox import PushOutbox
+from notifications.simulation import FakeMessagingApi, SimulatedSheetsRepository, build_dataset
+from utils.circuit_breaker import (CircuitBreaker, CircuitOpenError, get_circuit_breaker, is_outage_error,
+                                   circuit_breaker_states, GOOGLE_SHEETS, LINE_API, SYSTEM_BUSY_MESSAGE,
+                                   STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN)
+from utils.message_sender import RobustMessageSender
+
+
+class StatusError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure(ConnectionError("down"))
+    assert breaker.state == STATE_OPEN
+
+
+def test_state_transitions():
+    print("🧪 ทดสอบสถานะของ circuit breaker")
+    breaker = CircuitBreaker('test', failure_threshold=3, recovery_timeout=0.05)
+
+    def fail():
+        raise ConnectionError("connection refused")
+
+    for _ in range(3):
+        try:
+            breaker.call(fail)
+        except ConnectionError:
+            pass
+    assert breaker.state == STATE_OPEN
+
+    calls = []
+    try:
+        breaker.call(calls.append, 1)
+        assert False, "open circuit must fail fast"
+    except CircuitOpenError:
+        pass
+    assert calls == [] and breaker.snapshot()['rejected_total'] == 1
+
+    time.sleep(0.06)
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # ปล่อยการเรียกทดสอบครั้งเดียว
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN  # ทดสอบล้มเหลว -> เปิดต่อ
+
+    time.sleep(0.06)
+    breaker.call(calls.append, 2)
+    assert breaker.state == STATE_CLOSED and calls == [2]
+    print("   ✅ closed -> open -> half-open -> closed")
+
+
+def test_only_outage_errors_count():
+    assert is_outage_error(StatusError("server error", status=503))
+    assert is_outage_error(StatusError("rate limited", status=429))
+    assert is_outage_error(TimeoutError("read timed out"))
+    assert not is_outage_error(StatusError("invalid reply token", status=400))
+    assert not is_outage_error(ValueError("bad row"))
+
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    for _ in range(5):
+        breaker.record_error(StatusError("invalid reply token", status=400))
+    assert breaker.state == STATE_CLOSED
+    print("   ✅ นับเฉพาะ 429/5xx และ network error")
+
+
+def test_repository_fails_fast_while_open():
+    print("🧪 ทดสอบ repository ขณะวงจร Sheets เปิด")
+    spreadsheet = build_dataset(groups=1, appointments_per_group=2)
+    repo = SimulatedSheetsRepository(spreadsheet)
+    breaker = get_circuit_breaker(GOOGLE_SHEETS)
+    try:
+        open_breaker(breaker)
+        spreadsheet.calls.clear()
+        assert repo.get_appointments_by_user() == {}
+        assert repo.get_notification_settings() is None
+        assert spreadsheet.total_calls == 0  # ไม่เรียก Sheets เลย
+        assert circuit_breaker_states()[GOOGLE_SHEETS]['state'] == STATE_OPEN
+    finally:
+        breaker.record_success()
+    assert repo.get_appointments_by_user() == {}  # personal ว่างใน dataset นี้ แต่เรียก Sheets จริง
+    assert spreadsheet.total_calls > 0
+    print("   ✅ repository ไม่เรียก Sheets ขณะวงจรเปิด")
+
+
+def test_outbox_holds_pushes_while_line_is_down():
+    print("🧪 ทดสอบ outbox ขณะวงจร LINE เปิด")
+    api = FakeMessagingApi()
+    outbox = PushOutbox(db_path=':memory:', send_interval=0)
+    outbox.line_bot_api = api
+    outbox.enqueue("C1", ["สวัสดี"])
+    breaker = outbox.breaker
+    try:
+        open_breaker(breaker)
+        assert outbox.drain_once() == 0
+        assert api.calls['push_message'] == 0
+        assert outbox.stats()['retrying'] == 0  # ไม่นับเป็น attempt
+        assert outbox._seconds_until_next_due() > 0
+    finally:
+        breaker.record_success()
+    assert outbox.drain_once() == 1
+    assert api.calls['push_message'] == 1
+    print("   ✅ ข้อความรอในคิวจนวงจรปิด")
+
+
+def test_sender_busy_reply_and_push_fallback():
+    print("🧪 ทดสอบ sender ขณะวงจร LINE เปิด")
+    api = FakeMessagingApi()
+    sender = RobustMessageSender(api)
+    sender.outbox = PushOutbox(db_path=':memory:')
+
+    assert sender.send_busy_reply("token")
+    assert api.replied[0].messages[0].text == SYSTEM_BUSY_MESSAGE
+
+    breaker = get_circuit_breaker(LINE_API)
+    try:
+        open_breaker(breaker)
+        started = time.time()
+        result = sender.send_reply_async("token", "ข้อความ", recipient_id="U1").result(timeout=5)
+        assert time.time() - started < 1.0
+        assert result == (True, None, 'push')  # ไม่รอ retry - ส่งเข้า outbox ทันที
+        assert sender.outbox.stats()['depth'] == 1
+        assert not sender.send_busy_reply("token")
+    finally:
+        breaker.record_success()
+    assert api.calls['reply_message'] == 1
+    print("   ✅ ตอบกลับล้มเหลวทันทีและ push แทน")
+
+
+if __name__ == "__main__":
+    test_state_transitions()
+    test_only_outage_errors_count()
+    test_repository_fails_fast_while_open()
+    test_outbox_holds_pushes_while_line_is_down()
+    test_sender_busy_reply_and_push_fallback()
+    print("🎉 ผ่านทั้งหมด")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ CommandRouter
+ตรวจว่า trie เลือกคำสั่งตามลำดับความสำคัญเดิม (ตรงทั้งข้อความ/ขึ้นต้น), การตัด mention และการข้าม
+ข้อความในกลุ่ม และ latency histogram ต่อคำสั่ง
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from handlers import COMMAND_ROUTER
+from utils.command_router import Command, CommandContext, CommandRouter, strip_mention
+
+
+def name_of(message, context_type="personal"):
+    command, _, _ = COMMAND_ROUTER.route(message, context_type)
+    return command.name if command else None
+
+
+def test_registry_matches_previous_routing():
+    print("🧪 ทดสอบการหาคำสั่งจาก registry")
+    cases = {
+        "สวัสดี": 'greeting',
+        "HELP": 'help',
+        "เพิ่มนัด ไปหาหมอ ศุกร์หน้า 9:30": 'add_appointment',
+        "ดูนัด": 'list_appointments',
+        "ดูนัด 123": None,  # ดูนัดต้องตรงทั้งข้อความ
+        "นัดหมาย": 'list_appointments',
+        "นัดย้อนหลัง": 'history_menu',  # ตรงทั้งข้อความชนะ "ย้อนหลัง" ที่ประกาศทีหลัง
+        "ย้อนหลัง 2 เดือน": 'history',
+        "ดูย้อนหลัง มีนาคม 2025": 'history',
+        "ยกเลิกนัด ABC123": 'delete_appointment',
+        "แก้นัด ABC123 นัดหมาย:\"x\"": 'edit_appointment',
+        "เวลาเตือน 07:30": 'set_delivery_time',
+        "เตือน": 'reminder_info',
+        "test date": 'test_date_parser',
+        "  status  ": 'status',
+        "กินข้าวยัง": None,
+        "": None,
+    }
+    for message, expected in cases.items():
+        assert name_of(message) == expected, (message, name_of(message))
+    print("   ✅ ลำดับความสำคัญเหมือน if/elif เดิม")
+
+
+def test_group_gate_and_mentions():
+    print("🧪 ทดสอบข้อความในกลุ่ม")
+    assert strip_mention("@Bot ดูนัด") == "ดูนัด"
+    assert strip_mention("@Bot") == ""
+    assert strip_mention("ดูนัด") == "ดูนัด"
+
+    assert name_of("@Bot  ดูนัด", "group") == 'list_appointments'
+    assert name_of("ดูการนัด", "personal") == 'list_appointments'
+    command, message, message_lower = COMMAND_ROUTER.route("ดูการนัด", "group")  # ไม่ใช่ keyword ของกลุ่ม
+    assert command is None and message_lower == ''
+    assert COMMAND_ROUTER.route("@Alice", "group")[2] == ''
+    assert COMMAND_ROUTER.route("เช็คทันที", "group")[2] == ''
+    command, message, message_lower = COMMAND_ROUTER.route("สถานะ", "group")  # ถึงบอทแต่ไม่ใช่คำสั่ง
+    assert command is None and message_lower == 'สถานะ'
+    assert COMMAND_ROUTER.is_group_command("ทดสอบวันที่")
+    print("   ✅ ตัด mention และข้ามข้อความสนทนา")
+
+
+def test_latency_histogram_per_command():
+    print("🧪 ทดสอบ latency histogram")
+
+    def boom(ctx):
+        raise ValueError("bad")
+
+    router = CommandRouter([
+        Command('echo', ('echo',), handler=lambda ctx: ctx.user_message),
+        Command('boom', ('boom',), exact=True, handler=boom),
+    ])
+    context = CommandContext("echo hi", "U1", "personal", "U1")
+    for _ in range(3):
+        command, _, _ = router.route("echo hi", "personal")
+        assert router.dispatch(command, context) == "echo hi"
+    try:
+        router.dispatch(router.match("boom"), context)
+        assert False, "handler error must propagate"
+    except ValueError:
+        pass
+    router.route("อื่น ๆ", "personal")
+
+    stats = router.stats()
+    assert stats['commands']['echo']['count'] == 3
+    assert stats['commands']['echo']['buckets']['le_10ms'] == 3
+    assert stats['commands']['echo']['p95_ms'] == 10.0
+    assert stats['commands']['boom']['errors'] == 1
+    assert stats['unmatched_total'] == 1
+    print("   ✅ เก็บเวลาแยกต่อคำสั่ง")
+
+
+if __name__ == "__main__":
+    test_registry_matches_previous_routing()
+    test_group_gate_and_mentions()
+    test_latency_histogram_per_command()
+    print("🎉 ผ่านทั้งหมด")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ delivery time buckets
+ตรวจสอบการจัดผู้รับเข้า bucket, quiet hours และการกระจายผู้รับที่ไม่ได้ตั้งเวลา
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.delivery_schedule import DeliverySchedule, parse_time
+
+
+def test_parse_time():
+    """ทดสอบการแปลงข้อความเวลา"""
+    assert parse_time("07:30") == (7, 30)
+    assert parse_time("7.05") == (7, 5)
+    assert parse_time("18:00 น.") == (18, 0)
+    assert parse_time("25:00") is None
+    assert parse_time("เช้า") is None
+    print("   ✅ parse_time ถูกต้อง")
+
+
+def test_preferred_time_buckets():
+    """เวลาที่ตั้งถูกปัดลงตาม bucket และ quiet hours ถูกปฏิเสธ"""
+    print("🧪 ทดสอบ delivery buckets")
+    schedule = DeliverySchedule(bucket_minutes=15, quiet_hours="21:00-07:00", default_window="08:00-10:00")
+
+    assert schedule.validate("07:40") == "07:40"
+    assert schedule.validate("22:30") is None  # อยู่ใน quiet hours
+    assert schedule.validate("06:59") is None
+
+    schedule.set_preference("C1", "07:40")
+    assert schedule.bucket_for("C1") == "07:30"
+    assert "07:30" in schedule.occupied_buckets()
+
+    # ค่าที่แก้ใน Sheets ตรง ๆ แล้วอยู่ใน quiet hours ถูกเลื่อนไปหลัง quiet hours
+    schedule.load({"C2": "23:10"})
+    assert schedule.bucket_for("C2") == "07:00"
+    assert schedule.bucket_for("C1") in schedule.occupied_buckets()
+    print("   ✅ bucket และ quiet hours ถูกต้อง")
+
+
+def test_quiet_hours_end_between_buckets():
+    """quiet hours ที่จบไม่ตรง bucket ต้องไม่ทำให้ bucket ย้อนเข้า quiet hours"""
+    schedule = DeliverySchedule(bucket_minutes=15, quiet_hours="21:00-07:10", default_window="07:00-08:00")
+
+    assert schedule.validate("07:12") == "07:12"
+    schedule.set_preference("C1", "07:12")
+    assert schedule.bucket_for("C1") == "07:15"
+
+    schedule.set_preference("C2", "23:10")
+    assert schedule.bucket_for("C2") == "07:15"
+
+    schedule.set_preference("C3", "07:40")
+    assert schedule.bucket_for("C3") == "07:30"
+
+    for bucket in schedule.occupied_buckets():
+        hour, minute = parse_time(bucket)
+        assert not schedule.is_quiet(hour * 60 + minute), bucket
+    print("   ✅ bucket ไม่ย้อนเข้า quiet hours")
+
+
+def test_default_recipients_spread_across_window():
+    """ผู้รับที่ไม่ได้ตั้งเวลาถูกกระจายในช่วงค่าเริ่มต้นแบบคงที่"""
+    schedule = DeliverySchedule(bucket_minutes=15, quiet_hours="21:00-07:00", default_window="08:00-10:00")
+    recipients = [f"C{i:04d}" for i in range(200)]
+
+    buckets = {schedule.bucket_for(r) for r in recipients}
+    assert buckets <= schedule.occupied_buckets()
+    assert len(buckets) == 8  # 08:00 ถึง 09:45 ทุก 15 นาที
+    assert schedule.bucket_for("C0001") == schedule.bucket_for("C0001")
+
+    in_first = schedule.recipients_in_bucket("08:00", recipients)
+    assert 0 < len(in_first) < len(recipients)
+    print("   ✅ กระจายผู้รับในช่วงค่าเริ่มต้น")
+
+
+def test_failed_settings_read_keeps_preferences():
+    """อ่าน settings จาก Sheets ไม่สำเร็จต้องไม่ล้างเวลาที่ผู้รับตั้งไว้"""
+    from notifications.simulation import (FakeMessagingApi, SimulatedSheetsRepository, build_dataset,
+                                          build_simulated_service)
+
+    class FailingSettingsRepository(SimulatedSheetsRepository):
+        def get_notification_settings(self):
+            return None
+
+    repo = FailingSettingsRepository(build_dataset(groups=1, appointments_per_group=1))
+    service = build_simulated_service(FakeMessagingApi(), repo)
+    try:
+        service.delivery_schedule.set_preference("C1", "18:00")
+        service._load_delivery_settings()
+        assert service.delivery_schedule.bucket_for("C1") == "18:00"
+    finally:
+        service.stop_scheduler()
+    print("   ✅ คงเวลาเดิมเมื่ออ่าน settings ไม่สำเร็จ")
+
+
+if __name__ == "__main__":
+    test_parse_time()
+    test_preferred_time_buckets()
+    test_quiet_hours_end_between_buckets()
+    test_default_recipients_spread_across_window()
+    test_failed_settings_read_keeps_preferences()
+    print("🎉 ผ่านทั้งหมด")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ graceful shutdown
+ตรวจว่า dispatcher หยุดรับ event ใหม่, ทำคิวให้หมดภายใน deadline, บันทึก event ที่ค้าง
+(รวม event ต้นทางของงาน defer_in_chat) ให้ process ถัดไป, shutdown hooks ทำครั้งเดียวตามลำดับ
+และ SIGTERM เริ่ม hooks ก่อน interpreter ปิด (executor ยังใช้ได้ และงานที่ค้างไม่ยืดเวลาปิดเกิน deadline)
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+from notifications.run_state import RunStateStore
+from test_webhook_dispatcher import CHANNEL_SECRET, make_body, sign, wait_for
+from utils import shutdown
+from utils.background import BoundedExecutor
+from utils.webhook_dispatcher import WebhookDispatcher, WebhookShuttingDown, defer_in_chat
+
+
+def make_blocking_dispatcher(received, release, defer=False):
+    handler = WebhookHandler(CHANNEL_SECRET)
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        text = event.message.text
+        if defer:
+            # เหมือนการลบนัด: ตอบก่อนแล้วส่งงานที่เหลือต่อ
+            defer_in_chat(lambda: (release.wait(timeout=5), received.append(f"{text}:1")))
+            defer_in_chat(lambda: received.append(f"{text}:2"))
+            return
+        release.wait(timeout=5)
+        received.append(text)
+
+    return WebhookDispatcher(handler, workers=1, max_queue=10)
+
+
+def test_drain_finishes_queue_within_deadline():
+    print("🧪 ทดสอบ drain ทำคิวให้หมด")
+    db_path = os.path.join(tempfile.mkdtemp(), 'state.sqlite3')
+    received, release = [], threading.Event()
+    dispatcher = make_blocking_dispatcher(received, release)
+    dispatcher.start()
+    body = make_body(["ดูนัด 1", "ดูนัด 2", "ดูนัด 3"])
+    assert dispatcher.submit(body, sign(body)) == 3
+
+    threading.Timer(0.2, release.set).start()
+    assert dispatcher.drain(timeout=5, db_path=db_path) == 0
+    assert received == ["ดูนัด 1", "ดูนัด 2", "ดูนัด 3"]
+    try:
+        dispatcher.submit(body, sign(body))
+        assert False, "dispatcher must reject events while shutting down"
+    except WebhookShuttingDown:
+        pass
+    print("   ✅ event ทั้งหมดเสร็จก่อนหยุด และ event ใหม่ได้ 503")
+
+
+def test_unfinished_events_are_restored():
+    print("🧪 ทดสอบบันทึก event ที่ค้างแล้วนำกลับมาทำ")
+    db_path = os.path.join(tempfile.mkdtemp(), 'state.sqlite3')
+    received, release = [], threading.Event()
+    dispatcher = make_blocking_dispatcher(received, release)
+    dispatcher.start()
+    body = make_body(["ดูนัด 1", "ดูนัด 2", "ดูนัด 3"])
+    dispatcher.submit(body, sign(body))
+    assert wait_for(lambda: dispatcher.stats()['in_flight'] == 1)
+
+    started = time.time()
+    assert dispatcher.drain(timeout=0.2, db_path=db_path) == 2  # event แรกกำลังทำอยู่
+    assert time.time() - started < 1.0
+    release.set()
+    assert wait_for(lambda: received == ["ดูนัด 1"])
+
+    restarted_received = []
+    restarted = make_blocking_dispatcher(restarted_received, release)
+    restarted.start()
+    try:
+        assert restarted.restore_backlog(db_path) == 2
+        assert wait_for(lambda: restarted_received == ["ดูนัด 2", "ดูนัด 3"])
+        assert restarted.restore_backlog(db_path) == 0  # ถูกลบหลังนำกลับมาแล้ว
+    finally:
+        restarted.stop()
+    print("   ✅ process ถัดไปทำ event ที่ค้างต่อตามลำดับ")
+
+
+def test_deferred_work_persists_origin_event():
+    print("🧪 ทดสอบงาน defer_in_chat ที่ค้างตอนปิด")
+    db_path = os.path.join(tempfile.mkdtemp(), 'state.sqlite3')
+    received, release = [], threading.Event()
+    dispatcher = make_blocking_dispatcher(received, release, defer=True)
+    dispatcher.start()
+    body = make_body(["ลบนัด 1"])
+    dispatcher.submit(body, sign(body))
+    assert wait_for(lambda: dispatcher.stats()['in_flight'] == 1 and dispatcher.stats()['depth'] == 1)
+
+    assert dispatcher.drain(timeout=0.2, db_path=db_path) == 1  # งานที่สองยังไม่ได้เริ่ม
+    release.set()
+    assert wait_for(lambda: received == ["ลบนัด 1:1"])
+
+    restarted_received = []
+    restarted = make_blocking_dispatcher(restarted_received, release, defer=True)
+    restarted.start()
+    try:
+        assert restarted.restore_backlog(db_path) == 1
+        assert wait_for(lambda: restarted_received == ["ลบนัด 1:1", "ลบนัด 1:2"])
+    finally:
+        restarted.stop()
+    print("   ✅ event ต้นทางถูกบันทึกแทนงานที่ยังไม่ได้ทำ")
+
+
+def test_background_drain_and_run_suspend():
+    print("🧪 ทดสอบ drain ของงานเบื้องหลังและ suspend รอบแจ้งเตือน")
+    executor = BoundedExecutor(workers=1, queue_size=2, name='test-shutdown')
+    executor.submit(time.sleep, 0.1)
+    executor.submit(time.sleep, 0.1)
+    assert executor.drain(timeout=5) == 0
+    assert executor.stats()['pending'] == 0
+
+    store = RunStateStore(os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+    assert store.claim('08:00', '2026-01-01')
+    assert not store.take_over('08:00', '2026-01-01', lease_seconds=600)
+    store.suspend('08:00', '2026-01-01')
+    assert store.interrupted_runs('2026-01-01')[0]['heartbeat_at'] == 0
+    assert store.take_over('08:00', '2026-01-01', lease_seconds=600)  # ไม่ต้องรอ lease หมด
+    print("   ✅ รองานที่ค้าง และรอบที่หยุดกลางทางรับช่วงได้ทันที")
+
+
+def test_shutdown_hooks_run_once_in_order():
+    print("🧪 ทดสอบ shutdown hooks")
+    saved = (list(shutdown._hooks), shutdown._done)
+    shutdown._hooks.clear()
+    shutdown._done = False
+    calls = []
+    try:
+        shutdown.add_shutdown_hook('first', lambda remaining: calls.append(('first', remaining)) or 'ok')
+        shutdown.add_shutdown_hook('broken', lambda remaining: 1 / 0)
+        shutdown.add_shutdown_hook('last', lambda remaining: calls.append(('last', remaining)) or 3)
+
+        results = shutdown.graceful_shutdown(deadline_seconds=5)
+        assert [name for name, _ in calls] == ['first', 'last']
+        assert all(0 < remaining <= 5 for _, remaining in calls)
+        assert results['first'] == 'ok' and results['last'] == 3 and results['broken'].startswith('error')
+        assert shutdown.shutdown_requested()
+        assert shutdown.graceful_shutdown() == {} and len(calls) == 2
+    finally:
+        shutdown._hooks[:] = saved[0]
+        shutdown._done = saved[1]
+        shutdown._requested.clear()
+    print("   ✅ hook ทำครั้งเดียวตามลำดับ และ hook ที่ error ไม่หยุดตัวถัดไป")
+
+
+SIGTERM_SCRIPT = textwrap.dedent("""
+    import signal, sys, threading, time
+    sys.path.insert(0, sys.argv[2])
+    from utils import shutdown
+    from utils.background import BoundedExecutor
+    from utils.message_sender import get_retry_executor
+
+    executor = BoundedExecutor(workers=1, queue_size=20, name='queued')
+    for _ in range(10):
+        executor.submit(time.sleep, 1)  # งานค้าง ~10 วินาที
+    shutdown.add_shutdown_hook('background', executor.drain)
+    shutdown.add_shutdown_hook('retry', lambda remaining: get_retry_executor().submit(lambda: 'ok').result(1))
+
+    alive = threading.Event()
+    alive.set()
+    if sys.argv[1] == 'server':
+        signal.signal(signal.SIGTERM, lambda signum, frame: alive.clear())  # เหมือน handle_exit ของ gunicorn
+    shutdown.install_signal_handlers()
+    print('ready', flush=True)
+    try:
+        while alive.is_set():
+            time.sleep(0.05)
+        shutdown.wait_for_shutdown()  # worker_exit ใน gunicorn.conf.py
+    finally:
+        print('results', shutdown._results, flush=True)
+""")
+
+
+def run_sigterm(mode):
+    env = dict(os.environ, SHUTDOWN_DEADLINE_SECONDS='1.5')
+    process = subprocess.Popen([sys.executable, '-c', SIGTERM_SCRIPT, mode, os.path.dirname(os.path.abspath(__file__))],
+                               stdout=subprocess.PIPE, text=True, env=env)
+    assert process.stdout.readline().strip() == 'ready'
+    started = time.time()
+    process.send_signal(signal.SIGTERM)
+    output, _ = process.communicate(timeout=15)
+    return process.returncode, time.time() - started, output
+
+
+def test_sigterm_runs_hooks_before_interpreter_exit():
+    print("🧪 ทดสอบ SIGTERM กับ process ที่มีงานค้าง")
+    for mode, exit_code in (('plain', 128 + signal.SIGTERM), ('server', 0)):
+        returncode, elapsed, output = run_sigterm(mode)
+        assert returncode == exit_code, (mode, returncode, output)
+        assert elapsed < 5, (mode, elapsed)  # ไม่รองานค้างทั้ง 10 วินาที
+        assert "'retry': 'ok'" in output, output  # executor อื่นยังรับงานได้ระหว่าง hooks
+        assert "'background': 0" not in output and "'background':" in output
+    print("   ✅ hooks ทำภายใน deadline ก่อน executor ถูกปิด")
+
+
+if __name__ == "__main__":
+    test_drain_finishes_queue_within_deadline()
+    test_unfinished_events_are_restored()
+    test_deferred_work_persists_origin_event()
+    test_background_drain_and_run_suspend()
+    test_shutdown_hooks_run_once_in_order()
+    test_sigterm_runs_hooks_before_interpreter_exit()
+    print("🎉 ผ่านทั้งหมด")
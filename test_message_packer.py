@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ message packer: แบ่งข้อความยาวตามนัดหมายเป็นหลายข้อความและหลาย request
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from storage.models import Appointment
+from utils.message_packer import pack_requests, pack_texts, split_segments, text_length
+from utils.message_renderer import BANGKOK_TZ, classify_by_urgency, render_digest, render_digest_segments
+
+
+NOW = BANGKOK_TZ.localize(datetime(2030, 1, 15, 8, 0))
+
+
+def test_pack_keeps_segments_whole():
+    print("🧪 ทดสอบ message packer")
+    segments = [f"📅 นัดหมาย {index}\n   🆔 {index:04d}\n\n" for index in range(100)]
+    texts = pack_texts(segments, max_chars=200)
+    assert all(text_length(text) <= 200 for text in texts)
+    joined = ''.join(text + "\n\n" for text in texts)
+    assert joined == ''.join(segments)  # ไม่มีนัดหมายหายหรือถูกตัดกลาง
+
+    requests = pack_requests(segments, max_chars=200)
+    assert [len(texts) for texts in requests][:-1] == [5] * (len(requests) - 1)
+    assert sum(len(texts) for texts in requests) == len(texts)
+
+    assert pack_requests(["สั้น"]) == [["สั้น"]]
+    assert split_segments("a\n\nb") == ["a\n\n", "b"]
+    print("   ✅ แบ่งตามขอบเขตนัดหมาย")
+
+
+def test_oversized_segment_is_split_by_line():
+    texts = pack_texts(["บรรทัด\n" * 100], max_chars=50)
+    assert all(text_length(text) <= 50 for text in texts)
+    assert ''.join(texts).count("บรรทัด") == 100
+    assert text_length("🔥") == 2  # LINE นับ emoji นอก BMP เป็นสองตัวอักษร
+
+
+def test_large_digest_is_complete():
+    """digest ที่มีนัดด่วนหลายร้อยรายการต้องครบทุกนัดหมาย"""
+    appointments = [Appointment(id=f"U{index:03d}", group_id="C1",
+                                datetime_iso=(NOW + timedelta(days=index % 2, minutes=index)).replace(tzinfo=None).isoformat(),
+                                location="โรงพยาบาลทดสอบ", building_floor_dept="", note=f"นัดหมายด่วน {index}")
+                    for index in range(300)]
+    groups = classify_by_urgency(appointments, NOW.date())
+    segments = render_digest_segments(groups, 300, NOW, "08:00")
+    assert ''.join(segments) == render_digest(groups, 300, NOW, "08:00")
+
+    requests = pack_requests(segments)
+    texts = [text for request in requests for text in request]
+    print(f"   📊 300 นัดด่วน -> {len(texts)} ข้อความใน {len(requests)} request")
+    assert all(len(request) <= 5 for request in requests)
+    assert all(text_length(text) <= 5000 for text in texts)
+    assert all(f"🆔 U{index:03d}" in ''.join(texts) for index in range(300))
+    assert len(requests) == -(-len(texts) // 5)  # request เพิ่มเมื่อจำเป็นเท่านั้น
+
+
+if __name__ == "__main__":
+    test_pack_keeps_segments_whole()
+    test_oversized_segment_is_split_by_line()
+    test_large_digest_is_complete()
+    print("🎉 ผ่านทั้งหมด")
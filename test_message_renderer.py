@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ message renderer ที่ใช้ร่วมกันระหว่างสรุปรายวัน, ดูนัด, ประวัติ และการยืนยันการลบ
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from storage.models import Appointment
+from utils.message_renderer import (BANGKOK_TZ, ICON_PAST, classify_by_urgency, render_appointment_items,
+                                    render_deleted_appointment, render_digest)
+from benchmark_renderer import run_benchmark
+
+
+NOW = BANGKOK_TZ.localize(datetime(2030, 1, 15, 8, 0))
+
+
+def make_appointment(apt_id, days_ahead, **fields):
+    when = (NOW + timedelta(days=days_ahead)).replace(hour=10, minute=30, tzinfo=None)
+    values = dict(location="LINE Bot", building_floor_dept="General", note=f"นัด {apt_id}")
+    values.update(fields)
+    return Appointment(id=apt_id, group_id="C1", datetime_iso=when.isoformat(), **values)
+
+
+def test_list_items_skip_placeholders():
+    """รายการนัดหมายไม่แสดงค่า placeholder และเลือกไอคอนตามเวลา"""
+    print("🧪 ทดสอบ render_appointment_items")
+    items = render_appointment_items([
+        make_appointment("A1", 1, location="ศิริราช", contact_person="หมอเอ"),
+        make_appointment("A2", -2),
+    ], now=NOW)
+    assert items == (
+        "📅 1. 🔴 นัด A1\n     🕐 16/01/2030 10:30\n     📍 ศิริราช\n     👤 หมอเอ\n     🆔 A1\n\n"
+        "📅 2. ⚪ นัด A2\n     🕐 13/01/2030 10:30\n     🆔 A2\n\n"
+    )
+    history = render_appointment_items([make_appointment("A3", 3)], icon=ICON_PAST)
+    assert history.startswith("📅 1. ⚪ นัด A3")
+    print("   ✅ รายการนัดหมายถูกต้อง")
+
+
+def test_digest_groups_and_urgent_only():
+    """digest แบ่งกลุ่มตามความเร่งด่วน และโหมด urgent_only ตัดกลุ่มอื่นออก"""
+    appointments = [make_appointment("U0", 0, contact_person="หมอบี"), make_appointment("W3", 3),
+                    make_appointment("F9", 9), make_appointment("P1", -1)]
+    groups = classify_by_urgency(appointments, NOW.date())
+    assert [len(group) for group in groups] == [1, 1, 1, 1]
+
+    digest = render_digest(groups, 4, NOW, "08:00")
+    assert "🔥 วันนี้ - นัด U0\n   📅 10:30 พบ หมอบี" in digest
+    assert "🔴 ในอีก 3 วัน - นัด W3" in digest
+    assert "⏰ เมื่อ 1 วันที่แล้ว - นัด P1" in digest
+    assert digest.endswith("ทุกวัน 08:00 น.")
+
+    urgent_only = render_digest(groups, 4, NOW, "08:00", urgent_only=True)
+    assert "นัด W3" not in urgent_only and "ℹ️ วันนี้แสดงเฉพาะนัดหมายด่วน" in urgent_only
+    print("   ✅ digest ถูกต้อง")
+
+
+def test_deleted_confirmation():
+    message = render_deleted_appointment(make_appointment("D1", 2, contact_person="คุณซี"))
+    assert "• รหัส: D1" in message and "• วันที่: 17/01/2030" in message and "• เวลา: 10:30" in message
+    assert message.endswith("• บุคคล/ผู้ติดต่อ: คุณซี")
+    print("   ✅ ข้อความยืนยันการลบถูกต้อง")
+
+
+def test_benchmark_1k_items():
+    """agenda 1,000 รายการต้องสร้างข้อความได้ (แสดงเวลาเพื่อเปรียบเทียบ)"""
+    result = run_benchmark(items=1000, repeat=3)
+    print(f"   📊 1k items: digest {result['digest_ms']} ms, list {result['list_ms']} ms")
+    assert result['list_chars'] > 0
+
+
+if __name__ == "__main__":
+    test_list_items_skip_placeholders()
+    test_digest_groups_and_urgent_only()
+    test_deleted_confirmation()
+    test_benchmark_1k_items()
+    print("🎉 ผ่านทั้งหมด")
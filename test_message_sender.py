@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ RobustMessageSender.send_reply_async
+retry ทำนอก webhook thread ภายในอายุของ reply token แล้ว push แทนเมื่อรู้แน่ว่า token ยังไม่ถูกใช้
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.outbox import PushOutbox
+from utils.message_sender import MessageQueue, RobustMessageSender, REPLY_TOKEN_TTL_SECONDS
+
+
+class StatusError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ScriptedApi:
+    """reply_message จำลองที่ล้มเหลวตาม script แล้วสำเร็จ"""
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.replies = []
+        self.pushes = []
+        self.threads = []
+        self.timeouts = []
+
+    def reply_message(self, request, _request_timeout=None):
+        self.threads.append(threading.current_thread().name)
+        self.timeouts.append(_request_timeout)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.replies.append(request)
+
+    def push_message(self, request, x_line_retry_key=None):
+        self.pushes.append(request)
+
+
+def make_sender(api):
+    sender = RobustMessageSender(api)
+    sender.base_timeout = 0.01
+    sender.outbox = PushOutbox(db_path=':memory:')
+    return sender
+
+
+def test_retry_runs_off_the_request_thread():
+    print("🧪 ทดสอบ async reply retry")
+    api = ScriptedApi([Exception("Connection reset by peer")])
+    sender = make_sender(api)
+
+    started = time.time()
+    future = sender.send_reply_async("token", "สวัสดี", recipient_id="U1")
+    assert time.time() - started < 0.5  # ไม่รอ retry ใน thread ของ webhook
+    assert future.result(timeout=5) == (True, None, 'reply')
+    assert api.threads[0] == threading.current_thread().name
+    assert api.threads[1].startswith('reply-retry')
+    assert all(0 < timeout <= sender.reply_timeout for timeout in api.timeouts)  # ไม่มีครั้งไหนรอไม่จำกัด
+    assert sender.outbox.stats()['depth'] == 0
+    print("   ✅ retry สำเร็จบน executor")
+
+
+def test_expired_token_falls_back_to_push():
+    """token ใกล้หมดอายุหรือใช้ไม่ได้ -> push ผ่าน outbox แทน"""
+    api = ScriptedApi([Exception("Read timeout")] * 3)
+    sender = make_sender(api)
+    received_at = time.time() - REPLY_TOKEN_TTL_SECONDS  # token หมดอายุแล้ว
+    success, error, channel = sender.send_reply_async("token", "ข้อความ", recipient_id="C1",
+                                                      received_at=received_at).result(timeout=5)
+    assert (success, channel) == (True, 'push')
+    assert len(api.threads) == 0  # token หมดอายุแล้ว (event รอในคิวนาน) - ไม่ลอง reply เลย
+    assert sender.outbox.stats()['depth'] == 1
+
+    api = ScriptedApi([StatusError("Invalid reply token", status=400)])
+    sender = make_sender(api)
+    assert sender.send_reply_async("token", "ข้อความ", recipient_id="C1").result(timeout=5)[2] == 'push'
+    assert len(api.threads) == 1
+
+    api = ScriptedApi([StatusError("Invalid reply token", status=400)])
+    success, error, channel = make_sender(api).send_reply_async("token", "ข้อความ").result(timeout=5)
+    assert not success and channel is None
+
+    # 429 ไม่ได้ใช้ token - push ได้ และ event ที่ถูกส่งซ้ำไม่ push ซ้ำ (dedup key ของ reply token)
+    api = ScriptedApi([StatusError("Too many requests", status=429), StatusError("Invalid reply token", status=400)])
+    sender = make_sender(api)
+    assert sender.send_reply_async("token", "ข้อความ", recipient_id="C1").result(timeout=5) == (True, None, 'push')
+    received_at = time.time() - REPLY_TOKEN_TTL_SECONDS
+    sender.send_reply_async("token", "ข้อความ", recipient_id="C1", received_at=received_at).result(timeout=5)
+    assert len(api.threads) == 2 and sender.outbox.stats()['depth'] == 1
+    print("   ✅ push แทน reply เมื่อ token ใช้ไม่ได้")
+
+
+def test_ambiguous_failure_does_not_push():
+    """timeout หรือ 5xx อาจส่ง reply ถึงผู้ใช้แล้ว - ไม่ push ซ้ำ"""
+    print("🧪 ทดสอบ reply ที่ไม่รู้ผล")
+    api = ScriptedApi([Exception("Read timeout")] * 3)
+    sender = make_sender(api)
+    success, error, channel = sender.send_reply_async("token", "ข้อความ", recipient_id="C1").result(timeout=5)
+    assert (success, channel) == (False, None) and 'timeout' in error
+    assert len(api.threads) == 3 and sender.outbox.stats()['depth'] == 0
+
+    # 500 แล้ว token ใช้ไม่ได้ = reply แรกอาจใช้ token ไปแล้ว
+    api = ScriptedApi([StatusError("Internal error", status=500), StatusError("Invalid reply token", status=400)])
+    sender = make_sender(api)
+    assert sender.send_reply_async("token", "ข้อความ", recipient_id="C1").result(timeout=5)[0] is False
+    assert len(api.threads) == 2 and sender.outbox.stats()['depth'] == 0
+    print("   ✅ รายงานว่าล้มเหลวแทนการ push ซ้ำ")
+
+
+def test_message_queue_packs_one_reply():
+    """หลายส่วนของคำตอบส่งใน reply เดียว ส่วนที่เกิน 5 ข้อความเข้า outbox ตามลำดับหลัง reply"""
+    api = ScriptedApi([])
+    sender = make_sender(api)
+    sender.outbox.line_bot_api = api
+    queue = MessageQueue(sender)
+    for index in range(7):
+        queue.add_message("token", f"ส่วนที่ {index}", recipient_id="U1")
+    queue.add_message("other", "คำตอบอื่น", recipient_id="U2")
+
+    started = time.time()
+    assert queue.send_all(delay_between=1.0) == (8, 0)
+    assert time.time() - started < 0.5  # ไม่มีการ sleep ระหว่างข้อความ
+    assert len(api.replies) == 2
+    assert [m.text for m in api.replies[0].messages] == [f"ส่วนที่ {index}" for index in range(5)]
+    assert api.pushes == []  # ส่วนที่เกินไม่ถูก push ตรงนอก outbox
+    assert sender.outbox.stats()['depth'] == 1
+
+    # event เดิมถูกส่งซ้ำ (redelivery) - ส่วนที่เกินไม่ถูก enqueue ซ้ำ
+    for index in range(7):
+        queue.add_message("token", f"ส่วนที่ {index}", recipient_id="U1")
+    queue.send_all()
+    assert sender.outbox.drain_once() == 1
+    assert len(api.pushes) == 1 and api.pushes[0].to == "U1"
+    assert [m.text for m in api.pushes[0].messages] == ["ส่วนที่ 5", "ส่วนที่ 6"]
+
+    # reply ล้มเหลว -> push แทนผ่าน outbox, ส่วนที่เกินโดยไม่มี recipient -> dropped
+    api = ScriptedApi([StatusError("Invalid reply token", status=400)] * 2)
+    sender = make_sender(api)
+    queue = MessageQueue(sender)
+    queue.add_message("token", "ก", recipient_id="U1")
+    for index in range(6):
+        queue.add_message("expired", f"ข {index}")
+    assert queue.send_all() == (6, 1)
+    assert wait_until(lambda: sender.outbox.stats()['depth'] == 1)
+    print("   ✅ MessageQueue ส่งใน reply เดียว")
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+if __name__ == "__main__":
+    test_retry_runs_off_the_request_thread()
+    test_expired_token_falls_back_to_push()
+    test_ambiguous_failure_does_not_push()
+    test_message_queue_packs_one_reply()
+    print("🎉 ผ่านทั้งหมด")
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ durable push outbox
+ตรวจสอบ dedup, retry แบบ backoff และการย้ายไป dead-letter table
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.outbox import PushOutbox
+
+
+class FlakyApi:
+    """LINE API จำลองที่ล้มเหลวตามจำนวนครั้งที่กำหนด"""
+
+    def __init__(self, failures=0, status=None):
+        self.failures = failures
+        self.status = status
+        self.sent = []
+        self.retry_keys = []
+
+    def push_message(self, request, x_line_retry_key=None):
+        self.retry_keys.append(x_line_retry_key)
+        if self.failures > 0:
+            self.failures -= 1
+            error = Exception("Connection reset by peer")
+            error.status = self.status
+            raise error
+        self.sent.append(request)
+
+
+def make_outbox(api, max_attempts=3):
+    outbox = PushOutbox(db_path=':memory:', max_attempts=max_attempts,
+                        base_backoff=0.0, max_backoff=0.0, send_interval=0)
+    outbox.line_bot_api = api
+    return outbox
+
+
+def test_enqueue_and_send_with_dedup():
+    """ข้อความเดียวกัน (dedup_key) ถูก enqueue ครั้งเดียวและถูกส่ง"""
+    print("🧪 ทดสอบ push outbox")
+    api = FlakyApi()
+    outbox = make_outbox(api)
+
+    assert outbox.enqueue("C1", ["สรุปนัดหมาย"], dedup_key="digest:2030-01-01:C1")
+    assert not outbox.enqueue("C1", ["สรุปนัดหมาย"], dedup_key="digest:2030-01-01:C1")
+    assert outbox.stats()['depth'] == 1
+
+    assert outbox.drain_once() == 1
+    assert len(api.sent) == 1
+    assert api.sent[0].messages[0].text == "สรุปนัดหมาย"
+    assert outbox.stats()['depth'] == 0
+
+    # ส่งไปแล้วก็ยังกันซ้ำได้ (เช่นสั่งรันรอบแจ้งเตือนซ้ำในวันเดียวกัน)
+    assert not outbox.enqueue("C1", ["สรุปนัดหมาย"], dedup_key="digest:2030-01-01:C1")
+    assert outbox.drain_once() == 0
+    assert len(api.sent) == 1
+    print("   ✅ enqueue/dedup/send ถูกต้อง")
+
+
+def test_sent_rows_are_purged_after_retention():
+    """แถวที่ส่งแล้วเกินช่วง retention ถูกลบ และ dedup_key ใช้ใหม่ได้"""
+    api = FlakyApi()
+    outbox = PushOutbox(db_path=':memory:', base_backoff=0.0, max_backoff=0.0,
+                        send_interval=0, sent_retention_hours=0)
+    outbox.line_bot_api = api
+    outbox.enqueue("C1", ["hello"], dedup_key="k1")
+    outbox.drain_once()
+
+    outbox._last_purge = 0.0
+    outbox.drain_once()
+    assert outbox.enqueue("C1", ["hello"], dedup_key="k1")
+    print("   ✅ ลบแถวที่ส่งแล้วตาม retention")
+
+
+def test_transient_failure_is_retried_with_same_retry_key():
+    """error ชั่วคราวถูก retry โดยใช้ X-Line-Retry-Key เดิม"""
+    api = FlakyApi(failures=1)
+    outbox = make_outbox(api)
+    outbox.enqueue("C1", ["hello"])
+
+    outbox.drain_once()
+    stats = outbox.stats()
+    assert stats['depth'] == 1 and stats['retrying'] == 1
+
+    time.sleep(0.01)
+    outbox.drain_once()
+    assert len(api.sent) == 1
+    assert api.retry_keys[0] == api.retry_keys[1]
+    print("   ✅ retry ใช้ retry key เดิม")
+
+
+def test_dead_letter_after_max_attempts_and_on_client_error():
+    """ล้มเหลวเกินจำนวนครั้ง หรือได้ 4xx จะย้ายไป dead letter"""
+    outbox = make_outbox(FlakyApi(failures=10), max_attempts=2)
+    outbox.enqueue("C1", ["hello"])
+    outbox.drain_once()
+    time.sleep(0.01)
+    outbox.drain_once()
+    assert outbox.stats()['depth'] == 0
+    assert outbox.stats()['dead_letters'] == 1
+
+    outbox = make_outbox(FlakyApi(failures=1, status=400), max_attempts=5)
+    outbox.enqueue("C2", ["hello"])
+    outbox.drain_once()
+    assert outbox.stats()['dead_letters'] == 1
+    assert outbox.dead_letters()[0]['recipient_id'] == "C2"
+    print("   ✅ dead letter ถูกต้อง")
+
+
+def test_interactive_push_jumps_bulk_queue():
+    """ข้อความตอบโต้ผู้ใช้ถูกส่งก่อน digest ที่ค้างอยู่ในคิว"""
+    from notifications.outbox import PRIORITY_INTERACTIVE
+
+    api = FlakyApi()
+    outbox = make_outbox(api)
+    for index in range(5):
+        outbox.enqueue(f"C{index}", ["สรุปนัดหมาย"], dedup_key=f"digest:C{index}")
+    outbox.enqueue("U1", ["⏳ กำลังลบนัดหมาย"], priority=PRIORITY_INTERACTIVE)
+
+    outbox.drain_once(limit=1)
+    assert api.sent[0].to == "U1"
+    print("   ✅ ข้อความตอบโต้ถูกส่งก่อน")
+
+
+def test_daily_run_sends_urgent_digests_first():
+    """รอบส่งประจำวัน: ผู้รับที่มีนัดใกล้ที่สุดได้รับ digest ก่อน ไม่ว่าจะอยู่ลำดับไหนใน agenda"""
+    from datetime import datetime, timedelta
+    from notifications.notification_service import BANGKOK_TZ
+    from notifications.simulation import (FakeMessagingApi, SimulatedSheetsRepository, build_dataset,
+                                          build_simulated_service)
+    from storage.models import Appointment
+
+    def appointment(recipient_id, days_ahead):
+        when = datetime.now(BANGKOK_TZ).replace(hour=23, minute=0, second=0, microsecond=0) + timedelta(days=days_ahead)
+        return Appointment(id=f"{recipient_id}-{days_ahead}", group_id=recipient_id,
+                           datetime_iso=when.isoformat(), location="", building_floor_dept="", note="นัด")
+
+    api = FakeMessagingApi()
+    service = build_simulated_service(api, SimulatedSheetsRepository(build_dataset(groups=0, appointments_per_group=0)))
+    service.outbox.line_bot_api = api
+    try:
+        service.agenda.finish_reconcile([
+            appointment("C-past", -2), appointment("C-future", 20), appointment("C-week", 4),
+            appointment("C-today", 0), appointment("C-tomorrow", 1), appointment("C-tomorrow", 30),
+        ])
+        service.check_and_send_notifications()
+        while service.outbox.drain_once(limit=2):
+            pass
+        order = [request.to for request in api.pushed]
+        print(f"   send order: {order}")
+        assert order[:2] == ["C-today", "C-tomorrow"]
+        assert order.index("C-week") < order.index("C-future") < order.index("C-past")
+    finally:
+        service.stop_scheduler()
+    print("   ✅ digest นัดด่วนถูกส่งก่อน")
+
+
+if __name__ == "__main__":
+    test_enqueue_and_send_with_dedup()
+    test_sent_rows_are_purged_after_retention()
+    test_transient_failure_is_retried_with_same_retry_key()
+    test_dead_letter_after_max_attempts_and_on_client_error()
+    test_interactive_push_jumps_bulk_queue()
+    test_daily_run_sends_urgent_digests_first()
+    print("🎉 ผ่านทั้งหมด")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+ทดสอบการประหยัดโควตา push ของระบบแจ้งเตือน
+ตรวจสอบตัวนับโควตา, งบรายวันที่ใช้ร่วมกันทุก bucket, การข้าม digest ที่ไม่เปลี่ยน
+(บันทึกเมื่อ outbox ส่งสำเร็จ) และโหมดส่งเฉพาะนัดด่วน
+"""
+
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.notification_service import BANGKOK_TZ
+from notifications.quota import (QuotaTracker, DigestHistory, digest_fingerprint,
+                                 QUOTA_MODE_NORMAL, QUOTA_MODE_URGENT_ONLY)
+from notifications.simulation import (FakeMessagingApi, SimulatedSheetsRepository, build_dataset,
+                                      build_simulated_service)
+from storage.models import Appointment
+
+
+def make_appointment(apt_id, days_ahead, note="นัดทดสอบ"):
+    when = datetime.now(BANGKOK_TZ).replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=days_ahead)
+    return Appointment(id=apt_id, group_id="C1", datetime_iso=when.isoformat(),
+                       location="โรงพยาบาลทดสอบ", building_floor_dept="", note=note)
+
+
+def test_quota_tracker_plans_urgent_only_when_budget_low():
+    """งบวันนี้ไม่พอสำหรับ digest ทุกราย -> ส่งเฉพาะนัดด่วน"""
+    print("🧪 ทดสอบ QuotaTracker")
+    api = FakeMessagingApi(quota_limit=1000, quota_used=100)
+    tracker = QuotaTracker(api, db_path=':memory:')
+    today = date(2030, 1, 30)  # เหลือ 2 วันในเดือน
+
+    assert tracker.plan(50, today) == QUOTA_MODE_NORMAL
+    assert tracker.remaining() == 900
+
+    tracker.record_push("C1")
+    tracker.record_push("C2", message_count=3)  # นับตามจำนวนข้อความใน request
+    assert tracker.local_usage() == 4
+    assert tracker.remaining() == 896
+
+    api.quota_used = 950
+    tracker.refresh(force=True)
+    assert tracker.plan(50, today) == QUOTA_MODE_URGENT_ONLY
+
+    unlimited = QuotaTracker(FakeMessagingApi(), db_path=':memory:')
+    assert unlimited.plan(10_000, today) == QUOTA_MODE_NORMAL
+    print("   ✅ โควตาและโหมดส่งถูกต้อง")
+
+
+def test_daily_allowance_is_spent_down_by_buckets():
+    """งบของวันถูกกำหนดครั้งเดียว แล้วแต่ละ bucket ใช้จากงบที่เหลือ"""
+    print("🧪 ทดสอบงบรายวันข้าม bucket")
+    tracker = QuotaTracker(FakeMessagingApi(quota_limit=1000, quota_used=100), db_path=':memory:')
+    today = date(2030, 1, 30)  # งบวันนี้ (900 - 100 กันไว้) / 2 วัน = 400
+
+    assert tracker.allowance_left(today) == 400
+    assert tracker.plan(300, today) == QUOTA_MODE_NORMAL  # bucket 08:00
+    tracker.spend(300, today)
+    assert tracker.allowance_left(today) == 100
+    assert tracker.plan(150, today) == QUOTA_MODE_URGENT_ONLY  # bucket 18:00 เห็นเฉพาะงบที่เหลือ
+    assert tracker.plan(150, date(2030, 1, 31)) == QUOTA_MODE_NORMAL  # วันใหม่ได้งบใหม่
+    print("   ✅ bucket หลังของวันไม่ได้งบทั้งวันซ้ำ")
+
+
+def test_digest_history_skips_unchanged():
+    """digest เดิมถูกข้ามจนครบ resend_days"""
+    history = DigestHistory(':memory:', resend_days=3)
+    fingerprint = digest_fingerprint([make_appointment("a1", 5)])
+    today = date(2030, 1, 10)
+
+    assert not history.is_unchanged("C1", fingerprint, today)
+    history.remember("C1", fingerprint, today)
+    assert history.is_unchanged("C1", fingerprint, today + timedelta(days=2))
+    assert not history.is_unchanged("C1", fingerprint, today + timedelta(days=3))
+    assert not history.is_unchanged("C1", digest_fingerprint([make_appointment("a1", 6)]), today)
+
+    # digest ที่ enqueue แล้วมีผลเมื่อส่งสำเร็จเท่านั้น
+    history.expect("digest:2030-01-10:C2", "C2", fingerprint, today)
+    assert not history.is_unchanged("C2", fingerprint, today)
+    assert history.confirm("digest:2030-01-10:C2")
+    assert history.is_unchanged("C2", fingerprint, today)
+    assert not history.confirm("digest:2030-01-10:C2")
+    print("   ✅ digest history ถูกต้อง")
+
+
+def test_service_skips_unchanged_digest_but_keeps_urgent():
+    """ข้าม digest ที่ไม่เปลี่ยน เว้นแต่มีนัดวันนี้/พรุ่งนี้"""
+    api = FakeMessagingApi()
+    service = build_simulated_service(api, SimulatedSheetsRepository(build_dataset(groups=1, appointments_per_group=1)))
+    service.outbox.line_bot_api = api  # ส่งแบบ synchronous ด้วย drain_once
+    now = datetime.now(BANGKOK_TZ)
+    try:
+        later = [make_appointment("a1", 5), make_appointment("a2", 12)]
+        assert service._send_daily_notification_summary(later, "C1", now)
+        assert service._send_daily_notification_summary(later, "C1", now)  # ยังไม่ได้ส่งจริง - ไม่ข้าม
+        service.outbox.drain_once()
+        assert not service._send_daily_notification_summary(later, "C1", now)
+        assert service.quota.local_usage() >= 1
+
+        urgent = [make_appointment("b1", 1), make_appointment("b2", 12)]
+        assert service._send_daily_notification_summary(urgent, "C2", now)
+        assert service._send_daily_notification_summary(urgent, "C2", now)
+
+        # โควตาใกล้หมด: ไม่มีนัดด่วน = ไม่ส่ง, มีนัดด่วน = ส่งเฉพาะนัดด่วน
+        assert not service._send_daily_notification_summary([make_appointment("c1", 4)], "C3", now,
+                                                             QUOTA_MODE_URGENT_ONLY)
+        assert service._send_daily_notification_summary(urgent, "C4", now, QUOTA_MODE_URGENT_ONLY)
+    finally:
+        service.stop_scheduler()
+    print("   ✅ service ข้าม digest ที่ไม่เปลี่ยน")
+
+
+if __name__ == "__main__":
+    test_quota_tracker_plans_urgent_only_when_budget_low()
+    test_daily_allowance_is_spent_down_by_buckets()
+    test_digest_history_skips_unchanged()
+    test_service_skips_unchanged_digest_but_keeps_urgent()
+    print("🎉 ผ่านทั้งหมด")
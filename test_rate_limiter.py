@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ rate limiter ของคำสั่ง (utils/rate_limiter.py)
+ตรวจ sliding window ต่อผู้ใช้และต่อกลุ่ม, การอ่าน COMMAND_RATE_LIMITS, การตอบด้วยคำตอบล่าสุด
+ของคำสั่งอ่านอย่างเดียว และการล้างคำตอบเมื่อข้อมูลใน worksheet เปลี่ยน
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from handlers import COMMAND_ROUTER, COMMAND_THROTTLE
+from storage import change_feed
+from storage.change_feed import ChangeEvent
+from utils.rate_limiter import CommandThrottle, RateLimit, parse_rate_limits
+
+
+def command(name):
+    return next(command for command in COMMAND_ROUTER.commands if command.name == name)
+
+
+def test_parse_rate_limits():
+    print("🧪 ทดสอบการอ่าน COMMAND_RATE_LIMITS")
+    limits = parse_rate_limits("default=6/15/60, list_appointments=3/6/30,broken=1/2,")
+    assert limits == {'default': RateLimit(6, 15, 60.0), 'list_appointments': RateLimit(3, 6, 30.0)}
+    assert set(COMMAND_THROTTLE.limits) >= {'default', 'list_appointments'}
+    print("   ✅ ข้ามรายการที่รูปแบบผิด")
+
+
+def test_sliding_window_per_user_and_group():
+    print("🧪 ทดสอบ sliding window ต่อผู้ใช้และต่อกลุ่ม")
+    throttle = CommandThrottle({'list_appointments': RateLimit(2, 3, 0.3)})
+    list_command = command('list_appointments')
+
+    assert throttle.acquire(list_command, 'U1', 'group', 'G1') == 0
+    assert throttle.acquire(list_command, 'U1', 'group', 'G1') == 0
+    assert 0 < throttle.acquire(list_command, 'U1', 'group', 'G1') <= 0.3  # เกินขีดของผู้ใช้
+    assert throttle.acquire(list_command, 'U2', 'group', 'G1') == 0
+    assert throttle.acquire(list_command, 'U3', 'group', 'G1') > 0  # เกินขีดของกลุ่ม
+    assert throttle.acquire(list_command, 'U3', 'group', 'G2') == 0  # กลุ่มอื่นไม่กระทบ
+    assert throttle.acquire(list_command, 'U1', 'personal', 'U1') > 0  # ขีดของผู้ใช้นับข้ามแชท
+
+    time.sleep(0.35)
+    assert throttle.acquire(list_command, 'U1', 'group', 'G1') == 0  # window เลื่อนไปแล้ว
+    stats = throttle.stats()
+    assert stats['throttled_total'] == {'list_appointments': 3} and stats['allowed_total'] == 5
+    print("   ✅ นับทั้งผู้ใช้และกลุ่ม และปล่อยเมื่อ window เลื่อน")
+
+
+def test_default_limit_only_for_sheets_commands():
+    print("🧪 ทดสอบขีดจำกัด default")
+    throttle = CommandThrottle({'default': RateLimit(1, 1, 60)})
+    assert throttle.limit_for(command('help')) is None
+    assert throttle.limit_for(command('delete_appointment')) == RateLimit(1, 1, 60)
+    for _ in range(5):
+        assert throttle.acquire(command('help'), 'U1', 'personal', 'U1') == 0
+    assert throttle.acquire(command('delete_appointment'), 'U1', 'personal', 'U1') == 0
+    assert throttle.acquire(command('delete_appointment'), 'U1', 'personal', 'U1') > 0
+    print("   ✅ คำสั่งที่ไม่ใช้ Sheets ไม่ถูกจำกัด")
+
+
+def test_throttled_replies_use_cache():
+    print("🧪 ทดสอบคำตอบเมื่อเกินขีดจำกัด")
+    throttle = CommandThrottle({'default': RateLimit(1, 1, 60)})
+    list_command, delete_command = command('list_appointments'), command('delete_appointment')
+
+    reply = throttle.throttled_reply(list_command, 'group', 'G1', 'ดูนัด', 12.2)
+    assert '13 วินาที' in reply  # ยังไม่มีคำตอบที่เก็บไว้
+
+    throttle.remember_reply(list_command, 'group', 'G1', 'ดูนัด', "📋 นัดหมาย 2 รายการ")
+    throttle.remember_reply(delete_command, 'group', 'G1', 'ลบนัด a', "ลบแล้ว")  # ไม่ใช่คำสั่งอ่านอย่างเดียว
+    reply = throttle.throttled_reply(list_command, 'group', 'G1', 'ดูนัด', 5)
+    assert reply.startswith("📋 นัดหมาย 2 รายการ") and 'วินาทีที่แล้ว' in reply
+    assert throttle.throttled_reply(list_command, 'group', 'G2', 'ดูนัด', 5).startswith('⏳')
+    assert throttle.throttled_reply(delete_command, 'group', 'G1', 'ลบนัด a', 5).startswith('⏳')
+    assert throttle.stats()['cached_replies_total'] == 1
+
+    throttle.invalidate('personal')
+    assert throttle.stats()['cached_replies'] == 1
+    throttle.invalidate('group_G1')
+    assert throttle.throttled_reply(list_command, 'group', 'G1', 'ดูนัด', 5).startswith('⏳')
+
+    expired = CommandThrottle({}, cache_seconds=0.05)
+    expired.remember_reply(list_command, 'personal', 'U1', 'ดูนัด', "เก่า")
+    time.sleep(0.1)
+    assert expired.throttled_reply(list_command, 'personal', 'U1', 'ดูนัด', 5).startswith('⏳')
+    print("   ✅ ตอบจากคำตอบล่าสุดหรือขอให้รอ")
+
+
+def test_change_feed_invalidates_shared_cache():
+    print("🧪 ทดสอบการล้างคำตอบเมื่อมีการแก้ไขนัดหมาย")
+    list_command = command('list_appointments')
+    COMMAND_THROTTLE.remember_reply(list_command, 'group', 'Gfeed', 'ดูนัด', "📋 ก่อนเพิ่มนัด")
+    assert COMMAND_THROTTLE.throttled_reply(list_command, 'group', 'Gfeed', 'ดูนัด', 5).startswith("📋")
+    change_feed.publish(ChangeEvent(op='add', context='group_Gfeed', appointment_id='A1'))
+    assert COMMAND_THROTTLE.throttled_reply(list_command, 'group', 'Gfeed', 'ดูนัด', 5).startswith('⏳')
+    print("   ✅ คำตอบเก่าไม่ถูกใช้หลังข้อมูลเปลี่ยน")
+
+
+if __name__ == "__main__":
+    test_parse_rate_limits()
+    test_sliding_window_per_user_and_group()
+    test_default_limit_only_for_sheets_commands()
+    test_throttled_replies_use_cache()
+    test_change_feed_invalidates_shared_cache()
+    print("🎉 ผ่านทั้งหมด")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ run metrics: ring buffer ของรอบล่าสุด, เวลาต่อขั้นตอน และ p50/p95 latency ของ push
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from utils.run_metrics import RunMetrics, percentile, get_run_metrics
+
+
+def test_percentile_nearest_rank():
+    print("🧪 ทดสอบ percentile")
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile([3.0], 95) == 3.0
+    assert percentile([], 50) is None
+    print("   ✅ percentile ถูกต้อง")
+
+
+def test_ring_buffer_and_nested_runs():
+    """เก็บเฉพาะรอบล่าสุด, รอบซ้อนใช้รอบเดิม และรอบที่ล้มเหลวถูกนับ"""
+    metrics = RunMetrics(history=3, latency_samples=10)
+    for index in range(5):
+        with metrics.run('notification', label=f"b{index}"):
+            with metrics.stage('rendering'):
+                pass
+            with metrics.run('reconcile'):  # reconcile ภายในรอบแจ้งเตือน
+                with metrics.stage('sheet_reads'):
+                    pass
+                metrics.count('sheet_reads', 2)
+
+    runs = metrics.recent_runs()
+    assert [run['label'] for run in runs] == ['b4', 'b3', 'b2']
+    assert set(runs[0]['stages_ms']) == {'rendering', 'sheet_reads'}
+    assert runs[0]['counts'] == {'sheet_reads': 2}
+
+    try:
+        with metrics.run('notification', label='boom'):
+            metrics.error('digest')
+            raise RuntimeError("sheet down")
+    except RuntimeError:
+        pass
+    failed = metrics.recent_runs(limit=1)[0]
+    assert failed['status'] == 'failed'
+    assert failed['errors'] == {'digest': 1, 'RuntimeError': 1}
+
+    metrics.count('ignored')  # นอกรอบ - ไม่มีผล
+    for ms in range(1, 21):
+        metrics.record_push(ms / 1000.0, error='500' if ms == 20 else None)
+    latency = metrics.push_latency()
+    assert latency['samples'] == 10  # เก็บ 10 sample ล่าสุด (11..20 ms)
+    assert latency['p50_ms'] == 15.0 and latency['p95_ms'] == 20.0
+    assert latency['errors'] == {'500': 1}
+    print("   ✅ ring buffer ถูกต้อง")
+
+
+def test_simulated_run_reports_stages():
+    """รอบจำลองต้องรายงานเวลาของทุกขั้นตอนและ latency ของ push"""
+    from simulate_notifications import main
+
+    report = main(['--groups', '4', '--personal-users', '2', '--appointments', '3', '--json'])
+    stages = report['runs'][0]['stages_ms']
+    for stage in ('worksheet_discovery', 'sheet_reads', 'decode', 'grouping', 'rendering', 'queueing'):
+        assert stage in stages, stage
+    assert 'pushes' not in stages  # push จริงเกิดใน outbox sender ไม่ใช่ในรอบ
+    assert report['runs'][0]['push_latency']['p50_ms'] is not None
+
+    latest = get_run_metrics().recent_runs(limit=1)[0]
+    assert latest['kind'] == 'notification' and latest['counts']['recipients'] == 6
+    assert get_run_metrics().push_latency()['samples'] >= 6
+    print("   ✅ รอบจำลองรายงานเวลาต่อขั้นตอน")
+
+
+if __name__ == "__main__":
+    test_percentile_nearest_rank()
+    test_ring_buffer_and_nested_runs()
+    test_simulated_run_reports_stages()
+    print("🎉 ผ่านทั้งหมด")
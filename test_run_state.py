@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ run ledger และการ catch-up รอบแจ้งเตือนที่พลาดไประหว่าง restart
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from notifications.notification_service import BANGKOK_TZ
+from notifications.run_state import RunStateStore
+from notifications.simulation import (FakeMessagingApi, SimulatedSheetsRepository, build_dataset,
+                                      build_simulated_service)
+
+
+def make_service(api, jobstore_path=':memory:'):
+    spreadsheet = build_dataset(groups=3, appointments_per_group=4, seed=7)
+    service = build_simulated_service(api, SimulatedSheetsRepository(spreadsheet), jobstore_path=jobstore_path)
+    service.outbox.line_bot_api = api
+    return service
+
+
+def test_ledger_roundtrip():
+    """บันทึกรอบที่เสร็จแล้วและอ่านกลับได้"""
+    print("🧪 Testing run ledger...")
+    store = RunStateStore(':memory:')
+    assert not store.has_completed('08:00', '2025-10-01')
+    store.mark_completed('08:00', '2025-10-01', recipients=3)
+    store.mark_completed('08:00', '2025-10-02', recipients=2)
+    assert store.has_completed('08:00', '2025-10-01')
+    assert not store.has_completed('08:15', '2025-10-01')
+    assert store.last_completed('08:00') == '2025-10-02'
+    print("✅ Ledger OK")
+
+
+def test_bucket_runs_once_per_day():
+    """bucket เดียวกันรันซ้ำในวันเดียวกันต้องไม่ส่งสรุปซ้ำ"""
+    print("🧪 Testing bucket run idempotency...")
+    api = FakeMessagingApi()
+    service = make_service(api)
+    try:
+        service.reconcile_agenda()
+        recipients = list(service.agenda.snapshot())
+        bucket = service.delivery_schedule.bucket_for(recipients[0])
+
+        service.check_and_send_notifications(bucket)
+        while service.outbox.drain_once():
+            pass
+        first = api.calls['push_message']
+        assert first > 0
+
+        service.check_and_send_notifications(bucket)
+        while service.outbox.drain_once():
+            pass
+        print(f"   pushes after first run: {first}, after second: {api.calls['push_message']}")
+        assert api.calls['push_message'] == first
+        today = datetime.now(BANGKOK_TZ).date().isoformat()
+        assert service.run_state.has_completed(bucket, today)
+    finally:
+        service.stop_scheduler()
+    print("✅ Bucket idempotency OK")
+
+
+def test_claim_is_exclusive():
+    """จองรอบเดียวกันได้เพียงครั้งเดียว แม้จาก store คนละ connection บนไฟล์เดียวกัน"""
+    print("🧪 Testing exclusive run claim...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'state.sqlite3')
+        worker_a, worker_b = RunStateStore(path), RunStateStore(path)
+        assert worker_a.claim('08:00', '2025-10-01')
+        assert not worker_b.claim('08:00', '2025-10-01')
+        assert not worker_a.has_completed('08:00', '2025-10-01')
+
+        worker_a.release('08:00', '2025-10-01')
+        assert worker_b.claim('08:00', '2025-10-01')
+        worker_b.mark_completed('08:00', '2025-10-01', recipients=1)
+        worker_b.release('08:00', '2025-10-01')  # รอบที่เสร็จแล้วปล่อยไม่ได้
+        assert worker_a.has_completed('08:00', '2025-10-01')
+        assert not worker_a.claim('08:00', '2025-10-01')
+    print("✅ Exclusive claim OK")
+
+
+def _persist_jobs_with_missed_bucket(path):
+    """สร้าง job store แล้วเลื่อนเวลารันของ bucket แรกไปในอดีต (เหมือน process หยุดตอนถึงเวลา)"""
+    api = FakeMessagingApi()
+    first = make_service(api, jobstore_path=path)
+    first.start_scheduler()
+    job_ids = sorted(job.id for job in first.scheduler.get_jobs() if job.id.startswith('notification_bucket_'))
+    assert job_ids, "bucket jobs should be persisted"
+    first.stop_scheduler()
+
+    editor = make_service(api, jobstore_path=path)
+    editor.scheduler.start(paused=True)
+    editor.scheduler.modify_job(job_ids[0], next_run_time=datetime.now(BANGKOK_TZ) - timedelta(minutes=10))
+    # ไม่ shutdown editor: APScheduler ประมวลผล job ที่ถึงกำหนดหนึ่งรอบตอน shutdown แม้จะ paused
+    return job_ids[0]
+
+
+def test_missed_run_detected_after_restart():
+    """job ที่เวลารันผ่านไประหว่าง process ไม่ทำงานต้องถูกตรวจพบและรันย้อนหลัง"""
+    print("🧪 Testing missed-run catch-up across restart...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'state.sqlite3')
+        missed_job_id = _persist_jobs_with_missed_bucket(path)
+
+        service = make_service(FakeMessagingApi(), jobstore_path=path)
+        service.start_scheduler()
+        try:
+            print(f"   missed runs: {service.missed_runs}")
+            assert [run['job_id'] for run in service.missed_runs] == [missed_job_id]
+            assert service.missed_runs[0]['within_grace']
+
+            # หลัง catch-up เวลารันถัดไปต้องเลื่อนไปอนาคต
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                if service.scheduler.get_job(missed_job_id).next_run_time > datetime.now(BANGKOK_TZ):
+                    break
+                time.sleep(0.05)
+            assert service.scheduler.get_job(missed_job_id).next_run_time > datetime.now(BANGKOK_TZ)
+        finally:
+            service.stop_scheduler()
+    print("✅ Missed-run catch-up OK")
+
+
+def test_missed_run_caught_up_from_ledger():
+    """job store ใหม่ (นัดรอบถัดไปเป็นพรุ่งนี้) แต่ ledger ยังไม่มีรอบของวันนี้ - ต้องส่งย้อนหลังทันที"""
+    print("🧪 Testing ledger-based catch-up with a fresh job store...")
+    now = datetime.now(BANGKOK_TZ)
+    today = now.date().isoformat()
+    yesterday = (now - timedelta(days=1)).date().isoformat()
+    passed = max(now - timedelta(minutes=10), now.replace(hour=0, minute=0, second=0, microsecond=0))
+    bucket = passed.strftime('%H:%M')
+
+    service = make_service(FakeMessagingApi())
+    service.delivery_schedule.occupied_buckets = lambda: {bucket}
+    assert service._detect_missed_runs() == []  # bucket ที่ไม่เคยส่งมาก่อนไม่ถือว่าพลาด
+    service.run_state.mark_completed(bucket, yesterday, 3)
+    service.start_scheduler()
+    try:
+        print(f"   missed runs: {service.missed_runs}")
+        assert [(run['bucket'], run['catch_up']) for run in service.missed_runs] == [(bucket, 'ledger')]
+        assert service.missed_runs[0]['last_completed'] == yesterday
+        deadline = time.time() + 5
+        while time.time() < deadline and not service.run_state.has_completed(bucket, today):
+            time.sleep(0.05)
+        assert service.run_state.has_completed(bucket, today)
+        assert service.run_state.last_completed(bucket) == today
+
+        assert service._detect_missed_runs() == []  # รอบของวันนี้เสร็จแล้ว
+    finally:
+        service.stop_scheduler()
+    print("✅ Ledger catch-up OK")
+
+
+class SimulatedCrash(BaseException):
+    """จำลอง process ตายกลางรอบ (ไม่ถูก except Exception ของ service จับ)"""
+
+
+def test_interrupted_run_resumes_from_checkpoint():
+    """รอบที่หยุดกลางทางถูกรับช่วงต่อจาก batch ที่ยังไม่เสร็จ - ไม่ส่งซ้ำและไม่ตกหล่น"""
+    print("🧪 Testing checkpointed run resume...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'state.sqlite3')
+        spreadsheet = build_dataset(groups=7, appointments_per_group=2, seed=11)
+        first_api, second_api = FakeMessagingApi(), FakeMessagingApi()
+
+        first = build_simulated_service(first_api, SimulatedSheetsRepository(spreadsheet),
+                                        run_state=RunStateStore(path))
+        first.outbox.line_bot_api = first_api
+        first.run_batch_size = 3
+        first.reconcile_agenda()
+        recipients = list(first.agenda.snapshot())
+        first.delivery_schedule.bucket_for = lambda recipient_id: '08:00'
+        first.delivery_schedule.recipients_in_bucket = lambda bucket, agenda: list(agenda)
+
+        send = first._send_daily_notification_summary
+        sent_before_crash = []
+
+        def crash_in_second_batch(appointments, recipient_id, *args):
+            if len(sent_before_crash) == 3:
+                raise SimulatedCrash()
+            sent_before_crash.append(recipient_id)
+            return send(appointments, recipient_id, *args)
+
+        first._send_daily_notification_summary = crash_in_second_batch
+        try:
+            first.check_and_send_notifications('08:00')
+        except SimulatedCrash:
+            pass
+        while first.outbox.drain_once():
+            pass
+
+        today = datetime.now(BANGKOK_TZ).date().isoformat()
+        status = first.run_status()[0]
+        print(f"   status after crash: {status['batches_done']}/{status['batches_total']} batches, "
+              f"{status['progress_percent']}%")
+        assert status['status'] == 'running' and status['batches_done'] == 1 and status['batches_total'] == 3
+        assert status['progress_percent'] == round(100 * 3 / 7, 1)
+
+        # worker ใหม่: lease ยังไม่หมด = ไม่รับช่วง, หมดแล้ว = ทำต่อจาก batch ที่สอง
+        second = build_simulated_service(second_api, SimulatedSheetsRepository(spreadsheet),
+                                         run_state=RunStateStore(path))
+        second.outbox.line_bot_api = second_api
+        second.check_and_send_notifications('08:00')
+        assert second_api.calls['push_message'] == 0
+
+        second.run_lease_seconds = 0
+        time.sleep(0.01)
+        second.check_and_send_notifications('08:00')
+        while second.outbox.drain_once():
+            pass
+
+        first_recipients = [request.to for request in first_api.pushed]
+        second_recipients = [request.to for request in second_api.pushed]
+        assert first_recipients == sent_before_crash
+        assert not set(first_recipients) & set(second_recipients)
+        assert sorted(first_recipients + second_recipients) == sorted(recipients)
+        assert second.run_state.has_completed('08:00', today)
+        assert second.run_status()[0]['progress_percent'] == 100.0
+    print("✅ Checkpointed resume OK")
+
+
+class BlockingSettingsRepository(SimulatedSheetsRepository):
+    """Repository ที่การอ่าน settings ครั้งที่สองขึ้นไปค้างจนกว่าจะปล่อย (จำลอง Sheets ช้าระหว่าง reconcile)"""
+
+    def __init__(self, spreadsheet):
+        super().__init__(spreadsheet)
+        self.reads = 0
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def get_notification_settings(self):
+        self.reads += 1
+        if self.reads > 1:
+            self.entered.set()
+            self.release.wait(timeout=30)
+        return super().get_notification_settings()
+
+
+def test_stop_during_catch_up_does_not_hang():
+    """หยุด scheduler ระหว่างที่รอบ catch-up กำลัง reconcile ต้องไม่ค้าง"""
+    print("🧪 Testing shutdown during a running bucket job...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'state.sqlite3')
+        _persist_jobs_with_missed_bucket(path)
+
+        repo = BlockingSettingsRepository(build_dataset(groups=3, appointments_per_group=4, seed=7))
+        service = build_simulated_service(FakeMessagingApi(), repo, jobstore_path=path)
+        service.start_scheduler()
+        try:
+            assert repo.entered.wait(timeout=10), "catch-up run should reach the settings read"
+            stopper = threading.Thread(target=service.stop_scheduler, daemon=True)
+            stopper.start()
+            stopper.join(timeout=5)
+            assert not stopper.is_alive(), "stop_scheduler blocked on the running job"
+        finally:
+            repo.release.set()
+            time.sleep(0.5)  # ให้ job ที่ค้างอยู่จบก่อนลบไฟล์
+    print("✅ Shutdown OK")
+
+
+if __name__ == "__main__":
+    test_ledger_roundtrip()
+    test_bucket_runs_once_per_day()
+    test_claim_is_exclusive()
+    test_missed_run_detected_after_restart()
+    test_missed_run_caught_up_from_ledger()
+    test_interrupted_run_resumes_from_checkpoint()
+    test_stop_during_catch_up_does_not_hang()
+    print("\n🎉 All run state tests passed!")
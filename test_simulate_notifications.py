@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ notification run simulator
+รันรอบแจ้งเตือนกับ LINE API และ Google Sheets จำลอง
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from simulate_notifications import main
+from notifications.simulation import SimulatedSheetsRepository, build_dataset
+
+
+def test_simulated_run_pushes_every_group():
+    """ทุกกลุ่มที่มีนัดหมายต้องได้รับสรุปหนึ่งข้อความ และรอบที่สองไม่อ่าน Sheets ซ้ำ"""
+    print("🧪 ทดสอบ notification simulator")
+
+    report = main(['--groups', '5', '--appointments', '4', '--runs', '2', '--json'])
+    first, second = report['runs']
+
+    assert first['pushes'] == 5
+    assert first['sheets_calls'] > 0
+    assert second['pushes'] == 5
+    assert second['sheets_calls'] == 0  # ใช้ agenda ที่ materialize ไว้แล้ว
+    print("   ✅ simulator ทำงานถูกต้อง")
+
+
+def test_personal_users_read_once():
+    """นัดหมายส่วนตัวของผู้ใช้ทุกคนอ่านจาก appointments_personal ครั้งเดียว และผู้ใช้ทุกคนได้รับสรุป"""
+    spreadsheet = build_dataset(groups=0, appointments_per_group=3, personal_users=4, seed=3)
+    by_user = SimulatedSheetsRepository(spreadsheet).get_appointments_by_user("personal")
+    assert len(by_user) == 4
+    assert all(len(appointments) == 3 and all(apt.group_id == user_id for apt in appointments)
+               for user_id, appointments in by_user.items())
+    assert spreadsheet.calls['get_all_records'] == 1
+
+    report = main(['--groups', '2', '--personal-users', '6', '--appointments', '3', '--json'])
+    assert report['runs'][0]['pushes'] == 8
+    print("   ✅ personal users ได้รับแจ้งเตือนจากการอ่านครั้งเดียว")
+
+
+if __name__ == "__main__":
+    test_simulated_run_pushes_every_group()
+    test_personal_users_read_once()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+ทดสอบการกัน webhook event ซ้ำด้วย webhookEventId
+ตรวจ TTL, ขนาดสูงสุด, การจำข้าม restart และการทิ้ง event ที่ LINE ส่งซ้ำใน dispatcher
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from test_webhook_dispatcher import make_dispatcher, sign, wait_for
+from utils.webhook_dedup import WebhookEventDedup
+from utils.webhook_dispatcher import WebhookQueueFull
+
+
+def make_body(event_ids, redelivery=False):
+    events = [{
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'webhookEventId': event_id,
+        'deliveryContext': {'isRedelivery': redelivery},
+        'replyToken': f'token-{event_id}',
+        'source': {'type': 'user', 'userId': 'U1'},
+        'message': {'type': 'text', 'id': event_id, 'quoteToken': 'q', 'text': event_id}
+    } for event_id in event_ids]
+    return json.dumps({'destination': 'Ubot', 'events': events})
+
+
+def test_memory_dedup_ttl_and_bound():
+    print("🧪 ทดสอบ dedup ในหน่วยความจำ")
+    dedup = WebhookEventDedup(ttl_seconds=0.05, max_entries=2, persist=False)
+    assert dedup.claim("E1", redelivered=False)
+    assert not dedup.claim("E1")
+    assert dedup.claim(None) and dedup.claim(None)  # ไม่มี id - ประมวลผลเสมอ
+
+    time.sleep(0.06)
+    assert dedup.claim("E1")  # หมดอายุแล้ว
+
+    dedup.ttl = 60
+    dedup.claim("E2")
+    dedup.claim("E3")
+    assert dedup.stats()['tracked'] == 2
+    assert dedup.claim("E1")  # ถูกดันออกเพราะเกิน max_entries
+    assert dedup.stats()['duplicates_total'] == 1
+    print("   ✅ TTL และขนาดสูงสุดทำงาน")
+
+
+def test_persistent_dedup_survives_restart():
+    print("🧪 ทดสอบ dedup ข้าม restart")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'dedup.sqlite3')
+        first = WebhookEventDedup(db_path=db_path, persist=True)
+        assert first.claim("E1", redelivered=False)
+        assert first.claim("E2")
+
+        second = WebhookEventDedup(db_path=db_path, persist=True)  # process ใหม่
+        assert not second.claim("E1")
+        assert not second.claim("E2")
+        assert second.claim("E3")
+        assert second.stats()['duplicates_total'] == 2
+    print("   ✅ event ที่เห็นก่อน restart ยังถูกกัน")
+
+
+def test_claim_is_atomic_and_keeps_expiry_order():
+    print("🧪 ทดสอบ claim ระหว่างหลาย worker")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'dedup.sqlite3')
+        first = WebhookEventDedup(db_path=db_path, persist=True)
+        second = WebhookEventDedup(db_path=db_path, persist=True)  # gunicorn worker อีกตัว
+        # ส่งครั้งแรก (isRedelivery = false) ถึงสอง worker - ประมวลผลได้ครั้งเดียว
+        assert first.claim("E1", redelivered=False)
+        assert not second.claim("E1", redelivered=False)
+
+        # แถวที่หมดอายุแต่ยังไม่ถูก purge นับเป็น event ใหม่
+        first._conn.execute("UPDATE webhook_events SET seen_at = ? WHERE event_id = 'E1'", (time.time() - 7200,))
+        third = WebhookEventDedup(ttl_seconds=3600, db_path=db_path, persist=True)
+        assert third.claim("E1")
+
+        # event ที่พบซ้ำในไฟล์ถูกจำด้วยเวลาปัจจุบัน - ลำดับเวลาในหน่วยความจำไม่เสีย
+        second.claim("E2")
+        seen = list(second._seen.values())
+        assert seen == sorted(seen)
+        second.ttl = 0.05
+        time.sleep(0.06)
+        second.claim("E3")
+        assert list(second._seen) == ["E3"]
+    print("   ✅ INSERT ... ON CONFLICT ตัดสินจาก rowcount และหมดอายุตามลำดับ")
+
+
+def test_dispatcher_drops_redelivered_events():
+    print("🧪 ทดสอบ dispatcher ทิ้ง event ที่ส่งซ้ำ")
+    dispatcher, received, release = make_dispatcher()
+    dispatcher.dedup = WebhookEventDedup(persist=False)
+    release.set()
+    dispatcher.start()
+    try:
+        body = make_body(["A1", "A2"])
+        assert dispatcher.submit(body, sign(body)) == 2
+        assert wait_for(lambda: len(received) == 2)
+
+        redelivered = make_body(["A2", "A3"], redelivery=True)
+        assert dispatcher.submit(redelivered, sign(redelivered)) == 1
+        assert wait_for(lambda: len(received) == 3)
+        assert sorted(received) == ["A1", "A2", "A3"]
+
+        stats = dispatcher.stats()
+        assert stats['duplicates_total'] == 1
+        assert stats['redelivered_total'] == 2
+    finally:
+        dispatcher.stop()
+    print("   ✅ ประมวลผลเฉพาะ event ใหม่")
+
+
+def test_rejected_payload_is_not_claimed():
+    """payload ที่ถูกปฏิเสธเพราะคิวเต็มต้องประมวลผลได้เมื่อ LINE ส่งซ้ำ"""
+    dispatcher, _, _ = make_dispatcher(max_queue=1)  # ไม่ start
+    dispatcher.dedup = WebhookEventDedup(persist=False)
+    body = make_body(["B1", "B2"])
+    try:
+        dispatcher.submit(body, sign(body))
+        assert False, "queue overflow must raise"
+    except WebhookQueueFull:
+        pass
+    assert dispatcher.dedup.stats()['tracked'] == 0
+    retry = make_body(["B1"], redelivery=True)
+    assert dispatcher.submit(retry, sign(retry)) == 1
+    print("   ✅ payload ที่ถูกปฏิเสธไม่ถูกจำ")
+
+
+if __name__ == "__main__":
+    test_memory_dedup_ttl_and_bound()
+    test_persistent_dedup_survives_restart()
+    test_claim_is_atomic_and_keeps_expiry_order()
+    test_dispatcher_drops_redelivered_events()
+    test_rejected_payload_is_not_claimed()
+    print("🎉 ผ่านทั้งหมด")
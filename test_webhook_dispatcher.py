@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+ทดสอบ WebhookDispatcher
+ตรวจ signature ใน request thread, ตอบกลับทันทีขณะ worker ประมวลผล event,
+ปฏิเสธเมื่อคิวเต็ม, บันทึกอายุของ reply token, เรียง event ต่อแชท และข้ามข้อความสนทนาในกลุ่ม
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+from handlers import is_bot_event
+from utils.webhook_dispatcher import WebhookDispatcher, WebhookQueueFull, defer_in_chat
+
+CHANNEL_SECRET = "test-secret"
+
+
+def sign(body: str) -> str:
+    digest = hmac.new(CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def make_body(texts, age_seconds=0.0, sources=None):
+    timestamp = int((time.time() - age_seconds) * 1000)
+    sources = sources or [{'type': 'user', 'userId': 'U1'}] * len(texts)
+    events = [{
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': timestamp,
+        'webhookEventId': f'E{index}',
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': f'token-{index}',
+        'source': source,
+        'message': {'type': 'text', 'id': str(index), 'quoteToken': 'q', 'text': text}
+    } for index, (text, source) in enumerate(zip(texts, sources))]
+    return json.dumps({'destination': 'Ubot', 'events': events})
+
+
+def make_dispatcher(workers=2, max_queue=10):
+    handler = WebhookHandler(CHANNEL_SECRET)
+    received = []
+    release = threading.Event()
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        release.wait(timeout=5)
+        received.append(event.message.text)
+
+    return WebhookDispatcher(handler, workers=workers, max_queue=max_queue), received, release
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_submit_returns_before_processing():
+    print("🧪 ทดสอบ webhook ตอบกลับทันที")
+    dispatcher, received, release = make_dispatcher()
+    dispatcher.start()
+    try:
+        body = make_body(["ดูนัด", "help"])
+        started = time.time()
+        assert dispatcher.submit(body, sign(body)) == 2
+        assert time.time() - started < 0.1
+        assert received == []  # handler ยังทำงานอยู่ใน worker
+
+        release.set()
+        assert wait_for(lambda: len(received) == 2)
+        assert sorted(received) == ["help", "ดูนัด"]
+        stats = dispatcher.stats()
+        assert stats['processed_total'] == 2 and stats['depth'] == 0
+        assert stats['reply_token_age']['samples'] == 2
+    finally:
+        dispatcher.stop()
+    print("   ✅ event ถูกประมวลผลใน worker pool")
+
+
+def test_invalid_signature_is_rejected_inline():
+    dispatcher, _, _ = make_dispatcher()
+    body = make_body(["ดูนัด"])
+    try:
+        dispatcher.submit(body, sign(body + " "))
+        assert False, "invalid signature must raise"
+    except InvalidSignatureError:
+        pass
+    assert dispatcher.stats()['accepted_total'] == 0
+    assert dispatcher.submit(json.dumps({'destination': 'Ubot', 'events': []}),
+                             sign(json.dumps({'destination': 'Ubot', 'events': []}))) == 0
+    print("   ✅ signature ไม่ถูกต้องถูกปฏิเสธ")
+
+
+def test_full_queue_rejects_whole_payload():
+    dispatcher, _, _ = make_dispatcher(max_queue=3)  # ไม่ start - event ค้างในคิว
+    first = make_body(["a", "b"])
+    assert dispatcher.submit(first, sign(first)) == 2
+    second = make_body(["c", "d"])
+    try:
+        dispatcher.submit(second, sign(second))
+        assert False, "queue overflow must raise"
+    except WebhookQueueFull:
+        pass
+    stats = dispatcher.stats()
+    assert stats['depth'] == 2 and stats['rejected_total'] == 2
+    print("   ✅ คิวเต็มปฏิเสธทั้ง payload")
+
+
+def test_concurrent_submits_respect_queue_limit():
+    """submit พร้อมกันหลาย thread: ตรวจคิวและเข้าคิวเป็นขั้นตอนเดียว - ไม่เกิน max_queue"""
+    dispatcher, _, _ = make_dispatcher(max_queue=10)  # ไม่ start - event ค้างในคิว
+    barrier = threading.Barrier(40)
+    results = []
+
+    def submit(index):
+        body = make_body([f"ดูนัด {index}"])
+        barrier.wait()
+        try:
+            results.append(dispatcher.submit(body, sign(body)))
+        except WebhookQueueFull:
+            results.append(0)
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = dispatcher.stats()
+    assert sum(results) == 10 and stats['depth'] == 10 and stats['rejected_total'] == 30
+    print("   ✅ submit พร้อมกันไม่เกินขนาดคิว")
+
+
+def test_expired_reply_tokens_are_counted():
+    dispatcher, received, release = make_dispatcher()
+    release.set()
+    dispatcher.start()
+    try:
+        body = make_body(["ดูนัด"], age_seconds=120)
+        dispatcher.submit(body, sign(body))
+        assert wait_for(lambda: received == ["ดูนัด"])
+        assert wait_for(lambda: dispatcher.stats()['processed_total'] == 1)
+        stats = dispatcher.stats()
+        assert stats['expired_tokens_total'] == 1
+        assert stats['reply_token_age']['max_ms'] >= 120_000
+    finally:
+        dispatcher.stop()
+    print("   ✅ นับ reply token ที่หมดอายุ")
+
+
+def test_same_chat_in_order_other_chats_in_parallel():
+    """event ของกลุ่มเดียวกันทำทีละ event ตามลำดับ กลุ่มต่างกันทำพร้อมกัน"""
+    print("🧪 ทดสอบการเรียง event ต่อแชท")
+    handler = WebhookHandler(CHANNEL_SECRET)
+    spans = []
+    lock = threading.Lock()
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        started = time.perf_counter()
+        time.sleep(0.05)
+        with lock:
+            spans.append((event.source.group_id, event.message.text, started, time.perf_counter()))
+
+    dispatcher = WebhookDispatcher(handler, workers=4, max_queue=20)
+    dispatcher.start()
+    try:
+        group = lambda group_id: {'type': 'group', 'groupId': group_id, 'userId': 'U1'}
+        texts = ["เพิ่มนัด", "ดูนัด", "ลบนัด", "แก้ไขนัด", "ดูนัด"]
+        sources = [group("C1"), group("C1"), group("C1"), group("C2"), group("C2")]
+        body = make_body(texts, sources=sources)
+        dispatcher.submit(body, sign(body))
+        assert wait_for(lambda: len(spans) == 5)
+    finally:
+        dispatcher.stop()
+
+    for group_id, expected in (("C1", ["เพิ่มนัด", "ดูนัด", "ลบนัด"]), ("C2", ["แก้ไขนัด", "ดูนัด"])):
+        chat = sorted((span for span in spans if span[0] == group_id), key=lambda span: span[2])
+        assert [span[1] for span in chat] == expected
+        for previous, current in zip(chat, chat[1:]):
+            assert current[2] >= previous[3]  # ไม่ทับกัน
+    first_c1 = min(span[2] for span in spans if span[0] == "C1")
+    first_c2 = min(span[2] for span in spans if span[0] == "C2")
+    assert abs(first_c1 - first_c2) < 0.04  # สองกลุ่มเริ่มพร้อมกัน
+    assert dispatcher.stats()['chats_busy'] == 0
+    print("   ✅ ลำดับต่อแชทถูกต้องและแชทต่างกันทำขนานกัน")
+
+
+def test_multi_chat_payload_adds_burst_workers():
+    """payload ที่มี event จากหลายกลุ่มมากกว่าจำนวน worker ปกติ ทำพร้อมกันด้วย worker ชั่วคราว"""
+    print("🧪 ทดสอบ worker ชั่วคราวสำหรับ payload หลายแชท")
+    handler = WebhookHandler(CHANNEL_SECRET)
+    done = []
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        time.sleep(0.2)  # เหมือนรอ Sheets I/O
+        done.append(event.source.group_id)
+
+    dispatcher = WebhookDispatcher(handler, workers=2, max_queue=20, max_workers=6, burst_idle_seconds=0.1)
+    dispatcher.start()
+    try:
+        sources = [{'type': 'group', 'groupId': f'C{index}', 'userId': 'U1'} for index in range(6)]
+        body = make_body(["ดูนัด"] * 6, sources=sources)
+        started = time.perf_counter()
+        dispatcher.submit(body, sign(body))
+        assert wait_for(lambda: len(done) == 6)
+        assert time.perf_counter() - started < 0.35  # ไม่ใช่ 3 รอบของ 2 worker (0.6s)
+        assert dispatcher.stats()['burst_workers_total'] == 4
+        assert wait_for(lambda: dispatcher.stats()['workers_alive'] == 2)  # worker ชั่วคราวหยุดเมื่อว่าง
+        assert dispatcher.stats()['workers_idle'] == 2
+    finally:
+        dispatcher.stop()
+    print("   ✅ event ของทุกกลุ่มทำพร้อมกัน")
+
+
+def test_deferred_task_runs_before_next_event_of_chat():
+    """งานที่ handler ส่งต่อ (เช่น ลบนัด) ทำก่อนคำสั่งถัดไปของแชทเดียวกัน"""
+    handler = WebhookHandler(CHANNEL_SECRET)
+    order = []
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    def handle_text(event):
+        text = event.message.text
+        order.append(text)
+        if text == "ลบนัด":
+            assert defer_in_chat(lambda: (time.sleep(0.05), order.append("ลบเสร็จ")))
+
+    dispatcher = WebhookDispatcher(handler, workers=4, max_queue=10)
+    dispatcher.start()
+    try:
+        body = make_body(["ลบนัด", "ดูนัด"])
+        dispatcher.submit(body, sign(body))
+        assert wait_for(lambda: len(order) == 3)
+        assert order == ["ลบนัด", "ลบเสร็จ", "ดูนัด"]
+        assert dispatcher.stats()['deferred_tasks_total'] == 1
+    finally:
+        dispatcher.stop()
+    assert not defer_in_chat(lambda: None)  # นอก worker
+    print("   ✅ งานที่ส่งต่อทำก่อนคำสั่งถัดไป")
+
+
+def test_group_chatter_is_dropped_before_queueing():
+    """ข้อความสนทนาในกลุ่มไม่เข้าคิว ไม่สร้าง model และนับแยกจาก event ที่ประมวลผล"""
+    print("🧪 ทดสอบ prefilter ข้อความในกลุ่ม")
+    group = {'type': 'group', 'groupId': 'C1', 'userId': 'U1'}
+    user = {'type': 'user', 'userId': 'U1'}
+    texts = ["กินข้าวยัง", "  ดูนัด", "555", "HELP", "สวัสดีครับทุกคน", "คุยเล่น"]
+    sources = [group, group, group, group, group, user]
+    body = make_body(texts, sources=sources)
+    events = json.loads(body)['events']
+    assert [is_bot_event(event) for event in events] == [False, True, False, True, True, True]
+    assert is_bot_event({'type': 'join', 'source': group})
+
+    dispatcher, received, release = make_dispatcher()
+    dispatcher.prefilter = is_bot_event
+    release.set()
+    dispatcher.start()
+    try:
+        assert dispatcher.submit(body, sign(body)) == 4
+        chatter = make_body(["ฮ่าๆ", "ok"], sources=[group, group])
+        assert dispatcher.submit(chatter, sign(chatter)) == 0
+        assert wait_for(lambda: len(received) == 4)
+        stats = dispatcher.stats()
+        assert stats['ignored_total'] == 4 and stats['accepted_total'] == 4
+    finally:
+        dispatcher.stop()
+    try:
+        dispatcher.submit(chatter, sign(chatter + " "))
+        assert False, "signature is still checked for chatter"
+    except InvalidSignatureError:
+        pass
+    print("   ✅ ข้อความที่ไม่ใช่คำสั่งถูกข้ามตั้งแต่ /callback")
+
+
+if __name__ == "__main__":
+    test_submit_returns_before_processing()
+    test_invalid_signature_is_rejected_inline()
+    test_full_queue_rejects_whole_payload()
+    test_concurrent_submits_respect_queue_limit()
+    test_expired_reply_tokens_are_counted()
+    test_same_chat_in_order_other_chats_in_parallel()
+    test_multi_chat_payload_adds_burst_workers()
+    test_deferred_task_runs_before_next_event_of_chat()
+    test_group_chatter_is_dropped_before_queueing()
+    print("🎉 ผ่านทั้งหมด")
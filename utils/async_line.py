@@ -0,0 +1,113 @@
+"""
+LINE Messaging API client แบบ async (aiohttp) สำหรับ ASGI mode (asgi.py)
+
+ใช้ ClientSession เดียวต่อ event loop - TCPConnector เก็บ connection แบบ keep-alive ไว้ใช้ซ้ำ
+ระหว่าง reply ของ webhook และ push ของ outbox โดยไม่ต้องใช้ thread ต่อ request
+
+error แปลงให้เข้ากับ retry/circuit breaker เดิม: HTTP error มี .status เหมือน ApiException ของ SDK,
+ปัญหาการเชื่อมต่อเป็น ConnectionError และ timeout เป็น TimeoutError
+"""
+
+import asyncio
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+from utils.line_client import LINE_CONNECTION_POOL_SIZE, channel_access_token
+
+logger = logging.getLogger(__name__)
+
+LINE_API_BASE_URL = os.getenv('LINE_API_BASE_URL', 'https://api.line.me')
+# timeout ต่อ request และเวลาที่เก็บ connection ว่างไว้ใช้ซ้ำ (วินาที)
+ASYNC_LINE_TIMEOUT_SECONDS = float(os.getenv('ASYNC_LINE_TIMEOUT_SECONDS', 10))
+ASYNC_HTTP_KEEPALIVE_SECONDS = float(os.getenv('ASYNC_HTTP_KEEPALIVE_SECONDS', 60))
+
+
+class LineApiError(Exception):
+    """LINE API ตอบ HTTP error (status เหมือน linebot ApiException)"""
+
+    def __init__(self, status: int, body: str):
+        super().__init__(f"LINE API error {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+
+class AsyncLineClient:
+    """reply/push ผ่าน LINE Messaging API ด้วย aiohttp (ใช้ภายใน event loop เดียว)"""
+
+    def __init__(self, access_token: str = None, pool_size: int = LINE_CONNECTION_POOL_SIZE,
+                 base_url: str = LINE_API_BASE_URL, timeout: float = ASYNC_LINE_TIMEOUT_SECONDS):
+        self.access_token = access_token or channel_access_token()
+        self.pool_size = pool_size
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=ASYNC_HTTP_KEEPALIVE_SECONDS)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Authorization': f'Bearer {self.access_token}'}
+            )
+        return self._session
+
+    async def _post(self, path: str, payload: dict, headers: dict = None, timeout: float = None):
+        # timeout=None ของ aiohttp คือไม่มี timeout - ส่งเฉพาะเมื่อระบุ (ไม่งั้นใช้ค่าของ session)
+        options = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        try:
+            async with self._get_session().post(f"{self.base_url}{path}", json=payload, headers=headers,
+                                                **options) as response:
+                if response.status >= 400:
+                    raise LineApiError(response.status, await response.text())
+                await response.read()
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(f"LINE API request timeout ({timeout or self.timeout}s): {path}") from e
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"LINE API connection failed: {e}") from e
+
+    async def reply(self, reply_token: str, texts: List[str], timeout: float = None):
+        """ส่ง reply หนึ่ง request (ไม่เกิน 5 ข้อความ) - timeout แทนค่าของ session ได้"""
+        await self._post('/v2/bot/message/reply', {
+            'replyToken': reply_token,
+            'messages': [{'type': 'text', 'text': text} for text in texts]
+        }, timeout=timeout)
+
+    async def push(self, to: str, texts: List[str], retry_key: str = None):
+        """ส่ง push หนึ่ง request - retry_key (X-Line-Retry-Key) กันการส่งซ้ำเมื่อ retry"""
+        await self._post('/v2/bot/message/push', {
+            'to': to,
+            'messages': [{'type': 'text', 'text': text} for text in texts]
+        }, headers={'X-Line-Retry-Key': retry_key} if retry_key else None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+# event loop และ client ของ ASGI mode - worker thread ส่ง reply ผ่าน loop นี้แทนการ block รอ HTTP
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_client: Optional[AsyncLineClient] = None
+
+
+def install(loop: asyncio.AbstractEventLoop, client: AsyncLineClient):
+    """เรียกจาก lifespan startup ของ asgi.py"""
+    global _loop, _client
+    _loop, _client = loop, client
+    logger.info(f"Async LINE client installed (pool size {client.pool_size})")
+
+
+def uninstall():
+    global _loop, _client
+    _loop, _client = None, None
+
+
+def installed() -> Optional[Tuple[asyncio.AbstractEventLoop, AsyncLineClient]]:
+    """(event loop, client) ของ ASGI mode - None เมื่อรันแบบ Flask/gunicorn หรือ loop หยุดแล้ว"""
+    loop, client = _loop, _client
+    if loop is None or client is None or not loop.is_running():
+        return None
+    return loop, client
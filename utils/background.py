@@ -0,0 +1,129 @@
+"""
+Executor สำหรับงานเบื้องหลังของ handler (เช่น การลบนัดหมายที่ไม่ได้ถูกเรียกจาก webhook dispatcher)
+จำนวน thread และจำนวนงานที่รอมีขอบเขต - เมื่อเต็ม submit จะรอสักครู่แล้ว raise BackgroundQueueFull
+ให้ผู้เรียกทำงานเอง (backpressure) แทนการสร้าง thread ใหม่ไม่จำกัด
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# จำนวน thread, จำนวนงานที่รอได้ และเวลาที่ submit รอเมื่อคิวเต็ม (วินาที)
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', 4))
+BACKGROUND_QUEUE_SIZE = int(os.getenv('BACKGROUND_QUEUE_SIZE', 32))
+BACKGROUND_SUBMIT_TIMEOUT = float(os.getenv('BACKGROUND_SUBMIT_TIMEOUT', 2))
+
+
+class BackgroundQueueFull(Exception):
+    """งานเบื้องหลังเต็มทั้ง thread และคิว - ผู้เรียกควรทำงานเองหรือปฏิเสธ"""
+
+
+class BoundedExecutor:
+    """ThreadPoolExecutor ที่จำกัดจำนวนงานค้าง (กำลังทำ + รอ) ด้วย semaphore"""
+
+    def __init__(self, workers: int = BACKGROUND_WORKERS, queue_size: int = BACKGROUND_QUEUE_SIZE,
+                 name: str = 'background'):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self.submitted_total = 0
+        self.rejected_total = 0
+        self.failed_total = 0
+
+    def submit(self, func: Callable, *args, timeout: float = BACKGROUND_SUBMIT_TIMEOUT, **kwargs) -> Future:
+        """
+        ส่งงานเข้า executor
+
+        Args:
+            func: งานที่ต้องทำ
+            timeout (float): เวลารอ slot ว่างเมื่อเต็ม (0 = ไม่รอ)
+
+        Returns:
+            Future: ผลของงาน
+
+        Raises:
+            BackgroundQueueFull: ไม่มี slot ว่างภายใน timeout
+        """
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected_total += 1
+            raise BackgroundQueueFull(f"Background executor full ({self.capacity} tasks)")
+        with self._lock:
+            self._pending += 1
+            self.submitted_total += 1
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+            self._idle.notify_all()
+        self._slots.release()
+
+    def _done(self, future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Background task failed: {future.exception()}")
+            with self._lock:
+                self.failed_total += 1
+        self._release()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def drain(self, timeout: float) -> int:
+        """
+        graceful shutdown: ไม่รับงานใหม่และรองานที่ค้างให้เสร็จภายใน timeout
+
+        Returns:
+            int: จำนวนงานที่ยังไม่เสร็จเมื่อครบเวลา
+        """
+        deadline = time.time() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            pending = self._pending
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if pending:
+            logger.warning(f"{pending} background tasks did not finish before shutdown")
+        return pending
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'capacity': self.capacity,
+                'pending': self._pending,
+                'submitted_total': self.submitted_total,
+                'rejected_total': self.rejected_total,
+                'failed_total': self.failed_total
+            }
+
+
+_background: Optional[BoundedExecutor] = None
+_background_lock = threading.Lock()
+
+
+def get_background_executor() -> BoundedExecutor:
+    """คืน BoundedExecutor ที่ใช้ร่วมกันทั้ง process (สร้างเมื่อเรียกครั้งแรก)"""
+    global _background
+    with _background_lock:
+        if _background is None:
+            _background = BoundedExecutor()
+        return _background
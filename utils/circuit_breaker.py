@@ -0,0 +1,223 @@
+"""
+Circuit breaker ต่อ dependency (LINE Messaging API, Google Sheets)
+เมื่อ dependency ล้มเหลวติดกันเกินเกณฑ์ วงจรจะเปิด (open) และทุกการเรียกจะล้มเหลวทันที
+แทนการรอ timeout/retry จนครบ - หลัง recovery timeout จะปล่อยการเรียกทดสอบ (half-open)
+ถ้าสำเร็จวงจรจะปิดอีกครั้ง ถ้าล้มเหลวจะเปิดต่อ
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# จำนวนครั้งที่ล้มเหลวติดกันก่อนเปิดวงจร และเวลาที่เปิดค้างไว้ก่อนปล่อยการเรียกทดสอบ
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RECOVERY_SECONDS = float(os.getenv('CIRCUIT_RECOVERY_SECONDS', 30))
+# จำนวนการเรียกทดสอบพร้อมกันสูงสุดในสถานะ half-open
+CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv('CIRCUIT_HALF_OPEN_MAX_CALLS', 1))
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+# ชื่อ breaker ของแต่ละ dependency
+LINE_API = 'line_api'
+GOOGLE_SHEETS = 'google_sheets'
+
+# ข้อความตอบกลับทันทีเมื่อ dependency ที่คำสั่งต้องใช้ไม่พร้อม
+SYSTEM_BUSY_MESSAGE = "⏳ ขณะนี้ระบบไม่สามารถเชื่อมต่อฐานข้อมูลนัดหมายได้ชั่วคราว กรุณาลองใหม่อีกครั้งในอีกสักครู่"
+
+
+class CircuitOpenError(Exception):
+    """เรียก dependency ขณะวงจรเปิดอยู่ (ไม่ได้ส่ง request จริง)"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit '{name}' is open (retry in {retry_in:.1f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def _status_of(error: Exception) -> Optional[int]:
+    """HTTP status ของ error (LINE ApiException มี .status, gspread APIError มี .response.status_code)"""
+    status = getattr(error, 'status', None)
+    if isinstance(status, int):
+        return status
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_outage_error(error: Exception) -> bool:
+    """
+    error ที่บ่งว่า dependency ไม่พร้อม (นับเป็นความล้มเหลวของวงจร)
+    429/5xx และ error ระดับ network/timeout นับ - 4xx อื่นและ error ของข้อมูลไม่นับ
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = _status_of(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, OSError):  # ConnectionError, TimeoutError, requests.RequestException
+        return True
+    if type(error).__module__.split('.')[0] in ('urllib3', 'requests', 'http'):
+        return True
+    message = str(error).lower()
+    return "connection reset" in message or "timeout" in message or "timed out" in message
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker แบบนับความล้มเหลวติดกัน (thread-safe)
+
+    closed -> open เมื่อล้มเหลวติดกันครบ failure_threshold
+    open -> half_open เมื่อครบ recovery_timeout (ปล่อยการเรียกทดสอบไม่เกิน half_open_max_calls)
+    half_open -> closed เมื่อการเรียกทดสอบสำเร็จ, -> open เมื่อล้มเหลว
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 recovery_timeout: float = CIRCUIT_RECOVERY_SECONDS,
+                 half_open_max_calls: int = CIRCUIT_HALF_OPEN_MAX_CALLS,
+                 is_failure: Callable[[Exception], bool] = is_outage_error):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.is_failure = is_failure
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.rejected_total = 0
+        self.opened_total = 0
+        self.last_error: Optional[str] = None
+
+    def _current_state(self) -> str:
+        """สถานะปัจจุบัน (ต้องถือ lock) - open ที่ครบ recovery timeout ถือเป็น half_open"""
+        if self._state == STATE_OPEN and time.time() - self._opened_at >= self.recovery_timeout:
+            self._state = STATE_HALF_OPEN
+            self._probes = 0
+            logger.info(f"Circuit '{self.name}' half-open - allowing probe calls")
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def is_open(self) -> bool:
+        """วงจรเปิดและยังไม่ถึงเวลาทดสอบ (ไม่ใช้สิทธิ์การเรียกทดสอบ)"""
+        return self.state == STATE_OPEN
+
+    def seconds_until_retry(self) -> float:
+        """เวลาที่เหลือก่อนวงจรที่เปิดอยู่จะปล่อยการเรียกทดสอบ (0 = เรียกได้)"""
+        with self._lock:
+            if self._current_state() != STATE_OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.recovery_timeout - time.time())
+
+    def allow_request(self) -> bool:
+        """
+        ขอสิทธิ์เรียก dependency หนึ่งครั้ง - ผู้เรียกต้องรายงานผลด้วย record_success/record_failure/record_error
+
+        Returns:
+            bool: False หากวงจรเปิดอยู่ (หรือการเรียกทดสอบใน half-open ครบแล้ว)
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == STATE_CLOSED:
+                return True
+            if state == STATE_HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            self.rejected_total += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != STATE_CLOSED:
+                logger.info(f"Circuit '{self.name}' closed - dependency recovered")
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self, error: Exception = None):
+        with self._lock:
+            if error is not None:
+                self.last_error = f"{type(error).__name__}: {str(error)[:200]}"
+            self._failures += 1
+            if self._state == STATE_HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != STATE_OPEN:
+                    self.opened_total += 1
+                    logger.error(f"Circuit '{self.name}' opened after {self._failures} consecutive failures: "
+                                 f"{self.last_error}")
+                self._state = STATE_OPEN
+                self._opened_at = time.time()
+                self._probes = 0
+
+    def record_error(self, error: Exception):
+        """รายงานผลของการเรียกที่ error - นับเป็นความล้มเหลวเฉพาะ error ที่ is_failure ยอมรับ"""
+        if self.is_failure(error):
+            self.record_failure(error)
+        else:
+            self.record_success()  # dependency ตอบกลับได้ (เช่น 4xx) - ไม่ใช่ปัญหาการเชื่อมต่อ
+
+    @contextmanager
+    def guard(self):
+        """
+        ครอบการเรียก dependency: raise CircuitOpenError ทันทีหากวงจรเปิด
+        และบันทึกผลตาม exception ที่ออกจาก block
+        """
+        if not self.allow_request():
+            raise CircuitOpenError(self.name, self.seconds_until_retry())
+        try:
+            yield
+        except Exception as e:
+            self.record_error(e)
+            raise
+        self.record_success()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """เรียก func ผ่าน guard()"""
+        with self.guard():
+            return func(*args, **kwargs)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            retry_in = max(0.0, self._opened_at + self.recovery_timeout - time.time()) if state == STATE_OPEN else 0.0
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'opened_at': datetime.fromtimestamp(self._opened_at).isoformat() if self._opened_at else None,
+                'retry_in_seconds': round(retry_in, 1),
+                'opened_total': self.opened_total,
+                'rejected_total': self.rejected_total,
+                'last_error': self.last_error
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """คืน CircuitBreaker ของ dependency ที่ใช้ร่วมกันทั้ง process (สร้างเมื่อเรียกครั้งแรก)"""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def circuit_breaker_states() -> Dict[str, dict]:
+    """สถานะของ breaker ทุกตัว (LINE API และ Google Sheets แสดงเสมอ) สำหรับ /health และ /warmup"""
+    for name in (LINE_API, GOOGLE_SHEETS):
+        get_circuit_breaker(name)
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,250 @@
+"""
+Command router สำหรับข้อความของผู้ใช้
+คำสั่งประกาศเป็นรายการ Command (คำสั่งภาษาไทย/อังกฤษ) แล้ว compile เป็น prefix trie ครั้งเดียว
+การหาคำสั่งเดินตาม trie ทีละตัวอักษร (O(ความยาวของคำสั่ง)) แทนการไล่ startswith/in ทีละเงื่อนไข
+และแต่ละคำสั่งเก็บ histogram ของเวลาที่ใช้ประมวลผลของตัวเอง
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# ขอบบนของแต่ละช่องใน latency histogram (มิลลิวินาที) - ช่องสุดท้ายคือ "มากกว่า"
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+@dataclass
+class CommandContext:
+    """ข้อมูลของข้อความที่ส่งให้ handler ของคำสั่ง"""
+    user_message: str  # ข้อความเดิม (ตัด mention ออกแล้ว)
+    user_id: str
+    context_type: str  # 'group' หรือ 'personal'
+    context_id: str
+
+
+@dataclass
+class Command:
+    """
+    คำสั่งหนึ่งคำสั่งใน registry
+
+    Attributes:
+        name: ชื่อคำสั่ง (ใช้ใน metrics)
+        keywords: คำที่เรียกคำสั่งนี้ (ตัวพิมพ์เล็ก)
+        handler: ฟังก์ชันรับ CommandContext คืนข้อความตอบกลับ
+        exact: True = ข้อความต้องตรงกับ keyword ทั้งข้อความ, False = ขึ้นต้นด้วย keyword
+        uses_sheets: คำสั่งอ่าน/เขียน Google Sheets (ตอบ "ระบบไม่พร้อม" เมื่อวงจรของ Sheets เปิด)
+        group: keyword ที่ใช้ได้ในกลุ่ม - True = ทุก keyword, False = ไม่มี, หรือระบุเป็น tuple
+        cacheable: คำสั่งอ่านอย่างเดียว - ตอบด้วยคำตอบล่าสุดได้เมื่อเกิน rate limit (ดู utils.rate_limiter)
+    """
+    name: str
+    keywords: Tuple[str, ...]
+    handler: Callable[[CommandContext], str]
+    exact: bool = False
+    uses_sheets: bool = False
+    group: Union[bool, Tuple[str, ...]] = True
+    cacheable: bool = False
+
+    def group_keywords(self) -> Tuple[str, ...]:
+        if self.group is True:
+            return self.keywords
+        return tuple(self.group) if self.group else ()
+
+
+@dataclass
+class LatencyHistogram:
+    """histogram ของเวลาประมวลผล (thread-safe ผ่าน lock ของ router)"""
+    counts: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+    total: int = 0
+    errors: int = 0
+    sum_ms: float = 0.0
+    max_ms: float = 0.0
+
+    def observe(self, ms: float):
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile_ms(self, q: float) -> Optional[float]:
+        """ค่าประมาณ quantile จากขอบบนของช่อง (ช่องสุดท้ายใช้ค่าสูงสุดที่เห็น)"""
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return float(LATENCY_BUCKETS_MS[index]) if index < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 1)
+        return round(self.max_ms, 1)
+
+    def to_dict(self) -> dict:
+        labels = [f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS] + [f"gt_{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            'count': self.total,
+            'errors': self.errors,
+            'avg_ms': round(self.sum_ms / self.total, 1) if self.total else None,
+            'p50_ms': self.quantile_ms(0.5),
+            'p95_ms': self.quantile_ms(0.95),
+            'max_ms': round(self.max_ms, 1) if self.total else None,
+            'buckets': dict(zip(labels, self.counts))
+        }
+
+
+class _TrieNode:
+    __slots__ = ('children', 'prefix', 'exact', 'group')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.prefix: Optional[Tuple[int, Command]] = None  # (ลำดับใน registry, คำสั่ง) ที่จับคู่แบบขึ้นต้น
+        self.exact: Optional[Tuple[int, Command]] = None  # คำสั่งที่ต้องตรงทั้งข้อความ
+        self.group = False  # ข้อความในกลุ่มที่ขึ้นต้นด้วย keyword นี้เป็นคำสั่งของบอท
+
+
+def strip_mention(message: str) -> str:
+    """
+    ตัด mention ที่ขึ้นต้นข้อความ ("@Bot ดูนัด" -> "ดูนัด")
+
+    Returns:
+        str: ข้อความหลัง mention หรือ "" หากมีแค่ mention อย่างเดียว
+    """
+    if not message.startswith('@'):
+        return message
+    space_index = message.find(' ')
+    return message[space_index + 1:].strip() if space_index > 0 else ''
+
+
+class CommandRouter:
+    """
+    หาคำสั่งของข้อความด้วย prefix trie ที่ compile จาก registry
+
+    ลำดับของ registry คือลำดับความสำคัญ: เมื่อหลาย keyword ตรงกับข้อความ (เช่น "นัดย้อนหลัง" แบบตรงทั้งข้อความ
+    กับ "ย้อนหลัง" แบบขึ้นต้น) คำสั่งที่ประกาศก่อนชนะ เหมือนลำดับ if/elif เดิม
+    """
+
+    def __init__(self, commands: Sequence[Command], group_prefixes: Sequence[str] = ()):
+        """
+        Args:
+            commands: registry ของคำสั่งตามลำดับความสำคัญ
+            group_prefixes: คำขึ้นต้นเพิ่มเติมที่ถือเป็นข้อความถึงบอทในกลุ่ม (ไม่มีคำสั่งของตัวเอง)
+        """
+        self.commands = list(commands)
+        self._root = _TrieNode()
+        self._lock = threading.Lock()
+        self._latency: Dict[str, LatencyHistogram] = {command.name: LatencyHistogram() for command in self.commands}
+        self.unmatched_total = 0
+        self.ignored_total = 0
+
+        for order, command in enumerate(self.commands):
+            for keyword in command.keywords:
+                node = self._insert(keyword)
+                slot = 'exact' if command.exact else 'prefix'
+                current = getattr(node, slot)
+                if current is None or current[0] > order:
+                    setattr(node, slot, (order, command))
+            for keyword in command.group_keywords():
+                self._insert(keyword).group = True
+        for keyword in group_prefixes:
+            self._insert(keyword).group = True
+
+    def _insert(self, keyword: str) -> _TrieNode:
+        node = self._root
+        for char in keyword.lower():
+            node = node.children.setdefault(char, _TrieNode())
+        return node
+
+    def is_group_command(self, message_lower: str) -> bool:
+        """ข้อความในกลุ่ม (ตัวพิมพ์เล็ก, ตัด mention แล้ว) ขึ้นต้นด้วย keyword ที่ใช้ในกลุ่มได้หรือไม่"""
+        node = self._root
+        for char in message_lower:
+            node = node.children.get(char)
+            if node is None:
+                return False
+            if node.group:
+                return True
+        return False
+
+    def match(self, message_lower: str) -> Optional[Command]:
+        """
+        คำสั่งของข้อความ (ตัวพิมพ์เล็ก ตัดช่องว่างหัวท้ายแล้ว)
+
+        Returns:
+            Command: คำสั่งที่ลำดับความสำคัญสูงสุดที่ตรงกับข้อความ หรือ None
+        """
+        best: Optional[Tuple[int, Command]] = None
+        node = self._root
+        for char in message_lower:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.prefix and (best is None or node.prefix[0] < best[0]):
+                best = node.prefix
+        else:
+            if node.exact and (best is None or node.exact[0] < best[0]):
+                best = node.exact
+        return best[1] if best else None
+
+    def route(self, message: str, context_type: str) -> Tuple[Optional[Command], str, str]:
+        """
+        เตรียมข้อความและหาคำสั่ง
+
+        ในกลุ่ม: ตัด mention แล้วข้ามข้อความที่ไม่ได้ขึ้นต้นด้วยคำสั่งที่ใช้ในกลุ่มได้
+
+        Returns:
+            tuple: (คำสั่งหรือ None, ข้อความหลังตัด mention, ข้อความตัวพิมพ์เล็ก)
+                   ข้อความตัวพิมพ์เล็กเป็น "" เมื่อเป็นข้อความในกลุ่มที่ไม่ใช่คำสั่ง (ผู้เรียกควรข้าม)
+        """
+        message = message.strip()
+        if context_type == "group":
+            message = strip_mention(message)
+            message_lower = message.lower()
+            if not self.is_group_command(message_lower):
+                with self._lock:
+                    self.ignored_total += 1
+                return None, message, ''
+        else:
+            message_lower = message.lower()
+        command = self.match(message_lower)
+        if command is None:
+            with self._lock:
+                self.unmatched_total += 1
+        return command, message, message_lower
+
+    @contextmanager
+    def timed(self, command: Command):
+        """บันทึกเวลาที่ใช้ประมวลผลคำสั่งลง histogram ของคำสั่งนั้น (รวมกรณี error)"""
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                histogram = self._latency[command.name]
+                histogram.observe(elapsed_ms)
+                if failed:
+                    histogram.errors += 1
+
+    def dispatch(self, command: Command, context: CommandContext) -> str:
+        """เรียก handler ของคำสั่งพร้อมจับเวลา"""
+        with self.timed(command):
+            return command.handler(context)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'commands': {name: histogram.to_dict() for name, histogram in self._latency.items()
+                             if histogram.total},
+                'unmatched_total': self.unmatched_total,
+                'ignored_total': self.ignored_total
+            }
@@ -0,0 +1,45 @@
+"""
+LINE Messaging API client ที่ใช้ร่วมกันทั้ง process
+สร้าง Configuration/ApiClient ครั้งเดียว - urllib3 pool ของ ApiClient เก็บ connection แบบ keep-alive
+ไว้ใช้ซ้ำระหว่าง webhook worker, outbox และ reply retry แทนการเปิด TLS ใหม่ทุกครั้ง
+"""
+
+import logging
+import os
+import threading
+from typing import Optional
+
+from linebot.v3.messaging import ApiClient, Configuration, MessagingApi
+
+logger = logging.getLogger(__name__)
+
+# จำนวน connection สูงสุดที่เก็บไว้ใน pool (ควร >= webhook workers + outbox + reply retry ที่ทำพร้อมกัน)
+LINE_CONNECTION_POOL_SIZE = int(os.getenv('LINE_CONNECTION_POOL_SIZE', 20))
+
+_line_api: Optional[MessagingApi] = None
+_line_api_lock = threading.Lock()
+
+
+def channel_access_token() -> Optional[str]:
+    """Channel access token จาก environment (รองรับทั้งชื่อเดิมและชื่อใหม่สำหรับ Render)"""
+    return os.getenv('LINE_CHANNEL_ACCESS_TOKEN') or os.getenv('CHANNEL_ACCESS_TOKEN')
+
+
+def get_line_api(access_token: str = None) -> MessagingApi:
+    """
+    คืน MessagingApi ที่ใช้ร่วมกันทั้ง process (สร้างเมื่อเรียกครั้งแรก)
+
+    Args:
+        access_token (str): token ที่ใช้ตอนสร้างครั้งแรก (ค่าเริ่มต้นอ่านจาก environment)
+
+    Returns:
+        MessagingApi: client ที่ใช้ connection pool เดียวกัน
+    """
+    global _line_api
+    with _line_api_lock:
+        if _line_api is None:
+            configuration = Configuration(access_token=access_token or channel_access_token())
+            configuration.connection_pool_maxsize = LINE_CONNECTION_POOL_SIZE
+            _line_api = MessagingApi(ApiClient(configuration))
+            logger.info(f"LINE API client created (pool size {LINE_CONNECTION_POOL_SIZE})")
+        return _line_api
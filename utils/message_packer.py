@@ -0,0 +1,98 @@
+"""
+Message packer สำหรับข้อความยาว
+แบ่งข้อความตามขอบเขตของนัดหมาย (segment) ให้แต่ละ TextMessage ไม่เกินขนาดที่กำหนด
+แล้วรวมเป็น request ละไม่เกิน 5 ข้อความ (ขีดจำกัดของ LINE ต่อ push/reply หนึ่งครั้ง)
+"""
+
+import os
+from typing import Iterable, List
+
+# ขีดจำกัดของ LINE: 5 ข้อความต่อ request, 5000 ตัวอักษร (UTF-16) ต่อ TextMessage
+LINE_MAX_MESSAGES_PER_REQUEST = 5
+LINE_TEXT_MAX_CHARS = 5000
+# ขนาดสูงสุดต่อข้อความที่ packer ใช้ (เผื่อไว้จากขีดจำกัดจริง)
+MESSAGE_PACK_MAX_CHARS = int(os.getenv('MESSAGE_PACK_MAX_CHARS', 4500))
+
+
+def text_length(text: str) -> int:
+    """ความยาวตามที่ LINE นับ (UTF-16 code units - emoji นอก BMP นับเป็น 2)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_segments(text: str, separator: str = "\n\n") -> List[str]:
+    """
+    แบ่งข้อความที่ render แล้วเป็น segment ตาม separator (เก็บ separator ไว้ท้าย segment)
+
+    Args:
+        text (str): ข้อความเต็ม
+        separator (str): ตัวคั่นระหว่างนัดหมาย
+
+    Returns:
+        List[str]: segment ที่ต่อกันแล้วได้ข้อความเดิม
+    """
+    pieces = text.split(separator)
+    segments = [piece + separator for piece in pieces[:-1]]
+    if pieces[-1]:
+        segments.append(pieces[-1])
+    return segments
+
+
+def _hard_split(segment: str, max_chars: int) -> List[str]:
+    """แบ่ง segment ที่ยาวเกินหนึ่งข้อความ - ตัดตามบรรทัดก่อน ถ้าบรรทัดเดียวยังยาวเกินจึงตัดตามตัวอักษร"""
+    chunks, current = [], ''
+    for line in segment.splitlines(keepends=True):
+        while text_length(line) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ''
+            cut = max_chars
+            while text_length(line[:cut]) > max_chars:
+                cut -= 1
+            chunks.append(line[:cut])
+            line = line[cut:]
+        if current and text_length(current) + text_length(line) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def pack_texts(segments: Iterable[str], max_chars: int = MESSAGE_PACK_MAX_CHARS) -> List[str]:
+    """
+    รวม segment ต่อกันให้ได้ข้อความน้อยที่สุดโดยแต่ละข้อความไม่เกิน max_chars
+    ไม่ตัดกลาง segment เว้นแต่ segment เดียวยาวเกิน max_chars
+
+    Returns:
+        List[str]: ข้อความตามลำดับ
+    """
+    texts, current, current_length = [], '', 0
+    for segment in segments:
+        length = text_length(segment)
+        if length > max_chars:
+            if current:
+                texts.append(current)
+                current, current_length = '', 0
+            texts.extend(_hard_split(segment, max_chars))
+            continue
+        if current and current_length + length > max_chars:
+            texts.append(current)
+            current, current_length = '', 0
+        current += segment
+        current_length += length
+    if current:
+        texts.append(current)
+    return [text.rstrip('\n') for text in texts]
+
+
+def pack_requests(segments: Iterable[str], max_chars: int = MESSAGE_PACK_MAX_CHARS,
+                  max_messages: int = LINE_MAX_MESSAGES_PER_REQUEST) -> List[List[str]]:
+    """
+    แบ่งข้อความเป็น request ละไม่เกิน max_messages ข้อความ (request เพิ่มเมื่อจำเป็นเท่านั้น)
+
+    Returns:
+        List[List[str]]: รายการ request แต่ละรายการคือ list ของข้อความ
+    """
+    texts = pack_texts(segments, max_chars)
+    return [texts[start:start + max_messages] for start in range(0, len(texts), max_messages)]
@@ -0,0 +1,240 @@
+"""
+Message renderer สำหรับข้อความนัดหมาย
+รวม template ของสรุปรายวัน, รายการนัดหมาย, ประวัตินัดหมาย และการยืนยันการลบไว้ที่เดียว
+template ถูกเตรียมไว้ล่วงหน้า (bound str.format) การแปลงวันที่ถูก cache ตาม datetime_iso
+และข้อความถูกประกอบด้วย ''.join ในรอบเดียวแทนการต่อ string ทีละส่วน
+"""
+
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import pytz
+
+BANGKOK_TZ = pytz.timezone('Asia/Bangkok')
+
+DATETIME_FORMAT = '%d/%m/%Y %H:%M'
+TIME_FORMAT = '%H:%M'
+
+# ค่า placeholder ที่ไม่ต้องแสดงในข้อความ
+_HIDDEN_LOCATION = "LINE Bot"
+_HIDDEN_BUILDING = "General"
+
+# ---------------------------------------------------------------------------
+# Templates
+# ---------------------------------------------------------------------------
+_DIGEST_HEADER = "📋 สรุปนัดหมายประจำวัน ({count} รายการ)\n🕘 {now}\n\n".format
+_DIGEST_URGENT_ITEM = "{emoji} {label} - {note}\n   📅 {time}".format
+_DIGEST_UPCOMING_ITEM = "🔴 ในอีก {days} วัน - {note}\n   📅 {when}".format
+_DIGEST_FUTURE_ITEM = "📅 ในอีก {days} วัน - {note}\n   📅 {when}".format
+_DIGEST_PAST_ITEM = "⏰ เมื่อ {days} วันที่แล้ว - {note}\n   🆔 {id}\n\n".format
+_DIGEST_ID_LINE = "\n   🆔 {id}\n\n".format
+_DIGEST_MORE = "   และอีก {count} นัดหมาย...\n\n".format
+_DIGEST_FOOTER = "💡 พิมพ์ 'ดูนัด' เพื่อดูรายละเอียดทั้งหมด\n🔔 ระบบแจ้งเตือนอัตโนมัติทุกวัน {delivery_time} น.".format
+_DIGEST_URGENT_ONLY_NOTE = "ℹ️ วันนี้แสดงเฉพาะนัดหมายด่วน\n"
+
+_LIST_ITEM = "📅 {index}. {icon} {note}\n     🕐 {when}\n".format
+_LIST_LOCATION = "     📍 {}\n".format
+_LIST_BUILDING = "     🏢 {}\n".format
+_LIST_CONTACT = "     👤 {}\n".format
+_LIST_PHONE = "     📞 {}\n".format
+_LIST_ID = "     🆔 {}\n\n".format
+
+_DELETED = """✅ ลบนัดหมายเรียบร้อย!
+
+🗑️ นัดหมายที่ถูกลบ:
+• รหัส: {id}
+• ชื่อ: {note}
+• วันที่: {date}
+• เวลา: {time}
+• บุคคล/ผู้ติดต่อ: {contact}""".format
+
+ICON_UPCOMING = "🔴"
+ICON_PAST = "⚪"
+
+DIGEST_FUTURE_LIMIT = 3
+DIGEST_PAST_LIMIT = 2
+
+
+# ---------------------------------------------------------------------------
+# Cached date handling
+# ---------------------------------------------------------------------------
+@lru_cache(maxsize=8192)
+def parse_datetime(datetime_iso: str) -> datetime:
+    """แปลง datetime_iso เป็น datetime (ค่าที่ไม่มี timezone ถือเป็นเวลากรุงเทพฯ) - cache ตามข้อความ"""
+    value = datetime.fromisoformat(datetime_iso)
+    if value.tzinfo is None:
+        value = BANGKOK_TZ.localize(value)
+    return value
+
+
+@lru_cache(maxsize=8192)
+def format_datetime(datetime_iso: str, fmt: str = DATETIME_FORMAT) -> str:
+    """strftime ของ datetime_iso - cache ตาม (ข้อความ, รูปแบบ)"""
+    return parse_datetime(datetime_iso).strftime(fmt)
+
+
+def days_until(appointment, today: date) -> int:
+    """จำนวนวันจาก today ถึงวันนัด (ติดลบ = ผ่านมาแล้ว)"""
+    return (parse_datetime(appointment.datetime_iso).date() - today).days
+
+
+# ---------------------------------------------------------------------------
+# Daily digest
+# ---------------------------------------------------------------------------
+UrgencyGroups = Tuple[List[tuple], List[tuple], List[tuple], List[tuple]]
+
+
+def classify_by_urgency(appointments: Iterable, today: date) -> UrgencyGroups:
+    """
+    จัดกลุ่มนัดหมายตามความเร่งด่วน
+
+    Returns:
+        Tuple: (ด่วน วันนี้/พรุ่งนี้, สัปดาห์นี้ 2-7 วัน, อนาคต >7 วัน, ผ่านแล้ว)
+        แต่ละรายการเป็น (appointment, days_diff) ตามลำดับที่รับเข้ามา
+    """
+    urgent, upcoming, future, past = [], [], [], []
+    for appointment in appointments:
+        days_diff = days_until(appointment, today)
+        if days_diff < 0:
+            past.append((appointment, days_diff))
+        elif days_diff <= 1:
+            urgent.append((appointment, days_diff))
+        elif days_diff <= 7:
+            upcoming.append((appointment, days_diff))
+        else:
+            future.append((appointment, days_diff))
+    return urgent, upcoming, future, past
+
+
+def _location_suffix(appointment) -> str:
+    if appointment.location and appointment.location != _HIDDEN_LOCATION:
+        return " ที่ " + appointment.location
+    return ""
+
+
+def render_digest_segments(groups: UrgencyGroups, total: int, current_time: datetime,
+                           delivery_time: str, urgent_only: bool = False) -> List[str]:
+    """
+    สร้างข้อความสรุปนัดหมายประจำวันเป็น segment ละหนึ่งนัดหมาย
+    (หัวข้อของแต่ละกลุ่มติดอยู่กับนัดหมายแรกของกลุ่ม) สำหรับแบ่งข้อความยาวด้วย message packer
+
+    Args:
+        groups (UrgencyGroups): ผลจาก classify_by_urgency
+        total (int): จำนวนนัดหมายที่แสดงในหัวข้อ
+        current_time (datetime): เวลาที่ส่ง
+        delivery_time (str): เวลารับแจ้งเตือนของผู้รับ ('HH:MM') สำหรับ footer
+        urgent_only (bool): แสดงเฉพาะนัดด่วน (โควตาใกล้หมด)
+
+    Returns:
+        List[str]: segment ที่ต่อกันแล้วได้ข้อความสรุปเต็ม
+    """
+    urgent, upcoming, future, past = groups
+    segments = [_DIGEST_HEADER(count=total, now=current_time.strftime(DATETIME_FORMAT))]
+    append = segments.append
+
+    if urgent:
+        heading = "🚨 นัดหมายด่วน:\n"
+        for appointment, days_diff in urgent:
+            emoji, label = ("🔥", "วันนี้") if days_diff == 0 else ("⚡", "พรุ่งนี้")
+            contact = getattr(appointment, 'contact_person', None)
+            append(''.join((
+                heading,
+                _DIGEST_URGENT_ITEM(emoji=emoji, label=label, note=appointment.note,
+                                    time=format_datetime(appointment.datetime_iso, TIME_FORMAT)),
+                _location_suffix(appointment),
+                " พบ " + contact if contact else "",
+                _DIGEST_ID_LINE(id=appointment.id)
+            )))
+            heading = ""
+
+    if not urgent_only:
+        if upcoming:
+            heading = "📅 สัปดาห์นี้:\n"
+            for appointment, days_diff in upcoming:
+                append(''.join((
+                    heading,
+                    _DIGEST_UPCOMING_ITEM(days=days_diff, note=appointment.note,
+                                          when=format_datetime(appointment.datetime_iso)),
+                    _location_suffix(appointment),
+                    _DIGEST_ID_LINE(id=appointment.id)
+                )))
+                heading = ""
+
+        if future:
+            heading = "🟡 นัดหมายถัดไป:\n"
+            for appointment, days_diff in future[:DIGEST_FUTURE_LIMIT]:
+                append(''.join((
+                    heading,
+                    _DIGEST_FUTURE_ITEM(days=days_diff, note=appointment.note,
+                                        when=format_datetime(appointment.datetime_iso)),
+                    _location_suffix(appointment),
+                    _DIGEST_ID_LINE(id=appointment.id)
+                )))
+                heading = ""
+            if len(future) > DIGEST_FUTURE_LIMIT:
+                append(_DIGEST_MORE(count=len(future) - DIGEST_FUTURE_LIMIT))
+
+        if past:
+            heading = "⚪ ที่ผ่านมา:\n"
+            # เรียงจากล่าสุดก่อน
+            for appointment, days_diff in sorted(past, key=lambda item: item[1], reverse=True)[:DIGEST_PAST_LIMIT]:
+                append(heading + _DIGEST_PAST_ITEM(days=abs(days_diff), note=appointment.note, id=appointment.id))
+                heading = ""
+        footer = ""
+    else:
+        footer = _DIGEST_URGENT_ONLY_NOTE
+
+    append(footer + _DIGEST_FOOTER(delivery_time=delivery_time))
+    return segments
+
+
+def render_digest(groups: UrgencyGroups, total: int, current_time: datetime,
+                  delivery_time: str, urgent_only: bool = False) -> str:
+    """ข้อความสรุปนัดหมายประจำวันแบบข้อความเดียว (ดู render_digest_segments)"""
+    return ''.join(render_digest_segments(groups, total, current_time, delivery_time, urgent_only))
+
+
+# ---------------------------------------------------------------------------
+# Appointment lists (ดูนัด / ดูนัดย้อนหลัง)
+# ---------------------------------------------------------------------------
+def render_appointment_items(appointments: Sequence, now: Optional[datetime] = None,
+                             icon: Optional[str] = None) -> str:
+    """
+    สร้างรายการนัดหมายแบบละเอียด
+
+    Args:
+        appointments (Sequence[Appointment]): นัดหมายตามลำดับที่จะแสดง
+        now (datetime): ใช้เลือกไอคอนอนาคต/อดีต (เมื่อไม่ได้กำหนด icon)
+        icon (str): ไอคอนเดียวกันทุกรายการ (เช่น ICON_PAST สำหรับประวัติ)
+    """
+    parts = []
+    append = parts.append
+    for index, appointment in enumerate(appointments, 1):
+        item_icon = icon or (ICON_UPCOMING if parse_datetime(appointment.datetime_iso) >= now else ICON_PAST)
+        append(_LIST_ITEM(index=index, icon=item_icon, note=appointment.note,
+                          when=format_datetime(appointment.datetime_iso)))
+        if appointment.location and appointment.location != _HIDDEN_LOCATION:
+            append(_LIST_LOCATION(appointment.location))
+        if appointment.building_floor_dept and appointment.building_floor_dept != _HIDDEN_BUILDING:
+            append(_LIST_BUILDING(appointment.building_floor_dept))
+        if getattr(appointment, 'contact_person', None):
+            append(_LIST_CONTACT(appointment.contact_person))
+        if getattr(appointment, 'phone_number', None):
+            append(_LIST_PHONE(appointment.phone_number))
+        append(_LIST_ID(appointment.id))
+    return ''.join(parts)
+
+
+# ---------------------------------------------------------------------------
+# Delete confirmation
+# ---------------------------------------------------------------------------
+def render_deleted_appointment(appointment) -> str:
+    """ข้อความยืนยันหลังลบนัดหมายสำเร็จ"""
+    return _DELETED(
+        id=appointment.id,
+        note=appointment.note,
+        date=format_datetime(appointment.datetime_iso, '%d/%m/%Y'),
+        time=format_datetime(appointment.datetime_iso, TIME_FORMAT),
+        contact=appointment.contact_person
+    )
@@ -3,15 +3,73 @@ Connection and message handling utilities for LINE Bot
 Handles connection timeouts and message delivery failures
 """
 
+import asyncio
+import os
 import time
 import logging
-from typing import Optional, List, Tuple
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple
 from linebot.v3.messaging import (
     ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
 )
+from utils.message_packer import LINE_MAX_MESSAGES_PER_REQUEST, pack_texts, split_segments
+from utils.circuit_breaker import get_circuit_breaker, CircuitOpenError, LINE_API, SYSTEM_BUSY_MESSAGE
+from utils import async_line
 
 logger = logging.getLogger(__name__)
 
+# Reply token ใช้ได้ประมาณหนึ่งนาทีหลังได้รับ webhook - หยุด retry ก่อนหมดอายุแล้ว push แทน
+REPLY_TOKEN_TTL_SECONDS = float(os.getenv('REPLY_TOKEN_TTL_SECONDS', 50))
+# จำนวน thread สำหรับ retry reply นอก webhook request thread
+REPLY_RETRY_WORKERS = int(os.getenv('REPLY_RETRY_WORKERS', 4))
+# timeout ของ reply แต่ละครั้ง (ครั้งแรกทำใน webhook thread - ต้องไม่ค้างนาน)
+REPLY_REQUEST_TIMEOUT_SECONDS = float(os.getenv('REPLY_REQUEST_TIMEOUT_SECONDS', 5))
+
+# (success, error, channel) - channel คือ 'reply' หรือ 'push' (fallback)
+SendResult = Tuple[bool, Optional[str], Optional[str]]
+
+# ข้อความ "ระบบไม่พร้อม" สร้างไว้ครั้งเดียว - ตอบได้ทันทีโดยไม่ต้อง render/pack
+_BUSY_MESSAGES = [TextMessage(text=SYSTEM_BUSY_MESSAGE)]
+
+_retry_executor: Optional[ThreadPoolExecutor] = None
+_retry_executor_lock = threading.Lock()
+
+
+def get_retry_executor() -> ThreadPoolExecutor:
+    """Executor ร่วมของ process สำหรับ retry reply (สร้างเมื่อเรียกครั้งแรก)"""
+    global _retry_executor
+    with _retry_executor_lock:
+        if _retry_executor is None:
+            _retry_executor = ThreadPoolExecutor(max_workers=REPLY_RETRY_WORKERS,
+                                                 thread_name_prefix='reply-retry')
+        return _retry_executor
+
+
+def _is_retryable_send_error(error: Exception) -> bool:
+    """Connection reset / timeout / 429 / 5xx ลองใหม่ได้ - 4xx อื่น (เช่น reply token ใช้ไม่ได้) ไม่ต้องลอง"""
+    status = getattr(error, 'status', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, OSError):  # ConnectionError/TimeoutError จาก AsyncLineClient
+        return True
+    return "Connection reset" in str(error) or "timeout" in str(error).lower()
+
+
+def _reply_token_unused(error: Exception) -> bool:
+    """
+    True หาก reply ที่ล้มเหลวไม่ได้ใช้ reply token แน่นอน - push แทนได้โดยไม่ส่งซ้ำ
+    (วงจรเปิดจึงไม่ได้ส่ง, 429, หรือ 400 "Invalid reply token")
+    timeout / connection error / 5xx อาจส่งถึงผู้ใช้แล้ว จึงไม่นับ
+    """
+    if isinstance(error, CircuitOpenError):
+        return True
+    status = getattr(error, 'status', None)
+    if status == 429:
+        return True
+    body = f"{error} {getattr(error, 'body', '') or ''}".lower()
+    return status == 400 and 'invalid reply token' in body
+
 class RobustMessageSender:
     """Handles robust message sending with timeout and retry logic"""
     
@@ -19,7 +77,10 @@ class RobustMessageSender:
         self.line_bot_api = line_bot_api
         self.max_message_length = 1900  # Safe limit to prevent timeouts
         self.retry_attempts = 3
-        self.base_timeout = 5.0  # seconds
+        self.base_timeout = 5.0  # seconds (retry backoff)
+        self.reply_timeout = REPLY_REQUEST_TIMEOUT_SECONDS  # per reply request
+        self.outbox = None  # push fallback of send_reply_async (default: shared push outbox)
+        self.breaker = get_circuit_breaker(LINE_API)  # fail fast while the LINE API is down
         
     def send_reply_with_timeout(self, reply_token: str, message: str, 
                                max_retries: int = 3) -> Tuple[bool, Optional[str]]:
@@ -34,10 +95,7 @@ class RobustMessageSender:
         Returns:
             Tuple of (success: bool, error_message: Optional[str])
         """
-        # Truncate message if too long
-        if len(message) > self.max_message_length:
-            message = message[:self.max_message_length - 50] + "\n\n... (ข้อความถูกตัดเนื่องจากยาวเกินไป)"
-            logger.warning(f"Message truncated to {len(message)} characters")
+        texts = self._pack_reply(message)
         
         last_error = None
         
@@ -45,15 +103,11 @@ class RobustMessageSender:
             try:
                 start_time = time.time()
                 
-                self.line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=message)]
-                    )
-                )
+                self._reply(reply_token, texts)
                 
                 elapsed_time = time.time() - start_time
-                logger.info(f"Reply sent successfully in {elapsed_time:.2f}s (attempt {attempt + 1}): {message[:50]}...")
+                logger.info(f"Reply sent successfully in {elapsed_time:.2f}s (attempt {attempt + 1}, "
+                            f"{len(texts)} messages): {texts[0][:50]}...")
                 return True, None
                 
             except Exception as e:
@@ -75,12 +129,200 @@ class RobustMessageSender:
         logger.error(f"Failed to send reply after {max_retries} attempts: {last_error}")
         return False, last_error
     
+    def _pack_reply(self, message: str) -> List[str]:
+        """
+        Split long messages on item boundaries into up to 5 messages of one reply;
+        truncate only what does not fit into a single reply
+        """
+        texts = pack_texts(split_segments(message), self.max_message_length) or [message]
+        if len(texts) > LINE_MAX_MESSAGES_PER_REQUEST:
+            texts = texts[:LINE_MAX_MESSAGES_PER_REQUEST]
+            texts[-1] = texts[-1][:self.max_message_length - 50] + "\n\n... (ข้อความถูกตัดเนื่องจากยาวเกินไป)"
+            logger.warning(f"Message truncated to {LINE_MAX_MESSAGES_PER_REQUEST} messages")
+        return texts
+    
+    def _reply(self, reply_token: str, texts: List[str], timeout: Optional[float] = None):
+        self.breaker.call(
+            self.line_bot_api.reply_message,
+            ReplyMessageRequest(
+                reply_token=reply_token,
+                messages=[TextMessage(text=text) for text in texts]
+            ),
+            _request_timeout=timeout
+        )
+    
+    def send_busy_reply(self, reply_token: str) -> bool:
+        """
+        Reply with the prebuilt "system busy" message (one attempt, no retry or push fallback)
+        
+        Used when a dependency the command needs has an open circuit breaker.
+        In ASGI mode the reply is sent on the event loop without waiting for it.
+        """
+        async_mode = async_line.installed()
+        if async_mode:
+            loop, client = async_mode
+            asyncio.run_coroutine_threadsafe(
+                self._reply_on_loop(client, reply_token, [SYSTEM_BUSY_MESSAGE], None, time.time() + 1, 1), loop)
+            return True
+        try:
+            self.breaker.call(
+                self.line_bot_api.reply_message,
+                ReplyMessageRequest(reply_token=reply_token, messages=_BUSY_MESSAGES)
+            )
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to send busy reply: {e}")
+            return False
+    
+    def send_reply_async(self, reply_token: str, message: str, recipient_id: Optional[str] = None,
+                         received_at: Optional[float] = None, max_retries: int = 3) -> "Future[SendResult]":
+        """
+        Send a reply without blocking the webhook thread on retries
+        
+        The first attempt runs inline with a REPLY_REQUEST_TIMEOUT_SECONDS timeout.
+        Retryable failures are retried on the shared retry executor with exponential
+        backoff, but only while the reply token is still valid (received_at +
+        REPLY_TOKEN_TTL_SECONDS). The message is pushed to recipient_id through the
+        push outbox (dedup key 'reply:<token>') only when the token is known to be
+        unused: it expired before the first attempt, or every attempt was rejected
+        without reaching the user (400 "Invalid reply token", 429, open circuit).
+        After a timeout or 5xx the reply may already have been delivered, so the
+        failure is reported instead of risking a duplicate push.
+        
+        In ASGI mode (utils.async_line installed) the reply and its retries run on
+        the event loop through the pooled AsyncLineClient instead of this thread.
+        
+        Args:
+            reply_token: LINE reply token
+            message: Message text to send
+            recipient_id: user/group ID for the push fallback (None = no fallback)
+            received_at: epoch seconds when the webhook event was created (default: now)
+            max_retries: Maximum reply attempts
+            
+        Returns:
+            Future resolving to (success, error_message, channel)
+        """
+        return self.send_texts_async(reply_token, self._pack_reply(message), recipient_id, received_at, max_retries)
+    
+    def send_texts_async(self, reply_token: str, texts: List[str], recipient_id: Optional[str] = None,
+                         received_at: Optional[float] = None, max_retries: int = 3) -> "Future[SendResult]":
+        """send_reply_async for already packed texts (at most 5 - one ReplyMessageRequest)"""
+        deadline = (received_at or time.time()) + REPLY_TOKEN_TTL_SECONDS
+        
+        if time.time() >= deadline:
+            # event รอในคิวนานจน token หมดอายุแล้ว - ไม่ต้องลอง reply
+            expired: Future = Future()
+            expired.set_result(self._push_fallback(recipient_id, texts, reply_token, "reply token expired"))
+            return expired
+        
+        async_mode = async_line.installed()
+        if async_mode:
+            loop, client = async_mode
+            return asyncio.run_coroutine_threadsafe(
+                self._reply_on_loop(client, reply_token, texts, recipient_id, deadline, max_retries), loop)
+        
+        try:
+            self._reply(reply_token, texts, timeout=min(self.reply_timeout, deadline - time.time()))
+            logger.info(f"Reply sent ({len(texts)} messages): {texts[0][:50]}...")
+            future: Future = Future()
+            future.set_result((True, None, 'reply'))
+            return future
+        except Exception as e:
+            logger.warning(f"Reply attempt 1 failed: {e}")
+            first_error = e
+        
+        try:
+            return get_retry_executor().submit(
+                self._retry_reply, reply_token, texts, recipient_id, deadline, max_retries, first_error
+            )
+        except RuntimeError as e:
+            # executor ถูกปิดแล้ว (process กำลังปิด) - ไม่ retry ส่งต่อให้ outbox
+            logger.warning(f"Reply retry unavailable: {e}")
+            fallback: Future = Future()
+            fallback.set_result(self._after_failed_reply(recipient_id, texts, reply_token, first_error,
+                                                         not _reply_token_unused(first_error)))
+            return fallback
+    
+    def _retry_reply(self, reply_token: str, texts: List[str], recipient_id: Optional[str],
+                     deadline: float, max_retries: int, last_error: Exception) -> SendResult:
+        """Retry on the executor thread; fall back to push once the token is known to be unused"""
+        maybe_delivered = not _reply_token_unused(last_error)
+        for attempt in range(1, max_retries):
+            if not _is_retryable_send_error(last_error):
+                break
+            delay = self.base_timeout * (2 ** (attempt - 1))
+            if time.time() + delay >= deadline:
+                logger.info("Reply token expires before the next retry")
+                break
+            time.sleep(delay)
+            try:
+                self._reply(reply_token, texts, timeout=min(self.reply_timeout, deadline - time.time()))
+                logger.info(f"Reply sent on attempt {attempt + 1}")
+                return True, None, 'reply'
+            except Exception as e:
+                last_error = e
+                maybe_delivered = maybe_delivered or not _reply_token_unused(e)
+                logger.warning(f"Reply attempt {attempt + 1} failed: {e}")
+        
+        return self._after_failed_reply(recipient_id, texts, reply_token, last_error, maybe_delivered)
+    
+    async def _reply_on_loop(self, client, reply_token: str, texts: List[str], recipient_id: Optional[str],
+                             deadline: float, max_retries: int) -> SendResult:
+        """Reply through AsyncLineClient on the event loop; retries wait with asyncio.sleep"""
+        last_error = None
+        maybe_delivered = False
+        for attempt in range(max_retries):
+            if attempt:
+                if not _is_retryable_send_error(last_error):
+                    break
+                delay = self.base_timeout * (2 ** (attempt - 1))
+                if time.time() + delay >= deadline:
+                    logger.info("Reply token expires before the next retry")
+                    break
+                await asyncio.sleep(delay)
+            try:
+                with self.breaker.guard():
+                    await client.reply(reply_token, texts, timeout=min(self.reply_timeout, deadline - time.time()))
+                logger.info(f"Reply sent on attempt {attempt + 1} ({len(texts)} messages, async)")
+                return True, None, 'reply'
+            except Exception as e:
+                last_error = e
+                maybe_delivered = maybe_delivered or not _reply_token_unused(e)
+                logger.warning(f"Reply attempt {attempt + 1} failed: {e}")
+        
+        return self._after_failed_reply(recipient_id, texts, reply_token, last_error, maybe_delivered)
+    
+    def _after_failed_reply(self, recipient_id: Optional[str], texts: List[str], reply_token: str,
+                            last_error, maybe_delivered: bool) -> SendResult:
+        """Push instead only when no failed attempt may have delivered the reply"""
+        if maybe_delivered:
+            # timeout/5xx: LINE อาจส่ง reply ไปแล้ว - push ซ้ำจะทำให้ผู้ใช้ได้ข้อความสองครั้ง
+            logger.error(f"Reply outcome unknown, not pushing to avoid a duplicate: {last_error}")
+            return False, str(last_error), None
+        return self._push_fallback(recipient_id, texts, reply_token, last_error)
+    
+    def _push_fallback(self, recipient_id: Optional[str], texts: List[str], reply_token: str,
+                       last_error) -> SendResult:
+        """Queue the reply texts as a push to recipient_id once the reply token is known to be unused"""
+        if not recipient_id:
+            logger.error(f"Failed to send reply and no push fallback target: {last_error}")
+            return False, str(last_error), None
+        
+        # ส่งผ่าน outbox (durable + retry) ด้วย priority ของข้อความตอบโต้
+        # dedup key กัน event ที่ถูกส่งซ้ำ (redelivery) push คำตอบเดิมสองครั้ง
+        from notifications.outbox import get_outbox, PRIORITY_INTERACTIVE
+        (self.outbox or get_outbox()).enqueue(recipient_id, texts, dedup_key=f"reply:{reply_token}",
+                                              priority=PRIORITY_INTERACTIVE)
+        logger.info(f"Reply to {recipient_id} queued as push after reply failed: {last_error}")
+        return True, None, 'push'
+    
     def send_fallback_message(self, reply_token: str) -> bool:
         """Send a simple fallback error message"""
         try:
             fallback_message = "❌ เกิดข้อผิดพลาดในการส่งข้อความ กรุณาลองใหม่อีกครั้ง"
             
-            self.line_bot_api.reply_message(
+            self.breaker.call(
+                self.line_bot_api.reply_message,
                 ReplyMessageRequest(
                     reply_token=reply_token,
                     messages=[TextMessage(text=fallback_message)]
@@ -94,48 +336,79 @@ class RobustMessageSender:
             return False
 
 class MessageQueue:
-    """Handles queued message sending for multi-step operations"""
+    """
+    Collects the parts of a multi-part response and sends them in as few requests as possible
+    
+    All parts queued for one reply token are packed into a single ReplyMessageRequest
+    (up to 5 messages) sent through RobustMessageSender.send_texts_async, so the reply
+    gets the same off-thread retries and push fallback as any other reply. Parts that do
+    not fit are queued in the push outbox at interactive priority in requests of 5 once
+    the reply has finished - the outbox keeps them after the reply and in order.
+    """
     
     def __init__(self, sender: RobustMessageSender):
         self.sender = sender
-        self.queue: List[Tuple[str, str]] = []  # (reply_token, message)
+        self.queue: List[Tuple[str, str, Optional[str]]] = []  # (reply_token, message, recipient_id)
         
-    def add_message(self, reply_token: str, message: str):
-        """Add message to queue"""
-        self.queue.append((reply_token, message))
+    def add_message(self, reply_token: str, message: str, recipient_id: Optional[str] = None):
+        """
+        Add message to queue
+        
+        Args:
+            reply_token: LINE reply token of the event being answered
+            message: Message text (long text is split on item boundaries)
+            recipient_id: user/group ID for messages that do not fit into the reply
+        """
+        self.queue.append((reply_token, message, recipient_id))
         
-    def send_all(self, delay_between: float = 1.0) -> Tuple[int, int]:
+    def send_all(self, delay_between: float = 0.0, received_at: Optional[float] = None) -> Tuple[int, int]:
         """
-        Send all queued messages with delays
+        Send all queued messages: one reply per token, overflow as pushes through the outbox
         
         Args:
-            delay_between: Delay between messages in seconds
+            delay_between: Ignored - kept for backward compatibility (no sleeps between parts)
+            received_at: epoch seconds when the webhook event was created (reply token lifetime)
             
         Returns:
-            Tuple of (successful_count, failed_count)
+            Tuple of (handed_off_count, dropped_count) counted in text messages - dropped
+            messages are overflow without a recipient_id to push to
         """
-        successful = 0
-        failed = 0
+        replies: Dict[str, dict] = {}
+        for reply_token, message, recipient_id in self.queue:
+            entry = replies.setdefault(reply_token, {'texts': [], 'recipient_id': None})
+            entry['texts'].extend(pack_texts(split_segments(message), self.sender.max_message_length) or [message])
+            entry['recipient_id'] = entry['recipient_id'] or recipient_id
+        self.queue.clear()
         
-        for i, (reply_token, message) in enumerate(self.queue):
-            # Add delay between messages (except first)
-            if i > 0:
-                time.sleep(delay_between)
-                
-            success, error = self.sender.send_reply_with_timeout(reply_token, message)
+        handed_off = 0
+        dropped = 0
+        for reply_token, entry in replies.items():
+            texts, recipient_id = entry['texts'], entry['recipient_id']
+            reply_texts = texts[:LINE_MAX_MESSAGES_PER_REQUEST]
+            pending = texts[LINE_MAX_MESSAGES_PER_REQUEST:]
+            if pending and not recipient_id:
+                logger.error(f"{len(pending)} queued messages dropped: no recipient_id for push overflow")
+                dropped += len(pending)
+                pending = []
             
-            if success:
-                successful += 1
-            else:
-                failed += 1
-                # Send fallback for failed messages
-                self.sender.send_fallback_message(reply_token)
-        
-        # Clear queue after sending
-        self.queue.clear()
+            future = self.sender.send_texts_async(reply_token, reply_texts, recipient_id, received_at)
+            handed_off += len(reply_texts) + len(pending)
+            if pending:
+                future.add_done_callback(
+                    lambda _, recipient_id=recipient_id, pending=pending, reply_token=reply_token:
+                        self._queue_overflow(recipient_id, pending, reply_token))
         
-        logger.info(f"Message queue processed: {successful} successful, {failed} failed")
-        return successful, failed
+        logger.info(f"Message queue processed: {handed_off} handed off, {dropped} dropped")
+        return handed_off, dropped
+    
+    def _queue_overflow(self, recipient_id: str, texts: List[str], reply_token: str):
+        """Queue overflow pushes of 5 messages; the dedup key keeps a redelivered event from pushing twice"""
+        from notifications.outbox import get_outbox, PRIORITY_INTERACTIVE
+        outbox = self.sender.outbox or get_outbox()
+        for index, start in enumerate(range(0, len(texts), LINE_MAX_MESSAGES_PER_REQUEST)):
+            outbox.enqueue(recipient_id, texts[start:start + LINE_MAX_MESSAGES_PER_REQUEST],
+                           dedup_key=f"reply-overflow:{reply_token}:{index}", priority=PRIORITY_INTERACTIVE)
+        logger.info(f"{len(texts)} overflow messages to {recipient_id} queued in the outbox")
 
 def create_connection_aware_sender(line_bot_api: MessagingApi) -> RobustMessageSender:
     """Factory function to create a robust message sender"""
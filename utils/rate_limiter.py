@@ -0,0 +1,214 @@
+"""
+Rate limiter ของคำสั่งต่อผู้ใช้และต่อกลุ่ม (sliding window)
+กันไม่ให้ผู้ใช้หรือกลุ่มเดียวส่งคำสั่งที่อ่าน Google Sheets ถี่จนใช้ read quota ร่วมของทุกคนหมด
+
+คำสั่งที่เกินขีดจำกัดไม่ถูกส่งต่อให้ handler: คำสั่งอ่านอย่างเดียว (เช่น "ดูนัด") ตอบด้วยคำตอบล่าสุด
+ที่เก็บไว้ของแชทเดียวกัน ส่วนคำสั่งอื่นตอบข้อความขอให้รอ
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ขีดจำกัดต่อคำสั่ง รูปแบบ "ชื่อคำสั่ง=ต่อผู้ใช้/ต่อกลุ่ม/วินาที" คั่นด้วยจุลภาค
+# "default" ใช้กับคำสั่งที่อ่าน/เขียน Sheets ที่ไม่ได้ระบุ - คำสั่งที่ไม่ใช้ Sheets ไม่จำกัด เว้นแต่ระบุ
+COMMAND_RATE_LIMITS = os.getenv(
+    'COMMAND_RATE_LIMITS',
+    'default=6/15/60,list_appointments=3/6/60,history=3/6/60'
+)
+# อายุของคำตอบที่เก็บไว้ตอบคำสั่งอ่านอย่างเดียวที่เกินขีดจำกัด (วินาที) และจำนวนคำตอบสูงสุด
+COMMAND_REPLY_CACHE_SECONDS = float(os.getenv('COMMAND_REPLY_CACHE_SECONDS', 300))
+COMMAND_REPLY_CACHE_SIZE = int(os.getenv('COMMAND_REPLY_CACHE_SIZE', 1000))
+
+THROTTLED_MESSAGE = "⏳ มีการใช้คำสั่งนี้บ่อยเกินไป กรุณารอประมาณ {seconds} วินาทีแล้วลองใหม่อีกครั้ง"
+CACHED_REPLY_NOTE = "\n\nℹ️ ข้อมูลเมื่อ {seconds} วินาทีที่แล้ว (มีการเรียกคำสั่งนี้ถี่เกินไป)"
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """จำนวนครั้งที่ใช้ได้ภายใน window_seconds ต่อผู้ใช้หนึ่งคน และต่อกลุ่มหนึ่งกลุ่ม (0 = ไม่จำกัด)"""
+    per_user: int
+    per_group: int
+    window_seconds: float
+
+
+def parse_rate_limits(spec: str) -> Dict[str, RateLimit]:
+    """
+    แปลงค่า COMMAND_RATE_LIMITS
+
+    Args:
+        spec (str): เช่น "default=6/15/60,list_appointments=3/6/60"
+
+    Returns:
+        Dict[str, RateLimit]: ขีดจำกัดตามชื่อคำสั่ง (ข้ามรายการที่รูปแบบผิดพร้อม log)
+    """
+    limits = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            name, values = entry.split('=', 1)
+            per_user, per_group, window = values.split('/')
+            limits[name.strip()] = RateLimit(int(per_user), int(per_group), float(window))
+        except ValueError:
+            logger.error(f"Invalid rate limit entry ignored: {entry!r}")
+    return limits
+
+
+class SlidingWindowLimiter:
+    """
+    sliding window log ต่อ key: เก็บเวลาของการใช้งานที่ยังอยู่ใน window (ไม่เกิน limit รายการต่อ key)
+    key ที่ไม่มีการใช้งานใน window แล้วถูกลบเมื่อเจอระหว่าง acquire
+    """
+
+    def __init__(self):
+        self._hits: Dict[Tuple, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, key: Tuple, limit: int, window_seconds: float, now: float = None) -> float:
+        """เวลาที่ต้องรอก่อน key นี้จะใช้ได้อีกครั้ง (0 = ใช้ได้ทันที)"""
+        if limit <= 0:
+            return 0.0
+        now = time.time() if now is None else now
+        with self._lock:
+            hits = self._evict(key, window_seconds, now)
+            if hits is None or len(hits) < limit:
+                return 0.0
+            return max(0.0, hits[0] + window_seconds - now)
+
+    def record(self, key: Tuple, limit: int, window_seconds: float, now: float = None):
+        if limit <= 0:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            hits = self._evict(key, window_seconds, now)
+            if hits is None:
+                hits = self._hits[key] = deque(maxlen=limit)
+            hits.append(now)
+
+    def _evict(self, key: Tuple, window_seconds: float, now: float) -> Optional[Deque[float]]:
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - window_seconds:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return None
+        return hits
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hits)
+
+
+class CommandThrottle:
+    """
+    ตรวจขีดจำกัดของคำสั่งก่อนเรียก handler และเก็บคำตอบล่าสุดของคำสั่งอ่านอย่างเดียว
+
+    การใช้งานหนึ่งครั้งถูกนับทั้งกับผู้ใช้และกับกลุ่ม (ในแชทกลุ่ม) และนับเฉพาะเมื่อผ่านทั้งสองขีดจำกัด
+    - คำสั่งที่ถูกปฏิเสธไม่ยืด window ออกไป
+    """
+
+    def __init__(self, limits: Dict[str, RateLimit] = None, cache_seconds: float = COMMAND_REPLY_CACHE_SECONDS,
+                 cache_size: int = COMMAND_REPLY_CACHE_SIZE):
+        self.limits = parse_rate_limits(COMMAND_RATE_LIMITS) if limits is None else dict(limits)
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        self._limiter = SlidingWindowLimiter()
+        self._lock = threading.Lock()
+        # (context ของ worksheet, context_id, คำสั่ง, ข้อความ) -> (เวลาที่เก็บ, คำตอบ)
+        self._replies: 'OrderedDict[Tuple[str, str, str, str], Tuple[float, str]]' = OrderedDict()
+        self.allowed_total = 0
+        self.throttled_total: Dict[str, int] = {}
+        self.cached_replies_total = 0
+
+    def limit_for(self, command) -> Optional[RateLimit]:
+        """ขีดจำกัดของคำสั่ง (None = ไม่จำกัด)"""
+        limit = self.limits.get(command.name)
+        if limit is None and command.uses_sheets:
+            limit = self.limits.get('default')
+        return limit
+
+    def acquire(self, command, user_id: str, context_type: str, context_id: str) -> float:
+        """
+        ขอใช้คำสั่งหนึ่งครั้ง
+
+        Returns:
+            float: 0 หากใช้ได้ (นับการใช้งานแล้ว) หรือจำนวนวินาทีที่ต้องรอหากเกินขีดจำกัด
+        """
+        limit = self.limit_for(command)
+        if limit is None:
+            return 0.0
+        checks = [(('user', user_id, command.name), limit.per_user)]
+        if context_type == 'group':
+            checks.append((('group', context_id, command.name), limit.per_group))
+
+        with self._lock:  # ตรวจและนับเป็นขั้นตอนเดียว - สอง worker ใช้ slot สุดท้ายพร้อมกันไม่ได้
+            now = time.time()
+            wait = max(self._limiter.retry_after(key, count, limit.window_seconds, now) for key, count in checks)
+            if wait > 0:
+                self.throttled_total[command.name] = self.throttled_total.get(command.name, 0) + 1
+                return wait
+            for key, count in checks:
+                self._limiter.record(key, count, limit.window_seconds, now)
+            self.allowed_total += 1
+        return 0.0
+
+    @staticmethod
+    def _reply_key(command, context_type: str, context_id: str, message_lower: str) -> Tuple[str, str, str, str]:
+        sheet_context = f"group_{context_id}" if context_type == 'group' else 'personal'
+        return sheet_context, context_id, command.name, message_lower
+
+    def remember_reply(self, command, context_type: str, context_id: str, message_lower: str, reply: str):
+        """เก็บคำตอบของคำสั่งอ่านอย่างเดียว ไว้ตอบเมื่อแชทเดียวกันเรียกคำสั่งเดิมเกินขีดจำกัด"""
+        if not command.cacheable or self.cache_seconds <= 0:
+            return
+        key = self._reply_key(command, context_type, context_id, message_lower)
+        with self._lock:
+            self._replies[key] = (time.time(), reply)
+            self._replies.move_to_end(key)
+            while len(self._replies) > self.cache_size:
+                self._replies.popitem(last=False)
+
+    def throttled_reply(self, command, context_type: str, context_id: str, message_lower: str,
+                        retry_after: float) -> str:
+        """คำตอบของคำสั่งที่เกินขีดจำกัด: คำตอบที่เก็บไว้ (ถ้ายังไม่หมดอายุ) หรือข้อความขอให้รอ"""
+        if command.cacheable:
+            key = self._reply_key(command, context_type, context_id, message_lower)
+            with self._lock:
+                cached = self._replies.get(key)
+                if cached and time.time() - cached[0] <= self.cache_seconds:
+                    self.cached_replies_total += 1
+                    return cached[1] + CACHED_REPLY_NOTE.format(seconds=int(time.time() - cached[0]))
+        return THROTTLED_MESSAGE.format(seconds=max(1, int(retry_after + 0.999)))
+
+    def invalidate(self, sheet_context: str):
+        """
+        ลบคำตอบที่เก็บไว้ของ worksheet ที่ข้อมูลเปลี่ยน (subscriber ของ change feed)
+
+        Args:
+            sheet_context (str): 'personal' หรือ 'group_{group_id}'
+        """
+        with self._lock:
+            for key in [key for key in self._replies if key[0] == sheet_context]:
+                del self._replies[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limits': {name: f"{limit.per_user}/{limit.per_group}/{limit.window_seconds:g}s"
+                           for name, limit in self.limits.items()},
+                'allowed_total': self.allowed_total,
+                'throttled_total': dict(self.throttled_total),
+                'cached_replies_total': self.cached_replies_total,
+                'cached_replies': len(self._replies),
+                'tracked_keys': len(self._limiter)
+            }
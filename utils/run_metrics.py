@@ -0,0 +1,203 @@
+"""
+Run metrics สำหรับรอบแจ้งเตือนและ reconcile
+เก็บเวลาต่อขั้นตอน (ค้นหา worksheet, อ่าน Sheets, decode, จัดกลุ่ม, render, ลง outbox),
+จำนวน และข้อผิดพลาดของรอบล่าสุดไว้ใน ring buffer ในหน่วยความจำ
+พร้อม sample latency ของ push (วัดโดย outbox sender รอบ push_message) สำหรับคำนวณ p50/p95
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# จำนวนรอบล่าสุดที่เก็บไว้ และจำนวน sample latency ของ push
+RUN_METRICS_HISTORY = int(os.getenv('RUN_METRICS_HISTORY', 50))
+PUSH_LATENCY_SAMPLES = int(os.getenv('PUSH_LATENCY_SAMPLES', 1000))
+
+# ชื่อขั้นตอนที่ใช้ในรอบแจ้งเตือน
+STAGE_WORKSHEET_DISCOVERY = 'worksheet_discovery'
+STAGE_SHEET_READS = 'sheet_reads'
+STAGE_DECODE = 'decode'
+STAGE_GROUPING = 'grouping'
+STAGE_RENDERING = 'rendering'
+# รอบแจ้งเตือนเพียงบันทึก push ลง outbox - เวลาของ LINE push จริงอยู่ใน push_latency()
+STAGE_QUEUEING = 'queueing'
+
+
+def percentile(values: Sequence[float], pct: float) -> Optional[float]:
+    """
+    ค่า percentile แบบ nearest-rank
+
+    Args:
+        values (Sequence[float]): ค่าที่ต้องการ (ไม่ต้องเรียง)
+        pct (float): 0-100
+
+    Returns:
+        float: ค่าที่ percentile นั้น หรือ None หากไม่มีข้อมูล
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class RunRecord:
+    """ข้อมูลของรอบหนึ่งรอบ: เวลาต่อขั้นตอน จำนวน และข้อผิดพลาด"""
+
+    def __init__(self, kind: str, label: str = None):
+        self.kind = kind
+        self.label = label
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.status = 'running'
+        self.stages: Dict[str, float] = {}
+        self.counts: Counter = Counter()
+        self.errors: Counter = Counter()
+
+    def add_stage(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        finished = self.finished_at or time.time()
+        return {
+            'kind': self.kind,
+            'label': self.label,
+            'status': self.status,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(),
+            'duration_ms': round((finished - self.started_at) * 1000, 1),
+            'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            'counts': dict(self.counts),
+            'errors': dict(self.errors)
+        }
+
+
+class RunMetrics:
+    """
+    Ring buffer ของรอบล่าสุด (thread-safe)
+
+    รอบถูกผูกกับ thread ที่เรียก run() - stage()/count()/error() ที่เรียกจาก thread เดียวกัน
+    (รวมถึงใน repository) จะถูกบันทึกเข้ารอบนั้น ถ้าไม่มีรอบที่กำลังทำงานจะถูกข้ามไป
+    """
+
+    def __init__(self, history: int = RUN_METRICS_HISTORY, latency_samples: int = PUSH_LATENCY_SAMPLES):
+        self._runs = deque(maxlen=history)
+        self._push_latencies = deque(maxlen=latency_samples)
+        self._push_errors: Counter = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def current(self) -> Optional[RunRecord]:
+        """รอบที่กำลังทำงานใน thread นี้"""
+        return getattr(self._local, 'run', None)
+
+    @contextmanager
+    def run(self, kind: str, label: str = None):
+        """
+        เริ่มรอบใหม่ (ถ้ามีรอบทำงานอยู่แล้วใน thread นี้ เช่น reconcile ภายในรอบแจ้งเตือน จะใช้รอบเดิม)
+
+        Args:
+            kind (str): ประเภทรอบ เช่น 'notification', 'reconcile'
+            label (str): รายละเอียด เช่น bucket
+        """
+        if self.current is not None:
+            yield self.current
+            return
+
+        record = RunRecord(kind, label)
+        self._local.run = record
+        with self._lock:
+            self._runs.append(record)
+        try:
+            yield record
+            record.status = 'completed'
+        except BaseException as e:
+            record.status = 'failed'
+            record.errors[type(e).__name__] += 1
+            raise
+        finally:
+            record.finished_at = time.time()
+            self._local.run = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """จับเวลาขั้นตอนหนึ่งของรอบปัจจุบัน (สะสมหากเรียกหลายครั้ง)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.current
+            if record is not None:
+                record.add_stage(name, time.perf_counter() - started)
+
+    def count(self, name: str, amount: int = 1):
+        record = self.current
+        if record is not None:
+            record.counts[name] += amount
+
+    def error(self, name: str):
+        record = self.current
+        if record is not None:
+            record.errors[name] += 1
+
+    def record_push(self, seconds: float, error: str = None):
+        """บันทึก latency ของ push หนึ่งครั้ง (เรียกจาก outbox sender)"""
+        with self._lock:
+            self._push_latencies.append(seconds)
+            if error:
+                self._push_errors[error] += 1
+
+    def recent_runs(self, limit: int = 20) -> List[dict]:
+        """รอบล่าสุด เรียงจากใหม่ไปเก่า"""
+        with self._lock:
+            runs = list(self._runs)[-limit:]
+        return [record.to_dict() for record in reversed(runs)]
+
+    def push_latency(self) -> dict:
+        with self._lock:
+            samples = list(self._push_latencies)
+            errors = dict(self._push_errors)
+
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            'samples': len(samples),
+            'p50_ms': ms(percentile(samples, 50)),
+            'p95_ms': ms(percentile(samples, 95)),
+            'max_ms': ms(max(samples) if samples else None),
+            'errors': errors
+        }
+
+    def stats(self, limit: int = 20) -> dict:
+        """สรุปสำหรับ endpoint: รอบล่าสุด, latency ของ push และข้อผิดพลาดรวม"""
+        runs = self.recent_runs(limit)
+        error_totals: Counter = Counter()
+        for run in runs:
+            error_totals.update(run['errors'])
+        return {
+            'runs': runs,
+            'push_latency': self.push_latency(),
+            'run_errors': dict(error_totals)
+        }
+
+
+_run_metrics: Optional[RunMetrics] = None
+_run_metrics_lock = threading.Lock()
+
+
+def get_run_metrics() -> RunMetrics:
+    """คืน RunMetrics ที่ใช้ร่วมกันทั้ง process (สร้างเมื่อเรียกครั้งแรก)"""
+    global _run_metrics
+    with _run_metrics_lock:
+        if _run_metrics is None:
+            _run_metrics = RunMetrics()
+        return _run_metrics
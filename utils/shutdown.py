@@ -0,0 +1,146 @@
+"""
+Graceful shutdown ของ process (SIGTERM จาก Render/gunicorn ตอน redeploy)
+
+signal handler เริ่ม graceful_shutdown() ใน thread แยกทันที แล้วส่งต่อให้ handler เดิม (เช่น ของ gunicorn)
+worker_exit ของ gunicorn (gunicorn.conf.py) หรือ lifespan ของ asgi.py รอ thread นั้นก่อน interpreter ปิด
+hook แต่ละตัวได้เวลาที่เหลือจาก deadline ร่วม SHUTDOWN_DEADLINE_SECONDS ตามลำดับที่ลงทะเบียน
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# เวลารวมที่ใช้ปิดได้ (วินาที) - ควรน้อยกว่า graceful timeout ของ platform (Render ให้ 30 วินาที)
+SHUTDOWN_DEADLINE_SECONDS = float(os.getenv('SHUTDOWN_DEADLINE_SECONDS', 20))
+
+_hooks: List[Tuple[str, Callable[[float], object]]] = []
+_hooks_lock = threading.Lock()
+_requested = threading.Event()
+_done = False
+_installed = False
+_thread = None  # thread ที่ทำ graceful_shutdown (เริ่มจาก signal handler)
+_results = {}
+
+
+def add_shutdown_hook(name: str, hook: Callable[[float], object]):
+    """
+    ลงทะเบียนงานที่ต้องทำตอนปิด process (ทำตามลำดับที่ลงทะเบียน)
+
+    Args:
+        name (str): ชื่อที่ใช้ใน log
+        hook: ฟังก์ชันรับเวลาที่เหลือ (วินาที) - ต้องคืนภายในเวลานั้น
+    """
+    with _hooks_lock:
+        _hooks.append((name, hook))
+
+
+def shutdown_requested() -> bool:
+    """ได้รับ SIGTERM/SIGINT แล้วหรือกำลังปิด"""
+    return _requested.is_set()
+
+
+def graceful_shutdown(deadline_seconds: float = None) -> dict:
+    """
+    ทำ shutdown hooks ทั้งหมดครั้งเดียว (เรียกซ้ำได้ - ครั้งถัดไปไม่ทำอะไร)
+
+    Returns:
+        dict: ผลของแต่ละ hook ตามชื่อ (หรือข้อความ error)
+    """
+    global _done
+    with _hooks_lock:
+        if _done:
+            return {}
+        _done = True
+        hooks = list(_hooks)
+    _requested.set()
+
+    deadline = time.time() + (SHUTDOWN_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds)
+    results = {}
+    logger.info(f"Graceful shutdown started ({len(hooks)} hooks)")
+    for name, hook in hooks:
+        remaining = max(0.0, deadline - time.time())
+        try:
+            results[name] = hook(remaining)
+        except Exception as e:
+            logger.error(f"Shutdown hook {name} failed: {e}", exc_info=True)
+            results[name] = f"error: {e}"
+    logger.info(f"Graceful shutdown finished: {results}")
+    return results
+
+
+def start_graceful_shutdown() -> threading.Thread:
+    """
+    เริ่ม graceful_shutdown ใน thread แยก (ครั้งเดียว) - เรียกจาก signal handler ได้เพราะไม่รอ
+
+    ต้องเริ่มก่อน interpreter เริ่มปิด: concurrent.futures ปิด executor ทั้งหมด (รอทุกงานโดยไม่มี timeout)
+    ก่อน atexit callback จะได้ทำงาน ทำให้ deadline ใช้ไม่ได้และ submit งานใหม่ไม่ได้
+
+    Returns:
+        threading.Thread: thread ที่ทำ shutdown hooks
+    """
+    global _thread
+    _requested.set()
+    with _hooks_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run_shutdown, name='graceful-shutdown')
+            _thread.start()
+        return _thread
+
+
+def _run_shutdown():
+    _results.update(graceful_shutdown())
+
+
+def wait_for_shutdown(timeout: float = None) -> dict:
+    """
+    เริ่ม (ถ้ายังไม่เริ่ม) แล้วรอ graceful shutdown จนเสร็จ
+    ใช้ใน worker_exit ของ gunicorn (gunicorn.conf.py) และ lifespan ของ asgi.py - ก่อน interpreter ปิด
+
+    Args:
+        timeout (float): เวลารอสูงสุด (ค่าเริ่มต้น SHUTDOWN_DEADLINE_SECONDS + 5)
+
+    Returns:
+        dict: ผลของแต่ละ hook
+    """
+    thread = start_graceful_shutdown()
+    thread.join(SHUTDOWN_DEADLINE_SECONDS + 5 if timeout is None else timeout)
+    if thread.is_alive():
+        logger.warning("Graceful shutdown did not finish in time")
+    return dict(_results)
+
+
+def _signal_handler(previous):
+    def handle(signum, frame):
+        thread = start_graceful_shutdown()
+        if callable(previous) and previous is not signal.default_int_handler:
+            # เช่น gunicorn worker: หยุดรับ request แล้วออก - worker_exit รอ shutdown thread
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # ไม่มี server จัดการ signal: รอให้ hooks เสร็จก่อนออก (SIG_DFL จะฆ่า process ทันที)
+            thread.join(SHUTDOWN_DEADLINE_SECONDS + 5)
+            if callable(previous):
+                previous(signum, frame)  # KeyboardInterrupt เหมือนเดิม
+            raise SystemExit(128 + signum)
+    return handle
+
+
+def install_signal_handlers():
+    """
+    ตั้ง SIGTERM/SIGINT handler ที่เริ่ม graceful shutdown ทันทีเมื่อได้รับ signal
+    ต้องเรียกจาก main thread - thread อื่นข้ามการตั้ง handler (ใช้ worker_exit/lifespan แทน)
+    """
+    global _installed
+    with _hooks_lock:
+        if _installed:
+            return
+        _installed = True
+    if threading.current_thread() is not threading.main_thread():
+        logger.warning("Signal handlers not installed (not on main thread)")
+        return
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, _signal_handler(signal.getsignal(signum)))
@@ -0,0 +1,133 @@
+"""
+กันการประมวลผล webhook event ซ้ำด้วย webhookEventId
+LINE ส่ง event เดิมซ้ำ (deliveryContext.isRedelivery) เมื่อไม่ได้รับ 200 ทันเวลา
+ถ้าไม่กันไว้ คำสั่งเช่น "เพิ่มนัด" จะสร้างนัดหมายซ้ำ
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from storage import local_db
+
+logger = logging.getLogger(__name__)
+
+# จำ webhookEventId ไว้นานเท่าไร และสูงสุดกี่รายการในหน่วยความจำ
+WEBHOOK_DEDUP_TTL_SECONDS = float(os.getenv('WEBHOOK_DEDUP_TTL_SECONDS', 86400))
+WEBHOOK_DEDUP_MAX_ENTRIES = int(os.getenv('WEBHOOK_DEDUP_MAX_ENTRIES', 10000))
+# เก็บลง LOCAL_DB_PATH ด้วย เพื่อให้ยังกันซ้ำได้หลัง restart และระหว่าง gunicorn workers
+WEBHOOK_DEDUP_PERSIST = os.getenv('WEBHOOK_DEDUP_PERSIST', 'true').lower() == 'true'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_events_seen ON webhook_events (seen_at);
+"""
+
+# ลบ event_id ที่หมดอายุออกจากไฟล์อย่างมากทุกกี่วินาที
+_PURGE_INTERVAL_SECONDS = 600
+
+
+class WebhookEventDedup:
+    """
+    ชุด webhookEventId ที่เห็นแล้ว (thread-safe) แบบจำกัดขนาดและหมดอายุตามเวลา
+
+    ตรวจในหน่วยความจำก่อน (O(1)) แล้วจึงใช้ INSERT ... ON CONFLICT ในไฟล์ local ซึ่งเป็นทั้งการตรวจ
+    และการบันทึกในคำสั่งเดียว (atomic ระหว่าง gunicorn workers) ตัดสินจาก rowcount
+    event ที่ไม่มี webhookEventId ถือว่าใหม่เสมอ
+    """
+
+    def __init__(self, ttl_seconds: float = WEBHOOK_DEDUP_TTL_SECONDS,
+                 max_entries: int = WEBHOOK_DEDUP_MAX_ENTRIES,
+                 db_path: str = None, persist: bool = WEBHOOK_DEDUP_PERSIST):
+        """
+        Args:
+            ttl_seconds (float): เวลาที่จำ event_id ไว้
+            max_entries (int): จำนวน event_id สูงสุดในหน่วยความจำ (เก่าสุดถูกลบก่อน)
+            db_path (str): ไฟล์ SQLite (ค่าเริ่มต้น LOCAL_DB_PATH)
+            persist (bool): False = จำในหน่วยความจำเท่านั้น
+        """
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.duplicates_total = 0
+        self._conn = None
+        if persist:
+            self._conn = local_db.connect(db_path)
+            with self._lock:
+                self._conn.executescript(_SCHEMA)
+
+    def claim(self, event_id: Optional[str], redelivered: bool = True) -> bool:
+        """
+        บันทึก event_id หากยังไม่เคยเห็น
+
+        Args:
+            event_id (str): webhookEventId
+            redelivered (bool): deliveryContext.isRedelivery ของ event (ใช้ใน log - ทุก event ถูกตรวจ)
+
+        Returns:
+            bool: True หาก event ใหม่ (ควรประมวลผล), False หากซ้ำ
+        """
+        if not event_id:
+            return True
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._seen:
+                self.duplicates_total += 1
+                return False
+            is_new = True
+            if self._conn is not None:
+                try:
+                    # บันทึกใหม่ หรือแทนแถวที่หมดอายุแต่ยังไม่ถูก purge - rowcount 0 = เห็นแล้วภายใน TTL
+                    cursor = self._conn.execute(
+                        "INSERT INTO webhook_events (event_id, seen_at) VALUES (?, ?) "
+                        "ON CONFLICT (event_id) DO UPDATE SET seen_at = excluded.seen_at "
+                        "WHERE webhook_events.seen_at < ?",
+                        (event_id, now, now - self.ttl)
+                    )
+                    is_new = cursor.rowcount > 0
+                except Exception as e:
+                    logger.error(f"Webhook dedup store failed, using memory only: {e}")
+            # เวลาปัจจุบันเสมอ - _expire อาศัยลำดับเวลาของ OrderedDict
+            self._remember(event_id, now)
+            if not is_new:
+                self.duplicates_total += 1
+                if not redelivered:
+                    logger.warning(f"Webhook event {event_id} seen before although not marked as redelivery")
+            return is_new
+
+    def _remember(self, event_id: str, seen_at: float):
+        self._seen[event_id] = seen_at
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _expire(self, now: float):
+        """ลบ event_id ที่หมดอายุ (ต้องถือ lock) - OrderedDict เรียงตามเวลาที่เห็น"""
+        cutoff = now - self.ttl
+        while self._seen:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff:
+                break
+            self._seen.popitem(last=False)
+        if self._conn is not None and now - self._last_purge >= _PURGE_INTERVAL_SECONDS:
+            self._last_purge = now
+            try:
+                self._conn.execute("DELETE FROM webhook_events WHERE seen_at < ?", (cutoff,))
+            except Exception as e:
+                logger.warning(f"Failed to purge webhook dedup store: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'tracked': len(self._seen),
+                'duplicates_total': self.duplicates_total,
+                'persistent': self._conn is not None
+            }
@@ -0,0 +1,523 @@
+"""
+Webhook dispatcher สำหรับ LINE webhook
+ตรวจ signature ใน request thread แล้วส่ง event เข้าคิวที่มีขนาดจำกัด ให้ worker pool ประมวลผล
+เพื่อให้ /callback ตอบ 200 OK ได้ทันทีโดยไม่รอ Sheets I/O และการ parse ข้อความ
+event ของแชทเดียวกัน (กลุ่ม/ห้อง/ผู้ใช้) ทำทีละ event ตามลำดับที่ได้รับ แชทต่างกันทำพร้อมกันได้
+"""
+
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.models.events import UnknownEvent
+from linebot.v3.webhooks import Event, MessageEvent
+
+from storage import local_db
+from utils.message_sender import REPLY_TOKEN_TTL_SECONDS
+from utils.run_metrics import percentile
+from utils.webhook_dedup import WebhookEventDedup
+
+logger = logging.getLogger(__name__)
+
+# จำนวน worker ที่ประมวลผล event และจำนวน event ที่รอในคิวได้สูงสุด
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+# worker เพิ่มชั่วคราวเมื่อมีแชทรอมากกว่า worker ที่ว่าง (เช่น payload เดียวมี event จากหลายกลุ่ม)
+# สูงสุดกี่ตัวรวม WEBHOOK_WORKERS และหยุดเมื่อว่างนานกี่วินาที
+WEBHOOK_MAX_WORKERS = int(os.getenv('WEBHOOK_MAX_WORKERS', 16))
+WEBHOOK_BURST_IDLE_SECONDS = float(os.getenv('WEBHOOK_BURST_IDLE_SECONDS', 30))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 200))
+# จำนวน sample อายุของ reply token ที่เก็บไว้คำนวณ p50/p95
+WEBHOOK_TOKEN_AGE_SAMPLES = int(os.getenv('WEBHOOK_TOKEN_AGE_SAMPLES', 1000))
+
+
+# dispatcher และแชทที่ worker thread นี้กำลังทำ (ใช้โดย defer_in_chat)
+_worker_context = threading.local()
+
+
+class WebhookQueueFull(Exception):
+    """คิว event เต็ม - /callback ควรตอบ 503 ให้ LINE ส่งซ้ำภายหลัง"""
+
+
+class WebhookShuttingDown(WebhookQueueFull):
+    """process กำลังปิด (graceful shutdown) - ไม่รับ event ใหม่"""
+
+
+_BACKLOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_backlog (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    destination TEXT,
+    accepted_at REAL NOT NULL
+);
+"""
+
+
+class _DeferredTask:
+    """งานจาก defer_in_chat พร้อม event ต้นทาง (ใช้บันทึก event นั้นแทนเมื่อปิด process ก่อนงานได้ทำ)"""
+    __slots__ = ('func', 'origin', 'destination')
+
+    def __init__(self, func: Callable[[], None], origin: Optional[dict], destination: Optional[str]):
+        self.func = func
+        self.origin = origin
+        self.destination = destination
+
+    def __call__(self):
+        self.func()
+
+
+def chat_key(raw_event: dict) -> str:
+    """
+    key ของบทสนทนาที่ event อยู่ - groupId / roomId / userId ตามชนิดของ source
+
+    Returns:
+        str: key สำหรับเรียง event (event ที่ไม่มี source ได้ key ว่าง และถูกเรียงรวมกัน)
+    """
+    source = raw_event.get('source') or {}
+    return source.get('groupId') or source.get('roomId') or source.get('userId') or ''
+
+
+def defer_in_chat(task: Callable[[], None]) -> bool:
+    """
+    ให้ task ทำต่อจาก event ปัจจุบันในคิวของแชทเดียวกัน (ก่อน event ถัดไปของแชทนั้น)
+    handler ตอบกลับได้ทันทีโดยงานที่ตามมา (เช่น การลบนัดหมาย) ยังคงลำดับกับคำสั่งถัดไปของแชท
+
+    Returns:
+        bool: False หากไม่ได้ถูกเรียกจาก worker ของ dispatcher (ผู้เรียกต้องทำ task เอง)
+    """
+    deferred = getattr(_worker_context, 'deferred', None)
+    if deferred is None:
+        return False
+    deferred.append(task)
+    return True
+
+
+class WebhookDispatcher:
+    """
+    คิว event ของ webhook พร้อม worker pool
+
+    - submit() ตรวจ signature และแยก event จาก body (ใน request thread) แล้วเข้าคิวทั้ง payload
+      หรือปฏิเสธทั้ง payload เมื่อคิวเต็ม - event ที่ prefilter ไม่รับ (เช่น ข้อความสนทนาในกลุ่ม)
+      และ event ที่ webhookEventId ซ้ำ (LINE ส่งซ้ำ) ถูกทิ้งก่อนเข้าคิว
+    - แต่ละแชท (chat_key) มีคิวของตัวเอง worker หยิบแชทที่พร้อมจาก ready queue ทีละ event
+      เมื่อแชทที่พร้อมมีมากกว่า worker ที่ว่าง จะเพิ่ม worker ชั่วคราวได้ถึง max_workers เพื่อให้ event
+      ของหลายแชทใน payload เดียวทำพร้อมกัน แทนการรอ Sheets I/O ของกันและกัน
+      แชทที่มี worker ทำอยู่จะไม่ถูกหยิบซ้ำจนกว่า event นั้นเสร็จ (เช่น เพิ่มนัดแล้วดูนัด
+      หรือแก้ไขแล้วลบในกลุ่มเดียวกันไม่แข่งกัน) และแชทที่ยังมี event ค้างจะต่อท้าย ready queue
+      เพื่อให้แชทอื่นได้ทำสลับกัน
+    - worker แปลง event เป็น model ของ SDK แล้วเรียก handler ที่ลงทะเบียนไว้กับ WebhookHandler
+      งานที่ handler ส่งต่อด้วย defer_in_chat() เข้าคิวของแชทก่อน event ถัดไป
+    - บันทึกอายุของ reply token ตอนเริ่มประมวลผล (event ที่รอนานเกิน REPLY_TOKEN_TTL_SECONDS
+      จะถูกตอบด้วย push แทนโดย RobustMessageSender.send_reply_async)
+    """
+
+    def __init__(self, handler: WebhookHandler, workers: int = WEBHOOK_WORKERS,
+                 max_queue: int = WEBHOOK_QUEUE_SIZE, dedup: Optional[WebhookEventDedup] = None,
+                 prefilter: Optional[Callable[[dict], bool]] = None, max_workers: int = WEBHOOK_MAX_WORKERS,
+                 burst_idle_seconds: float = WEBHOOK_BURST_IDLE_SECONDS):
+        self.handler = handler
+        self.dedup = dedup  # None = ไม่กัน event ซ้ำ
+        self.prefilter = prefilter  # รับ event ดิบ (dict) คืน False = ทิ้งโดยไม่สร้าง model/ไม่ log
+        self.workers = workers
+        self.max_workers = max(workers, max_workers)
+        self.burst_idle_seconds = burst_idle_seconds
+        self.max_queue = max_queue
+        self._lanes: Dict[str, Deque[tuple]] = {}  # chat key -> (raw event หรือ task, destination, accepted_at)
+        self._ready: Deque[str] = deque()  # แชทที่มี event รอและไม่มี worker ทำอยู่
+        self._busy: Set[str] = set()  # แชทที่ worker กำลังทำ
+        self._depth = 0
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self.accepting = True  # False ระหว่าง graceful shutdown
+        self._backlog_saved = False
+        self._in_flight = 0
+        self._idle = 0  # worker ที่รอ event อยู่
+        self._started_at: Dict[str, float] = {}  # chat key -> เวลาที่เริ่มทำ event ปัจจุบัน
+        self._token_ages = deque(maxlen=WEBHOOK_TOKEN_AGE_SAMPLES)
+        self.accepted_total = 0
+        self.ignored_total = 0
+        self.processed_total = 0
+        self.failed_total = 0
+        self.rejected_total = 0
+        self.expired_tokens_total = 0
+        self.deferred_tasks_total = 0
+        self.burst_workers_total = 0
+        self.duplicates_total = 0
+        self.redelivered_total = 0
+
+    # ------------------------------------------------------------------
+    # Request side
+    # ------------------------------------------------------------------
+    def submit(self, body: str, signature: str) -> int:
+        """
+        ตรวจ signature แล้วนำ event ทั้งหมดใน body เข้าคิว
+
+        Args:
+            body (str): request body ของ webhook
+            signature (str): ค่า X-Line-Signature
+
+        Returns:
+            int: จำนวน event ที่เข้าคิว (ไม่รวม event ที่ prefilter ไม่รับและ event ที่ webhookEventId ซ้ำ)
+
+        Raises:
+            InvalidSignatureError: signature ไม่ถูกต้อง
+            WebhookQueueFull: คิวรับ event ทั้งหมดใน body ไม่ได้ (WebhookShuttingDown ระหว่างปิด process)
+        """
+        if not self.handler.parser.signature_validator.validate(body, signature):
+            raise InvalidSignatureError('Invalid signature. signature=' + signature)
+        if not self.accepting:
+            raise WebhookShuttingDown("Webhook dispatcher is shutting down")
+
+        payload = json.loads(body)
+        events = payload.get('events') or []
+        if not events:
+            return 0  # webhook verification จาก LINE Console ส่ง events ว่าง
+        if self.prefilter is not None:
+            received = len(events)
+            events = [event for event in events if self.prefilter(event)]
+            if len(events) < received:
+                with self._condition:
+                    self.ignored_total += received - len(events)
+            if not events:
+                return 0
+
+        destination = payload.get('destination')
+        accepted_at = time.time()
+        redelivered = sum(1 for event in events if (event.get('deliveryContext') or {}).get('isRedelivery'))
+        received = len(events)
+        # ตรวจคิว, บันทึก event_id และเข้าคิวภายใต้ lock เดียว - submit พร้อมกันไม่เกิน max_queue
+        # และ event_id ถูกบันทึกเฉพาะเมื่อคิวรับได้ (payload ที่ถูกปฏิเสธต้องประมวลผลได้เมื่อ LINE ส่งซ้ำ)
+        with self._condition:
+            if not self.accepting:
+                raise WebhookShuttingDown("Webhook dispatcher is shutting down")
+            if self._depth + len(events) > self.max_queue:
+                self.rejected_total += len(events)
+                raise WebhookQueueFull(f"Webhook queue full ({self._depth}/{self.max_queue})")
+            if self.dedup is not None:
+                events = [event for event in events
+                          if self.dedup.claim(event.get('webhookEventId'),
+                                              bool((event.get('deliveryContext') or {}).get('isRedelivery', True)))]
+                if len(events) < received:
+                    logger.info(f"Dropped {received - len(events)} duplicate webhook events "
+                                f"({redelivered} redelivered in payload)")
+
+            self.redelivered_total += redelivered
+            self.duplicates_total += received - len(events)
+            if not events:
+                return 0
+            for event in events:
+                key = chat_key(event)
+                lane = self._lanes.setdefault(key, deque())
+                if not lane and key not in self._busy:
+                    self._ready.append(key)
+                lane.append((event, destination, accepted_at))
+            self._depth += len(events)
+            self.accepted_total += len(events)
+            self._condition.notify(len(events))
+            self._add_burst_workers()
+        return len(events)
+
+    # ------------------------------------------------------------------
+    # Worker side
+    # ------------------------------------------------------------------
+    def start(self):
+        """เริ่ม worker threads (เรียกซ้ำได้)"""
+        if any(thread.is_alive() for thread in self._threads):
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'webhook-worker-{index}', daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Webhook dispatcher started with {self.workers} workers (up to {self.max_workers})")
+
+    def _add_burst_workers(self):
+        """เพิ่ม worker ชั่วคราวให้พอกับแชทที่รอ (ต้องถือ condition) - ไม่ทำก่อน start() หรือหลัง stop()"""
+        if not self._threads or self._stop.is_set():
+            return
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        shortfall = len(self._ready) - self._idle
+        count = min(shortfall, self.max_workers - len(self._threads))
+        for _ in range(max(0, count)):
+            self.burst_workers_total += 1
+            thread = threading.Thread(target=self._run, args=(True,), daemon=True,
+                                      name=f'webhook-burst-{self.burst_workers_total}')
+            self._threads.append(thread)
+            thread.start()
+            self._idle += 1  # นับว่าว่างตั้งแต่สร้าง เพื่อไม่ให้ submit ถัดไปสร้างซ้ำ
+
+    def stop(self, timeout: float = 10.0):
+        """หยุด worker หลังทำ event ที่กำลังประมวลผลอยู่เสร็จ (event ที่ยังอยู่ในคิวจะไม่ถูกประมวลผล)"""
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        deadline = time.time() + timeout
+        for thread in list(self._threads):
+            thread.join(max(0.0, deadline - time.time()))
+        logger.info("Webhook dispatcher stopped")
+
+    def drain(self, timeout: float, db_path: str = None) -> int:
+        """
+        graceful shutdown: หยุดรับ event ใหม่ ทำ event ที่อยู่ในคิวให้เสร็จภายใน timeout
+        แล้วหยุด worker และบันทึก event ที่ยังไม่ได้เริ่มลง LOCAL_DB_PATH ให้ process ถัดไปทำต่อ
+
+        Args:
+            timeout (float): เวลาสูงสุดที่รอ (วินาที)
+            db_path (str): ไฟล์ SQLite (ค่าเริ่มต้น LOCAL_DB_PATH)
+
+        Returns:
+            int: จำนวน event ที่บันทึกไว้ทำต่อ
+        """
+        self.accepting = False
+        deadline = time.time() + timeout
+        with self._condition:
+            while (self._depth or self._in_flight) and any(t.is_alive() for t in self._threads):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(min(remaining, 0.1))
+        self.stop(timeout=max(0.0, deadline - time.time()))
+        with self._condition:
+            in_flight = self._in_flight
+        if in_flight:
+            logger.warning(f"{in_flight} webhook events were still running at shutdown")
+        return self.persist_backlog(db_path)
+
+    def persist_backlog(self, db_path: str = None) -> int:
+        """
+        ย้าย event ที่ยังรอในคิวลงฐานข้อมูล local (เรียกหลัง stop)
+        งานจาก defer_in_chat ที่ยังไม่ได้ทำถูกบันทึกเป็น event ต้นทาง (เช่น "ลบนัด ...") ครั้งเดียวต่อ event
+
+        Returns:
+            int: จำนวน event ที่บันทึก
+        """
+        with self._condition:
+            rows = []
+            for lane in self._lanes.values():
+                seen_origins = set()
+                for item, destination, accepted_at in lane:
+                    if callable(item):
+                        if item.origin is None or id(item.origin) in seen_origins:
+                            continue
+                        seen_origins.add(id(item.origin))
+                        item, destination = item.origin, item.destination
+                    rows.append((json.dumps(item, ensure_ascii=False), destination, accepted_at))
+            self._lanes.clear()
+            self._ready.clear()
+            self._depth = 0
+            self._backlog_saved = True
+        if not rows:
+            return 0
+        conn = local_db.connect(db_path)
+        try:
+            conn.executescript(_BACKLOG_SCHEMA)
+            conn.executemany("INSERT INTO webhook_backlog (event, destination, accepted_at) VALUES (?, ?, ?)", rows)
+        finally:
+            conn.close()
+        logger.warning(f"Saved {len(rows)} unprocessed webhook events for the next process")
+        return len(rows)
+
+    def restore_backlog(self, db_path: str = None) -> int:
+        """
+        นำ event ที่ process ก่อนหน้าบันทึกไว้ตอนปิดกลับเข้าคิว (ไม่ผ่าน prefilter/dedup ซ้ำ)
+        reply token ของ event เหล่านี้มักหมดอายุแล้ว - คำตอบจะถูก push แทน
+
+        Returns:
+            int: จำนวน event ที่นำกลับเข้าคิว
+        """
+        conn = local_db.connect(db_path)
+        try:
+            conn.executescript(_BACKLOG_SCHEMA)
+            rows = conn.execute("SELECT id, event, destination, accepted_at FROM webhook_backlog ORDER BY id").fetchall()
+            if rows:
+                conn.execute("DELETE FROM webhook_backlog WHERE id <= ?", (rows[-1]['id'],))
+        finally:
+            conn.close()
+        if not rows:
+            return 0
+        with self._condition:
+            for row in rows:
+                event = json.loads(row['event'])
+                key = chat_key(event)
+                lane = self._lanes.setdefault(key, deque())
+                if not lane and key not in self._busy:
+                    self._ready.append(key)
+                lane.append((event, row['destination'], row['accepted_at']))
+            self._depth += len(rows)
+            self.accepted_total += len(rows)
+            self._condition.notify(len(rows))
+            self._add_burst_workers()
+        logger.warning(f"Restored {len(rows)} webhook events saved at the last shutdown")
+        return len(rows)
+
+    def _run(self, burst: bool = False):
+        """
+        วนหยิบ event จาก ready queue
+
+        Args:
+            burst (bool): worker ชั่วคราว - จบเมื่อไม่มีงานนาน burst_idle_seconds
+        """
+        counted_idle = burst  # _add_burst_workers นับ worker ใหม่เป็น idle ไว้แล้ว
+        while True:
+            with self._condition:
+                if not counted_idle:
+                    self._idle += 1
+                counted_idle = False
+                idle_since = time.time()
+                while not self._ready and not self._stop.is_set():
+                    if not burst:
+                        self._condition.wait()
+                        continue
+                    remaining = idle_since + self.burst_idle_seconds - time.time()
+                    if remaining <= 0:
+                        self._idle -= 1
+                        return
+                    self._condition.wait(remaining)
+                self._idle -= 1
+                if self._stop.is_set():
+                    return
+                key = self._ready.popleft()
+                raw_event, destination, accepted_at = self._lanes[key].popleft()
+                self._busy.add(key)
+                self._started_at[key] = time.time()
+                self._depth -= 1
+                self._in_flight += 1
+            _worker_context.deferred = []
+            try:
+                if callable(raw_event):
+                    self._run_task(raw_event)
+                else:
+                    self._process(raw_event, destination)
+            finally:
+                deferred, _worker_context.deferred = _worker_context.deferred, None
+                with self._condition:
+                    self._in_flight -= 1
+                    self._busy.discard(key)
+                    self._started_at.pop(key, None)
+                    if deferred:
+                        # งานที่ event นี้ส่งต่อ ทำก่อน event ที่รออยู่ของแชทเดียวกัน (ไม่นับกับ max_queue)
+                        now = time.time()
+                        origin = (raw_event.origin, raw_event.destination) if callable(raw_event) \
+                            else (raw_event, destination)
+                        if self._backlog_saved:
+                            # drain หมดเวลาและบันทึกคิวไปแล้ว - งานนี้จะไม่มี worker มาทำ
+                            logger.warning(f"{len(deferred)} deferred tasks of chat {key} dropped at shutdown")
+                        self._lanes.setdefault(key, deque()).extendleft(
+                            (_DeferredTask(task, *origin), None, now) for task in reversed(deferred))
+                        self._depth += len(deferred)
+                    if self._lanes.get(key):
+                        self._ready.append(key)  # event ถัดไปของแชทนี้ - ต่อท้ายเพื่อสลับกับแชทอื่น
+                        self._condition.notify()
+                    else:
+                        self._lanes.pop(key, None)  # lane อาจถูกย้ายลงฐานข้อมูลแล้วระหว่าง drain
+
+    def _process(self, raw_event: dict, destination: Optional[str]):
+        timestamp = raw_event.get('timestamp')
+        if timestamp and raw_event.get('replyToken'):
+            age = time.time() - timestamp / 1000
+            with self._condition:
+                self._token_ages.append(age)
+                if age >= REPLY_TOKEN_TTL_SECONDS:
+                    self.expired_tokens_total += 1
+            if age >= REPLY_TOKEN_TTL_SECONDS:
+                logger.warning(f"Reply token of {raw_event.get('webhookEventId')} is {age:.1f}s old "
+                               f"- the reply will be pushed instead")
+
+        try:
+            self._dispatch(self._parse_event(raw_event), destination)
+            with self._condition:
+                self.processed_total += 1
+        except Exception as e:
+            logger.error(f"Webhook event {raw_event.get('type')} failed: {e}", exc_info=True)
+            with self._condition:
+                self.failed_total += 1
+
+    def _run_task(self, task: Callable[[], None]):
+        try:
+            task()
+        except Exception as e:
+            logger.error(f"Deferred webhook task failed: {e}", exc_info=True)
+        with self._condition:
+            self.deferred_tasks_total += 1
+
+    @staticmethod
+    def _parse_event(raw_event: dict) -> Event:
+        """แปลง event JSON เป็น model ของ SDK (เหมือน WebhookParser.parse)"""
+        try:
+            return Event.from_dict(raw_event)
+        except ValueError:
+            logger.info(f"Unknown event type. type={raw_event.get('type')}")
+            return UnknownEvent.new_from_json_dict(raw_event)
+
+    def _dispatch(self, event: Event, destination: Optional[str]):
+        """เรียก handler ที่ลงทะเบียนด้วย handler.add() / handler.default() ตามกติกาเดียวกับ WebhookHandler.handle"""
+        handlers = self.handler._handlers
+        func = None
+        if isinstance(event, MessageEvent):
+            func = handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+        if func is None:
+            func = handlers.get(type(event).__name__) or self.handler._default
+        if func is None:
+            logger.info(f"No handler of {type(event).__name__} and no default handler")
+            return
+
+        parameters = inspect.signature(func).parameters.values()
+        if any(p.kind == p.VAR_POSITIONAL for p in parameters) or len(parameters) == 2:
+            func(event, destination)
+        elif len(parameters) == 1:
+            func(event)
+        else:
+            func()
+
+    # ------------------------------------------------------------------
+    # Introspection
+    # ------------------------------------------------------------------
+    def stats(self) -> dict:
+        """ความลึกของคิว, จำนวนแชทที่รอ/กำลังทำ, event ที่กำลังประมวลผล และอายุของ reply token ตอนเริ่มประมวลผล"""
+        with self._condition:
+            ages = list(self._token_ages)
+            oldest = min((lane[0][2] for lane in self._lanes.values() if lane), default=None)
+            stats = {
+                'depth': self._depth,
+                'max_queue': self.max_queue,
+                'chats_waiting': len(self._ready),
+                'chats_busy': len(self._busy),
+                'in_flight': self._in_flight,
+                'workers': self.workers,
+                'max_workers': self.max_workers,
+                'workers_alive': sum(1 for thread in self._threads if thread.is_alive()),
+                'workers_idle': self._idle,
+                'burst_workers_total': self.burst_workers_total,
+                'oldest_wait_seconds': round(time.time() - oldest, 3) if oldest else 0,
+                'oldest_in_flight_seconds': round(time.time() - min(self._started_at.values()), 3)
+                if self._started_at else 0,
+                'accepted_total': self.accepted_total,
+                'ignored_total': self.ignored_total,
+                'processed_total': self.processed_total,
+                'failed_total': self.failed_total,
+                'rejected_total': self.rejected_total,
+                'expired_tokens_total': self.expired_tokens_total,
+                'deferred_tasks_total': self.deferred_tasks_total,
+                'duplicates_total': self.duplicates_total,
+                'redelivered_total': self.redelivered_total
+            }
+
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        stats['reply_token_age'] = {
+            'samples': len(ages),
+            'p50_ms': ms(percentile(ages, 50)),
+            'p95_ms': ms(percentile(ages, 95)),
+            'max_ms': ms(max(ages) if ages else None)
+        }
+        return stats